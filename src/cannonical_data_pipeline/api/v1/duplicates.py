@@ -0,0 +1,93 @@
+import json
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+from fastapi.responses import StreamingResponse
+
+from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+
+router = APIRouter(prefix="", tags=["duplicates"])
+
+DEFAULT_TABLE = "deduplicated_institutions_kb"
+MAX_PAGE_SIZE = 100000
+
+
+def _csv(value: Optional[str]):
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _ndjson(conn, first, groups, limit):
+    """Serialize the groups as NDJSON lines, ending with the page line; releases `conn`."""
+    sent, last = 0, None
+    try:
+        if first is not None:
+            for group in _chain(first, groups):
+                yield json.dumps(group, ensure_ascii=False, default=str) + "\n"
+                sent, last = sent + 1, group
+        page = {"page": {"groups": sent, "next": dup_mod.encode_cursor(last) if sent == limit else None}}
+        yield json.dumps(page) + "\n"
+    except Exception as exc:
+        # Headers are already sent: report the failure in-band, the client keeps its last cursor
+        page = {"page": {"groups": sent, "next": dup_mod.encode_cursor(last) if last else None}, "error": str(exc)}
+        yield json.dumps(page) + "\n"
+    finally:
+        groups.close()
+        release_connection(conn)
+
+
+def _chain(first, groups):
+    yield first
+    yield from groups
+
+
+# GET /api/v1/duplicates/groups
+# Purpose: stream the duplicate groups of a table as NDJSON, one group per line, as they are found
+# Query params:
+#   ?table=deduplicated_institutions_kb   table in the public schema
+#   &columns=institution,english_name     columns to check (default: all non-unique columns)
+#   &fields=id,uuid_institution           record fields returned per member row (default: all)
+#   &records=false                        omit the member rows (ids and counts only)
+#   &limit=1000                           groups per page
+#   &after=<cursor>                       the "next" cursor of the previous page
+#   &case_insensitive=true
+# Groups are ordered by column, count (descending) and value; the last line is the page line,
+# whose "next" is null once every group has been returned.
+# Example response:
+# {"column": "institution", "value": "utrecht university", "count": 3, "ids": [4, 9, 17],
+#  "records": [{"id": 4, "uuid_institution": "..."}, ...]}
+# ...
+# {"page": {"groups": 1000, "next": "WyJpbnN0aXR1dGlvbiIsIDIsICJ4Il0="}}
+@router.get("/groups")
+def stream_duplicate_groups(
+    table: str = Query(DEFAULT_TABLE),
+    columns: Optional[str] = None,
+    fields: Optional[str] = None,
+    records: bool = True,
+    limit: int = Query(1000, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[str] = None,
+    case_insensitive: bool = True,
+):
+    conn = acquire_connection()
+    try:
+        groups = dup_mod.stream_duplicate_groups(
+            conn,
+            table,
+            columns=_csv(columns),
+            fields=_csv(fields),
+            case_insensitive=case_insensitive,
+            after=dup_mod.decode_cursor(after) if after else None,
+            limit=limit,
+            include_records=records,
+        )
+        # The first group is read here so invalid parameters answer 400 instead of a broken stream
+        first = next(groups, None)
+    except ValueError as exc:
+        release_connection(conn)
+        raise HTTPException(status_code=400, detail=str(exc))
+    except Exception:
+        release_connection(conn)
+        raise
+    return StreamingResponse(_ndjson(conn, first, groups, limit), media_type="application/x-ndjson")
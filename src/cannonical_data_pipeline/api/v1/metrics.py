@@ -3,6 +3,9 @@ from fastapi import APIRouter, Query
 from datetime import datetime
 from typing import Optional
 from src.cannonical_data_pipeline.deduplication import list_tables as list_tables_mod
+from src.cannonical_data_pipeline.infra import async_db, db
+from src.cannonical_data_pipeline.ingestion import es_sync
+from src.cannonical_data_pipeline.reports import metrics_snapshot
 
 router = APIRouter(prefix="", tags=["metrics"])
 
@@ -20,7 +23,7 @@ router = APIRouter(prefix="", tags=["metrics"])
 #   }
 # }
 @router.get("/sync/status")
-def get_sync_status(target: str = Query("all")):
+async def get_sync_status(target: str = Query("all")):
     # Replace with actual checks: DB ping, last job timestamps, ES cluster health, API health
     now = datetime.utcnow().isoformat() + "Z"
     return {
@@ -36,6 +39,10 @@ def get_sync_status(target: str = Query("all")):
 # GET /metrics/sync/counts
 # Purpose: compare counts between DB source table(s), deduplicated table, and ES index
 # Query params: ?source_table=...&dedup_table=...&es_index=...&since=ISO8601
+# es_count is the number of documents the incremental ES sync recorded as indexed (es_sync_state);
+# dedup_count counts canonical institutions (distinct uuid_institution), one document each.
+# Without query params the answer comes from the in-memory metrics snapshot (source_count is then
+# the planner's row estimate); any param runs exact live counts.
 # Example response:
 # {
 #   "source_count": 12000,
@@ -43,44 +50,47 @@ def get_sync_status(target: str = Query("all")):
 #   "es_count": 11800,
 #   "delta_source_to_dedup": 200,
 #   "delta_dedup_to_es": 0,
-#   "snapshot_time": "2026-01-05T11:59:00Z"
+#   "es_index": "rda_institutions",
+#   "snapshot_time": "2026-01-05T11:59:00Z",   # end of the last successful sync
+#   "last_sync": {"finished_at": "...", "success": true, "indexed": 12, "deleted": 3, "failed": 0}
 # }
 @router.get("/sync/counts")
-def get_sync_counts(
+async def get_sync_counts(
     source_table: Optional[str] = None,
     dedup_table: Optional[str] = None,
     es_index: Optional[str] = None,
     since: Optional[str] = None,
 ):
-    # Query DB and ES for counts; return diffs and percentages
-    return {
-        "source_count": 12000,
-        "dedup_count": 11800,
-        "es_count": 11800,
-        "delta_source_to_dedup": 200,
-        "delta_dedup_to_es": 0,
-        "snapshot_time": datetime.utcnow().isoformat() + "Z"
-    }
+    try:
+        if not (source_table or dedup_table or es_index or since):
+            return (await metrics_snapshot.get_service().get_async())["sync"]
+        return await es_sync.sync_counts_async(
+            source_table=source_table or "institution",
+            dedup_table=dedup_table or es_sync.DEDUP_TABLE,
+            es_index=es_index,
+            since=since,
+        )
+    except Exception as exc:
+        return {"status": "ERROR", "error": str(exc)}
 
 # GET /metrics/sync/lag
-# Purpose: show ingestion lag (time since source change -> indexed in ES)
-# Query params: ?window_minutes=60
+# Purpose: show ingestion lag (deduplication run that produced a document -> indexed in ES)
+# Query params: ?window_minutes=60&es_index=...
 # Example response:
 # {
 #   "avg_lag_seconds": 45.2,
 #   "p95_lag_seconds": 120,
 #   "max_lag_seconds": 3600,
-#   "samples": [...]
+#   "count": 230,
+#   "seconds_since_last_sync": 300.5,
+#   "samples": [{"uuid_institution": "...", "indexed_at": "...", "lag_seconds": 12.3}, ...]
 # }
 @router.get("/sync/lag")
-def get_sync_lag(window_minutes: int = Query(60, ge=1)):
-    # Compute lag using last-modified timestamps in DB vs ES `_timestamp` or job logs
-    return {
-        "avg_lag_seconds": 45.2,
-        "p95_lag_seconds": 120,
-        "max_lag_seconds": 3600,
-        "window_minutes": window_minutes
-    }
+async def get_sync_lag(window_minutes: int = Query(60, ge=1), es_index: Optional[str] = None):
+    try:
+        return await es_sync.sync_lag_async(window_minutes=window_minutes, es_index=es_index)
+    except Exception as exc:
+        return {"status": "ERROR", "error": str(exc), "window_minutes": window_minutes}
 
 # GET /metrics/ingest/throughput
 # Purpose: ingestion throughput and error rates for recent time windows
@@ -94,7 +104,7 @@ def get_sync_lag(window_minutes: int = Query(60, ge=1)):
 #   "buckets": [{"t":"2026-01-05T11:00:00Z","count":60,"errors":0}, ...]
 # }
 @router.get("/ingest/throughput")
-def get_ingest_throughput(window_minutes: int = Query(60, ge=1), granularity: str = Query("minute")):
+async def get_ingest_throughput(window_minutes: int = Query(60, ge=1), granularity: str = Query("minute")):
     # Use job logs or ES ingest stats to build metrics
     return {
         "window_minutes": window_minutes,
@@ -111,18 +121,19 @@ def get_ingest_throughput(window_minutes: int = Query(60, ge=1), granularity: st
 #   "total_rows": 12000,
 #   "deduplicated_rows": 200,
 #   "dedup_rate": 0.0167,
+#   "canonical_institutions": 11800,
+#   "deprecated_uuids": 200,
 #   "last_dedup_run": "2026-01-05T11:50:00Z",
-#   "per_country": {"NL": 120, "US": 80}
+#   "per_country": {"Netherlands": {"uuid_country": "...", "rows": 120, "deduplicated_rows": 4, "dedup_rate": 0.0333}},
+#   "generated_at": "2026-01-05T11:59:00Z"   # time of the metrics snapshot
 # }
 @router.get("/dedup/stats")
-def get_dedup_stats():
-    # Query deduplicated table and mapping tables for counts
-    return {
-        "total_rows": 12000,
-        "deduplicated_rows": 200,
-        "dedup_rate": 0.0167,
-        "last_dedup_run": datetime.utcnow().isoformat() + "Z"
-    }
+async def get_dedup_stats():
+    try:
+        snapshot = await metrics_snapshot.get_service().get_async()
+    except Exception as exc:
+        return {"status": "ERROR", "error": str(exc)}
+    return {**snapshot["dedup"], "generated_at": snapshot["generated_at"]}
 
 # GET /metrics/errors
 # Purpose: recent pipeline errors, failures and counts (paginated)
@@ -133,7 +144,7 @@ def get_dedup_stats():
 #   "errors": [{"time":"...","component":"external_api","message":"timeout", "job_id":"..."}]
 # }
 @router.get("/errors")
-def get_errors(since: Optional[str] = None, limit: int = Query(50, ge=1, le=1000)):
+async def get_errors(since: Optional[str] = None, limit: int = Query(50, ge=1, le=1000)):
     return {
         "total_errors": 0,
         "errors": []
@@ -144,17 +155,50 @@ def get_errors(since: Optional[str] = None, limit: int = Query(50, ge=1, le=1000
 # Example response:
 # {"status":"OK","checks":{"db":true,"es":true,"queue":true}}
 @router.get("/health")
-def health():
+async def health():
     # Perform quick DB and ES pings
     return {"status": "OK", "checks": {"db": True, "es": True, "queue": True}}
 
-# GET /metrics/sync/list_tables
-# Purpose: return list of tables in public schema (delegates to deduplication.list_tables)
+# GET /metrics/list_tables
+# Purpose: return list of tables in public schema with row counts
+# Query params: ?exact=true runs COUNT(*) on every table (slow on large tables); by default the
+# planner estimates of the in-memory metrics snapshot are returned ("estimated": true per table).
 @router.get("/list_tables")
-def get_list_tables():
-    report = list_tables_mod.list_tables()
+async def get_list_tables(exact: bool = False):
+    if not exact:
+        try:
+            snapshot = await metrics_snapshot.get_service().get_async()
+            return {"status": "OK", "tables": snapshot["tables"], "generated_at": snapshot["generated_at"]}
+        except Exception as exc:
+            return {"status": "ERROR", "error": str(exc), "tables": []}
+    report = await list_tables_mod.list_tables_async(exact=True)
     # report is {'tables': [{'name':..., 'rows':...}, ...], 'error': None} or {'tables': [], 'error': '...'}
     if report.get('error'):
         # Return a 500-style error structure but keep status 200 semantics for now
         return {"status": "ERROR", "error": report.get('error'), "tables": report.get('tables', [])}
     return {"status": "OK", "tables": report.get('tables', [])}
+
+# GET /metrics/snapshot
+# Purpose: the whole in-memory metrics snapshot plus the state of its background refresh
+# Example response:
+# {"generated_at": "...", "exact": false, "collect_seconds": 0.04, "tables": [...], "dedup": {...},
+#  "sync": {...}, "service": {"ttl": 60.0, "running": true, "age_seconds": 12.5, "refreshes": 30,
+#  "failures": 0, "last_error": null, "last_error_at": null}}
+@router.get("/snapshot")
+async def get_metrics_snapshot():
+    service = metrics_snapshot.get_service()
+    try:
+        return {**(await service.get_async()), "service": service.status()}
+    except Exception as exc:
+        return {"status": "ERROR", "error": str(exc), "service": service.status()}
+
+# GET /metrics/db/pool
+# Purpose: connection pool statistics, used to size db_pool_min_size/db_pool_max_size under load;
+# "async" is the pool of the API handlers (infra.async_db), the rest the pool of the pipeline/jobs
+# Example response:
+# {"initialized": true, "size": 4, "in_use": 2, "idle": 2, "max_size": 10,
+#  "waits": 3, "wait_time_total": 0.42, "wait_time_avg": 0.14, "wait_time_max": 0.3, "timeouts": 0, ...,
+#  "async": {"initialized": true, "size": 1, "in_use": 0, ...}}
+@router.get("/db/pool")
+async def get_db_pool_stats():
+    return {**db.pool_stats(), "async": async_db.async_pool_stats()}
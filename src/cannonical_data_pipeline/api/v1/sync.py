@@ -1,140 +1,59 @@
-from fastapi import APIRouter, BackgroundTasks, HTTPException, Body, Query
+from fastapi import APIRouter, HTTPException, Body, Query, Request
+from fastapi.responses import StreamingResponse
 from typing import Optional, Dict, Any
-from datetime import datetime
-import threading
-import uuid
-import subprocess
-import sys
-from pathlib import Path
-import os
-import time
-import errno
+import asyncio
+import json
 
 from src.cannonical_data_pipeline.deduplication.apply_deduplication import apply_deduplication
 from src.cannonical_data_pipeline.deduplication.add_columns import apply_add_columns
+from src.cannonical_data_pipeline.deduplication.dedup_tables import run_dedup_tables
+from src.cannonical_data_pipeline.deduplication.propagate_uuids import propagate_uuids
 from src.cannonical_data_pipeline.deduplication.update_uuids import apply_update_uuids
+from src.cannonical_data_pipeline.deduplication.rebuild_shadow import rebuild_deduplication_shadow
+from src.cannonical_data_pipeline.deduplication.pipeline import ISOLATION_MODES, run_dag, run_pipeline
 from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+from src.cannonical_data_pipeline.infra import jobs, progress
+from src.cannonical_data_pipeline.ingestion.es_sync import sync_institutions
 
 router = APIRouter(prefix="/sync", tags=["sync"])
 
-# In-memory state for simple background runs and schedules
-_last_run_lock = threading.Lock()
-_last_run: Dict[str, Any] = {"time": None, "success": None, "report": None}
+# Runs, schedules and their reports live in the job store (infra.jobs): background runs are
+# queued jobs picked up by the worker pool of any API process, schedules are rows enqueued by
+# whichever process ticks first, and the state survives restarts.
+PIPELINE_MODE = "pipeline"
 
-_schedules_lock = threading.Lock()
-_schedules: Dict[str, Dict[str, Any]] = {}
+# The modes of _run_mode
+MODES = ("apply-deduplication", "apply-deduplication-incremental", "rebuild-shadow", "add-columns", "update-uuids",
+         "propagate-uuids", "dedup-tables", "run-all", "es-sync", "es-sync-full", "check-duplicates")
 
-# Pipeline process guard
-_pipeline_lock = threading.Lock()
-_pipeline_process: Optional[subprocess.Popen] = None
-_pipeline_task: Dict[str, Any] = {"task_id": None, "start_time": None, "end_time": None, "returncode": None}
+# Event streams: ring buffer polling, keepalive comment interval, and status polling of jobs
+# run by another process
+STREAM_TICK_SECONDS = 0.25
+STREAM_KEEPALIVE_SECONDS = 15
+STREAM_POLL_SECONDS = 2
 
-# File-based lock (POSIX atomic create) to prevent concurrent runs across processes
-# Default lock file placed in repo root so it's shared by processes on the same host
-_repo_root = Path(__file__).resolve().parents[3]
-_file_lock_path = _repo_root / ".run_pipeline.lock"
-_file_lock_fd: Optional[int] = None
 
+def _run_mode(mode: str, schema: str = "public", on_event=None) -> Dict[str, Any]:
+    """Execute one of the supported modes and return its report.
 
-def _acquire_file_lock(timeout: float = 0) -> Optional[int]:
-    """Attempt to acquire a lock by atomically creating the lock file.
-
-    Returns the opened file descriptor if successful, or None if lock is held by another live process.
-    If a stale lock file is found (PID not alive), it will be removed and acquisition retried.
-    timeout=0 means try once; >0 will retry until timeout seconds.
+    on_event receives the step and row progress events of the modes that report them.
     """
-    start = time.time()
-    lock_path_str = str(_file_lock_path)
-    while True:
-        try:
-            fd = os.open(lock_path_str, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
-            # Write our pid for debugging and future stale detection
-            try:
-                os.write(fd, f"{os.getpid()}\n".encode())
-                os.fsync(fd)
-            except Exception:
-                pass
-            return fd
-        except FileExistsError:
-            # Someone else created the lock file — check if it's stale
-            try:
-                with open(lock_path_str, 'r') as f:
-                    content = f.read().strip()
-                    pid = int(content.splitlines()[0]) if content else None
-            except Exception:
-                pid = None
-
-            if pid:
-                try:
-                    # check if process is alive
-                    os.kill(pid, 0)
-                    # process exists -> lock held
-                    return None
-                except OSError as e:
-                    if e.errno in (errno.ESRCH,):
-                        # stale PID: remove lock file and retry
-                        try:
-                            os.unlink(lock_path_str)
-                        except Exception:
-                            pass
-                        # retry immediately
-                        continue
-                    else:
-                        # unknown error checking pid — treat as locked
-                        return None
-            else:
-                # no pid found in file -> remove and retry
-                try:
-                    os.unlink(lock_path_str)
-                except Exception:
-                    pass
-                continue
-        except Exception:
-            # unexpected OS error — don't acquire
-            return None
-        # timeout handling
-        if timeout > 0 and (time.time() - start) >= timeout:
-            return None
-        time.sleep(0.1)
-
-
-def _release_file_lock(fd: Optional[int]):
-    """Release the acquired file lock and remove the lock file."""
-    lock_path_str = str(_file_lock_path)
-    try:
-        if fd is not None:
-            try:
-                os.close(fd)
-            except Exception:
-                pass
-        # Attempt to remove the lock file; ignore failures
-        try:
-            if os.path.exists(lock_path_str):
-                os.unlink(lock_path_str)
-        except Exception:
-            pass
-    finally:
-        return
-
-
-def _update_last_run(success: bool, report: Dict[str, Any]):
-    with _last_run_lock:
-        _last_run["time"] = datetime.utcnow().isoformat() + "Z"
-        _last_run["success"] = success
-        _last_run["report"] = report
-
+    def _update_uuids_progress(state):
+        progress.emit(on_event, "progress", step="update_uuids", **state)
 
-def _run_mode(mode: str, schema: str = "public") -> Dict[str, Any]:
-    """Execute one of the supported modes and return its report."""
     mode_map = {
         "apply-deduplication": apply_deduplication,
+        "apply-deduplication-incremental": lambda schema="public": apply_deduplication(incremental=True),
+        "rebuild-shadow": rebuild_deduplication_shadow,
         "add-columns": apply_add_columns,
-        "update-uuids": apply_update_uuids,
-        "run-all": lambda schema="public": {
-            "apply": apply_deduplication(schema=schema),
-            "add_columns": apply_add_columns(schema=schema),
-            "update_uuids": apply_update_uuids(schema=schema),
-        },
+        "update-uuids": lambda schema="public": apply_update_uuids(schema=schema, on_progress=_update_uuids_progress),
+        "propagate-uuids": propagate_uuids,
+        "dedup-tables": run_dedup_tables,
+        # scheduled by the tables each step reads/writes; independent steps run concurrently
+        "run-all": lambda: run_dag(steps=("apply_deduplication", "add_columns", "update_uuids"), state_path=None,
+                                   on_event=on_event),
+        "es-sync": lambda: sync_institutions(),
+        "es-sync-full": lambda: sync_institutions(full=True),
         "check-duplicates": lambda schema="public": dup_mod.generate_duplicates_report(table_name="deduplicated_institutions_kb", only_with_duplicates=True),
     }
 
@@ -151,82 +70,163 @@ def _run_mode(mode: str, schema: str = "public") -> Dict[str, Any]:
         return func()
 
 
-def _run_in_background(task_id: str, mode: str, schema: str):
+def run_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Job runner for the worker pool: execute a queued job and return its report.
+
+    Progress events go to the job's ring buffer (infra.progress), streamed by GET
+    /jobs/{job_id}/events while the job runs; the report keeps a size-capped tail of them.
+    """
+    params = job.get("params") or {}
+    log = progress.open_log(job["job_id"])
+    log("job_started", job_id=job["job_id"], mode=job["mode"])
     try:
-        report = _run_mode(mode, schema=schema)
-        _update_last_run(True, {"task_id": task_id, "mode": mode, "report": report})
-    except Exception as e:
-        _update_last_run(False, {"task_id": task_id, "mode": mode, "error": str(e)})
+        if job["mode"] == PIPELINE_MODE:
+            report = run_pipeline(isolation=params.get("isolation", "inprocess"), atomic=params.get("atomic", True),
+                                  on_event=log)
+        else:
+            report = _run_mode(job["mode"], schema=params.get("schema", "public"), on_event=log)
+        log("job_finished", success=not (isinstance(report, dict) and report.get("success") is False))
+    except Exception as exc:
+        log("job_finished", success=False, error=str(exc))
+        raise
+    finally:
+        log.close()
+    if isinstance(report, dict):
+        report = {**report, "progress_tail": log.tail()}
+    return report
+
+
+def _jobs() -> jobs.JobService:
+    return jobs.get_service(run_job)
+
+
+async def _job_or_404(job_id: int) -> Dict[str, Any]:
+    job = await _jobs().store.get_async(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job
 
 
-@router.post("/trigger")
-def trigger_sync(
+@router.post("/trigger", status_code=202)
+async def trigger_sync(
     mode: str = Body("run-all"),
     schema: str = Body("public"),
-    background: bool = Body(False),
-    background_tasks: BackgroundTasks = None,
+    background: bool = Body(True),
 ):
-    """Trigger a sync operation.
+    """Queue a sync operation as a job and return its id (202); follow it with GET /jobs/{task_id}.
 
-    - mode: which sync action to run (apply-deduplication|add-columns|update-uuids|run-all|check-duplicates)
+    - mode: which sync action to run (apply-deduplication|apply-deduplication-incremental|rebuild-shadow|add-columns|update-uuids|propagate-uuids|dedup-tables|run-all|es-sync|es-sync-full|check-duplicates)
     - schema: optional schema name
-    - background: if true, runs the task in background and returns a task id
+    - background: ignored, every run is a job so no request waits for a pipeline
     """
-    if not background:
-        try:
-            report = _run_mode(mode, schema=schema)
-            _update_last_run(True, {"mode": mode, "report": report})
-            return {"success": True, "mode": mode, "report": report}
-        except Exception as exc:
-            _update_last_run(False, {"mode": mode, "error": str(exc)})
-            raise HTTPException(status_code=500, detail=str(exc))
-
-    # background run
-    task_id = str(uuid.uuid4())
-    thread = threading.Thread(target=_run_in_background, args=(task_id, mode, schema), daemon=True)
-    with _schedules_lock:
-        # store as ad-hoc task entry (no repeat)
-        _schedules[task_id] = {"mode": mode, "schema": schema, "type": "oneoff", "thread": thread, "created": datetime.utcnow().isoformat() + "Z"}
-    thread.start()
-    return {"accepted": True, "task_id": task_id, "mode": mode}
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode: {mode}")
+    job = await _jobs().submit_async(mode, {"schema": schema})
+    return {"accepted": True, "task_id": str(job["job_id"]), "mode": mode, "status": job["status"]}
 
 
 @router.get("/last")
-def last_run_status():
-    """Return the last run status and report."""
-    with _last_run_lock:
-        return _last_run.copy()
-
-
-def _schedule_runner(name: str):
-    """Internal runner that executes the scheduled job and reschedules it."""
-    with _schedules_lock:
-        conf = _schedules.get(name)
-        if not conf or not conf.get("enabled"):
+async def last_run_status():
+    """Return the last finished run status and report."""
+    job = await _jobs().store.last_finished_async()
+    if job is None:
+        return {"time": None, "success": None, "report": None}
+    return {"time": job["finished_at"], "success": job["status"] == "succeeded", "task_id": str(job["job_id"]),
+            "mode": job["mode"], "schedule": job["schedule"], "report": job["report"], "error": job["error"]}
+
+
+@router.get("/jobs")
+async def list_jobs(status: Optional[str] = Query(None), mode: Optional[str] = Query(None),
+                    limit: int = Query(50, ge=1, le=500)):
+    """Recent jobs, newest first, with status, timing and report."""
+    if status is not None and status not in jobs.STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {', '.join(jobs.STATUSES)}")
+    service = _jobs()
+    return {"jobs": await service.store.list_jobs_async(status=status, mode=mode, limit=limit),
+            "service": service.status()}
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: int):
+    return await _job_or_404(job_id)
+
+
+def _sse(kind: str, data: Dict[str, Any], seq: int = None) -> str:
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {kind}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+async def _event_stream(job_id: int, after: int):
+    store = _jobs().store
+    seq, status = after, None
+    log = progress.get_log(job_id)
+    while log is None:
+        # queued, or run by another process: follow the status until the log shows up here or the job ends
+        job = await store.get_async(job_id)
+        if job["finished_at"] is not None:
+            tail = job["report"].get("progress_tail", []) if isinstance(job["report"], dict) else []
+            for event in tail:
+                if event["seq"] > seq:
+                    yield _sse(event["kind"], event, event["seq"])
+            yield _sse("end", {"job_id": job_id, "status": job["status"], "error": job["error"]})
             return
-        interval = conf.get("interval_seconds")
-        mode = conf.get("mode")
-        schema = conf.get("schema")
-
-    # Run sync (synchronously in this thread)
-    try:
-        report = _run_mode(mode, schema=schema)
-        _update_last_run(True, {"schedule": name, "mode": mode, "report": report})
-    except Exception as e:
-        _update_last_run(False, {"schedule": name, "mode": mode, "error": str(e)})
-
-    # Reschedule next run
-    with _schedules_lock:
-        conf = _schedules.get(name)
-        if conf and conf.get("enabled"):
-            timer = threading.Timer(interval, _schedule_runner, args=(name,))
-            conf["timer"] = timer
-            timer.daemon = True
-            timer.start()
+        if job["status"] != status:
+            status = job["status"]
+            yield _sse("status", {"job_id": job_id, "status": status, "worker": job["worker"]})
+        else:
+            yield ": waiting\n\n"
+        await asyncio.sleep(STREAM_POLL_SECONDS)
+        log = progress.get_log(job_id)
+
+    # the ring buffer is polled from the event loop; no thread waits on it
+    quiet = 0.0
+    while True:
+        events, dropped = log.since(seq)
+        if dropped:
+            yield _sse("dropped", {"count": dropped})
+        for event in events:
+            seq = event["seq"]
+            yield _sse(event["kind"], event, seq)
+        if events:
+            quiet = 0.0
+            continue
+        if log.closed:
+            break
+        if quiet >= STREAM_KEEPALIVE_SECONDS:
+            yield ": keepalive\n\n"
+            quiet = 0.0
+        await asyncio.sleep(STREAM_TICK_SECONDS)
+        quiet += STREAM_TICK_SECONDS
+
+    # the log closes just before the worker records the outcome
+    job = await store.get_async(job_id)
+    for _ in range(50):
+        if job["finished_at"] is not None:
+            break
+        await asyncio.sleep(0.1)
+        job = await store.get_async(job_id)
+    yield _sse("end", {"job_id": job_id, "status": job["status"], "error": job["error"]})
+
+
+@router.get("/jobs/{job_id}/events")
+async def job_events(job_id: int, request: Request, after: int = Query(0, ge=0)):
+    """Stream the progress events of a job as Server-Sent Events, ending with an `end` event.
+
+    Events of a job running in this process come live from its ring buffer; `after`, or the
+    Last-Event-ID header of a reconnecting client, resumes after that event, and a `dropped`
+    event counts the events the buffer overwrote meanwhile. For a job queued or run by another
+    process the stream sends its status until it ends, then the event tail saved in its report.
+    """
+    await _job_or_404(job_id)
+    last_event_id = request.headers.get("last-event-id", "")
+    if last_event_id.isdigit():
+        after = int(last_event_id)
+    return StreamingResponse(_event_stream(job_id, after), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @router.post("/schedule")
-def create_schedule(
+async def create_schedule(
     name: str = Body("default"),
     mode: str = Body("run-all"),
     interval_seconds: int = Body(...),
@@ -236,159 +236,59 @@ def create_schedule(
     """Create a recurring schedule that runs `mode` every `interval_seconds` seconds."""
     if interval_seconds <= 0:
         raise HTTPException(status_code=400, detail="interval_seconds must be > 0")
-
-    with _schedules_lock:
-        if name in _schedules:
-            raise HTTPException(status_code=409, detail=f"schedule '{name}' already exists")
-
-        conf = {"mode": mode, "schema": schema, "interval_seconds": interval_seconds, "enabled": True, "created": datetime.utcnow().isoformat() + "Z"}
-        _schedules[name] = conf
-        # start timer
-        timer = threading.Timer(interval_seconds, _schedule_runner, args=(name,))
-        timer.daemon = True
-        conf["timer"] = timer
-        timer.start()
-
+    if mode not in MODES:
+        raise HTTPException(status_code=400, detail=f"Unknown mode: {mode}")
+
+    service = _jobs()
+    schedule = await service.store.create_schedule_async(name, mode, interval_seconds, {"schema": schema},
+                                                         start_immediately=start_immediately)
+    if schedule is None:
+        raise HTTPException(status_code=409, detail=f"schedule '{name}' already exists")
     if start_immediately:
-        # spawn immediate background thread to run once now
-        thread = threading.Thread(target=_run_in_background, args=(f"sched-{name}-{uuid.uuid4()}", mode, schema), daemon=True)
-        thread.start()
-
-    return {"created": True, "schedule": name, "interval_seconds": interval_seconds, "mode": mode}
+        service.wake()
+    return {"created": True, "schedule": name, "interval_seconds": interval_seconds, "mode": mode,
+            "next_run_at": schedule["next_run_at"]}
 
 
 @router.get("/schedule")
-def list_schedules():
-    with _schedules_lock:
-        out = {name: {k: v for k, v in conf.items() if k != "timer" and k != "thread"} for name, conf in _schedules.items()}
-    return out
+async def list_schedules():
+    return {schedule.pop("name"): schedule for schedule in await _jobs().store.list_schedules_async()}
 
 
 @router.delete("/schedule")
-def delete_schedule(name: str = Query(...)):
-    with _schedules_lock:
-        conf = _schedules.get(name)
-        if not conf:
-            raise HTTPException(status_code=404, detail="schedule not found")
-        conf["enabled"] = False
-        timer = conf.get("timer")
-        if timer:
-            try:
-                timer.cancel()
-            except Exception:
-                pass
-        del _schedules[name]
+async def delete_schedule(name: str = Query(...)):
+    if not await _jobs().store.delete_schedule_async(name):
+        raise HTTPException(status_code=404, detail="schedule not found")
     return {"deleted": True, "schedule": name}
 
 
 @router.post("/manage/enable")
-def enable_schedule(name: str = Body(...)):
-    with _schedules_lock:
-        conf = _schedules.get(name)
-        if not conf:
-            raise HTTPException(status_code=404, detail="schedule not found")
-        if conf.get("enabled"):
-            return {"enabled": True, "schedule": name}
-        conf["enabled"] = True
-        # start a timer for next run
-        timer = threading.Timer(conf["interval_seconds"], _schedule_runner, args=(name,))
-        timer.daemon = True
-        conf["timer"] = timer
-        timer.start()
+async def enable_schedule(name: str = Body(...)):
+    if not await _jobs().store.set_schedule_enabled_async(name, True):
+        raise HTTPException(status_code=404, detail="schedule not found")
     return {"enabled": True, "schedule": name}
 
 
 @router.post("/manage/disable")
-def disable_schedule(name: str = Body(...)):
-    with _schedules_lock:
-        conf = _schedules.get(name)
-        if not conf:
-            raise HTTPException(status_code=404, detail="schedule not found")
-        conf["enabled"] = False
-        timer = conf.get("timer")
-        if timer:
-            try:
-                timer.cancel()
-            except Exception:
-                pass
+async def disable_schedule(name: str = Body(...)):
+    if not await _jobs().store.set_schedule_enabled_async(name, False):
+        raise HTTPException(status_code=404, detail="schedule not found")
     return {"disabled": True, "schedule": name}
 
 
-@router.post("/sync-now")
-def sync_now(background_tasks: BackgroundTasks = None):
-    """Run the sync pipeline immediately."""
-    # Ensure only one pipeline process at a time (in-memory) and across processes (file lock)
-    with _pipeline_lock:
-        global _pipeline_process, _file_lock_fd
-        if _pipeline_process and _pipeline_process.poll() is None:
-            raise HTTPException(status_code=429, detail="Pipeline is already running")
-
-        # Try to acquire file lock (non-blocking). If lock exists and held by live process -> 429
-        fd = _acquire_file_lock(timeout=0)
-        if fd is None:
-            raise HTTPException(status_code=429, detail="Pipeline is already running (file lock)")
-        # remember fd so monitor can release it later
-        _file_lock_fd = fd
-
-        # Path to the runner: repo/src/run_pipeline.py
-        runner_path = Path(__file__).resolve().parents[3] / "run_pipeline.py"
-        if not runner_path.exists():
-            # Release file lock before raising
-            _release_file_lock(_file_lock_fd)
-            _file_lock_fd = None
-            raise HTTPException(status_code=500, detail=f"runner not found: {runner_path}")
-
-        # Prepare command to run the pipeline
-        cmd = [sys.executable, str(runner_path)]
-
-        # Start the pipeline process
-        try:
-            _pipeline_process = subprocess.Popen(
-                cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True
-            )
-        except Exception as e:
-            # failed to start process — release lock and re-raise
-            _release_file_lock(_file_lock_fd)
-            _file_lock_fd = None
-            raise HTTPException(status_code=500, detail=f"failed to start pipeline: {e}")
-
-    task_id = str(uuid.uuid4())
-
-    def _monitor_pipeline():
-        global _pipeline_process, _file_lock_fd
-        try:
-            stdout, stderr = _pipeline_process.communicate()
-            returncode = _pipeline_process.returncode
-
-            # Capture output and errors
-            report = {
-                "task_id": task_id,
-                "stdout": stdout.strip(),
-                "stderr": stderr.strip(),
-                "returncode": returncode,
-            }
-
-            if returncode == 0:
-                _update_last_run(True, report)
-            else:
-                _update_last_run(False, report)
-        except Exception as e:
-            _update_last_run(False, {"task_id": task_id, "error": str(e)})
-        finally:
-            # Always clear in-memory process pointer and release file lock
-            with _pipeline_lock:
-                _pipeline_process = None
-            try:
-                _release_file_lock(_file_lock_fd)
-            finally:
-                _file_lock_fd = None
-
-    # Run the monitor in the background
-    if background_tasks is None:
-        # if FastAPI did not supply BackgroundTasks, run monitor in a thread
-        thread = threading.Thread(target=_monitor_pipeline, daemon=True)
-        thread.start()
-    else:
-        background_tasks.add_task(_monitor_pipeline)
-
-    return {"accepted": True, "task_id": task_id}
+@router.post("/sync-now", status_code=202)
+async def sync_now(isolation: str = Query("inprocess"), atomic: bool = Query(True)):
+    """Run the sync pipeline immediately.
+
+    The pipeline is queued as an exclusive job (see deduplication.pipeline): while one pipeline
+    job is queued or running, in any process, another request gets 429.
+    isolation=subprocess runs each step in its own interpreter instead.
+    """
+    if isolation not in ISOLATION_MODES:
+        raise HTTPException(status_code=400, detail=f"isolation must be one of {', '.join(ISOLATION_MODES)}")
+
+    job = await _jobs().submit_async(PIPELINE_MODE, {"isolation": isolation, "atomic": atomic},
+                                     exclusive_key=PIPELINE_MODE)
+    if job is None:
+        raise HTTPException(status_code=429, detail="Pipeline is already running")
+    return {"accepted": True, "task_id": str(job["job_id"]), "isolation": isolation}
@@ -0,0 +1,306 @@
+"""Benchmark harness of the deduplication steps on synthetic data.
+
+For every (rows, duplicate_ratio) scale the harness recreates the `public` schema of a dedicated
+benchmark database (never the configured one), loads a synthetic dataset (benchmarks.synthetic)
+and runs the steps in pipeline order, each the way its CLI runs it: on its own connection,
+committing on its own. Every step runs in a fresh spawned process, so its peak RSS is its own
+and not a leftover of an earlier step or of the data generation; its connection counts the
+queries (execute/executemany/copy calls) it sends, and its statement trace (infra.tracing) gives
+the queries that took most of its time.
+
+A step result has wall `seconds`, `rows` (the rows it processes: mapping lines for
+insert_mapping, institution rows otherwise), `rows_per_second`, `queries`, `peak_rss_kb`
+(Linux ru_maxrss of the step's process) and `error`. Results are saved as JSON under
+logs/benchmarks/ and compared with a baseline result (by default the previous one): steps that
+got slower or sent more queries than `tolerance` allows are listed as regressions.
+"""
+import json
+import multiprocessing
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+try:
+    import psycopg2
+    from psycopg2 import sql
+except Exception:
+    psycopg2 = None
+    sql = None
+
+from src.cannonical_data_pipeline.benchmarks import synthetic
+from src.cannonical_data_pipeline.infra.db import get_conn_params
+from src.cannonical_data_pipeline.infra.tracing import TracingCursor
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+RESULTS_DIR = REPO_ROOT / 'logs' / 'benchmarks'
+DATA_DIR = RESULTS_DIR / 'data'
+
+STEPS = ('insert_mapping', 'apply_deduplication', 'add_columns', 'update_uuids', 'duplicates_report')
+REPORT_TABLE = 'deduplicated_institutions_kb'
+REPORT_COLUMNS = ('institution', 'original_institution', 'uuid_institution')
+STEP_TIMEOUT = 6 * 3600
+# How often a step process still running without a result is checked for having died
+RESULT_POLL_SECONDS = 1.0
+
+# Compared metrics; seconds below MIN_SECONDS are noise and never a regression
+COMPARED_METRICS = ('seconds', 'queries', 'peak_rss_kb')
+MIN_SECONDS = 0.1
+
+
+class CountingCursor(TracingCursor):
+    """Cursor counting the queries of its process; installed through conn_params['cursor_factory']."""
+    counts = {'execute': 0, 'executemany': 0, 'copy': 0}
+
+    def execute(self, query, vars=None):
+        CountingCursor.counts['execute'] += 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        CountingCursor.counts['executemany'] += 1
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, statement, file, size=8192):
+        CountingCursor.counts['copy'] += 1
+        return super().copy_expert(statement, file, size)
+
+
+def _run_step(name: str, conn_params: dict, mapping_csv: str):
+    # imported here: the step modules load settings, the parent process does not need them
+    from src.cannonical_data_pipeline.deduplication.add_columns import apply_add_columns
+    from src.cannonical_data_pipeline.deduplication.apply_deduplication import apply_deduplication
+    from src.cannonical_data_pipeline.deduplication.check_duplicates import generate_duplicates_report
+    from src.cannonical_data_pipeline.deduplication.insert_mapping import insert_mapping_csv
+    from src.cannonical_data_pipeline.deduplication.update_uuids import apply_update_uuids
+
+    if name == 'insert_mapping':
+        return insert_mapping_csv(mapping_csv, conn_params=conn_params)
+    if name == 'apply_deduplication':
+        return apply_deduplication(conn_params)
+    if name == 'add_columns':
+        return apply_add_columns(conn_params)
+    if name == 'update_uuids':
+        return apply_update_uuids(conn_params)
+    if name == 'duplicates_report':
+        return generate_duplicates_report(conn_params, table_name=REPORT_TABLE, columns=REPORT_COLUMNS)
+    raise ValueError(f"unknown benchmark step: {name}")
+
+
+def _summary(report) -> dict:
+    """Integer counters of a step report, and the group count of each column of a duplicates report."""
+    if not isinstance(report, dict):
+        return {}
+    summary = {key: value for key, value in report.items() if isinstance(value, int) and not isinstance(value, bool)}
+    if isinstance(report.get('columns'), dict):
+        summary['duplicate_groups'] = {column: len(groups or []) for column, groups in report['columns'].items()}
+    return summary
+
+
+def _step_process(name: str, conn_params: dict, mapping_csv: str, results):
+    """Entry point of a step's process: run the step and put its measurements on `results`."""
+    from src.cannonical_data_pipeline.deduplication.pipeline import step_error
+    from src.cannonical_data_pipeline.infra.tracing import trace_step
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    with trace_step(name) as trace:
+        try:
+            report = _run_step(name, {**conn_params, 'cursor_factory': CountingCursor}, mapping_csv)
+            error = step_error(report)
+        except Exception as exc:
+            report, error = None, str(exc)
+    seconds = time.perf_counter() - started
+    results.put({'seconds': round(seconds, 3), 'error': error, 'queries': sum(CountingCursor.counts.values()),
+                 'query_calls': dict(CountingCursor.counts), 'result': _summary(report),
+                 'top_queries': trace.summary()['top_queries'],
+                 'baseline_rss_kb': baseline_rss,
+                 'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss})
+
+
+def _wait_for_result(process, results, timeout: float) -> dict:
+    """The measurements the step process puts on `results`.
+
+    Raises RuntimeError as soon as the process exits without putting them (killed, crashed or
+    failed to start) and TimeoutError after `timeout` seconds.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        # checked before the get: a process that put its result has flushed it before exiting
+        alive = process.is_alive()
+        try:
+            return results.get(timeout=RESULT_POLL_SECONDS)
+        except queue.Empty:
+            pass
+        if not alive:
+            raise RuntimeError(f'step process exited with code {process.exitcode} without a result')
+        if time.monotonic() >= deadline:
+            raise TimeoutError(f'step timed out after {timeout}s')
+
+
+def run_step(name: str, conn_params: dict, mapping_csv, rows: int, timeout: float = STEP_TIMEOUT) -> dict:
+    """Run one step in a spawned process and return its measurements."""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=_step_process, args=(name, conn_params, str(mapping_csv), results),
+                              name=f'benchmark-{name}')
+    started = time.perf_counter()
+    process.start()
+    try:
+        measured = _wait_for_result(process, results, timeout)
+    except (RuntimeError, TimeoutError) as exc:
+        measured = {'seconds': round(time.perf_counter() - started, 3), 'queries': None, 'peak_rss_kb': None,
+                    'error': str(exc)}
+    finally:
+        process.join(5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    seconds = measured['seconds']
+    return {'name': name, 'rows': rows, 'rows_per_second': round(rows / seconds, 1) if seconds else None,
+            **measured}
+
+
+def ensure_database(conn_params: dict, dbname: str):
+    """Create database `dbname` unless it exists, connecting with `conn_params`."""
+    conn = psycopg2.connect(**conn_params)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (dbname,))
+            if cur.fetchone() is None:
+                cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname)))
+    finally:
+        conn.close()
+
+
+def reset_database(conn_params: dict, manifest: dict) -> dict:
+    """Drop everything in the benchmark database's public schema and load the dataset."""
+    conn = psycopg2.connect(**conn_params)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA IF EXISTS public CASCADE; CREATE SCHEMA public;")
+        loaded = synthetic.load(conn, manifest)
+        conn.commit()
+        return loaded
+    finally:
+        conn.close()
+
+
+def _server_version(conn_params: dict):
+    try:
+        conn = psycopg2.connect(**conn_params)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SHOW server_version")
+                return cur.fetchone()[0]
+        finally:
+            conn.close()
+    except Exception:
+        return None
+
+
+def _release() -> dict:
+    release = {'version': None, 'commit': None}
+    try:
+        from src.cannonical_data_pipeline.infra.commons import get_project_details
+        release['version'] = get_project_details(base_dir=str(REPO_ROOT), keys=['version'])['version']
+    except Exception:
+        pass
+    try:
+        release['commit'] = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                           text=True, timeout=10).stdout.strip() or None
+    except Exception:
+        pass
+    return release
+
+
+def _log(message: str):
+    print(f"[benchmark] {message}", file=sys.stderr, flush=True)
+
+
+def run_benchmark(scales=(10_000,), duplicate_ratios=(0.3,), steps=STEPS, seed: int = 42,
+                  mapping_coverage: float = 1.0, country_noise: float = 0.1, dbname: str = None,
+                  conn_params: dict = None, data_dir=DATA_DIR) -> dict:
+    """Run `steps` at every (rows, duplicate_ratio) combination and return the result document."""
+    if psycopg2 is None:
+        raise RuntimeError('psycopg2 is required but not installed')
+    unknown = [name for name in steps if name not in STEPS]
+    if unknown:
+        raise ValueError(f"unknown benchmark steps: {unknown}; known: {list(STEPS)}")
+    conn_params = dict(conn_params or get_conn_params(quiet=True))
+    dbname = dbname or f"{conn_params['dbname']}_benchmark"
+    if dbname == conn_params['dbname']:
+        raise ValueError(f"refusing to benchmark in the configured database {dbname!r}: its public schema is dropped")
+    ensure_database(conn_params, dbname)
+    bench_params = {**conn_params, 'dbname': dbname}
+
+    result = {
+        'run_id': datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ'),
+        **_release(),
+        'python': platform.python_version(),
+        'postgres': _server_version(bench_params),
+        'database': dbname,
+        'params': {'seed': seed, 'mapping_coverage': mapping_coverage, 'country_noise': country_noise,
+                   'steps': list(steps)},
+        'scales': [],
+    }
+    for rows in scales:
+        for ratio in duplicate_ratios:
+            _log(f"rows={rows} duplicate_ratio={ratio}: generating data")
+            manifest = synthetic.generate(data_dir, rows, ratio, seed, mapping_coverage, country_noise)
+            scale = {'rows': rows, 'duplicate_ratio': ratio, 'data': manifest,
+                     'load': reset_database(bench_params, manifest), 'steps': []}
+            for name in steps:
+                step_rows = manifest['counts']['mapping'] if name == 'insert_mapping' else rows
+                step = run_step(name, bench_params, synthetic.mapping_csv(manifest), step_rows)
+                _log(f"rows={rows} duplicate_ratio={ratio}: {name} {step['seconds']}s, {step['queries']} queries"
+                     + (f", error: {step['error']}" if step['error'] else ''))
+                scale['steps'].append(step)
+            result['scales'].append(scale)
+    return result
+
+
+def _keyed(result: dict) -> dict:
+    return {(scale['rows'], scale['duplicate_ratio'], step['name']): step
+            for scale in result.get('scales', []) for step in scale.get('steps', [])}
+
+
+def compare(result: dict, baseline: dict, tolerance: float = 0.2) -> list:
+    """Steps of `result` whose metrics exceed the baseline's by more than `tolerance` (a fraction)."""
+    regressions = []
+    previous = _keyed(baseline)
+    for key, step in _keyed(result).items():
+        before = previous.get(key)
+        if before is None or step.get('error'):
+            continue
+        for metric in COMPARED_METRICS:
+            now, then = step.get(metric), before.get(metric)
+            if not now or not then:
+                continue
+            if metric == 'seconds' and max(now, then) < MIN_SECONDS:
+                continue
+            if now > then * (1 + tolerance):
+                regressions.append({'rows': key[0], 'duplicate_ratio': key[1], 'step': key[2], 'metric': metric,
+                                    'value': now, 'baseline': then, 'ratio': round(now / then, 3)})
+    return regressions
+
+
+def latest_result(results_dir=RESULTS_DIR, before: str = None):
+    """Path of the most recent saved result (older than run id `before`), or None."""
+    results_dir = Path(results_dir)
+    if not results_dir.is_dir():
+        return None
+    paths = sorted(p for p in results_dir.glob('*.json') if before is None or p.stem < before)
+    return paths[-1] if paths else None
+
+
+def save_result(result: dict, results_dir=RESULTS_DIR, path=None) -> Path:
+    path = Path(path) if path else Path(results_dir) / f"{result['run_id']}.json"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as fh:
+        json.dump(result, fh, indent=2, default=str)
+    return path
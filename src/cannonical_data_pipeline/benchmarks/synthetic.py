@@ -0,0 +1,163 @@
+"""Reproducible synthetic institution data for the pipeline benchmarks.
+
+generate() writes `rows` institution rows, their institution_country rows and the institution
+mapping CSV that insert_mapping_csv loads. A `duplicate_ratio` share of the rows are spelling
+variants (case, spacing, abbreviations, a leading "The") of an earlier canonical institution,
+each with its own UUID; `mapping_coverage` of the variants get a mapping line to their canonical
+name, which is what apply_deduplication and update_uuids act on. A variant usually shares its
+canonical institution's country, so the (institution, uuid_country) groups of update_uuids have
+several members; `country_noise` of them get a random country instead.
+
+The same parameters and seed always give the same data. Rows are streamed to CSV files (no row
+is kept in memory, so 10M rows cost what 10k do) in a directory named after the parameters,
+which later runs reuse; load() copies them into a database with COPY.
+"""
+import csv
+import json
+import random
+import time
+import uuid
+from pathlib import Path
+
+KINDS = ("University", "Institute", "College", "Academy", "Centre", "Laboratory", "School", "Foundation",
+         "Observatory", "Hospital")
+FIELDS = ("Technology", "Science", "Medicine", "Arts", "Engineering", "Agriculture", "Economics", "Law",
+          "Data Science", "Marine Research", "Social Studies")
+SYLLABLES = ("ka", "lo", "mi", "ne", "ru", "ta", "vo", "zi", "ber", "dam", "gen", "hol", "lin", "mar", "sen", "tor")
+ABBREVIATIONS = (("University", "Univ."), ("Institute", "Inst."), ("College", "Coll."), ("Centre", "Ctr."),
+                 ("Laboratory", "Lab."), ("Foundation", "Fdn."))
+COUNTRIES = 200
+
+# The source tables as in resources/data/db/schema.sql
+SOURCE_DDL = """
+CREATE TABLE institution (
+    uuid_institution character varying NOT NULL,
+    institution character varying NOT NULL,
+    english_name character varying NOT NULL,
+    parent_institution character varying NOT NULL
+);
+CREATE TABLE institution_country (
+    uuid_institution character varying NOT NULL,
+    institution character varying NOT NULL,
+    uuid_country character varying NOT NULL,
+    country character varying NOT NULL
+);
+"""
+
+FILES = {"institution": "institution.csv", "institution_country": "institution_country.csv",
+         "mapping": "institution_mapping.csv"}
+
+
+def canonical_name(index: int) -> str:
+    """Unique institution name of canonical institution `index` (the place encodes the index)."""
+    digits = []
+    n = index
+    while True:
+        n, digit = divmod(n, len(SYLLABLES))
+        digits.append(SYLLABLES[digit])
+        if n == 0:
+            break
+    place = "".join(reversed(digits)).capitalize()
+    return f"{KINDS[index % len(KINDS)]} of {FIELDS[index // len(KINDS) % len(FIELDS)]} {place}"
+
+
+def _abbreviate(name: str) -> str:
+    for word, short in ABBREVIATIONS:
+        if word in name:
+            return name.replace(word, short, 1)
+    return "The " + name
+
+
+VARIANTS = (str.upper, str.lower, lambda name: name.replace(" ", "  ", 1), _abbreviate, lambda name: "The " + name)
+
+
+def _country(index: int) -> tuple:
+    number = index % COUNTRIES
+    return str(uuid.UUID(int=number + 1)), f"Country {number:03d}"
+
+
+def iter_rows(rows: int, duplicate_ratio: float, seed: int = 42, mapping_coverage: float = 1.0,
+              country_noise: float = 0.1):
+    """Yield (uuid, institution, english_name, parent, uuid_country, country, canonical or None) per row.
+
+    `canonical` is the name a variant maps to, None for canonical rows and unmapped variants.
+    """
+    rng = random.Random(seed)
+    canonicals = 0
+    for _ in range(rows):
+        row_uuid = str(uuid.UUID(int=rng.getrandbits(128), version=4))
+        if canonicals and rng.random() < duplicate_ratio:
+            index = rng.randrange(canonicals)
+            canonical = canonical_name(index)
+            name = rng.choice(VARIANTS)(canonical)
+            mapped = canonical if name != canonical and rng.random() < mapping_coverage else None
+            country = _country(index * 7919 if rng.random() >= country_noise else rng.randrange(COUNTRIES))
+        else:
+            index = canonicals
+            canonicals += 1
+            canonical = name = canonical_name(index)
+            mapped = None
+            country = _country(index * 7919)
+        parent = canonical_name(index // 10) if index % 10 == 9 else ""
+        yield row_uuid, name, canonical, parent, country[0], country[1], mapped
+
+
+def dataset_dir(root, rows: int, duplicate_ratio: float, seed: int, mapping_coverage: float,
+                country_noise: float) -> Path:
+    return Path(root) / f"rows{rows}_dup{duplicate_ratio:g}_map{mapping_coverage:g}_noise{country_noise:g}_seed{seed}"
+
+
+def generate(root, rows: int, duplicate_ratio: float, seed: int = 42, mapping_coverage: float = 1.0,
+             country_noise: float = 0.1) -> dict:
+    """Write (or reuse) the dataset's CSV files under `root` and return its manifest."""
+    if not 0 <= duplicate_ratio < 1:
+        raise ValueError(f"duplicate_ratio must be in [0, 1): {duplicate_ratio}")
+    directory = dataset_dir(root, rows, duplicate_ratio, seed, mapping_coverage, country_noise)
+    manifest_path = directory / "manifest.json"
+    if manifest_path.exists():
+        with open(manifest_path, encoding="utf-8") as fh:
+            return {**json.load(fh), "reused": True}
+
+    directory.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    counts = {"institution": 0, "variants": 0, "mapping": 0}
+    with open(directory / FILES["institution"], "w", newline="", encoding="utf-8") as inst_fh, \
+            open(directory / FILES["institution_country"], "w", newline="", encoding="utf-8") as country_fh, \
+            open(directory / FILES["mapping"], "w", newline="", encoding="utf-8") as mapping_fh:
+        institutions, countries, mapping = csv.writer(inst_fh), csv.writer(country_fh), csv.writer(mapping_fh)
+        mapping.writerow(("original", "normalized"))
+        for row_uuid, name, canonical, parent, uuid_country, country, mapped in iter_rows(
+                rows, duplicate_ratio, seed, mapping_coverage, country_noise):
+            institutions.writerow((row_uuid, name, canonical, parent))
+            countries.writerow((row_uuid, name, uuid_country, country))
+            counts["institution"] += 1
+            if name != canonical:
+                counts["variants"] += 1
+            if mapped is not None:
+                mapping.writerow((name, mapped))
+                counts["mapping"] += 1
+
+    manifest = {"rows": rows, "duplicate_ratio": duplicate_ratio, "seed": seed, "mapping_coverage": mapping_coverage,
+                "country_noise": country_noise, "directory": str(directory), "counts": counts,
+                "seconds": round(time.perf_counter() - started, 3)}
+    with open(manifest_path, "w", encoding="utf-8") as fh:
+        json.dump(manifest, fh, indent=2)
+    return {**manifest, "reused": False}
+
+
+def load(conn, manifest: dict) -> dict:
+    """Create the source tables on `conn` and COPY the dataset into them (the caller commits)."""
+    directory = Path(manifest["directory"])
+    started = time.perf_counter()
+    with conn.cursor() as cur:
+        cur.execute(SOURCE_DDL)
+        for table in ("institution", "institution_country"):
+            with open(directory / FILES[table], encoding="utf-8") as fh:
+                # an empty parent_institution is an empty string, not NULL
+                cur.copy_expert(f"COPY {table} FROM STDIN WITH (FORMAT csv, NULL '\\N')", fh)
+        cur.execute("ANALYZE institution; ANALYZE institution_country;")
+    return {"seconds": round(time.perf_counter() - started, 3)}
+
+
+def mapping_csv(manifest: dict) -> Path:
+    return Path(manifest["directory"]) / FILES["mapping"]
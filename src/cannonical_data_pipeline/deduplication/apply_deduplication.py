@@ -1,9 +1,11 @@
 import json
 import sys
 
-import psycopg2
-
-from src.cannonical_data_pipeline.infra.db import get_conn_params
+from src.cannonical_data_pipeline.deduplication.indexes import ensure_indexes
+from src.cannonical_data_pipeline.deduplication.name_keys import ensure_key_columns, refresh_name_keys
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.tracing import traced
 
 
 CREATE_SQL = """
@@ -17,55 +19,289 @@ SELECT
     CASE WHEN m."normalized" IS NOT NULL THEN CURRENT_TIMESTAMP ELSE NULL END AS deduplication_timestamp,
     i.uuid_institution,
     i.english_name,
-    i.parent_institution
+    i.parent_institution,
+    ki.name_key AS institution_key,
+    ke.name_key AS english_name_key
 FROM
     institution i
 LEFT JOIN
     institution_mapping m
 ON
     i.institution = m."original"
+LEFT JOIN institution_name_keys ki ON ki.name = COALESCE(m."normalized", i.institution)
+LEFT JOIN institution_name_keys ke ON ke.name = i.english_name
 WHERE
     i.institution IS NOT NULL AND LENGTH(TRIM(i.institution)) > 0;
 """
 
 
-def apply_deduplication(conn_params=None):
-    """Connect to Postgres and execute the CREATE TABLE AS SELECT statement.
+# Change tracking: row triggers on the source tables log the affected keys so an incremental
+# run only touches deduplicated rows whose institution or mapping entry changed.
+TRACKING_SQL = """
+CREATE TABLE IF NOT EXISTS dedup_change_log (
+    change_id BIGSERIAL PRIMARY KEY,
+    source_table TEXT NOT NULL,
+    source_key TEXT,
+    changed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION dedup_log_change() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'TRUNCATE' THEN
+        -- a NULL key means every row is affected
+        INSERT INTO dedup_change_log (source_table, source_key) VALUES (TG_TABLE_NAME, NULL);
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO dedup_change_log (source_table, source_key) VALUES (TG_TABLE_NAME, to_jsonb(OLD) ->> TG_ARGV[0]);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO dedup_change_log (source_table, source_key) VALUES (TG_TABLE_NAME, to_jsonb(NEW) ->> TG_ARGV[0]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS dedup_log_institution ON institution;
+CREATE TRIGGER dedup_log_institution AFTER INSERT OR UPDATE OR DELETE ON institution
+    FOR EACH ROW EXECUTE FUNCTION dedup_log_change('uuid_institution');
+DROP TRIGGER IF EXISTS dedup_log_institution_truncate ON institution;
+CREATE TRIGGER dedup_log_institution_truncate AFTER TRUNCATE ON institution
+    FOR EACH STATEMENT EXECUTE FUNCTION dedup_log_change();
+
+DROP TRIGGER IF EXISTS dedup_log_institution_mapping ON institution_mapping;
+CREATE TRIGGER dedup_log_institution_mapping AFTER INSERT OR UPDATE OR DELETE ON institution_mapping
+    FOR EACH ROW EXECUTE FUNCTION dedup_log_change('original');
+DROP TRIGGER IF EXISTS dedup_log_institution_mapping_truncate ON institution_mapping;
+CREATE TRIGGER dedup_log_institution_mapping_truncate AFTER TRUNCATE ON institution_mapping
+    FOR EACH STATEMENT EXECUTE FUNCTION dedup_log_change();
+"""
+
+# Consume the visible change set; rows logged by still-running transactions stay for the next run
+CONSUME_CHANGES_SQL = "DELETE FROM dedup_change_log RETURNING source_table, source_key"
+
+# Before a full rebuild: drop the changes its snapshot will include. Unlike TRUNCATE, DELETE keeps
+# the changes committed after its snapshot, which the next incremental run applies.
+RESET_CHANGES_SQL = "DELETE FROM dedup_change_log"
+
+# Serialise the runs (full and incremental) against each other
+DEDUP_LOCK_KEY = 8_151_912
+
+# Source institution uuids touched by the logged mapping originals
+MAPPING_KEYS_SQL = "SELECT DISTINCT uuid_institution FROM institution WHERE institution = ANY(%(originals)s)"
+
+# Undo update_uuids for whole (institution, uuid_country) groups containing an affected row,
+# so the next update_uuids run normalizes those groups exactly as after a full rebuild.
+RESET_GROUPS_SQL = """
+WITH touched AS (
+    SELECT DISTINCT t.institution, t.uuid_country
+    FROM deduplicated_institutions_kb t
+    WHERE COALESCE(t.uuid_deprecated, t.uuid_institution) = ANY(%(keys)s)
+)
+UPDATE deduplicated_institutions_kb d
+SET uuid_institution = d.uuid_deprecated, uuid_deprecated = NULL
+FROM touched
+WHERE d.institution = touched.institution
+  AND d.uuid_country IS NOT DISTINCT FROM touched.uuid_country
+  AND d.uuid_deprecated IS NOT NULL
+"""
+
+# A deduplicated row maps back to its source row through the pre-normalization uuid
+DELETE_AFFECTED_SQL = """
+DELETE FROM deduplicated_institutions_kb d
+WHERE COALESCE(d.uuid_deprecated, d.uuid_institution) = ANY(%(keys)s)
+"""
+
+DELETE_ALL_SQL = "DELETE FROM deduplicated_institutions_kb"
+
+INSERT_SELECT = """
+SELECT
+    COALESCE(m."normalized", i.institution) AS institution,
+    i.institution AS original_institution,
+    CASE WHEN m."normalized" IS NOT NULL THEN TRUE ELSE FALSE END AS was_deduplicated,
+    CASE WHEN m."normalized" IS NOT NULL THEN CURRENT_TIMESTAMP ELSE NULL END AS deduplication_timestamp,
+    i.uuid_institution,
+    i.english_name,
+    i.parent_institution,
+    ki.name_key AS institution_key,
+    ke.name_key AS english_name_key{extra_select}
+FROM
+    institution i
+LEFT JOIN
+    institution_mapping m
+ON
+    i.institution = m."original"
+LEFT JOIN institution_name_keys ki ON ki.name = COALESCE(m."normalized", i.institution)
+LEFT JOIN institution_name_keys ke ON ke.name = i.english_name{extra_join}
+WHERE
+    i.institution IS NOT NULL AND LENGTH(TRIM(i.institution)) > 0{key_filter}
+"""
+
+# uuid_country exists once add_columns has run; fill it for re-inserted rows like add_columns does
+COUNTRY_SELECT = ",\n    ic.uuid_country"
+COUNTRY_JOIN = """
+LEFT JOIN LATERAL (
+    SELECT c.uuid_country FROM institution_country c WHERE c.uuid_institution = i.uuid_institution LIMIT 1
+) ic ON TRUE"""
+
+
+def _tracking_installed(cur) -> bool:
+    schema_catalog = catalog.get_catalog(cur)
+    return schema_catalog.has_table("dedup_change_log") and schema_catalog.has_table("deduplicated_institutions_kb")
+
+
+def _insert_sql(columns: set, keyed: bool) -> str:
+    """INSERT ... SELECT for deduplicated rows, optionally restricted to %(keys)s source uuids."""
+    target = ["institution", "original_institution", "was_deduplicated", "deduplication_timestamp",
+              "uuid_institution", "english_name", "parent_institution", "institution_key", "english_name_key"]
+    with_country = "uuid_country" in columns
+    if with_country:
+        target.append("uuid_country")
+    select = INSERT_SELECT.format(
+        extra_select=COUNTRY_SELECT if with_country else "",
+        extra_join=COUNTRY_JOIN if with_country else "",
+        key_filter="\n    AND i.uuid_institution = ANY(%(keys)s)" if keyed else "",
+    )
+    return f"INSERT INTO deduplicated_institutions_kb ({', '.join(target)})" + select
+
+
+def _apply_incremental(cur, result):
+    """Apply the logged change set to deduplicated_institutions_kb in the current transaction."""
+    # tables built before the name keys existed get the key columns, filled from the side table
+    ensure_key_columns(cur, "deduplicated_institutions_kb")
+    cur.execute(CONSUME_CHANGES_SQL)
+    changes = cur.fetchall()
+    result["changes"] = len(changes)
+    if not changes:
+        result["message"] = "No changes since the last run; 'deduplicated_institutions_kb' is up to date."
+        return
+
+    columns = catalog.get_catalog(cur).column_names("deduplicated_institutions_kb")
+    if any(key is None for _, key in changes):
+        # a source table was truncated: refresh every row but keep the table, its columns and indexes
+        result["name_keys"] = refresh_name_keys(cur, prune=True)
+        cur.execute(DELETE_ALL_SQL)
+        result["deleted"] = cur.rowcount
+        cur.execute(_insert_sql(columns, keyed=False))
+        result["inserted"] = cur.rowcount
+        result["message"] = "Source truncated; all rows of 'deduplicated_institutions_kb' refreshed in place."
+        return
 
-    Returns a dict with keys: success (bool), table (str), message (str), error (optional).
+    keys = {key for table, key in changes if table == "institution"}
+    originals = sorted({key for table, key in changes if table == "institution_mapping"})
+    if originals:
+        cur.execute(MAPPING_KEYS_SQL, {"originals": originals})
+        keys.update(r[0] for r in cur.fetchall())
+    params = {"keys": sorted(keys)}
+    result["affected_keys"] = len(keys)
+    result["name_keys"] = refresh_name_keys(cur, uuids=keys, originals=originals)
+
+    has_deprecated = "uuid_deprecated" in columns
+    if has_deprecated:
+        cur.execute(RESET_GROUPS_SQL, params)
+        result["reset"] = cur.rowcount
+        cur.execute(DELETE_AFFECTED_SQL, params)
+    else:
+        cur.execute("DELETE FROM deduplicated_institutions_kb d WHERE d.uuid_institution = ANY(%(keys)s)", params)
+    result["deleted"] = cur.rowcount
+    cur.execute(_insert_sql(columns, keyed=True), params)
+    result["inserted"] = cur.rowcount
+    if has_deprecated:
+        # groups the re-inserted rows joined must be re-normalized as well
+        cur.execute(RESET_GROUPS_SQL, params)
+        result["reset"] += cur.rowcount
+    result["message"] = (
+        f"Applied {len(changes)} change(s) to 'deduplicated_institutions_kb': "
+        f"{result['deleted']} row(s) replaced by {result['inserted']}."
+    )
+
+
+def _ensure_indexes(cur, tables, result):
+    report = {"executed": [], "skipped": [], "errors": []}
+    created = ensure_indexes(cur, tables=tables, report=report)
+    if report["errors"]:
+        raise RuntimeError("; ".join(report["errors"]))
+    result["indexes"].extend(name for _, name in created)
+
+
+def apply_deduplication(conn_params=None, incremental: bool = False, conn=None):
+    """Connect to Postgres and build deduplicated_institutions_kb.
+
+    - incremental=False: DROP and re-create the table with CREATE TABLE AS SELECT. When change
+      tracking is installed, the changes the rebuild covers are deleted from the change log
+      first; changes committed after that stay logged for the next incremental run.
+    - incremental=True: apply only the change set logged by the triggers on `institution` and
+      `institution_mapping` since the last run. Affected rows are replaced in place, so the table
+      keeps its columns (id, uuid_country, uuid_deprecated) and indexes; the normalization of the
+      affected (institution, uuid_country) groups is reset for update_uuids to redo. The first
+      incremental run (no table or no tracking yet) installs the triggers and does a full build.
+
+    Missing supporting indexes (see deduplication.indexes) are created on the source tables
+    before the build and on deduplicated_institutions_kb after it. institution_name_keys gets
+    the keys of new names first (all names on full runs, the changed rows' names on incremental
+    runs) and the rows carry them as institution_key/english_name_key (see deduplication.name_keys).
+
+    With `conn` the statements run in the caller's transaction, which the caller commits.
+
+    Returns a dict with keys: success (bool), table (str), message (str), error (optional),
+    mode (str), indexes (names created), name_keys ({'new_names', 'pruned'}) and, for
+    incremental runs, changes/affected_keys/deleted/inserted/reset counts.
     """
-    params = conn_params or get_conn_params()
-    result = {"success": False, "table": "deduplicated_institutions_kb", "message": None, "error": None}
+    result = {"success": False, "table": "deduplicated_institutions_kb", "message": None, "error": None,
+              "mode": "incremental" if incremental else "full", "indexes": []}
 
-    conn = None
+    own_conn = conn is None
     try:
-        conn = psycopg2.connect(**params)
+        if own_conn:
+            conn = acquire_connection(conn_params)
         with conn.cursor() as cur:
-            cur.execute(CREATE_SQL)
-        conn.commit()
+            _ensure_indexes(cur, ("institution", "institution_mapping"), result)
+            cur.execute("SELECT pg_advisory_xact_lock(%s);", (DEDUP_LOCK_KEY,))
+            if incremental and _tracking_installed(cur):
+                result.update({"affected_keys": 0, "deleted": 0, "inserted": 0, "reset": 0})
+                _apply_incremental(cur, result)
+            else:
+                if incremental:
+                    # bootstrap: triggers first, so every change after the rebuild snapshot is logged
+                    result["mode"] = "full (bootstrap)"
+                    cur.execute(TRACKING_SQL)
+                    catalog.invalidate()
+                if catalog.get_catalog(cur).has_table("dedup_change_log"):
+                    # before CREATE TABLE AS, whose later snapshot includes every deleted change
+                    cur.execute(RESET_CHANGES_SQL)
+                result["name_keys"] = refresh_name_keys(cur, prune=True)
+                cur.execute(CREATE_SQL)
+                catalog.invalidate()
+                result["message"] = "Table 'deduplicated_institutions_kb' created/updated successfully."
+            if catalog.get_catalog(cur).has_table("update_uuids_checkpoint"):
+                # rows were replaced or reset: an interrupted chunked update_uuids must start over
+                cur.execute("DELETE FROM update_uuids_checkpoint WHERE table_name = %s;",
+                            ("public.deduplicated_institutions_kb",))
+            _ensure_indexes(cur, ("deduplicated_institutions_kb",), result)
+        if own_conn:
+            conn.commit()
         result["success"] = True
-        result["message"] = "Table 'deduplicated_institutions_kb' created/updated successfully."
     except Exception as exc:
         # try to include exception message
         result["error"] = str(exc)
         try:
-            if conn is not None:
+            if own_conn and conn is not None:
                 conn.rollback()
         except Exception:
             pass
     finally:
-        try:
-            if conn is not None:
-                conn.close()
-        except Exception:
-            pass
+        if result["mode"] != "incremental":
+            # the table was re-created (or its re-creation rolled back): forget its old columns
+            catalog.invalidate()
+        if own_conn:
+            release_connection(conn)
 
     return result
 
 
 if __name__ == '__main__':
     # run from CLI and print JSON result to stdout
-    res = apply_deduplication()
+    res = traced('apply_deduplication', apply_deduplication, incremental='--incremental' in sys.argv[1:])
     sys.stdout.write(json.dumps(res, ensure_ascii=False))
     sys.stdout.flush()
 
@@ -1,3 +1,6 @@
+import base64
+import json
+
 try:
     import psycopg2
     from psycopg2 import sql
@@ -6,165 +9,345 @@ except Exception:
     sql = None
 
 
-from src.cannonical_data_pipeline.infra.db import get_conn_params
+from src.cannonical_data_pipeline.deduplication.indexes import lower_indexed_columns
+from src.cannonical_data_pipeline.deduplication.name_keys import KEY_COLUMNS
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.db import acquire_connection, get_conn_params, release_connection
 
 
 def get_table_columns(conn, table_name):
     """Return list of (column_name, data_type) for the given table in public schema."""
-    q = """
-    SELECT column_name, data_type
-    FROM information_schema.columns
-    WHERE table_schema = 'public' AND table_name = %s
-    ORDER BY ordinal_position
+    with conn.cursor() as cur:
+        return get_catalog(cur, 'public').columns(table_name)
+
+
+TEXT_TYPES = ("character varying", "text", "character")
+
+# Maximum number of duplicate groups reported per column
+MAX_GROUPS_PER_COLUMN = 100
+
+# Groups fetched per server-side cursor round trip (and per member-row query) when streaming
+STREAM_BATCH_SIZE = 500
+
+
+def get_unique_columns(conn, table_name):
+    """Return the set of column names covered by a PRIMARY KEY, UNIQUE constraint or unique index.
+
+    Read from the cached schema catalog, so repeated per-column calls cost no queries.
+    Unique constraints are backed by unique indexes, so pg_index covers both.
     """
     with conn.cursor() as cur:
-        cur.execute(q, (table_name,))
-        return cur.fetchall()
+        return get_catalog(cur, 'public').unique_columns(table_name)
 
 
-def find_duplicates_for_column(conn, table_name, column_name, data_type, case_insensitive=True):
-    """Return list of (value, ids, count) where value appears more than once in the column.
+def get_name_key_columns(conn, table_name):
+    """Return {name column: key column} for the name columns of the table with a stored key
+    column (see deduplication.name_keys)."""
+    with conn.cursor() as cur:
+        names = get_catalog(cur, 'public').column_names(table_name)
+    return {col: key for col, key in KEY_COLUMNS.items() if col in names and key in names}
+
+
+def _value_expr(column_name, data_type, case_insensitive=True, key_columns=None):
+    """Build the grouping expression for a column: its stored name key when it has one,
+    LOWER(col::text) for the other text-like columns."""
+    if case_insensitive and key_columns and column_name in key_columns:
+        return sql.Identifier(key_columns[column_name])
+    if data_type in TEXT_TYPES and case_insensitive:
+        return sql.SQL('LOWER({col}::text)').format(col=sql.Identifier(column_name))
+    return sql.SQL('({col})::text').format(col=sql.Identifier(column_name))
+
+
+def _unpivot(columns, case_insensitive=True, key_columns=None):
+    """Return a LATERAL VALUES list turning each row into one (column, value) pair per column."""
+    return sql.SQL(', ').join(
+        sql.SQL('({name}, {expr})').format(
+            name=sql.Literal(column_name),
+            expr=_value_expr(column_name, data_type, case_insensitive, key_columns),
+        )
+        for column_name, data_type in columns
+    )
+
+
+def get_lower_indexed_columns(conn, table_name):
+    """Return the columns of the table with a LOWER(col) expression index (see deduplication.indexes)."""
+    with conn.cursor() as cur:
+        return lower_indexed_columns(get_catalog(cur, 'public'), table_name)
 
-    - For text-like columns and case_insensitive=True we compare LOWER(value).
-    - ids is an array of primary key ids collected for that group (if id column exists).
+
+def _record_fields(fields):
+    """Select list of the member rows: every column (t.*) or only `fields`."""
+    if fields is None:
+        return sql.SQL('t.*')
+    return sql.SQL(', ').join(sql.SQL('t.{}').format(sql.Identifier(f)) for f in fields)
+
+
+def _member_query(table_name, columns, groups, case_insensitive, has_id, indexed_columns, fields=None,
+                  key_columns=None):
+    """Build the member-row query and its params for the duplicate groups.
+
+    Text columns with a LOWER(col) expression index or a stored name key (indexed as a
+    supporting index) are fetched by lookups on their group values; the other columns share
+    one unpivoting pass joined to their group keys. `fields` restricts the returned record
+    columns (all columns when None).
+    """
+    table = sql.Identifier(table_name)
+    record = _record_fields(fields)
+    key_columns = key_columns or {}
+    indexed = [(c, t) for c, t in columns
+               if case_insensitive and t in TEXT_TYPES and (c in indexed_columns or c in key_columns)
+               and any(g[0] == c for g in groups)]
+    rest = [(c, t) for c, t in columns if (c, t) not in indexed]
+    rest_groups = [g for g in groups if g[0] not in {c for c, _ in indexed}]
+    order_id = sql.SQL(', t.{}').format(sql.Identifier('id')) if has_id else sql.SQL('')
+
+    unpivot_join = sql.SQL(
+        "SELECT u.col, u.val, {record}"
+        " FROM {table} t"
+        " CROSS JOIN LATERAL (VALUES {unpivot}) AS u(col, val)"
+        " JOIN unnest(%s::text[], %s::text[]) AS g(col, val)"
+        " ON g.col = u.col AND g.val = u.val"
+    )
+    if not indexed:
+        query = sql.SQL("{join} ORDER BY u.col, u.val{order_id}").format(
+            join=unpivot_join.format(record=record, table=table,
+                                     unpivot=_unpivot(columns, case_insensitive, key_columns)),
+            order_id=order_id)
+        return query, ([g[0] for g in groups], [g[1] for g in groups])
+
+    branches, params = [], []
+    for column_name, data_type in indexed:
+        expr = _value_expr(column_name, data_type, case_insensitive, key_columns)
+        branches.append(sql.SQL("SELECT {name}::text AS col, {expr} AS val, {record} FROM {table} t WHERE {expr} = ANY(%s::text[])").format(
+            name=sql.Literal(column_name), expr=expr, record=record, table=table))
+        params.append([g[1] for g in groups if g[0] == column_name])
+    if rest_groups:
+        branches.append(unpivot_join.format(record=record, table=table,
+                                            unpivot=_unpivot(rest, case_insensitive, key_columns)))
+        params.extend([[g[0] for g in rest_groups], [g[1] for g in rest_groups]])
+    # ORDER BY position: the record columns may themselves have columns named col or val
+    query = sql.SQL("SELECT * FROM ({union}) m ORDER BY 1, 2").format(union=sql.SQL(" UNION ALL ").join(branches))
+    return query, tuple(params)
+
+
+def scan_duplicates(conn, table_name, columns, case_insensitive=True, has_id=True, max_groups=MAX_GROUPS_PER_COLUMN,
+                    indexed_columns=(), key_columns=None):
+    """Find duplicate groups for all given columns with a constant number of queries.
+
+    - columns is a list of (column_name, data_type); callers filter out PK/UNIQUE columns.
+    - Groups for every column are computed in one table pass by unpivoting each row with
+      a LATERAL VALUES list and grouping on (column, value).
+    - Member rows for all groups are fetched in one batched query; text columns listed in
+      indexed_columns (with a LOWER(col) index) are fetched through that index.
+    - Name columns in key_columns ({column: key column}, see get_name_key_columns) are grouped
+      on their stored key instead of LOWER(col), so the group value is the normalized name key.
+
+    Returns a dict {column_name: [{'value', 'ids', 'count', 'records'}, ...]} containing only
+    columns that have duplicates, at most `max_groups` groups per column ordered by count.
     """
-    # Skip checking columns that are primary key or are declared UNIQUE
+    if not columns:
+        return {}
+
+    unpivot = _unpivot(columns, case_insensitive, key_columns)
+    id_expr = sql.SQL('t.{}').format(sql.Identifier('id')) if has_id else sql.SQL('NULL::integer')
+
+    group_query = sql.SQL(
+        "SELECT col, val, ids, cnt FROM ("
+        " SELECT u.col, u.val, array_agg({id_expr}) AS ids, COUNT(*) AS cnt,"
+        " row_number() OVER (PARTITION BY u.col ORDER BY COUNT(*) DESC, u.val) AS rn"
+        " FROM {table} t"
+        " CROSS JOIN LATERAL (VALUES {unpivot}) AS u(col, val)"
+        " WHERE u.val IS NOT NULL"
+        " GROUP BY u.col, u.val"
+        " HAVING COUNT(*) > 1"
+        ") g WHERE rn <= %s"
+        " ORDER BY col, cnt DESC, val"
+    ).format(id_expr=id_expr, table=sql.Identifier(table_name), unpivot=unpivot)
+
+    with conn.cursor() as cur:
+        cur.execute(group_query, (max_groups,))
+        groups = cur.fetchall()  # list of (col, val, ids, cnt)
+
+    if not groups:
+        return {}
+
+    results = {}
+    index = {}
+    for col, val, ids, cnt in groups:
+        entry = {'value': val, 'ids': ids, 'count': int(cnt), 'records': []}
+        results.setdefault(col, []).append(entry)
+        index[(col, val)] = entry
+
+    # Fetch the member rows of every group in one query
+    member_query, member_params = _member_query(table_name, columns, groups, case_insensitive, has_id,
+                                                set(indexed_columns or ()), key_columns=key_columns)
+
     try:
-        with conn.cursor() as _cur:
-            _cur.execute(
-                """
-                SELECT tc.constraint_type
-                FROM information_schema.table_constraints tc
-                JOIN information_schema.key_column_usage kcu
-                  ON tc.constraint_name = kcu.constraint_name
-                  AND tc.table_schema = kcu.table_schema
-                WHERE tc.table_schema = 'public' AND tc.table_name = %s AND kcu.column_name = %s
-                """,
-                (table_name, column_name),
-            )
-            constraint_rows = _cur.fetchall()
-            for (ctype,) in constraint_rows:
-                if ctype in ("PRIMARY KEY", "UNIQUE"):
-                    # indicate caller should skip this column
-                    return None
-
-            # Additional check: look for unique indexes in pg_catalog (covers unique indexes not exposed as table_constraints)
-            try:
-                _cur.execute(
-                    """
-                    SELECT i.indisunique
-                    FROM pg_index i
-                    JOIN pg_class t ON t.oid = i.indrelid
-                    JOIN pg_namespace n ON n.oid = t.relnamespace
-                    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(i.indkey)
-                    WHERE n.nspname = 'public' AND t.relname = %s AND a.attname = %s
-                    """,
-                    (table_name, column_name),
-                )
-                idx_rows = _cur.fetchall()
-                for (indisunique,) in idx_rows:
-                    if indisunique:
-                        # unique index found; skip this column
-                        return None
-            except Exception:
-                # If pg_catalog check fails for any reason, rollback to clear the aborted transaction and continue
-                try:
-                    conn.rollback()
-                except Exception:
-                    pass
-                # don't block duplicate checking
-                pass
+        with conn.cursor() as cur:
+            cur.execute(member_query, member_params)
+            desc = [d[0] for d in cur.description][2:] if cur.description else []
+            for row in cur.fetchall():
+                entry = index.get((row[0], row[1]))
+                if entry is not None:
+                    entry['records'].append(dict(zip(desc, row[2:])))
+        if has_id and (indexed_columns or key_columns):
+            for entry in index.values():
+                entry['records'].sort(key=lambda r: (r.get('id') is None, r.get('id')))
     except Exception:
-        # If constraint/index inspection fails, rollback and skip this column
+        # Keep the groups without records, as a failed row fetch should not hide the duplicates
         try:
             conn.rollback()
         except Exception:
             pass
-        return None
+        for entry in index.values():
+            entry['records'] = []
+
+    return results
 
-    # Build value expression depending on type used for grouping
-    is_text_like = data_type in ("character varying", "text", "character")
-    if is_text_like and case_insensitive:
-        val_expr = sql.SQL('LOWER({col}::text)').format(col=sql.Identifier(column_name))
-        compare_clause = sql.SQL('LOWER({col}::text) = %s').format(col=sql.Identifier(column_name))
-    else:
-        val_expr = sql.SQL('({col})::text').format(col=sql.Identifier(column_name))
-        compare_clause = sql.SQL('({col})::text = %s').format(col=sql.Identifier(column_name))
 
-    results = []
+def encode_cursor(group):
+    """Opaque keyset cursor pointing after `group` (a group yielded by stream_duplicate_groups)."""
+    key = json.dumps([group['column'], group['count'], group['value']], ensure_ascii=False)
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
 
+
+def decode_cursor(token):
+    """Return {'column', 'count', 'value'} from an encode_cursor() token; ValueError when invalid."""
     try:
-        with conn.cursor() as cur:
-            # Check if id column exists
-            cur.execute(
-                "SELECT 1 FROM information_schema.columns WHERE table_schema='public' AND table_name=%s AND column_name='id'",
-                (table_name,)
-            )
-            has_id = cur.fetchone() is not None
-
-            id_expr = sql.Identifier('id') if has_id else sql.SQL('NULL')
-
-            # Aggregate groups
-            group_query = sql.SQL(
-                "SELECT {val_expr} AS val, array_agg({id_expr}) AS ids, COUNT(*) AS cnt"
-                " FROM {table}"
-                " WHERE {col} IS NOT NULL"
-                " GROUP BY {val_expr}"
-                " HAVING COUNT(*) > 1"
-                " ORDER BY cnt DESC"
-                " LIMIT 100"
-            ).format(
-                val_expr=val_expr,
-                id_expr=sql.SQL('{col}').format(col=id_expr) if isinstance(id_expr, sql.Identifier) else sql.SQL('NULL'),
-                table=sql.Identifier(table_name),
-                col=sql.Identifier(column_name),
-            )
-
-            cur.execute(group_query)
-            groups = cur.fetchall()  # list of (val, ids, cnt)
-
-            # If no groups found, return None so callers can omit the column entirely
-            if not groups:
-                return None
+        column, count, value = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        return {'column': str(column), 'count': int(count), 'value': str(value)}
     except Exception:
-        # On failure, rollback and indicate caller should skip this column
-        try:
-            conn.rollback()
-        except Exception:
-            pass
-        return None
+        raise ValueError(f"Invalid cursor: {token!r}")
+
+
+def _group_query(table_name, column_name, data_type, case_insensitive, has_id, after=None, limit=None,
+                 key_columns=None):
+    """Duplicate groups (val, ids, cnt) of one column ordered by count descending then value,
+    starting after the keyset `after` ({'count', 'value'}) and stopping after `limit` groups."""
+    expr = _value_expr(column_name, data_type, case_insensitive, key_columns)
+    id_expr = sql.SQL('t.{}').format(sql.Identifier('id')) if has_id else sql.SQL('NULL::integer')
+    keyset, params = sql.SQL(''), []
+    if after is not None:
+        keyset = sql.SQL(" WHERE cnt < %s OR (cnt = %s AND val > %s)")
+        params = [after['count'], after['count'], after['value']]
+    bound = sql.SQL('')
+    if limit is not None:
+        bound = sql.SQL(" LIMIT %s")
+        params.append(limit)
+    query = sql.SQL(
+        "SELECT val, ids, cnt FROM ("
+        " SELECT {expr} AS val, array_agg({id_expr} ORDER BY {id_expr}) AS ids, COUNT(*) AS cnt"
+        " FROM {table} t"
+        " WHERE {expr} IS NOT NULL"
+        " GROUP BY 1"
+        " HAVING COUNT(*) > 1"
+        ") g{keyset}"
+        " ORDER BY cnt DESC, val{bound}"
+    ).format(expr=expr, id_expr=id_expr, table=sql.Identifier(table_name), keyset=keyset, bound=bound)
+    return query, params
+
+
+def _batch_records(conn, table_name, column, rows, case_insensitive, has_id, indexed_columns, fields,
+                   key_columns=None):
+    """Member records of a batch of (val, ids, cnt) group rows of one column, keyed by value."""
+    key_columns = key_columns or {}
+    query, params = _member_query(table_name, [column], [(column[0], val) for val, _, _ in rows],
+                                  case_insensitive, has_id, indexed_columns, fields, key_columns)
+    records = {}
+    with conn.cursor() as cur:
+        cur.execute(query, params)
+        desc = [d[0] for d in cur.description][2:] if cur.description else []
+        for row in cur.fetchall():
+            records.setdefault(row[1], []).append(dict(zip(desc, row[2:])))
+    if has_id and (column[0] in indexed_columns or column[0] in key_columns) and (fields is None or 'id' in fields):
+        for members in records.values():
+            members.sort(key=lambda r: (r.get('id') is None, r.get('id')))
+    return records
+
 
-    # For each group, fetch the actual rows that match the grouped value
+def stream_duplicate_groups(conn, table_name, columns=None, fields=None, case_insensitive=True, after=None,
+                            limit=None, include_records=True, batch_size=STREAM_BATCH_SIZE):
+    """Yield duplicate groups one at a time instead of building the whole report.
+
+    Groups are ordered by column (table order), count descending, then value, and yielded as
+    {'column', 'value', 'count', 'ids', 'records'}. Memory stays bounded by `batch_size`:
+    groups are read from a server-side cursor and the member rows are fetched per batch,
+    restricted to `fields` (all columns when None; no member query with include_records=False).
+    Name columns with a stored key are grouped on it (see scan_duplicates); the key columns
+    themselves are only checked when listed in `columns`.
+
+    Keyset pagination: `after` ({'column', 'count', 'value'}, see decode_cursor) resumes right
+    after that group and `limit` caps the number of groups yielded; pass encode_cursor() of
+    the last group as the next `after`. Unknown table, columns or fields raise ValueError
+    before anything is yielded (on the first next()).
+    """
+    table_columns = get_table_columns(conn, table_name)
+    if not table_columns:
+        raise ValueError(f"Table '{table_name}' does not exist or has no columns in schema 'public'.")
+    names = [c[0] for c in table_columns]
+    unknown = [c for c in list(columns or ()) + list(fields or ()) if c not in names]
+    if unknown:
+        raise ValueError(f"Unknown column(s) for table '{table_name}': {', '.join(sorted(set(unknown)))}")
+
+    unique_cols = get_unique_columns(conn, table_name)
+    key_columns = get_name_key_columns(conn, table_name)
+    eligible = [c for c in table_columns if c[0] not in unique_cols
+                and (c[0] in columns if columns else c[0] not in key_columns.values())]
+    if after is not None:
+        positions = [c[0] for c in eligible]
+        if after['column'] not in positions:
+            raise ValueError(f"Cursor column '{after['column']}' is not checked for duplicates")
+        eligible = eligible[positions.index(after['column']):]
+    has_id = 'id' in names
+    indexed_columns = get_lower_indexed_columns(conn, table_name) if include_records else set()
+    fields = list(fields) if fields is not None else None
+
+    remaining = limit
+    for column in eligible:
+        if remaining is not None and remaining <= 0:
+            return
+        keyset = after if after is not None and after['column'] == column[0] else None
+        query, params = _group_query(table_name, column[0], column[1], case_insensitive, has_id, keyset, remaining,
+                                     key_columns)
+        with conn.cursor(name='duplicate_groups') as cur:
+            cur.itersize = batch_size
+            cur.execute(query, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                records = {}
+                if include_records:
+                    records = _batch_records(conn, table_name, column, rows, case_insensitive, has_id,
+                                             indexed_columns, fields, key_columns)
+                for val, ids, cnt in rows:
+                    yield {'column': column[0], 'value': val, 'count': int(cnt), 'ids': ids,
+                           'records': records.get(val, [])}
+                if remaining is not None:
+                    remaining -= len(rows)
+
+
+def find_duplicates_for_column(conn, table_name, column_name, data_type, case_insensitive=True):
+    """Return list of {'value', 'ids', 'count', 'records'} where value appears more than once in the column.
+
+    Single-column wrapper around scan_duplicates. Returns None when the column is a
+    primary key / unique column or has no duplicates, so callers can omit it.
+    """
     try:
-        with conn.cursor() as cur2:
-            for val, ids, cnt in groups:
-                try:
-                    # fetch full rows for this group
-                    fetch_sql = sql.SQL('SELECT * FROM {table} WHERE {cond} ORDER BY id').format(
-                        table=sql.Identifier(table_name),
-                        cond=compare_clause,
-                    )
-                    cur2.execute(fetch_sql, (val,))
-                    rows = cur2.fetchall()
-                    desc = [d[0] for d in cur2.description] if cur2.description else []
-                    records = [dict(zip(desc, row)) for row in rows]
-                except Exception:
-                    # rollback the transaction so subsequent column checks can proceed
-                    try:
-                        conn.rollback()
-                    except Exception:
-                        pass
-                    records = []
-
-                results.append({'value': val, 'ids': ids, 'count': int(cnt), 'records': records})
+        if column_name in get_unique_columns(conn, table_name):
+            return None
+        has_id = any(c[0] == 'id' for c in get_table_columns(conn, table_name))
+        groups = scan_duplicates(conn, table_name, [(column_name, data_type)],
+                                 case_insensitive=case_insensitive, has_id=has_id,
+                                 indexed_columns=get_lower_indexed_columns(conn, table_name),
+                                 key_columns=get_name_key_columns(conn, table_name))
     except Exception:
         try:
             conn.rollback()
         except Exception:
             pass
         return None
-
-    return results
+    return groups.get(column_name) or None
 
 
 def generate_duplicates_report(conn_params=None, table_name='poc', case_insensitive=True, only_with_duplicates=True, columns=None):
@@ -180,12 +363,12 @@ def generate_duplicates_report(conn_params=None, table_name='poc', case_insensit
         report['error'] = 'psycopg2 is required but not installed'
         return report
 
-    params = conn_params or get_conn_params()
     conn = None
     try:
-        conn = psycopg2.connect(**params)
+        conn = acquire_connection(conn_params)
     except Exception as exc:
         # Mask password when returning error details
+        params = conn_params or get_conn_params(quiet=True)
         safe_params = {k: ('***' if k == 'password' and v else v) for k, v in (params.items() if isinstance(params, dict) else [])}
         report['error'] = f"Failed to connect to Postgres. Params: {safe_params}"
         report['details'] = str(exc)
@@ -197,26 +380,21 @@ def generate_duplicates_report(conn_params=None, table_name='poc', case_insensit
             report['error'] = f"Table '{table_name}' does not exist or has no columns in schema 'public'."
             return report
 
+        has_id = any(c[0] == 'id' for c in cols)
+
         # Optionally filter to provided columns
         if columns:
             cols = [c for c in cols if c[0] in set(columns)]
 
-        for column_name, data_type in cols:
-            group_entries = find_duplicates_for_column(conn, table_name, column_name, data_type, case_insensitive=case_insensitive)
-            if group_entries is None:
-                # Column is either PK/UNIQUE or has no duplicates, skip it
-                continue
+        # Skip columns that are primary key or declared UNIQUE (constraint or unique index), and
+        # the stored name keys unless asked for: their name columns are grouped on them
+        unique_cols = get_unique_columns(conn, table_name)
+        key_columns = get_name_key_columns(conn, table_name)
+        eligible = [c for c in cols if c[0] not in unique_cols and (columns or c[0] not in key_columns.values())]
 
-            col_list = []
-            for g in group_entries:
-                # g is a dict: {'value', 'ids', 'count', 'records'}
-                try:
-                    v = g.get('value')
-                except Exception:
-                    v = str(g.get('value'))
-                col_list.append({'value': v, 'ids': g.get('ids'), 'count': int(g.get('count')), 'records': g.get('records', [])})
-
-            report['columns'][column_name] = col_list
+        report['columns'] = scan_duplicates(conn, table_name, eligible, case_insensitive=case_insensitive, has_id=has_id,
+                                            indexed_columns=get_lower_indexed_columns(conn, table_name),
+                                            key_columns=key_columns)
 
         # Optionally reduce to only columns that have duplicates
         if only_with_duplicates:
@@ -228,8 +406,4 @@ def generate_duplicates_report(conn_params=None, table_name='poc', case_insensit
         report['details'] = str(exc)
         return report
     finally:
-        try:
-            if conn is not None:
-                conn.close()
-        except Exception:
-            pass
+        release_connection(conn)
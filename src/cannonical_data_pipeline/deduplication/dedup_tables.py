@@ -0,0 +1,416 @@
+"""Config-driven deduplication of the deduplicated_* link tables.
+
+Every entry of `dedup_tables` in conf/settings.toml declares one table:
+
+    [[default.dedup_tables]]
+    target = "deduplicated_institution_country"     # table (re)built by the engine
+    source = "institution_country"                  # table it is built from
+    name_column = "institution"                     # source column holding the institution name
+    uuid_column = "uuid_institution"                # institution UUID column (copied from the source)
+    deprecated_column = "uuid_deprecated_institution"
+
+Optional keys (defaults in SPEC_DEFAULTS): mapping / mapping_original / mapping_normalized (the
+name mapping joined on the name column), columns (source columns copied; default every column
+but the name column), country_from (table filling uuid_country by uuid_column when the source
+has none; "" to disable), key_columns (the groups whose UUIDs are normalized), normalize_from /
+normalize_from_uuid_column (the table whose groups give the canonical UUID: MIN(uuid) per group,
+default the target itself) and enabled.
+
+For each table the engine runs the three steps the hand-written modules run for
+deduplicated_institutions_kb (apply_deduplication, add_columns, update_uuids):
+  1. build: rows of the source with institution = COALESCE(mapping.normalized, name),
+     original_institution, was_deduplicated, deduplication_timestamp, the copied columns and
+     uuid_country. An existing target is refreshed in place (DELETE + INSERT ... SELECT), keeping
+     its id sequence, indexes and grants; a missing one is created.
+  2. columns: uuid_country, the deprecated column and id SERIAL are added when missing, and the
+     (key_columns) group index when dedup_auto_indexes is on.
+  3. normalize: deduplicated rows get the canonical UUID of their group, the previous one is
+     kept in the deprecated column.
+
+Standalone runs process the tables concurrently (dedup_tables_max_workers), each table in one
+transaction on its own pooled connection; a table whose source is the target of another entry
+waits for it. With `conn` (the pipeline) the tables run one after the other in the caller's
+transaction. deduplicated_institutions_kb itself keeps its dedicated steps (incremental change
+tracking, name keys, shadow rebuilds); the link tables take their canonical UUIDs from it.
+"""
+import contextvars
+import json
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from psycopg2 import sql
+
+from src.cannonical_data_pipeline.deduplication.indexes import auto_indexes_enabled
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.tracing import traced
+
+SPEC_DEFAULTS = {
+    "uuid_column": "uuid_institution",
+    "deprecated_column": "uuid_deprecated",
+    "mapping": "institution_mapping",
+    "mapping_original": "original",
+    "mapping_normalized": "normalized",
+    "columns": None,
+    "country_from": "institution_country",
+    "key_columns": ["institution", "uuid_country"],
+    "normalize_from": None,
+    "normalize_from_uuid_column": "uuid_institution",
+    "enabled": True,
+}
+
+REQUIRED_KEYS = ("target", "source", "name_column")
+
+# Columns every deduplicated table starts with, in this order
+DEDUP_COLUMNS = ("institution", "original_institution", "was_deduplicated", "deduplication_timestamp")
+
+BUILD_SELECT = """
+SELECT
+    COALESCE(m.{normalized}, s.{name}) AS institution,
+    s.{name} AS original_institution,
+    m.{normalized} IS NOT NULL AS was_deduplicated,
+    CASE WHEN m.{normalized} IS NOT NULL THEN CURRENT_TIMESTAMP ELSE NULL END AS deduplication_timestamp{copied}
+FROM {source} s
+LEFT JOIN {mapping} m ON s.{name} = m.{original}{country_join}
+WHERE s.{name} IS NOT NULL AND LENGTH(TRIM(s.{name})) > 0
+"""
+
+COUNTRY_JOIN = """
+LEFT JOIN LATERAL (
+    SELECT c.uuid_country FROM {country_from} c WHERE c.uuid_institution = s.{uuid} LIMIT 1
+) ic ON TRUE"""
+
+NORMALIZE_SQL = """
+WITH normalized_uuids AS (
+    SELECT MIN({from_uuid}) AS normalized_uuid, {keys}
+    FROM {normalize_from}
+    GROUP BY {keys}
+),
+records_to_update AS (
+    SELECT t.id, t.{uuid} AS old_uuid, n.normalized_uuid
+    FROM {target} t
+    JOIN normalized_uuids n ON {key_join}
+    WHERE t.was_deduplicated = TRUE AND t.{uuid} IS DISTINCT FROM n.normalized_uuid
+)
+UPDATE {target} t
+SET {deprecated} = r.old_uuid, {uuid} = r.normalized_uuid
+FROM records_to_update r
+WHERE t.id = r.id
+"""
+
+
+def _json(val):
+    # the DEDUP_TABLES environment variable holds the list as JSON
+    return json.loads(val) if isinstance(val, str) else val
+
+
+def load_specs(specs=None) -> list:
+    """Return the table specs (the dedup_tables setting by default) with their defaults filled in.
+
+    Raises ValueError on an entry without target, source or name_column, or a duplicate target.
+    """
+    if specs is None:
+        specs = setting("dedup_tables", "DEDUP_TABLES", [], _json)
+    loaded, targets = [], set()
+    for index, entry in enumerate(specs):
+        entry = dict(entry)
+        missing = [key for key in REQUIRED_KEYS if not entry.get(key)]
+        if missing:
+            raise ValueError(f"dedup_tables entry {index}: missing {', '.join(missing)}")
+        unknown = set(entry) - set(SPEC_DEFAULTS) - set(REQUIRED_KEYS)
+        if unknown:
+            raise ValueError(f"dedup_tables entry {index}: unknown key(s) {', '.join(sorted(unknown))}")
+        spec = {**SPEC_DEFAULTS, **entry}
+        spec["key_columns"] = list(spec["key_columns"])
+        spec["columns"] = list(spec["columns"]) if spec["columns"] is not None else None
+        spec["normalize_from"] = spec["normalize_from"] or spec["target"]
+        if spec["target"] in targets:
+            raise ValueError(f"dedup_tables: target {spec['target']} is declared twice")
+        targets.add(spec["target"])
+        if spec["enabled"]:
+            loaded.append(spec)
+    return loaded
+
+
+def spec_tables(specs=None) -> dict:
+    """{'reads', 'writes'} of all specs together, for the pipeline's table declarations.
+
+    An invalid dedup_tables setting declares no tables; running the specs reports the error.
+    """
+    try:
+        specs = load_specs(specs)
+    except ValueError:
+        return {"reads": (), "writes": ()}
+    reads, writes = set(), set()
+    for spec in specs:
+        reads.update(_reads(spec))
+        writes.add(spec["target"])
+    return {"reads": tuple(sorted(reads - writes)), "writes": tuple(sorted(writes))}
+
+
+def _reads(spec) -> set:
+    tables = {spec["source"], spec["mapping"], spec["normalize_from"]} | ({spec["country_from"]} - {""})
+    return tables - {spec["target"]}
+
+
+def _dependencies(specs) -> dict:
+    """{target: targets of other specs it reads}; raises ValueError on a cycle."""
+    targets = {spec["target"] for spec in specs}
+    deps = {spec["target"]: _reads(spec) & targets for spec in specs}
+    done = set()
+    while len(done) < len(deps):
+        ready = [t for t in deps if t not in done and deps[t] <= done]
+        if not ready:
+            raise ValueError(f"dedup_tables: circular dependency between {', '.join(sorted(set(deps) - done))}")
+        done.update(ready)
+    return deps
+
+
+def _copied_columns(spec, source_columns: list) -> list:
+    if spec["columns"] is not None:
+        return spec["columns"]
+    return [col for col in source_columns if col != spec["name_column"]]
+
+
+def build_sql(spec, copied: list, with_country: bool, schema: str = "public") -> sql.Composed:
+    """The SELECT producing the deduplicated rows of `spec` (see BUILD_SELECT)."""
+    ident = sql.Identifier
+    select = [sql.SQL(",\n    s.{0}").format(ident(col)) for col in copied]
+    if with_country:
+        select.append(sql.SQL(",\n    ic.uuid_country"))
+    country_join = sql.SQL("")
+    if with_country:
+        country_join = sql.SQL(COUNTRY_JOIN).format(country_from=ident(schema, spec["country_from"]),
+                                                    uuid=ident(spec["uuid_column"]))
+    return sql.SQL(BUILD_SELECT).format(
+        normalized=ident(spec["mapping_normalized"]), original=ident(spec["mapping_original"]),
+        name=ident(spec["name_column"]), source=ident(schema, spec["source"]),
+        mapping=ident(schema, spec["mapping"]), copied=sql.SQL("").join(select), country_join=country_join,
+    )
+
+
+def normalize_sql(spec, schema: str = "public") -> sql.Composed:
+    """The CTE + UPDATE giving the deduplicated rows of the target their group's canonical UUID."""
+    ident = sql.Identifier
+    keys = [ident(col) for col in spec["key_columns"]]
+    key_join = sql.SQL(" AND ").join(
+        sql.SQL("(t.{0} = n.{0} OR (t.{0} IS NULL AND n.{0} IS NULL))").format(k) for k in keys)
+    return sql.SQL(NORMALIZE_SQL).format(
+        from_uuid=ident(spec["normalize_from_uuid_column"]), keys=sql.SQL(", ").join(keys),
+        normalize_from=ident(schema, spec["normalize_from"]), target=ident(schema, spec["target"]),
+        uuid=ident(spec["uuid_column"]), deprecated=ident(spec["deprecated_column"]), key_join=key_join,
+    )
+
+
+def _ensure_columns(cur, schema: str, spec, report: dict):
+    """add_columns for a spec'd target: uuid_country, the deprecated column, id and the group index."""
+    schema_catalog = catalog.get_catalog(cur, schema)
+    target = spec["target"]
+    table = sql.Identifier(schema, target)
+    added = []
+    for col in ("uuid_country", spec["deprecated_column"]):
+        if not schema_catalog.has_column(target, col):
+            cur.execute(sql.SQL("ALTER TABLE {0} ADD COLUMN {1} VARCHAR;").format(table, sql.Identifier(col)))
+            added.append(f"ADD COLUMN {col}")
+    if not schema_catalog.has_column(target, "id"):
+        pk = "" if schema_catalog.has_primary_key(target) else " PRIMARY KEY"
+        cur.execute(sql.SQL("ALTER TABLE {0} ADD COLUMN id SERIAL" + pk + ";").format(table))
+        added.append("ADD COLUMN id SERIAL" + pk)
+    if added:
+        catalog.invalidate(schema)
+        report["executed"].extend(added)
+
+    keys = spec["key_columns"]
+    missing = [col for col in keys if not catalog.get_catalog(cur, schema).has_column(target, col)]
+    if missing:
+        raise ValueError(f"{schema}.{target} has no key column(s) {', '.join(missing)}")
+    if not auto_indexes_enabled():
+        return
+    if any(tuple(index["columns"][:len(keys)]) == tuple(keys) and not index["expression"]
+           for index in catalog.get_catalog(cur, schema).indexes(target)):
+        return
+    name = f"{target}_group_idx"
+    cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2});").format(
+        sql.Identifier(name), table, sql.SQL(", ").join(sql.Identifier(col) for col in keys)))
+    cur.execute(sql.SQL("ANALYZE {0};").format(table))
+    catalog.invalidate(schema)
+    report["executed"].append(f"CREATE INDEX {name}")
+
+
+def dedup_table(cur, spec, schema: str = "public", report: dict = None) -> dict:
+    """Build, complete and normalize one spec'd table in the caller's transaction.
+
+    Returns the table report: success, target, mode (created/refreshed), deleted, inserted,
+    normalized, executed, skipped, errors and seconds. A failed statement is recorded in
+    errors; the caller rolls its transaction back.
+    """
+    report = report if report is not None else {}
+    report.update({"success": False, "target": spec["target"], "mode": None, "deleted": 0, "inserted": 0,
+                   "normalized": 0, "executed": [], "skipped": [], "errors": [], "seconds": None})
+    started = time.perf_counter()
+    try:
+        _dedup_table(cur, spec, schema, report)
+        report["success"] = not report["errors"]
+    except Exception as exc:
+        report["errors"].append(str(exc))
+    finally:
+        # the table may have been created or altered (or that rolled back)
+        catalog.invalidate(schema)
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def _dedup_table(cur, spec, schema: str, report: dict):
+    schema_catalog = catalog.get_catalog(cur, schema)
+    target, source = spec["target"], spec["source"]
+    for table in (source, spec["mapping"]):
+        if not schema_catalog.has_table(table):
+            report["errors"].append(f"table {schema}.{table} does not exist")
+            return
+    source_columns = [col[0] for col in schema_catalog.columns(source)]
+    copied = _copied_columns(spec, source_columns)
+    needed = {spec["name_column"], spec["uuid_column"], *copied}
+    missing = sorted(needed - set(source_columns))
+    if missing:
+        report["errors"].append(f"table {schema}.{source} has no column(s) {', '.join(missing)}")
+        return
+    clashes = sorted(set(copied) & set(DEDUP_COLUMNS))
+    if clashes:
+        report["errors"].append(f"copied column(s) {', '.join(clashes)} clash with the deduplicated columns")
+        return
+    with_country = "uuid_country" not in copied and bool(spec["country_from"])
+    if with_country and not schema_catalog.has_table(spec["country_from"]):
+        report["skipped"].append(f"{spec['country_from']} does not exist; uuid_country left empty")
+        with_country = False
+    columns = list(DEDUP_COLUMNS) + copied + (["uuid_country"] if with_country else [])
+    select = build_sql(spec, copied, with_country, schema)
+    table = sql.Identifier(schema, target)
+
+    if schema_catalog.has_table(target):
+        report["mode"] = "refreshed"
+        absent = sorted(set(columns) - schema_catalog.column_names(target) - {"uuid_country"})
+        if absent:
+            report["errors"].append(f"table {schema}.{target} has no column(s) {', '.join(absent)}")
+            return
+        _ensure_columns(cur, schema, spec, report)
+        cur.execute(sql.SQL("DELETE FROM {0};").format(table))
+        report["deleted"] = cur.rowcount
+        cur.execute(sql.SQL("INSERT INTO {0} ({1})").format(
+            table, sql.SQL(", ").join(sql.Identifier(col) for col in columns)) + select)
+        report["inserted"] = cur.rowcount
+        report["executed"].append(f"refresh {target} from {source}")
+    else:
+        report["mode"] = "created"
+        cur.execute(sql.SQL("CREATE TABLE {0} AS").format(table) + select)
+        report["inserted"] = cur.rowcount
+        report["executed"].append(f"create {target} from {source}")
+        catalog.invalidate(schema)
+        _ensure_columns(cur, schema, spec, report)
+
+    if spec["normalize_from"] != target and not catalog.get_catalog(cur, schema).has_column(
+            spec["normalize_from"], spec["normalize_from_uuid_column"]):
+        report["skipped"].append(f"{spec['normalize_from']} does not exist; UUIDs not normalized")
+        return
+    cur.execute(normalize_sql(spec, schema))
+    report["normalized"] = cur.rowcount
+    report["executed"].append(f"normalize {spec['uuid_column']} by {', '.join(spec['key_columns'])}")
+
+
+def _table_worker(conn_params, spec, schema: str) -> dict:
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        with conn.cursor() as cur:
+            result = dedup_table(cur, spec, schema)
+        if result["success"]:
+            conn.commit()
+        else:
+            conn.rollback()
+        return result
+    finally:
+        release_connection(conn)
+
+
+def run_dedup_tables(conn_params=None, schema: str = "public", tables=None, conn=None, specs=None,
+                     max_workers: int = None) -> dict:
+    """Apply the dedup specs (all, or the targets listed in `tables`) and return a report.
+
+    Report keys: success, tables ({target: table report, see dedup_table}), executed, skipped,
+    errors and seconds. A table whose dependency failed is reported as skipped.
+    """
+    report = {"success": False, "tables": {}, "executed": [], "skipped": [], "errors": [], "seconds": None}
+    started = time.perf_counter()
+    try:
+        specs = load_specs(specs)
+        if tables is not None:
+            unknown = sorted(set(tables) - {spec["target"] for spec in specs})
+            if unknown:
+                raise ValueError(f"no dedup_tables entry for {', '.join(unknown)}")
+            specs = [spec for spec in specs if spec["target"] in tables]
+        deps = _dependencies(specs)
+    except ValueError as exc:
+        report["errors"].append(str(exc))
+        return report
+    if not specs:
+        report["skipped"].append("no dedup_tables configured")
+        report["success"] = True
+        return report
+    by_target = {spec["target"]: spec for spec in specs}
+
+    if conn is not None:
+        done = set()
+        while len(done) < len(by_target):
+            for target in [t for t in by_target if t not in done and deps[t] <= done]:
+                with conn.cursor() as cur:
+                    result = dedup_table(cur, by_target[target], schema)
+                report["tables"][target] = result
+                done.add(target)
+                if not result["success"]:
+                    # the caller's transaction is aborted: nothing else can run in it
+                    report["errors"].append(f"{target}: {'; '.join(result['errors'])}")
+                    report["seconds"] = round(time.perf_counter() - started, 3)
+                    return report
+    else:
+        workers = max_workers or setting("dedup_tables_max_workers", "DEDUP_TABLES_MAX_WORKERS", 4, int)
+        state = {target: "pending" for target in by_target}
+        with ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="dedup-tables") as pool:
+            running = {}
+            while True:
+                for target in by_target:
+                    if state[target] != "pending":
+                        continue
+                    if any(state[dep] == "failed" for dep in deps[target]):
+                        state[target] = "failed"
+                        report["skipped"].append(f"{target}: a table it reads failed")
+                    elif all(state[dep] == "done" for dep in deps[target]):
+                        state[target] = "running"
+                        # in a copy of this context, so the worker's statements land in the step's trace
+                        running[pool.submit(contextvars.copy_context().run, _table_worker, conn_params,
+                                            by_target[target], schema)] = target
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    target = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as exc:
+                        result = {"success": False, "target": target, "errors": [str(exc)]}
+                    report["tables"][target] = result
+                    state[target] = "done" if result["success"] else "failed"
+                    if not result["success"]:
+                        report["errors"].append(f"{target}: {'; '.join(result['errors'])}")
+
+    report["executed"] = [f"dedup {target}" for target, result in report["tables"].items() if result["success"]]
+    report["success"] = not report["errors"]
+    report["seconds"] = round(time.perf_counter() - started, 3)
+    return report
+
+
+if __name__ == '__main__':
+    # python -m ...dedup_tables [target ...]
+    res = traced('dedup_tables', run_dedup_tables, tables=sys.argv[1:] or None)
+    sys.stdout.write(json.dumps(res, ensure_ascii=False, default=str))
+    sys.stdout.flush()
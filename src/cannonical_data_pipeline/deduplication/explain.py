@@ -0,0 +1,229 @@
+"""EXPLAIN (ANALYZE, BUFFERS) capture of the statements a pipeline step runs.
+
+With capture on, the step's connection hands out PlanCursor cursors (connection.cursor_factory),
+so the step code is unchanged. Before running a statement for real, the cursor runs it once
+under EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) inside a savepoint that is rolled back, then runs
+it normally; results, rowcounts and errors are exactly those of the normal run. Multi-statement
+strings are replayed statement by statement in the savepoint, explaining the explainable ones
+(SELECT/WITH/INSERT/UPDATE/DELETE/VALUES and CREATE TABLE ... AS). Statements therefore run
+twice, sequences skip the values used by the discarded run: this is a diagnostic mode.
+
+Plans are saved per step to logs/plans/<run_id>/<step>.json; the step report gets a summary with
+the totals and, when an earlier capture of the step exists, its totals and the difference, so
+regressions stand out. Captured statements also go into the step's trace (infra.tracing), with
+the buffer counts of their plans.
+"""
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+from src.cannonical_data_pipeline.infra import tracing
+
+try:
+    from psycopg2.extensions import cursor as _base_cursor
+except Exception:
+    _base_cursor = object
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+PLANS_DIR = REPO_ROOT / 'logs' / 'plans'
+
+# Longest statement text kept in a plan file
+MAX_STATEMENT_CHARS = 4000
+
+_EXPLAINABLE = re.compile(
+    r'^\s*(?:SELECT|WITH|INSERT|UPDATE|DELETE|VALUES)\b'
+    r'|^\s*CREATE\s+(?:(?:TEMP|TEMPORARY|UNLOGGED)\s+)?TABLE\s+[^(]*?\sAS\b',
+    re.IGNORECASE | re.DOTALL,
+)
+_DOLLAR_TAG = re.compile(r'\$[A-Za-z_0-9]*\$')
+
+_BUFFER_KEYS = ('Shared Hit Blocks', 'Shared Read Blocks', 'Shared Dirtied Blocks', 'Shared Written Blocks',
+                'Temp Read Blocks', 'Temp Written Blocks')
+
+
+def split_statements(query: str) -> list:
+    """Split a SQL string on top-level semicolons (quotes, identifiers and $$ bodies respected)."""
+    statements, start, i, n = [], 0, 0, len(query)
+    while i < n:
+        ch = query[i]
+        if ch in ("'", '"'):
+            end = query.find(ch, i + 1)
+            while end != -1 and query[end + 1:end + 2] == ch:
+                end = query.find(ch, end + 2)
+            i = n if end == -1 else end + 1
+            continue
+        if ch == '-' and query.startswith('--', i):
+            end = query.find('\n', i)
+            i = n if end == -1 else end + 1
+            continue
+        if ch == '$':
+            tag = _DOLLAR_TAG.match(query, i)
+            if tag:
+                end = query.find(tag.group(0), tag.end())
+                i = n if end == -1 else end + len(tag.group(0))
+                continue
+        if ch == ';':
+            statements.append(query[start:i])
+            start = i + 1
+        i += 1
+    statements.append(query[start:])
+    return [s.strip() for s in statements if s.strip()]
+
+
+def is_explainable(statement: str) -> bool:
+    return bool(_EXPLAINABLE.match(statement))
+
+
+def _buffers(node: dict) -> dict:
+    return {key.lower().replace(' ', '_'): node.get(key, 0) for key in _BUFFER_KEYS}
+
+
+def _sum_buffers(plans) -> dict:
+    totals = {}
+    for plan in plans:
+        for key, value in plan['buffers'].items():
+            totals[key] = totals.get(key, 0) + (value or 0)
+    return totals
+
+
+class PlanCursor(_base_cursor):
+    """Cursor recording an EXPLAIN ANALYZE plan and the timing of every statement it runs.
+
+    `recorder` is set on the subclass made by StepCapture.cursor_class(); named (server-side)
+    cursors only record timings.
+    """
+    recorder = None
+
+    def execute(self, query, vars=None):
+        text = query.as_string(self.connection) if hasattr(query, 'as_string') else query
+        entry = {'statement': None, 'seconds': None, 'rowcount': None, 'plans': [], 'error': None}
+        if self.name is None:
+            statement = self.mogrify(text, vars)
+            statement = statement.decode('utf-8', 'replace') if isinstance(statement, bytes) else statement
+            entry['statement'] = statement[:MAX_STATEMENT_CHARS]
+            parts = split_statements(statement)
+            if any(is_explainable(part) for part in parts):
+                self._explain(parts, entry)
+        else:
+            entry['statement'] = str(text)[:MAX_STATEMENT_CHARS]
+        started = time.perf_counter()
+        error = None
+        try:
+            return super().execute(query, vars)
+        except Exception as exc:
+            error = str(exc).strip().split('\n', 1)[0]
+            raise
+        finally:
+            entry['seconds'] = round(time.perf_counter() - started, 6)
+            entry['rowcount'] = self.rowcount
+            self.recorder.record(entry)
+            # the statement also goes into the step's trace, with its plans' buffer counts
+            tracing.record(str(text).strip(), entry['seconds'], entry['rowcount'], error,
+                           buffers=_sum_buffers(entry['plans']))
+
+    def _explain(self, parts, entry):
+        super().execute('SAVEPOINT plan_capture;')
+        try:
+            for part in parts:
+                if not is_explainable(part):
+                    super().execute(part)
+                    continue
+                super().execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + part)
+                plan = self.fetchone()[0]
+                plan = plan[0] if isinstance(plan, list) else plan
+                if isinstance(plan, str):
+                    plan = json.loads(plan)[0]
+                entry['plans'].append({
+                    'statement': part[:MAX_STATEMENT_CHARS],
+                    'planning_ms': plan.get('Planning Time'),
+                    'execution_ms': plan.get('Execution Time'),
+                    'buffers': _buffers(plan.get('Plan', {})),
+                    'plan': plan.get('Plan'),
+                })
+        except Exception as exc:
+            entry['error'] = f"explain failed: {exc}"
+        finally:
+            super().execute('ROLLBACK TO SAVEPOINT plan_capture;')
+            super().execute('RELEASE SAVEPOINT plan_capture;')
+
+
+class StepCapture:
+    """Statements recorded for one step."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.statements = []
+        self._lock = threading.Lock()
+
+    def record(self, entry: dict):
+        with self._lock:
+            self.statements.append(entry)
+
+    def cursor_class(self):
+        return type('StepPlanCursor', (PlanCursor,), {'recorder': self})
+
+    def totals(self) -> dict:
+        plans = [p for s in self.statements for p in s['plans']]
+        totals = {
+            'statements': len(self.statements),
+            'explained': len(plans),
+            'seconds': round(sum(s['seconds'] or 0 for s in self.statements), 6),
+            'execution_ms': round(sum(p['execution_ms'] or 0 for p in plans), 3),
+            'planning_ms': round(sum(p['planning_ms'] or 0 for p in plans), 3),
+        }
+        for key in ('shared_hit_blocks', 'shared_read_blocks', 'temp_written_blocks'):
+            totals[key] = sum(p['buffers'].get(key, 0) for p in plans)
+        return totals
+
+
+class PlanCapture:
+    """Plan capture of one pipeline run, saved under plans_dir/<run_id>/."""
+
+    def __init__(self, plans_dir=PLANS_DIR, run_id: str = None):
+        self.plans_dir = Path(plans_dir)
+        self.run_id = run_id or datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        self.run_dir = self.plans_dir / self.run_id
+
+    def _previous(self, step: str):
+        """Totals of the most recent earlier capture of `step`, or None."""
+        if not self.plans_dir.is_dir():
+            return None
+        for run_dir in sorted((p for p in self.plans_dir.iterdir() if p.is_dir() and p.name < self.run_id),
+                              reverse=True):
+            try:
+                with open(run_dir / f'{step}.json', encoding='utf-8') as fh:
+                    return {'run_id': run_dir.name, **json.load(fh)['totals']}
+            except (OSError, ValueError, KeyError):
+                continue
+        return None
+
+    def save(self, step: StepCapture) -> dict:
+        """Write the step's plans and return the summary for the step report."""
+        totals = step.totals()
+        self.run_dir.mkdir(parents=True, exist_ok=True)
+        path = self.run_dir / f'{step.name}.json'
+        with open(path, 'w', encoding='utf-8') as fh:
+            json.dump({'step': step.name, 'run_id': self.run_id, 'totals': totals, 'statements': step.statements},
+                      fh, indent=2, default=str)
+        summary = {'file': str(path), **totals, 'previous': self._previous(step.name)}
+        if summary['previous']:
+            summary['delta_execution_ms'] = round(totals['execution_ms'] - (summary['previous'].get('execution_ms') or 0), 3)
+            summary['delta_seconds'] = round(totals['seconds'] - (summary['previous'].get('seconds') or 0), 6)
+        return summary
+
+    @contextmanager
+    def step(self, name: str, conn):
+        """Record the statements run on `conn` inside the block; yields {} filled with the summary."""
+        capture = StepCapture(name)
+        summary = {}
+        previous_factory = conn.cursor_factory
+        conn.cursor_factory = capture.cursor_class()
+        try:
+            yield summary
+        finally:
+            conn.cursor_factory = previous_factory
+            summary.update(self.save(capture))
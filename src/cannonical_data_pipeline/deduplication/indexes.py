@@ -0,0 +1,181 @@
+"""Supporting indexes for the deduplication joins, and an advisor reporting which are missing.
+
+SUPPORTING_INDEXES lists the indexes the steps rely on, with the statement each one serves:
+  - institution_mapping(original): the CREATE_SQL join and the incremental key lookup
+  - institution(institution): MAPPING_KEYS_SQL (institution = ANY(...)) of incremental runs
+  - institution_country(uuid_institution): the uuid_country join of add_columns
+  - deduplicated_institutions_kb(institution, uuid_country): the SQL_UPDATE grouping and join
+  - deduplicated_institutions_kb(COALESCE(uuid_deprecated, uuid_institution)): incremental deletes/resets
+  - deduplicated_institutions_kb(uuid_institution): the ES document grouping and sync joins
+  - deduplicated_institutions_kb(institution_key), (english_name_key): the normalized-name keys
+  - LOWER(col::text) on the text columns the case-insensitive duplicate scan groups on; the scan
+    fetches the member rows of those columns through the index instead of a second table pass
+
+An index is covered when the table already has an index of that name or a plain index whose
+leading columns are the spec's columns (e.g. a primary key on uuid_institution). Specs whose
+table or columns do not exist (yet) are skipped, so each step ensures what it can:
+apply_deduplication the source tables and the rebuilt table, add_columns the columns it added.
+Creation uses CREATE INDEX IF NOT EXISTS in the caller's transaction (not CONCURRENTLY, which
+cannot run inside one). dedup_auto_indexes=false turns automatic creation off.
+
+Run `python -m src.cannonical_data_pipeline.deduplication.indexes [--apply]` for the advice as JSON.
+"""
+import json
+import re
+import sys
+
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import connection
+
+DEDUP_TABLE = "deduplicated_institutions_kb"
+
+# (table, index name, key expressions, columns the keys need, purpose); plain columns are quoted
+# identifiers, expressions are written out and matched on the index name only
+SUPPORTING_INDEXES = (
+    ("institution_mapping", "institution_mapping_original_idx", ('"original"',), ("original",),
+     "CREATE_SQL join institution.institution = institution_mapping.original"),
+    ("institution", "institution_institution_idx", ('"institution"',), ("institution",),
+     "incremental MAPPING_KEYS_SQL lookup by institution"),
+    ("institution_country", "institution_country_uuid_institution_idx", ('"uuid_institution"',),
+     ("uuid_institution",), "add_columns uuid_country join on uuid_institution"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_group_idx", ('"institution"', '"uuid_country"'), ("institution", "uuid_country"),
+     "update_uuids grouping and join on (institution, uuid_country)"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_source_uuid_idx", ("(COALESCE(uuid_deprecated, uuid_institution))",),
+     ("uuid_deprecated", "uuid_institution"), "incremental delete/reset by source uuid"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_uuid_institution_idx", ('"uuid_institution"',), ("uuid_institution",),
+     "ES documents grouped by uuid_institution and sync joins"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_institution_key_idx", ('"institution_key"',), ("institution_key",),
+     "lookups and duplicate scans on the normalized institution key"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_english_name_key_idx", ('"english_name_key"',), ("english_name_key",),
+     "lookups and duplicate scans on the normalized english_name key"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_lower_institution_idx", ("(LOWER(institution::text))",), ("institution",),
+     "case-insensitive duplicate scan on institution"),
+    (DEDUP_TABLE, f"{DEDUP_TABLE}_lower_english_name_idx", ("(LOWER(english_name::text))",), ("english_name",),
+     "case-insensitive duplicate scan on english_name"),
+)
+
+# pg_get_indexdef() spells LOWER(col::text) as lower(col) for text and lower((col)::text) otherwise
+_LOWER_KEY = re.compile(r'\(lower\(\(?"?([^"()]+)"?\)?(?:::text)?\)\)')
+
+
+def auto_indexes_enabled() -> bool:
+    return setting("dedup_auto_indexes", "DEDUP_AUTO_INDEXES", True, bool)
+
+
+def _plain_columns(keys) -> tuple:
+    if not all(k.startswith('"') for k in keys):
+        return ()
+    return tuple(k.strip('"') for k in keys)
+
+
+def _covering_index(info, name: str, keys):
+    columns = _plain_columns(keys)
+    for index in info.indexes:
+        if index["name"] == name:
+            return index["name"]
+        if columns and not index["expression"] and tuple(index["columns"][:len(columns)]) == columns:
+            return index["name"]
+    return None
+
+
+def lower_indexed_columns(schema_catalog, table: str) -> set:
+    """Columns of `table` with an expression index on LOWER(col) usable by the duplicate scan."""
+    found = set()
+    for index in schema_catalog.indexes(table):
+        if index["expression"]:
+            match = _LOWER_KEY.search(index["definition"] or "")
+            if match and len(_LOWER_KEY.findall(index["definition"])) == 1:
+                found.add(match.group(1))
+    return found
+
+
+def advise(cur, schema: str = "public", tables=None, target: str = None, rename=None) -> list:
+    """Return one entry per supporting index of `tables` (all when None) with its status.
+
+    status is 'present' (an index covers it, see covered_by), 'missing', 'table_missing' or
+    'columns_missing'. With `target` the specs are checked against that table instead (e.g. a
+    shadow copy of the table), with the index names passed through `rename`.
+    """
+    schema_catalog = catalog.get_catalog(cur, schema)
+    advice = []
+    for table, name, keys, needs, purpose in SUPPORTING_INDEXES:
+        if tables is not None and table not in tables:
+            continue
+        entry = {"table": target or table, "name": rename(name) if rename else name, "spec": name,
+                 "keys": list(keys), "purpose": purpose, "status": "missing", "covered_by": None}
+        info = schema_catalog.table(entry["table"])
+        if info is None:
+            entry["status"] = "table_missing"
+        elif not set(needs) <= info.column_names:
+            entry["status"] = "columns_missing"
+        else:
+            covered_by = _covering_index(info, entry["name"], keys)
+            if covered_by:
+                entry.update(status="present", covered_by=covered_by)
+        advice.append(entry)
+    return advice
+
+
+def index_statement(schema: str, entry: dict) -> str:
+    return f'CREATE INDEX IF NOT EXISTS "{entry["name"]}" ON {schema}."{entry["table"]}" ({", ".join(entry["keys"])});'
+
+
+def ensure_indexes(cur, schema: str = "public", tables=None, report: dict = None, target: str = None,
+                   rename=None) -> list:
+    """Create the missing supporting indexes of `tables` in the caller's transaction.
+
+    Returns [(spec name, created name)] and records the creations in report["executed"]; a
+    failure is recorded in report["errors"] (the caller's transaction is then aborted, like any
+    failed statement of the step). ANALYZE runs on every table that got an index, so the planner
+    has statistics for the new expressions and for freshly rebuilt tables.
+    """
+    report = report if report is not None else {"executed": [], "skipped": [], "errors": []}
+    if not auto_indexes_enabled():
+        report["skipped"].append("supporting indexes disabled (dedup_auto_indexes)")
+        return []
+    created, analyze = [], []
+    for entry in advise(cur, schema, tables, target, rename):
+        if entry["status"] != "missing":
+            continue
+        try:
+            cur.execute(index_statement(schema, entry))
+        except Exception as exc:
+            report["errors"].append(f"failed to create index {entry['name']}: {exc}")
+            break
+        created.append((entry["spec"], entry["name"]))
+        report["executed"].append(f"CREATE INDEX {entry['name']}")
+        if entry["table"] not in analyze:
+            analyze.append(entry["table"])
+    if created:
+        catalog.invalidate(schema)
+        for table in analyze:
+            cur.execute(f'ANALYZE {schema}."{table}";')
+    return created
+
+
+def index_advice(conn_params=None, schema: str = "public", apply: bool = False) -> dict:
+    """Report the supporting indexes and their status; with apply=True create the missing ones."""
+    report = {"success": False, "advice": [], "executed": [], "skipped": [], "errors": []}
+    try:
+        with connection(conn_params) as conn:
+            try:
+                with conn.cursor() as cur:
+                    if apply:
+                        ensure_indexes(cur, schema, report=report)
+                    report["advice"] = advise(cur, schema)
+                if apply and not report["errors"]:
+                    conn.commit()
+            finally:
+                conn.rollback()
+                catalog.invalidate(schema)
+        report["success"] = not report["errors"]
+    except Exception as exc:
+        report["errors"].append(str(exc))
+    return report
+
+
+if __name__ == '__main__':
+    res = index_advice(apply='--apply' in sys.argv[1:])
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
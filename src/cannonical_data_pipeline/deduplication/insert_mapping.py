@@ -8,20 +8,204 @@ from pathlib import Path
 import re
 import io
 
-import psycopg2
+from src.cannonical_data_pipeline.infra.commons import app_settings
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.tracing import traced
 
-from cannonical_data_pipeline.infra.commons import app_settings
-from src.cannonical_data_pipeline.infra.db import get_conn_params
 
+ENSURE_STATEMENTS = (
+    """
+    CREATE TABLE IF NOT EXISTS institution_mapping (
+        id SERIAL PRIMARY KEY,
+        original TEXT,
+        normalized TEXT
+    )
+    """,
+    # Create a unique index to allow ON CONFLICT upsert on original
+    "CREATE UNIQUE INDEX IF NOT EXISTS institution_mapping_original_idx ON institution_mapping (original)",
+    """
+    CREATE TABLE IF NOT EXISTS institution_mapping_rejects (
+        id SERIAL PRIMARY KEY,
+        loaded_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        source_file TEXT,
+        line_no BIGINT,
+        raw_row TEXT,
+        reason TEXT
+    )
+    """,
+)
+
+STAGING_SQL = """
+CREATE TEMP TABLE institution_mapping_staging (
+    line_no BIGINT,
+    original TEXT,
+    normalized TEXT,
+    raw_row TEXT,
+    reason TEXT
+) ON COMMIT DROP
+"""
+
+COPY_STAGING_SQL = (
+    "COPY institution_mapping_staging (line_no, original, normalized, raw_row, reason)"
+    " FROM STDIN WITH (FORMAT csv)"
+)
+
+MERGE_SQL = """
+INSERT INTO institution_mapping ("original", "normalized")
+SELECT DISTINCT ON (original) original, normalized
+FROM institution_mapping_staging
+WHERE reason IS NULL
+ORDER BY original, line_no DESC
+ON CONFLICT (original) DO UPDATE SET normalized = EXCLUDED.normalized
+"""
+
+REJECTS_SQL = """
+INSERT INTO institution_mapping_rejects (source_file, line_no, raw_row, reason)
+SELECT %s, line_no, raw_row, reason
+FROM institution_mapping_staging
+WHERE reason IS NOT NULL
+ORDER BY line_no
+"""
+
+# Characters read per chunk when streaming the mapping CSV
+CSV_CHUNK_SIZE = 1024 * 1024
+
+# Quote repair: a quote followed by (optional whitespace and) a value gets a separating comma
+_REPAIR_RE = re.compile(r'"\s*(?=[A-Za-z0-9])')
+# A trailing quote + whitespace whose repair depends on the next chunk
+_PENDING_REPAIR_RE = re.compile(r'"\s*\Z')
+
+
+def iter_repaired_chunks(fobj, chunk_size=CSV_CHUNK_SIZE, stats=None):
+    """Yield quote-repaired text chunks from a text file object.
+
+    Produces exactly what re.sub(_REPAIR_RE, '",', whole_text) would, without holding the
+    whole file: a trailing `"` + whitespace is carried into the next chunk because
+    whether it gets repaired depends on the character that follows it.
+    """
+    carry = ''
+    while True:
+        chunk = fobj.read(chunk_size)
+        if not chunk:
+            break
+        text = carry + chunk
+        carry = ''
+        m = _PENDING_REPAIR_RE.search(text)
+        if m:
+            text, carry = text[:m.start()], text[m.start():]
+        repaired, n = _REPAIR_RE.subn('",', text)
+        if stats is not None:
+            stats['repairs'] = stats.get('repairs', 0) + n
+        if repaired:
+            yield repaired
+    if carry:
+        # nothing follows the carried quote, so it can never be repaired
+        yield carry
+
+
+def iter_lines(chunks):
+    """Re-split a stream of text chunks into '\n'-terminated lines for the csv module."""
+    pending = ''
+    for chunk in chunks:
+        pending += chunk
+        if '\n' not in chunk:
+            continue
+        parts = pending.split('\n')
+        pending = parts.pop()
+        for part in parts:
+            yield part + '\n'
+    if pending:
+        yield pending
+
+
+# Cap on error messages kept in the report; every reject is still stored in the rejects table
+MAX_REPORTED_ERRORS = 100
 
-def insert_mapping_csv(csv_path: str, dry_run=False):
+
+class _LineStream:
+    """Minimal file-like wrapper so copy_expert() can pull COPY data from a generator of lines."""
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._buf = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            try:
+                self._buf += next(self._lines)
+            except StopIteration:
+                break
+        if size < 0:
+            out, self._buf = self._buf, ''
+        else:
+            out, self._buf = self._buf[:size], self._buf[size:]
+        return out
+
+
+def _staging_lines(reader, report, split_concatenated=None):
+    """Validate CSV rows and yield them as COPY csv lines for the staging table.
+
+    Valid rows carry reason NULL; rejected rows keep their raw content and a reason.
+    Counts and error messages are accumulated in `report`.
+    """
+    buf = io.StringIO()
+    writer = csv.writer(buf, quoting=csv.QUOTE_NOTNULL, lineterminator='\n')
+
+    for row in reader:
+        orig = row.get('original')
+        norm = row.get('normalized')
+        reason = None
+        # If normalized is missing, try heuristic split from original
+        if (norm is None or str(norm).strip() == '') and isinstance(orig, str) and split_concatenated:
+            split = split_concatenated(orig)
+            if split:
+                before = dict(row)
+                orig, norm = split
+                report['auto_fixed'] += 1
+                if len(report['auto_fixed_examples']) < 5:
+                    report['auto_fixed_examples'].append({'before': before, 'after': {'original': orig, 'normalized': norm}})
+        # Reject rows without required data
+        if orig is None or norm is None:
+            reason = 'missing columns'
+        elif '\x00' in orig or '\x00' in norm:
+            reason = 'NUL character'
+
+        if reason is None:
+            writer.writerow((reader.line_num, orig, norm, None, None))
+            report['inserted'] += 1
+        else:
+            writer.writerow((reader.line_num, None, None, json.dumps(row, ensure_ascii=False).replace('\x00', ''), reason))
+            report['rejected'] += 1
+            if len(report['errors']) < MAX_REPORTED_ERRORS:
+                report['errors'].append(f"{reason} in row {reader.line_num}: {row}")
+
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def insert_mapping_csv(csv_path: str, dry_run=False, conn_params=None, chunk_size: int = CSV_CHUNK_SIZE, conn=None):
     """Read CSV and insert into institution_mapping(original, normalized).
 
     If dry_run=True the function only parses the CSV and returns a count without connecting to DB.
+    Without conn_params a connection is borrowed from the shared pool. With `conn` the load runs
+    in the caller's transaction and is neither committed nor rolled back here.
+
+    The file is streamed: it is read in `chunk_size` character chunks, quote-repaired
+    incrementally and parsed row by row straight into the DB writer, so memory stays flat
+    regardless of file size (chunk_size=-1 reads the whole file at once).
 
-    Returns a dict report: {inserted: int, errors: [str], error: None or msg, details: optional}
+    Rows are streamed into a temporary staging table with COPY FROM STDIN and merged into
+    institution_mapping with one upsert (the last row wins for a repeated `original`).
+    Rows missing `original`/`normalized` are kept in institution_mapping_rejects. The whole
+    load is one transaction, so a failure never leaves a partial mapping behind.
+
+    Returns a dict report: {inserted: int (valid rows staged), merged: int (rows upserted),
+    rejected: int, errors: [str] (first MAX_REPORTED_ERRORS), error: None or msg, details: optional}
     """
-    report = {'inserted': 0, 'errors': [], 'error': None, 'auto_fixed': 0, 'auto_fixed_examples': []}
+    report = {'inserted': 0, 'merged': 0, 'rejected': 0, 'errors': [], 'error': None,
+              'auto_fixed': 0, 'auto_fixed_examples': []}
 
     def _try_split_concatenated(orig: str):
         """Heuristic: if a field contains two concatenated values (no comma), try to split where a lower->Upper transition occurs.
@@ -30,158 +214,133 @@ def insert_mapping_csv(csv_path: str, dry_run=False):
         """
 
 
-    csv_file = Path(csv_path)
     try:
-        raw_text = csv_file.read_text(encoding='utf-8')
+        fh = open(Path(csv_path), encoding='utf-8')
     except Exception as exc:
         report['error'] = f"Failed to read CSV: {exc}"
         report['details'] = traceback.format_exc()
         return report
 
-    repaired_text = re.sub(r'"\s*(?=[A-Za-z0-9])', '",', raw_text)
-    repair_applied = repaired_text != raw_text
-    try:
-        print(f"[debug] csv_repair_applied={repair_applied}", file=sys.stderr)
-    except Exception:
-        pass
+    # One streaming pass: chunked read -> incremental quote repair -> csv rows -> validation
+    repair_stats = {'repairs': 0}
+    lines = iter_lines(iter_repaired_chunks(fh, chunk_size=chunk_size, stats=repair_stats))
+    reader = csv.DictReader(lines, delimiter=',', quotechar='"')
+    staging = _staging_lines(reader, report, _try_split_concatenated)
 
-    # Use StringIO for csv parsing
-    fobj = io.StringIO(repaired_text)
+    def _debug_repair():
+        try:
+            print(f"[debug] csv_repair_applied={repair_stats['repairs'] > 0} repairs={repair_stats['repairs']}", file=sys.stderr)
+        except Exception:
+            pass
 
-    # If dry_run, just parse and count rows to validate CSV
+    # If dry_run, just parse, validate and count rows in the same single pass
     if dry_run:
         try:
-            count = 0
-            reader = csv.DictReader(fobj, delimiter=',', quotechar='"')
-            for _ in reader:
-                count += 1
+            for _ in staging:
+                pass
+            report['found_rows'] = report['inserted'] + report['rejected']
             report['inserted'] = 0
-            report['found_rows'] = count
             return report
         except Exception as exc:
+            report['inserted'] = 0
             report['error'] = f"Failed to parse CSV in dry-run: {exc}"
             report['details'] = traceback.format_exc()
             return report
+        finally:
+            fh.close()
+            _debug_repair()
 
-    # Real run: connect to DB and insert
-    params = get_conn_params()
-    conn = None
+    # Real run: stream validated rows into a staging table with COPY, then merge set-based
+    own_conn = conn is None
     try:
-        conn = psycopg2.connect(**params)
+        if own_conn:
+            conn = acquire_connection(conn_params)
         cur = conn.cursor()
-        # Ensure the institution_mapping table exists and create a unique index on original
-        try:
-            cur.execute(
-                """
-                CREATE TABLE IF NOT EXISTS institution_mapping (
-                    id SERIAL PRIMARY KEY,
-                    original TEXT,
-                    normalized TEXT
-                )
-                """
-            )
-            # Create a unique index to allow ON CONFLICT upsert on original
-            cur.execute(
-                "CREATE UNIQUE INDEX IF NOT EXISTS institution_mapping_original_idx ON institution_mapping (original)"
-            )
-            conn.commit()
-        except Exception:
-            # If table creation fails, rollback and continue; inserts will likely fail later and be reported
+        # Ensure the institution_mapping and rejects tables exist and create a unique index on original
+        for stmt in ENSURE_STATEMENTS:
             try:
-                conn.rollback()
+                if not own_conn:
+                    cur.execute("SAVEPOINT ensure_mapping;")
+                cur.execute(stmt)
+                if own_conn:
+                    conn.commit()
+                else:
+                    cur.execute("RELEASE SAVEPOINT ensure_mapping;")
             except Exception:
-                pass
-
-        # Reset StringIO cursor to start for parsing
-        fobj.seek(0)
-        reader = csv.DictReader(fobj, delimiter=',', quotechar='"')
-
-        for row in reader:
-            try:
-                orig = row.get('original')
-                norm = row.get('normalized')
-                # If normalized is missing, try heuristic split from original
-                if (norm is None or str(norm).strip() == '') and isinstance(orig, str):
-                    split = _try_split_concatenated(orig)
-                    if split:
-                        orig, norm = split
-                        report['auto_fixed'] += 1
-                        if len(report['auto_fixed_examples']) < 5:
-                            report['auto_fixed_examples'].append({'before': row, 'after': {'original': orig, 'normalized': norm}})
-                # Skip rows without required data
-                if orig is None or norm is None:
-                    report['errors'].append(f"missing columns in row: {row}")
-                    continue
-                # Upsert: update normalized when original already exists
-                cur.execute(
-                    """
-                    INSERT INTO institution_mapping ("original", "normalized")
-                    VALUES (%s, %s)
-                    ON CONFLICT (original) DO UPDATE SET normalized = EXCLUDED.normalized
-                    """,
-                    (orig, norm)
-                )
-                report['inserted'] += 1
-            except Exception as exc_row:
-                # record the error and continue with next row
-                report['errors'].append(f"row error {row}: {exc_row}")
+                # If creation fails, rollback and continue; the merge will likely fail later and be reported
                 try:
-                    conn.rollback()
+                    if own_conn:
+                        conn.rollback()
+                    else:
+                        cur.execute("ROLLBACK TO SAVEPOINT ensure_mapping;")
                     cur = conn.cursor()
                 except Exception:
                     pass
-        # commit all successful inserts (those not rolled back)
-        try:
+
+        cur.execute(STAGING_SQL)
+        cur.copy_expert(COPY_STAGING_SQL, _LineStream(staging))
+        cur.execute(MERGE_SQL)
+        report['merged'] = cur.rowcount if cur.rowcount is not None else 0
+        if report['rejected']:
+            cur.execute(REJECTS_SQL, (str(csv_path),))
+        if own_conn:
             conn.commit()
-        except Exception as exc_commit:
-            report['error'] = f"failed to commit: {exc_commit}"
-            try:
-                conn.rollback()
-            except Exception:
-                pass
     except Exception as exc:
+        # Nothing is half-applied: the staging table, merge and rejects share one transaction
+        report['inserted'] = 0
+        report['merged'] = 0
         report['error'] = f"DB connection or processing failed: {exc}"
         report['details'] = traceback.format_exc()
         try:
-            if conn is not None:
+            if own_conn and conn is not None:
                 conn.rollback()
         except Exception:
             pass
     finally:
-        try:
-            if conn is not None:
-                conn.close()
-        except Exception:
-            pass
+        # the ENSURE statements may have created the mapping tables
+        catalog.invalidate()
+        if own_conn:
+            release_connection(conn)
+        fh.close()
+        _debug_repair()
 
     return report
 
 
-if __name__ == '__main__':
-    # Resolve mapping path from Dynaconf setting and ensure it exists before running
+def resolve_mapping_path() -> Path:
+    """Resolve app_settings.data_institution_mapping (a '@format {env[BASE_DIR]}/...' value) to a path.
+
+    Raises ValueError when the setting is missing and FileNotFoundError when the file does not exist.
+    """
     try:
         mapping_cfg = app_settings.data_institution_mapping
     except Exception:
         mapping_cfg = None
+    if not mapping_cfg:
+        raise ValueError("app_settings.data_institution_mapping is not configured")
+
+    mc = mapping_cfg
+    if isinstance(mc, str) and mc.startswith('@format '):
+        mc = mc[len('@format '):]
+    if '{env[BASE_DIR]}' in mc:
+        base = os.environ.get('BASE_DIR', str(Path(__file__).resolve().parents[3]))
+        mc = mc.replace('{env[BASE_DIR]}', base)
+    resolved_path = Path(mc).resolve()
+    if not resolved_path.exists():
+        raise FileNotFoundError(f"CSV file not found at resolved path: {resolved_path}")
+    return resolved_path
 
-    resolved_path = None
-    if mapping_cfg:
-        mc = mapping_cfg
-        if isinstance(mc, str) and mc.startswith('@format '):
-            mc = mc[len('@format '):]
-        if '{env[BASE_DIR]}' in mc:
-            base = os.environ.get('BASE_DIR', str(Path(__file__).resolve().parents[3]))
-            mc = mc.replace('{env[BASE_DIR]}', base)
-        resolved_path = Path(mc).resolve()
-        if not resolved_path.exists():
-            print(f"CSV file not found at resolved path: {resolved_path}", file=sys.stderr)
-            sys.exit(1)
-    else:
-        print("app_settings.data_institution_mapping is not configured", file=sys.stderr)
+
+if __name__ == '__main__':
+    # Resolve mapping path from Dynaconf setting and ensure it exists before running
+    try:
+        resolved_path = resolve_mapping_path()
+    except (ValueError, FileNotFoundError) as exc:
+        print(str(exc), file=sys.stderr)
         sys.exit(1)
 
     # Run a dry-run to validate the CSV and report
-    res = insert_mapping_csv(csv_path=resolved_path, dry_run=False)
+    res = traced('insert_mapping', insert_mapping_csv, csv_path=resolved_path, dry_run=False)
     print(json.dumps(res, indent=2, ensure_ascii=False))
     # exit non-zero on error
     if res.get('error'):
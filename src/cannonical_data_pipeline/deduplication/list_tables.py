@@ -1,51 +1,82 @@
 import json
-import psycopg2
+import sys
+
 from psycopg2 import sql
 
-from src.cannonical_data_pipeline.infra.db import get_conn_params
+from src.cannonical_data_pipeline.infra.async_db import afetch_plan
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection, run_plan
+
+
+# Row estimates from the planner statistics; n_live_tup covers tables never analyzed (reltuples = -1)
+ESTIMATES_SQL = """
+SELECT c.relname,
+       CASE WHEN c.reltuples >= 0 THEN c.reltuples::bigint ELSE COALESCE(s.n_live_tup, 0) END
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+WHERE n.nspname = %s AND c.relkind IN ('r', 'p')
+ORDER BY c.relname
+"""
+
+
+def row_counts_plan(schema: str = "public", exact: bool = False):
+    """Query plan (see infra.db.run_plan) of table_row_counts()."""
+    estimates = yield ESTIMATES_SQL, (schema,), 'all'
+    if not exact:
+        return [{"name": name, "rows": int(rows), "estimated": True} for name, rows in estimates]
+
+    tables_with_counts = []
+    for name, _ in estimates:
+        try:
+            yield "SAVEPOINT count_rows;", None, None
+            cnt = (yield sql.SQL("SELECT COUNT(*) FROM {}.{}").format(sql.Identifier(schema), sql.Identifier(name)),
+                   None, 'one')[0]
+            yield "RELEASE SAVEPOINT count_rows;", None, None
+        except Exception:
+            # If counting fails for any reason, report -1 to indicate unknown/error
+            yield "ROLLBACK TO SAVEPOINT count_rows;", None, None
+            cnt = -1
+        tables_with_counts.append({"name": name, "rows": cnt, "estimated": False})
+    return tables_with_counts
+
+
+def table_row_counts(cur, schema: str = "public", exact: bool = False) -> list:
+    """Return [{'name', 'rows', 'estimated'}] for the base tables of `schema`.
 
+    By default one catalog query returns the planner's row estimates (pg_class.reltuples), so no
+    table is scanned. exact=True runs COUNT(*) on every table instead (rows=-1 when that fails).
+    """
+    return run_plan(cur, row_counts_plan(schema, exact))
 
-def list_tables(conn_params=None):
-    """Return a dict report with a list of public base table names and row counts in the DB."""
-    params = conn_params or get_conn_params()
+
+def list_tables(conn_params=None, exact: bool = False):
+    """Return a dict report with a list of public base table names and row counts in the DB.
+
+    Row counts are planner estimates unless exact=True (a COUNT(*) per table).
+    """
     conn = None
     try:
-        conn = psycopg2.connect(**params)
+        conn = acquire_connection(conn_params)
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT table_name
-                FROM information_schema.tables
-                WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
-                ORDER BY table_name
-                """
-            )
-            rows = cur.fetchall()
-            tables = [r[0] for r in rows]
-
-            # For each table, get the row count using safe identifier handling
-            tables_with_counts = []
-            for t in tables:
-                try:
-                    cur.execute(sql.SQL("SELECT COUNT(*) FROM {}" ).format(sql.Identifier(t)))
-                    cnt = cur.fetchone()[0]
-                except Exception:
-                    # If counting fails for any reason, report -1 to indicate unknown/error
-                    cnt = -1
-                tables_with_counts.append({"name": t, "rows": cnt})
+            tables_with_counts = table_row_counts(cur, exact=exact)
+        conn.rollback()
         return {"tables": tables_with_counts, "error": None}
     except Exception as exc:
         return {"tables": [], "error": str(exc)}
     finally:
-        try:
-            if conn is not None:
-                conn.close()
-        except Exception:
-            pass
+        release_connection(conn)
+
+
+async def list_tables_async(exact: bool = False):
+    """list_tables() on the async pool, for the API handlers."""
+    try:
+        return {"tables": await afetch_plan(row_counts_plan(exact=exact)), "error": None}
+    except Exception as exc:
+        return {"tables": [], "error": str(exc)}
 
 
 def main(conn_params=None):
-    report = list_tables(conn_params=conn_params)
+    report = list_tables(conn_params=conn_params, exact='--exact' in sys.argv[1:])
     print(json.dumps(report, default=str))
     # exit non-zero if error
     if report.get("error"):
@@ -0,0 +1,187 @@
+"""Persistent normalized-name keys of the institution names.
+
+institution_name_keys maps every institution name to its normalized key (normalize_name():
+casefolded, accents stripped, punctuation, hyphens and whitespace collapsed to single spaces),
+with an index on the key. A key is computed once per distinct name: refresh_name_keys() only
+normalizes names that are not in the table yet (an anti-join on its primary key), restricted
+to the changed rows on incremental runs. apply_deduplication and rebuild_shadow refresh it
+before every build and copy the keys into deduplicated_institutions_kb (institution_key,
+english_name_key) with a join on the name, so no normalization runs per row in SQL; the
+duplicate scan (check_duplicates) groups those name columns on their stored keys and
+near_duplicates reads them, instead of recomputing them.
+
+Names covered: institution.institution, institution.english_name and
+institution_mapping.normalized (the deduplicated institution names). The key is computed in
+Python so it does not depend on the database locale. After changing normalize_name(), run
+`python -m src.cannonical_data_pipeline.deduplication.name_keys --rebuild` to recompute every
+key, then rebuild deduplicated_institutions_kb (a full apply_deduplication or rebuild_shadow run)
+so its copies of the keys follow; without --rebuild the CLI adds the missing keys and prunes
+unused names.
+"""
+import json
+import re
+import sys
+import unicodedata
+
+from psycopg2 import sql
+
+try:
+    from psycopg2.extras import execute_values
+except Exception:
+    execute_values = None
+
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import connection
+
+KEYS_TABLE = "institution_name_keys"
+
+# Name columns of the deduplicated tables and the columns holding their stored keys
+KEY_COLUMNS = {"institution": "institution_key", "english_name": "english_name_key"}
+
+# Names normalized and inserted per batch
+NAME_KEY_BATCH_SIZE = 5000
+
+_SEPARATORS = re.compile(r"[\W_]+")
+
+ENSURE_SQL = """
+CREATE TABLE IF NOT EXISTS institution_name_keys (
+    name TEXT PRIMARY KEY,
+    name_key TEXT NOT NULL,
+    computed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS institution_name_keys_name_key_idx ON institution_name_keys (name_key);
+"""
+
+# Names without a key; {institution_filter}/{mapping_filter} restrict them to changed rows
+NEW_NAMES_SQL = """
+SELECT DISTINCT s.name
+FROM (
+    SELECT institution AS name FROM institution{institution_filter}
+    UNION ALL
+    SELECT english_name FROM institution{institution_filter}{mapping_branch}
+) s
+WHERE s.name IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM institution_name_keys k WHERE k.name = s.name)
+"""
+
+MAPPING_BRANCH = """
+    UNION ALL
+    SELECT "normalized" FROM institution_mapping{mapping_filter}"""
+
+PRUNE_SQL = """
+DELETE FROM institution_name_keys k
+WHERE NOT EXISTS (SELECT 1 FROM institution i WHERE i.institution = k.name)
+  AND NOT EXISTS (SELECT 1 FROM institution i WHERE i.english_name = k.name){mapping_check}
+"""
+
+MAPPING_CHECK = """
+  AND NOT EXISTS (SELECT 1 FROM institution_mapping m WHERE m."normalized" = k.name)"""
+
+INSERT_KEYS_SQL = "INSERT INTO institution_name_keys (name, name_key) VALUES %s ON CONFLICT (name) DO NOTHING"
+
+# Keys of deduplicated rows that predate the key columns (or whose name had no key yet); a sql.SQL template.
+# Each column is filled on its own, so a row without english_name still gets its institution_key.
+BACKFILL_SQL = """
+UPDATE {table} d
+SET institution_key = COALESCE(d.institution_key,
+                               (SELECT k.name_key FROM institution_name_keys k WHERE k.name = d.institution)),
+    english_name_key = COALESCE(d.english_name_key,
+                                (SELECT k.name_key FROM institution_name_keys k WHERE k.name = d.english_name))
+WHERE d.institution_key IS NULL OR d.english_name_key IS NULL
+"""
+
+
+def normalize_name(value) -> str:
+    """Casefold, strip accents and collapse punctuation, hyphens and whitespace to single spaces."""
+    if value is None:
+        return ""
+    text = str(value).casefold()
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+    return _SEPARATORS.sub(" ", text).strip()
+
+
+def ensure_keys_table(cur):
+    if not catalog.get_catalog(cur).has_table(KEYS_TABLE):
+        cur.execute(ENSURE_SQL)
+        catalog.invalidate()
+
+
+def refresh_name_keys(cur, uuids=None, originals=None, prune: bool = False,
+                      batch_size: int = NAME_KEY_BATCH_SIZE) -> dict:
+    """Add the keys of names that have none, in the caller's transaction.
+
+    With `uuids` (institution.uuid_institution) and/or `originals` (institution_mapping.original)
+    only the names of those rows are considered; otherwise every name. prune=True also deletes
+    names no longer used by any source row. Returns {'new_names', 'pruned'}.
+    """
+    ensure_keys_table(cur)
+    has_mapping = catalog.get_catalog(cur).has_table("institution_mapping")
+    keyed = uuids is not None or originals is not None
+    params = {"uuids": sorted(uuids or ()), "originals": sorted(originals or ())}
+    query = NEW_NAMES_SQL.format(
+        institution_filter=" WHERE uuid_institution = ANY(%(uuids)s)" if keyed else "",
+        mapping_branch=MAPPING_BRANCH.format(
+            mapping_filter=' WHERE "original" = ANY(%(originals)s)' if keyed else "") if has_mapping else "",
+    )
+    stats = {"new_names": 0, "pruned": 0}
+    # Names are streamed from a server-side cursor so a first run over a large table stays flat
+    with cur.connection.cursor(name="institution_new_names") as names:
+        names.itersize = batch_size
+        names.execute(query, params)
+        while True:
+            batch = names.fetchmany(batch_size)
+            if not batch:
+                break
+            execute_values(cur, INSERT_KEYS_SQL, [(name, normalize_name(name)) for name, in batch],
+                           page_size=batch_size)
+            stats["new_names"] += len(batch)
+    if prune:
+        cur.execute(PRUNE_SQL.format(mapping_check=MAPPING_CHECK if has_mapping else ""))
+        stats["pruned"] = cur.rowcount
+    return stats
+
+
+def ensure_key_columns(cur, table: str, schema: str = "public") -> bool:
+    """Add institution_key/english_name_key to a deduplicated table built before they existed
+    and fill them from institution_name_keys. Returns True when columns were added."""
+    if set(KEY_COLUMNS.values()) <= catalog.get_catalog(cur, schema).column_names(table):
+        return False
+    qualified = sql.Identifier(schema, table)
+    cur.execute(sql.SQL("ALTER TABLE {0} ADD COLUMN IF NOT EXISTS institution_key TEXT,"
+                        " ADD COLUMN IF NOT EXISTS english_name_key TEXT;").format(qualified))
+    catalog.invalidate(schema)
+    refresh_name_keys(cur)
+    cur.execute(sql.SQL(BACKFILL_SQL).format(table=qualified))
+    return True
+
+
+def name_keys(conn_params=None, rebuild: bool = False) -> dict:
+    """Refresh institution_name_keys in its own transaction; rebuild=True recomputes every key."""
+    report = {"success": False, "table": KEYS_TABLE, "new_names": 0, "pruned": 0, "executed": [], "skipped": [],
+              "errors": []}
+    try:
+        with connection(conn_params) as conn:
+            try:
+                with conn.cursor() as cur:
+                    if rebuild:
+                        ensure_keys_table(cur)
+                        cur.execute(f"TRUNCATE {KEYS_TABLE};")
+                        report["executed"].append(f"TRUNCATE {KEYS_TABLE}")
+                    report.update(refresh_name_keys(cur, prune=not rebuild))
+                    report["executed"].append("refresh name keys")
+                conn.commit()
+                report["success"] = True
+            finally:
+                conn.rollback()
+                catalog.invalidate()
+    except Exception as exc:
+        report["errors"].append(str(exc))
+    return report
+
+
+if __name__ == '__main__':
+    res = name_keys(rebuild='--rebuild' in sys.argv[1:])
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
@@ -0,0 +1,305 @@
+"""Near-duplicate detection for institution names, proposing institution_mapping candidates.
+
+check_duplicates only groups identical LOWER(col) values; spelling variants such as
+"Helmholtz-Zentrum Berlin" / "Helmholtz Zentrum Berlin" or "Université" / "Universite" are left
+to the hand-curated institution_mapping.csv. This module proposes those mappings:
+
+  1. the distinct names of a column are loaded with their row counts and normalized keys
+     (casefolded, accents stripped, punctuation and hyphens collapsed to single spaces; read
+     from institution_name_keys, see name_keys); names with the same key are duplicates
+     outright (score 1.0)
+  2. blocking: two keys are only compared when they share one of their `block_tokens`
+     rarest tokens; tokens found in more than `max_block_size` keys ("university", "of", ...)
+     are not used as blocks, so the number of pairs grows with n * max_block_size, not n²
+  3. each candidate pair is scored with the Dice coefficient of the keys' character trigram
+     sets, computed with NumPy over chunks of pairs
+  4. pairs scoring >= threshold are merged into clusters; the name with the most rows is the
+     cluster's canonical name and every other member becomes a candidate mapping
+     original -> normalized, scored against the canonical name
+
+Candidates are ranked by score and carry the institution_mapping columns (original,
+normalized) plus score, column, cluster and rows; originals already in institution_mapping
+are left out. Settings: near_duplicate_threshold, near_duplicate_max_block_size,
+near_duplicate_block_tokens.
+
+Run `python -m src.cannonical_data_pipeline.deduplication.near_duplicates [--csv PATH] [--limit N]`
+for the report as JSON; --csv writes the candidates as a mapping CSV for review.
+"""
+import csv
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+try:
+    from psycopg2 import sql
+except Exception:
+    sql = None
+
+from src.cannonical_data_pipeline.deduplication.name_keys import KEYS_TABLE, normalize_name
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import connection
+
+SOURCE_TABLE = "institution"
+NAME_COLUMNS = ("institution", "english_name")
+
+# Candidate pairs scored per NumPy chunk
+SCORE_CHUNK_SIZE = 200_000
+
+NAMES_SQL = (
+    "SELECT {col}, COUNT(*) FROM {table}"
+    " WHERE {col} IS NOT NULL AND btrim({col}::text) <> ''"
+    " GROUP BY 1"
+)
+
+# Same, with the stored key of each name (deduplication.name_keys)
+KEYED_NAMES_SQL = (
+    "SELECT n.name, k.name_key, n.rows FROM ("
+    " SELECT {col} AS name, COUNT(*) AS rows FROM {table}"
+    " WHERE {col} IS NOT NULL AND btrim({col}::text) <> ''"
+    " GROUP BY 1"
+    ") n LEFT JOIN institution_name_keys k ON k.name = n.name"
+)
+
+
+def match_settings() -> dict:
+    return {
+        "threshold": setting("near_duplicate_threshold", "NEAR_DUPLICATE_THRESHOLD", 0.85, float),
+        "max_block_size": setting("near_duplicate_max_block_size", "NEAR_DUPLICATE_MAX_BLOCK_SIZE", 200, int),
+        "block_tokens": setting("near_duplicate_block_tokens", "NEAR_DUPLICATE_BLOCK_TOKENS", 3, int),
+    }
+
+
+class TrigramIndex:
+    """Distinct character trigrams of each key as CSR arrays, for vectorized Dice scores."""
+
+    def __init__(self, keys):
+        grams = [{f" {k} "[i:i + 3] for i in range(len(k))} for k in keys]
+        self.lengths = np.fromiter((len(g) for g in grams), dtype=np.int64, count=len(grams))
+        self.indptr = np.concatenate(([0], np.cumsum(self.lengths)))
+        codes, uniques = pd.factorize(pd.Series([g for gs in grams for g in gs], dtype=object))
+        self.codes = codes.astype(np.int64)
+        self.n_codes = max(len(uniques), 1)
+
+    def _grams(self, keys):
+        """(pair position, trigram code) of every trigram of keys[i], as two flat arrays."""
+        counts = self.lengths[keys]
+        pair = np.repeat(np.arange(len(keys)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return pair, self.codes[np.repeat(self.indptr[keys], counts) + offsets]
+
+    def dice(self, left, right) -> np.ndarray:
+        """Dice coefficient 2|A∩B| / (|A|+|B|) of the trigram sets of keys left[i] and right[i].
+
+        Both sides' (pair, trigram) codes are sorted together; a trigram shared by a pair shows
+        up as two equal neighbours, so the intersections are counted without a Python loop.
+        """
+        left = np.asarray(left, dtype=np.int64)
+        right = np.asarray(right, dtype=np.int64)
+        scores = np.empty(len(left), dtype=np.float64)
+        for start in range(0, len(left), SCORE_CHUNK_SIZE):
+            lo, ro = left[start:start + SCORE_CHUNK_SIZE], right[start:start + SCORE_CHUNK_SIZE]
+            lp, lc = self._grams(lo)
+            rp, rc = self._grams(ro)
+            merged = np.sort(np.concatenate((lp * self.n_codes + lc, rp * self.n_codes + rc)))
+            shared_pairs = merged[1:][merged[1:] == merged[:-1]] // self.n_codes
+            shared = np.bincount(shared_pairs, minlength=len(lo))
+            total = self.lengths[lo] + self.lengths[ro]
+            scores[start:start + len(lo)] = np.divide(2 * shared, total, out=np.zeros(len(lo)), where=total > 0)
+        return scores
+
+
+def candidate_pairs(keys, max_block_size: int = 200, block_tokens: int = 3) -> pd.DataFrame:
+    """Pairs (left, right), left < right, of key positions sharing a blocking token.
+
+    Each key is blocked on its `block_tokens` rarest tokens; tokens of more than
+    `max_block_size` keys are skipped.
+    """
+    tokens = pd.DataFrame(
+        [(i, tok) for i, key in enumerate(keys) for tok in set(key.split())],
+        columns=["key", "token"],
+    )
+    if tokens.empty:
+        return pd.DataFrame({"left": np.array([], dtype=np.int64), "right": np.array([], dtype=np.int64)})
+    tokens["df"] = tokens.groupby("token")["key"].transform("size")
+    tokens = tokens[(tokens["df"] > 1) & (tokens["df"] <= max_block_size)]
+    tokens = tokens.sort_values(["key", "df", "token"]).groupby("key").head(block_tokens)
+    pairs = tokens[["token", "key"]].merge(tokens[["token", "key"]], on="token", suffixes=("_l", "_r"))
+    pairs = pairs[pairs["key_l"] < pairs["key_r"]]
+    pairs = pairs[["key_l", "key_r"]].drop_duplicates().rename(columns={"key_l": "left", "key_r": "right"})
+    return pairs.reset_index(drop=True).astype(np.int64)
+
+
+def _clusters(n: int, left, right) -> np.ndarray:
+    """Connected components of the edges (left[i], right[i]) over n nodes, as a root per node."""
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(left.tolist(), right.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.fromiter((find(x) for x in range(n)), dtype=np.int64, count=n)
+
+
+def _canonical_order(names: pd.DataFrame) -> pd.DataFrame:
+    # Most rows first; on a tie prefer the accented / mixed-case spelling, then the text
+    names = names.assign(
+        _non_ascii=names["name"].map(lambda s: sum(ord(c) > 127 for c in s)),
+        _mixed=names["name"].map(lambda s: s != s.upper() and s != s.lower()),
+    )
+    return names.sort_values(["cluster", "rows", "_non_ascii", "_mixed", "name"],
+                             ascending=[True, False, False, False, True])
+
+
+def find_candidates(names: dict, threshold: float = 0.85, max_block_size: int = 200, block_tokens: int = 3,
+                    keys: dict = None):
+    """Return (candidates, stats) for {name: rows}.
+
+    `keys` ({name: normalized key}, e.g. from institution_name_keys) saves normalizing the names
+    again; names without a key there are normalized here.
+    candidates: [{'original', 'normalized', 'score', 'cluster', 'rows'}] ranked by score.
+    """
+    frame = pd.DataFrame({"name": list(names), "rows": list(names.values())})
+    keys = keys or {}
+    frame["key"] = [keys.get(name) or normalize_name(name) for name in frame["name"]]
+    frame = frame[frame["key"] != ""]
+    keys = pd.Index(frame["key"].unique())
+    frame["key_id"] = keys.get_indexer(frame["key"])
+    stats = {"names": len(frame), "keys": len(keys), "pairs": 0, "matched_pairs": 0, "clusters": 0}
+
+    trigrams = TrigramIndex(list(keys))
+    pairs = candidate_pairs(list(keys), max_block_size, block_tokens)
+    stats["pairs"] = len(pairs)
+    scores = trigrams.dice(pairs["left"].to_numpy(), pairs["right"].to_numpy())
+    matched = pairs[scores >= threshold]
+    stats["matched_pairs"] = len(matched)
+
+    frame["cluster"] = _clusters(len(keys), matched["left"].to_numpy(), matched["right"].to_numpy())[frame["key_id"]]
+    sizes = frame.groupby("cluster")["name"].transform("size")
+    frame = _canonical_order(frame[sizes > 1])
+    if frame.empty:
+        return [], stats
+
+    canonical = frame.groupby("cluster").head(1).set_index("cluster")
+    members = frame[~frame.index.isin(frame.groupby("cluster").head(1).index)].copy()
+    members["normalized"] = canonical.loc[members["cluster"], "name"].to_numpy()
+    canonical_key = canonical.loc[members["cluster"], "key_id"].to_numpy()
+    members["score"] = trigrams.dice(members["key_id"].to_numpy(), canonical_key)
+    stats["clusters"] = int(members["cluster"].nunique())
+
+    # Dense cluster numbers in rank order of each cluster's best score
+    best = members.groupby("cluster")["score"].transform("max")
+    members = members.assign(_best=best).sort_values(["_best", "cluster", "score", "name"],
+                                                     ascending=[False, True, False, True])
+    members["cluster"] = pd.factorize(members["cluster"])[0] + 1
+    members = members.sort_values(["score", "cluster", "name"], ascending=[False, True, True])
+    candidates = [
+        {"original": name, "normalized": normalized, "score": round(float(score), 4),
+         "cluster": int(cluster), "rows": int(rows)}
+        for name, normalized, score, cluster, rows in members[["name", "normalized", "score", "cluster", "rows"]]
+        .itertuples(index=False, name=None)
+    ]
+    return candidates, stats
+
+
+def load_names(cur, column: str, table: str = SOURCE_TABLE):
+    """({name: rows}, {name: key}) of the distinct non-blank values of table.column.
+
+    The keys come from institution_name_keys when it exists ({} otherwise).
+    """
+    if not get_catalog(cur).has_table(KEYS_TABLE):
+        cur.execute(sql.SQL(NAMES_SQL).format(col=sql.Identifier(column), table=sql.Identifier(table)))
+        return {name: int(rows) for name, rows in cur.fetchall()}, {}
+    cur.execute(sql.SQL(KEYED_NAMES_SQL).format(col=sql.Identifier(column), table=sql.Identifier(table)))
+    names, keys = {}, {}
+    for name, key, rows in cur.fetchall():
+        names[name] = int(rows)
+        if key is not None:
+            keys[name] = key
+    return names, keys
+
+
+def mapped_originals(cur) -> set:
+    if not get_catalog(cur).has_table("institution_mapping"):
+        return set()
+    cur.execute("SELECT original FROM institution_mapping")
+    return {row[0] for row in cur.fetchall()}
+
+
+def near_duplicate_candidates(conn_params=None, columns=NAME_COLUMNS, threshold: float = None,
+                              max_block_size: int = None, block_tokens: int = None,
+                              include_mapped: bool = False, limit: int = None) -> dict:
+    """Propose institution_mapping candidates for near-duplicate names of institution `columns`.
+
+    Returns a report with 'candidates' ranked by score (each with its 'column'), per-column
+    statistics and the settings used. Read-only: nothing is written to the database.
+    """
+    settings = match_settings()
+    settings.update({k: v for k, v in (("threshold", threshold), ("max_block_size", max_block_size),
+                                       ("block_tokens", block_tokens)) if v is not None})
+    report = {"success": False, "table": SOURCE_TABLE, "settings": settings, "columns": {}, "candidates": [],
+              "executed": [], "skipped": [], "errors": []}
+    try:
+        with connection(conn_params) as conn:
+            try:
+                with conn.cursor() as cur:
+                    available = get_catalog(cur).column_names(SOURCE_TABLE)
+                    mapped = set() if include_mapped else mapped_originals(cur)
+                    by_original = {}
+                    for column in columns:
+                        if column not in available:
+                            report["skipped"].append(f"column {SOURCE_TABLE}.{column} does not exist")
+                            continue
+                        names, keys = load_names(cur, column)
+                        candidates, stats = find_candidates(names, keys=keys, **settings)
+                        stats["stored_keys"] = len(keys)
+                        stats["already_mapped"] = sum(c["original"] in mapped for c in candidates)
+                        report["columns"][column] = stats
+                        report["executed"].append(f"near-duplicate scan of {SOURCE_TABLE}.{column}")
+                        for cand in candidates:
+                            if cand["original"] in mapped:
+                                continue
+                            current = by_original.get(cand["original"])
+                            if current is None or cand["score"] > current["score"]:
+                                by_original[cand["original"]] = {**cand, "column": column}
+            finally:
+                conn.rollback()
+        ranked = sorted(by_original.values(), key=lambda c: (-c["score"], c["column"], c["cluster"], c["original"]))
+        report["candidates"] = ranked[:limit] if limit else ranked
+        report["success"] = True
+    except Exception as exc:
+        report["errors"].append(str(exc))
+    return report
+
+
+def write_mapping_csv(candidates, path) -> int:
+    """Write candidates in the institution_mapping.csv format (original,normalized), ranked."""
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(("original", "normalized"))
+        for cand in candidates:
+            writer.writerow((cand["original"], cand["normalized"]))
+    return len(candidates)
+
+
+def _arg(flag: str):
+    args = sys.argv[1:]
+    return args[args.index(flag) + 1] if flag in args and args.index(flag) + 1 < len(args) else None
+
+
+if __name__ == '__main__':
+    limit = _arg('--limit')
+    res = near_duplicate_candidates(limit=int(limit) if limit else None)
+    csv_path = _arg('--csv')
+    if csv_path and res['success']:
+        res['csv'] = {'path': csv_path, 'rows': write_mapping_csv(res['candidates'], csv_path)}
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
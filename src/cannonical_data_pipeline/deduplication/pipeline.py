@@ -0,0 +1,453 @@
+"""Run the deduplication pipeline steps in order, in-process or one subprocess per step.
+
+Steps executed (in order):
+  1. insert_mapping
+  2. apply_deduplication
+  3. add_columns
+  4. update_uuids
+
+The optional propagate_uuids step (deduplication.propagate_uuids) rewrites the deprecated UUIDs
+in the tables that reference institutions; it runs when listed in `steps`, e.g.
+steps=STEPS + ('propagate_uuids',). Likewise the optional dedup_tables step deduplicates the link
+tables declared in the dedup_tables setting (deduplication.dedup_tables).
+
+In-process (the default) the step functions are called directly over one shared connection, so
+config, psycopg2 and the connection are set up once instead of once per step. With atomic=True
+the whole pipeline is one transaction: it is committed after the last step and rolled back as a
+whole when a step fails. With atomic=False each step is committed as soon as it succeeds.
+
+The subprocess isolation mode runs every step as `python -m <module>` and parses the JSON the
+step prints, like the original runner did. The step's stderr is streamed while it runs instead
+of being buffered until it exits; results keep only a size-capped tail of its output.
+
+run_dag() schedules the same steps as a DAG instead: every step declares the tables it reads and
+writes (STEP_TABLES), a step depends on the earlier steps it conflicts with on a table, and
+independent branches run concurrently on a thread pool, each node on its own pooled connection
+and committed on its own. Node states are saved after every node so a failed run can be resumed
+without redoing finished nodes.
+
+Every step result carries its wall time in `seconds` and the trace of its statements (duration,
+rowcount and error of each, see infra.tracing) in `trace`; the pipeline report adds the total.
+With explain=True (in-process only) every statement of every step is also captured with
+EXPLAIN (ANALYZE, BUFFERS) and the plans are saved per step (see deduplication.explain); each
+step result then has an `explain` summary compared with the previous capture.
+"""
+import json
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timezone
+from pathlib import Path
+
+from src.cannonical_data_pipeline.deduplication.add_columns import apply_add_columns
+from src.cannonical_data_pipeline.deduplication.apply_deduplication import apply_deduplication
+from src.cannonical_data_pipeline.deduplication.dedup_tables import run_dedup_tables, spec_tables
+from src.cannonical_data_pipeline.deduplication.explain import PlanCapture
+from src.cannonical_data_pipeline.deduplication.insert_mapping import insert_mapping_csv, resolve_mapping_path
+from src.cannonical_data_pipeline.deduplication.propagate_uuids import REFERENCES, propagate_uuids
+from src.cannonical_data_pipeline.deduplication.update_uuids import apply_update_uuids
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.progress import emit, tail_text
+from src.cannonical_data_pipeline.infra.tracing import trace_step
+
+REPO_ROOT = Path(__file__).resolve().parents[3]
+STEP_TIMEOUT = 600
+DAG_MAX_WORKERS = 4
+DAG_STATE_PATH = REPO_ROOT / 'logs' / 'pipeline_state.json'
+
+STEPS = ('insert_mapping', 'apply_deduplication', 'add_columns', 'update_uuids')
+ISOLATION_MODES = ('inprocess', 'subprocess')
+
+# Extra command line arguments of a step in subprocess mode: row progress on stderr
+STEP_ARGS = {'update_uuids': ('--progress',)}
+STDERR_TAIL_LINES = 200
+
+
+def _insert_mapping(conn):
+    return insert_mapping_csv(csv_path=resolve_mapping_path(), conn=conn)
+
+
+# Step name -> callable(conn) returning the step's report dict
+STEP_FUNCTIONS = {
+    'insert_mapping': _insert_mapping,
+    'apply_deduplication': lambda conn: apply_deduplication(conn=conn),
+    'add_columns': lambda conn: apply_add_columns(conn=conn),
+    'update_uuids': lambda conn: apply_update_uuids(conn=conn),
+    'propagate_uuids': lambda conn: propagate_uuids(conn=conn),
+    'dedup_tables': lambda conn: run_dedup_tables(conn=conn),
+}
+
+
+# Step name -> tables it reads and writes (a write implies a read); the DAG edges are derived from these
+STEP_TABLES = {
+    'insert_mapping': {'reads': (), 'writes': ('institution_mapping', 'institution_mapping_rejects')},
+    'apply_deduplication': {'reads': ('institution', 'institution_mapping', 'institution_country'),
+                            'writes': ('deduplicated_institutions_kb', 'dedup_change_log', 'institution_name_keys',
+                                       'update_uuids_checkpoint')},
+    'add_columns': {'reads': ('institution_country',), 'writes': ('deduplicated_institutions_kb',)},
+    'update_uuids': {'reads': (), 'writes': ('deduplicated_institutions_kb', 'update_uuids_checkpoint')},
+    'propagate_uuids': {'reads': ('deduplicated_institutions_kb',),
+                        'writes': ('uuid_remap',) + tuple(table for table, _ in REFERENCES)},
+    'dedup_tables': spec_tables(),
+}
+
+
+def step_error(report) -> str:
+    """Return the error message of a step report, or None when the step succeeded."""
+    if not isinstance(report, dict):
+        return None
+    if report.get('error'):
+        return report['error']
+    if report.get('success') is False:
+        return '; '.join(str(e) for e in report.get('errors') or []) or 'step failed'
+    return None
+
+
+def _step_result(name: str, isolation: str) -> dict:
+    return {'name': name, 'isolation': isolation, 'seconds': None, 'json': None, 'error': None}
+
+
+def run_step(name: str, conn, capture: PlanCapture = None) -> dict:
+    """Run one step in-process on `conn` (the caller owns the transaction) and time it.
+
+    res['trace'] is the step's statement trace (see infra.tracing). With a PlanCapture the step's
+    statements are also explained and res['explain'] summarizes them.
+    """
+    res = _step_result(name, 'inprocess')
+    started = time.perf_counter()
+    with trace_step(name) as trace:
+        try:
+            if capture is None:
+                res['json'] = STEP_FUNCTIONS[name](conn)
+            else:
+                with capture.step(name, conn) as summary:
+                    res['explain'] = summary
+                    res['json'] = STEP_FUNCTIONS[name](conn)
+            res['error'] = step_error(res['json'])
+        except Exception as exc:
+            res['error'] = str(exc)
+    res['seconds'] = round(time.perf_counter() - started, 3)
+    res['trace'] = trace.summary()
+    return res
+
+
+def _row_counts(report) -> dict:
+    """The integer counters (rows inserted/updated/...) at the top level of a step report."""
+    if not isinstance(report, dict):
+        return {}
+    return {key: value for key, value in report.items() if isinstance(value, int) and not isinstance(value, bool)}
+
+
+def _step_finished(on_event, result: dict):
+    emit(on_event, 'step_finished', step=result['name'], seconds=result['seconds'], error=result['error'],
+         rows=_row_counts(result['json']))
+
+
+def _stderr_event(on_event, name: str, line: str):
+    """A JSON object line on a step's stderr is row progress (e.g. update_uuids --progress), anything else output."""
+    if line.startswith('{'):
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            emit(on_event, 'progress', step=name,
+                 **{key: value for key, value in data.items() if key not in ('kind', 'seq', 'time', 'step')})
+            return
+    emit(on_event, 'output', step=name, stream='stderr', line=line)
+
+
+def run_step_subprocess(name: str, timeout: int = STEP_TIMEOUT, on_event=None) -> dict:
+    """Run one step as `python -m <module>` in its own interpreter and parse its JSON stdout.
+
+    stderr is read line by line while the step runs: every line goes to on_event (see
+    infra.progress) and only the last STDERR_TAIL_LINES are kept. Besides the common keys the
+    result has returncode and the size-capped tails of stdout and stderr.
+    """
+    res = _step_result(name, 'subprocess')
+    res.update({'returncode': None, 'stdout': None, 'stderr': None})
+    cmd = [sys.executable, '-m', f'{__package__}.{name}', *STEP_ARGS.get(name, ())]
+    stdout = []
+    stderr = deque(maxlen=STDERR_TAIL_LINES)
+
+    def _read_stderr(stream):
+        for line in stream:
+            line = line.rstrip('\n')
+            stderr.append(line)
+            _stderr_event(on_event, name, line)
+
+    started = time.perf_counter()
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                cwd=str(REPO_ROOT))
+        readers = [threading.Thread(target=lambda: stdout.append(proc.stdout.read()), daemon=True),
+                   threading.Thread(target=_read_stderr, args=(proc.stderr,), daemon=True)]
+        for reader in readers:
+            reader.start()
+        try:
+            res['returncode'] = proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            for reader in readers:
+                reader.join()
+        output = ''.join(stdout)
+        res['stdout'] = tail_text(output)
+        res['stderr'] = tail_text('\n'.join(stderr))
+        # Try to parse JSON output from stdout
+        try:
+            res['json'] = json.loads(output) if output.strip() else None
+        except Exception:
+            res['json'] = None
+        if res['returncode'] != 0:
+            # Prefer structured error if present
+            res['error'] = step_error(res['json']) or res['stderr'].strip() or f"script exited with code {res['returncode']}"
+        else:
+            res['error'] = step_error(res['json'])
+    except subprocess.TimeoutExpired:
+        res['returncode'] = -1
+        res['stderr'] = 'timeout'
+        res['error'] = 'timeout'
+    except Exception as e:
+        res['returncode'] = -1
+        res['stderr'] = str(e)
+        res['error'] = str(e)
+    # the step may have changed the schema in its own process
+    catalog.invalidate()
+    res['seconds'] = round(time.perf_counter() - started, 3)
+    return res
+
+
+def run_pipeline(isolation: str = 'inprocess', atomic: bool = True, continue_on_error: bool = False,
+                 conn_params=None, steps=STEPS, noop: bool = False, explain: bool = False, on_event=None) -> dict:
+    """Run `steps` in order and return a combined report.
+
+    Report keys: success, isolation, atomic, committed, seconds (total wall time) and steps (one
+    result per step with name, isolation, seconds, json, error). Steps that did not run because
+    an earlier one failed are listed with skipped=True.
+
+    A failed step stops the pipeline unless continue_on_error is set; an atomic in-process run
+    always stops, since the failed step aborted the shared transaction.
+
+    explain=True captures the plans of every statement (see the module docstring); the report
+    then has plans_dir with the saved plans.
+
+    on_event(kind, **fields), e.g. an infra.progress.ProgressLog, receives step_started and
+    step_finished (seconds, error, row counters) events while the pipeline runs, plus the row
+    progress and output lines of subprocess steps.
+    """
+    if isolation not in ISOLATION_MODES:
+        raise ValueError(f"Unknown isolation mode: {isolation} (expected one of {', '.join(ISOLATION_MODES)})")
+    if explain and isolation != 'inprocess':
+        raise ValueError("Plan capture (explain) needs the inprocess isolation mode")
+    unknown = [name for name in steps if name not in STEP_FUNCTIONS]
+    if unknown:
+        raise ValueError(f"Unknown pipeline step(s): {', '.join(unknown)}")
+
+    atomic = atomic and isolation == 'inprocess'
+    overall = {'success': True, 'isolation': isolation, 'atomic': atomic, 'committed': False,
+               'seconds': None, 'steps': []}
+    capture = PlanCapture() if explain and not noop else None
+    if capture is not None:
+        overall['plans_dir'] = str(capture.run_dir)
+    started = time.perf_counter()
+
+    def _skip_rest(index):
+        for name in steps[index:]:
+            skipped = _step_result(name, isolation)
+            skipped['skipped'] = True
+            overall['steps'].append(skipped)
+
+    if noop:
+        _skip_rest(0)
+        overall['seconds'] = 0.0
+        return overall
+
+    if isolation == 'subprocess':
+        for index, name in enumerate(steps):
+            emit(on_event, 'step_started', step=name, index=index, total=len(steps))
+            result = run_step_subprocess(name, on_event=on_event)
+            _step_finished(on_event, result)
+            overall['steps'].append(result)
+            if result['error']:
+                overall['success'] = False
+                if not continue_on_error:
+                    _skip_rest(index + 1)
+                    break
+        overall['committed'] = overall['success']
+        overall['seconds'] = round(time.perf_counter() - started, 3)
+        return overall
+
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        for index, name in enumerate(steps):
+            emit(on_event, 'step_started', step=name, index=index, total=len(steps))
+            result = run_step(name, conn, capture)
+            _step_finished(on_event, result)
+            overall['steps'].append(result)
+            if not result['error']:
+                if not atomic:
+                    conn.commit()
+                continue
+            overall['success'] = False
+            conn.rollback()
+            if atomic or not continue_on_error:
+                _skip_rest(index + 1)
+                break
+        if atomic and overall['success']:
+            conn.commit()
+        overall['committed'] = overall['success'] or not atomic
+    except Exception as exc:
+        overall['success'] = False
+        overall['error'] = str(exc)
+        try:
+            if conn is not None:
+                conn.rollback()
+        except Exception:
+            pass
+    finally:
+        # schema info cached inside the transaction may describe DDL that was rolled back
+        catalog.invalidate()
+        release_connection(conn)
+
+    overall['seconds'] = round(time.perf_counter() - started, 3)
+    return overall
+
+
+def build_dag(steps=STEPS, tables=None) -> dict:
+    """Return {step: set of steps it depends on} for `steps` in their declared order.
+
+    A step depends on every earlier step that writes a table it reads or writes, or that reads a
+    table it writes; steps that touch disjoint tables (or only read the same ones) are independent.
+    """
+    tables = STEP_TABLES if tables is None else tables
+    missing = [name for name in steps if name not in tables]
+    if missing:
+        raise ValueError(f"No table declaration for pipeline step(s): {', '.join(missing)}")
+
+    dag = {}
+    for index, name in enumerate(steps):
+        writes = set(tables[name]['writes'])
+        touches = writes | set(tables[name]['reads'])
+        dag[name] = {
+            earlier for earlier in steps[:index]
+            if set(tables[earlier]['writes']) & touches or set(tables[earlier]['reads']) & writes
+        }
+    return dag
+
+
+def load_dag_state(state_path=DAG_STATE_PATH) -> dict:
+    """Return the saved {step: status} of the last DAG run, or {} when there is none."""
+    try:
+        with open(state_path, encoding='utf-8') as fh:
+            return json.load(fh).get('nodes', {})
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_dag_state(state_path, nodes: dict):
+    if state_path is None:
+        return
+    path = Path(state_path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        json.dump({'updated': datetime.now(timezone.utc).isoformat(), 'nodes': nodes}, fh, indent=2)
+    tmp.replace(path)
+
+
+def _run_node(name: str, conn_params=None, capture: PlanCapture = None) -> dict:
+    """Run one DAG node on its own connection and commit it, or roll it back on failure."""
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        result = run_step(name, conn, capture)
+        if result['error']:
+            conn.rollback()
+        else:
+            conn.commit()
+        return result
+    except Exception as exc:
+        result = _step_result(name, 'inprocess')
+        result['error'] = str(exc)
+        try:
+            if conn is not None:
+                conn.rollback()
+        except Exception:
+            pass
+        return result
+    finally:
+        catalog.invalidate()
+        release_connection(conn)
+
+
+def run_dag(steps=STEPS, max_workers: int = DAG_MAX_WORKERS, resume: bool = False,
+            state_path=DAG_STATE_PATH, conn_params=None, tables=None, explain: bool = False,
+            on_event=None) -> dict:
+    """Run `steps` as a DAG (see build_dag), independent branches concurrently.
+
+    Each node runs in-process on its own connection and is committed when it succeeds. A failed
+    node blocks only the nodes that depend on it; independent branches run to completion.
+    Node states (done/failed/blocked) are saved to `state_path` after every node. With
+    resume=True nodes recorded as done by the previous run are not run again, so the run picks
+    up at the first failed node.
+
+    Report keys: success, max_workers, resumed (nodes taken from the saved state), seconds,
+    nodes ({step: status}) and steps (results of the nodes run, in completion order).
+    explain=True captures the plans of every node like run_pipeline does (plans_dir), and
+    on_event receives the step_started/step_finished events of the nodes.
+    """
+    dag = build_dag(steps, tables)
+    previous = load_dag_state(state_path) if resume and state_path is not None else {}
+    nodes = {name: 'done' if previous.get(name) == 'done' else 'pending' for name in steps}
+    overall = {'success': True, 'max_workers': max_workers,
+               'resumed': [name for name, status in nodes.items() if status == 'done'],
+               'seconds': None, 'nodes': nodes, 'steps': []}
+    capture = PlanCapture() if explain else None
+    if capture is not None:
+        overall['plans_dir'] = str(capture.run_dir)
+    started = time.perf_counter()
+
+    def _ready():
+        return [name for name in steps if nodes[name] == 'pending'
+                and all(nodes[dep] == 'done' for dep in dag[name])]
+
+    def _block_dependents():
+        changed = True
+        while changed:
+            changed = False
+            for name in steps:
+                if nodes[name] == 'pending' and any(nodes[dep] in ('failed', 'blocked') for dep in dag[name]):
+                    nodes[name] = 'blocked'
+                    changed = True
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers), thread_name_prefix='pipeline') as pool:
+        running = {}
+        while True:
+            for name in _ready():
+                nodes[name] = 'running'
+                emit(on_event, 'step_started', step=name)
+                running[pool.submit(_run_node, name, conn_params, capture)] = name
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                result = future.result()
+                _step_finished(on_event, result)
+                overall['steps'].append(result)
+                # node states are only touched here, on the scheduling thread
+                nodes[name] = 'failed' if result['error'] else 'done'
+                _block_dependents()
+                _save_dag_state(state_path, nodes)
+
+    overall['success'] = all(status == 'done' for status in nodes.values())
+    overall['seconds'] = round(time.perf_counter() - started, 3)
+    return overall
@@ -0,0 +1,316 @@
+"""Propagate the normalized institution UUIDs to the tables that reference institutions.
+
+update_uuids rewrites uuid_institution inside deduplicated_institutions_kb only and keeps the
+previous value in uuid_deprecated. This stage builds the old -> new map from those two columns
+once (the unlogged table uuid_remap, with chains of successive normalizations resolved to
+their last UUID) and rewrites every referencing column listed in REFERENCES with set-based
+UPDATEs, in batches of old UUIDs (keyset on uuid_remap.old_uuid).
+
+Referencing columns that are part of a primary key (e.g. individual_institution's
+(uuid_institution, uuid_rda_member)) can collide: the canonical UUID may already have a row
+with the same remaining key, or two deprecated UUIDs of one batch map to the same canonical
+one. Such rows are conflicts and handled by the conflict strategy:
+  - skip (default): the row keeps its deprecated UUID and is counted as a conflict
+  - delete: the row is a duplicate of the canonical row and is deleted
+Note that institution_country is keyed by uuid_institution alone and is read by add_columns
+and apply_deduplication for the uuid_country of every institution row: with `delete` the
+deprecated UUIDs of the institution table lose their country row.
+
+Run standalone, every table is handled by its own worker on its own pooled connection and
+every batch is committed, so the tables are rewritten in parallel with short transactions;
+the run is idempotent, an interrupted run is completed by running it again. With `conn` (the
+pipeline) the tables are rewritten one after the other in the caller's transaction.
+"""
+import contextvars
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import sql
+
+from src.cannonical_data_pipeline.deduplication.update_uuids import DEDUP_TABLE
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.tracing import traced
+
+# (table, referencing column) pairs rewritten from deprecated to normalized UUIDs
+REFERENCES = (
+    ("individual_institution", "uuid_institution"),
+    ("institution_country", "uuid_institution"),
+    ("institution_institution_role", "UUID_Institution"),
+    ("institution_organisation_type", "uuid_institution"),
+    ("website_member_institutions", "kb_uuid"),
+)
+
+CONFLICT_STRATEGIES = ("skip", "delete")
+
+MAP_TABLE = "uuid_remap"
+
+# Successive normalizations chained at most this deep are resolved to their last UUID
+MAX_CHAIN_DEPTH = 10
+
+# Serializes propagation runs: they share uuid_remap
+LOCK_KEY = "propagate_uuids"
+
+# The statements below are sql.SQL templates: {remap} is uuid_remap in the stage's schema
+MAP_SQL = """
+CREATE UNLOGGED TABLE IF NOT EXISTS {remap} (
+    old_uuid TEXT PRIMARY KEY,
+    new_uuid TEXT NOT NULL
+);
+TRUNCATE {remap};
+INSERT INTO {remap} (old_uuid, new_uuid)
+SELECT DISTINCT ON (uuid_deprecated) uuid_deprecated, uuid_institution
+FROM {table}
+WHERE uuid_deprecated IS NOT NULL AND uuid_institution IS NOT NULL AND uuid_deprecated <> uuid_institution
+ORDER BY uuid_deprecated, uuid_institution;
+ANALYZE {remap};
+"""
+
+RESOLVE_CHAINS_SQL = """
+UPDATE {remap} m SET new_uuid = n.new_uuid
+FROM {remap} n
+WHERE m.new_uuid = n.old_uuid AND n.new_uuid <> m.old_uuid
+"""
+
+NEXT_BATCH_SQL = """
+SELECT MAX(old_uuid), COUNT(*) FROM (
+    SELECT old_uuid FROM {remap}
+    WHERE %(after)s::text IS NULL OR old_uuid > %(after)s
+    ORDER BY old_uuid
+    LIMIT %(limit)s
+) b
+"""
+
+# One batch of one table. {keys}: the other primary key columns of the referencing column;
+# a candidate conflicts when the canonical UUID already has a row with the same keys ("taken")
+# or an earlier deprecated UUID of the batch claims it ("rank" > 1).
+REWRITE_SQL = """
+WITH batch AS (
+    SELECT old_uuid, new_uuid FROM {remap}
+    WHERE (%(after)s::text IS NULL OR old_uuid > %(after)s) AND old_uuid <= %(upto)s
+), candidates AS (
+    SELECT b.old_uuid, b.new_uuid{key_select},
+           {rank} AS rank,
+           {taken} AS taken
+    FROM {table} t JOIN batch b ON t.{column} = b.old_uuid
+), rewritten AS (
+    UPDATE {table} t SET {column} = c.new_uuid
+    FROM candidates c
+    WHERE t.{column} = c.old_uuid{key_match} AND c.rank = 1 AND NOT c.taken
+    RETURNING 1
+){deleted}
+SELECT (SELECT COUNT(*) FROM rewritten), (SELECT COUNT(*) FROM candidates WHERE rank > 1 OR taken), {deleted_count}
+"""
+
+DELETED_CTE = """, deleted AS (
+    DELETE FROM {table} t
+    USING candidates c
+    WHERE t.{column} = c.old_uuid{key_match} AND (c.rank > 1 OR c.taken)
+    RETURNING 1
+)"""
+
+
+def _settings() -> dict:
+    return {
+        "batch_size": setting("propagate_uuids_batch_size", "PROPAGATE_UUIDS_BATCH_SIZE", 5000, int),
+        "max_workers": setting("propagate_uuids_max_workers", "PROPAGATE_UUIDS_MAX_WORKERS", 4, int),
+        "conflict": setting("propagate_uuids_conflict", "PROPAGATE_UUIDS_CONFLICT", "skip", str),
+    }
+
+
+def _remap(schema: str) -> sql.Identifier:
+    return sql.Identifier(schema, MAP_TABLE)
+
+
+def rewrite_sql(table: str, column: str, keys=(), conflict: str = "skip", schema: str = "public") -> sql.Composed:
+    """The batch statement of one referencing column; `keys` are the other primary key columns."""
+    if conflict not in CONFLICT_STRATEGIES:
+        raise ValueError(f"Unknown conflict strategy: {conflict} (expected one of {', '.join(CONFLICT_STRATEGIES)})")
+    tbl, col = sql.Identifier(schema, table), sql.Identifier(column)
+    key_ids = [sql.Identifier(k) for k in keys or ()]
+    key_select = sql.SQL("").join(sql.SQL(", t.{0}").format(k) for k in key_ids)
+    key_match = sql.SQL("").join(sql.SQL(" AND t.{0} = c.{0}").format(k) for k in key_ids)
+    if keys is None:
+        # the column is not part of a key: nothing can collide
+        rank, taken = sql.SQL("1"), sql.SQL("FALSE")
+        key_select = key_match = sql.SQL("")
+    else:
+        rank = sql.SQL("ROW_NUMBER() OVER (PARTITION BY {0} ORDER BY b.old_uuid)").format(
+            sql.SQL(", ").join([sql.SQL("b.new_uuid")] + [sql.SQL("t.{0}").format(k) for k in key_ids]))
+        taken = sql.SQL("EXISTS (SELECT 1 FROM {0} x WHERE x.{1} = b.new_uuid{2})").format(
+            tbl, col, sql.SQL("").join(sql.SQL(" AND x.{0} = t.{0}").format(k) for k in key_ids))
+    deleted, deleted_count = sql.SQL(""), sql.SQL("0")
+    if conflict == "delete":
+        deleted = sql.SQL(DELETED_CTE).format(table=tbl, column=col, key_match=key_match)
+        deleted_count = sql.SQL("(SELECT COUNT(*) FROM deleted)")
+    return sql.SQL(REWRITE_SQL).format(remap=_remap(schema), table=tbl, column=col, key_select=key_select,
+                                       key_match=key_match, rank=rank, taken=taken, deleted=deleted,
+                                       deleted_count=deleted_count)
+
+
+def build_uuid_map(cur, schema: str = "public", table: str = DEDUP_TABLE) -> dict:
+    """(Re)build uuid_remap from `table`'s uuid_deprecated -> uuid_institution; returns its stats."""
+    remap = _remap(schema)
+    cur.execute(sql.SQL(MAP_SQL).format(remap=remap, table=sql.Identifier(schema, table)))
+    chained = 0
+    for _ in range(MAX_CHAIN_DEPTH):
+        cur.execute(sql.SQL(RESOLVE_CHAINS_SQL).format(remap=remap))
+        if not cur.rowcount:
+            break
+        chained += cur.rowcount
+    cur.execute(sql.SQL("DELETE FROM {} WHERE old_uuid = new_uuid;").format(remap))
+    cur.execute(sql.SQL("SELECT COUNT(*) FROM {};").format(remap))
+    return {"uuids": cur.fetchone()[0], "chained": chained}
+
+
+def _reference_keys(schema_catalog, table: str, column: str):
+    """The other primary key columns of `column`, or None when it is not part of the key."""
+    primary_key = schema_catalog.primary_key(table)
+    if column not in primary_key:
+        return None
+    return tuple(k for k in primary_key if k != column)
+
+
+def propagate_table(conn, table: str, column: str, keys, conflict: str, batch_size: int,
+                    commit: bool = False, schema: str = "public") -> dict:
+    """Rewrite one referencing column batch by batch; commit=True commits every batch."""
+    stats = {"column": column, "rewritten": 0, "conflicts": 0, "deleted": 0, "batches": 0, "seconds": None}
+    query = rewrite_sql(table, column, keys, conflict, schema)
+    next_batch = sql.SQL(NEXT_BATCH_SQL).format(remap=_remap(schema))
+    started = time.perf_counter()
+    after = None
+    while True:
+        with conn.cursor() as cur:
+            params = {"after": after, "limit": batch_size}
+            cur.execute(next_batch, params)
+            upto, _ = cur.fetchone()
+            if upto is None:
+                break
+            params["upto"] = upto
+            cur.execute(query, params)
+            rewritten, conflicts, deleted = cur.fetchone()
+        if commit:
+            conn.commit()
+        after = upto
+        stats["batches"] += 1
+        stats["rewritten"] += rewritten
+        stats["conflicts"] += conflicts
+        stats["deleted"] += deleted
+    stats["seconds"] = round(time.perf_counter() - started, 3)
+    return stats
+
+
+def _table_worker(conn_params, schema: str, table: str, column: str, keys, conflict: str, batch_size: int) -> dict:
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        return propagate_table(conn, table, column, keys, conflict, batch_size, commit=True, schema=schema)
+    except Exception:
+        if conn is not None:
+            conn.rollback()
+        raise
+    finally:
+        release_connection(conn)
+
+
+def propagate_uuids(conn_params=None, schema: str = "public", table: str = DEDUP_TABLE, conn=None,
+                    conflict: str = None, batch_size: int = None, max_workers: int = None,
+                    references=REFERENCES) -> dict:
+    """Rewrite the deprecated institution UUIDs of every table in `references`.
+
+    Defaults come from the propagate_uuids_conflict/_batch_size/_max_workers settings. Returns
+    a dict with keys: success, updated (rows rewritten in all tables), map ({'uuids', 'chained'}),
+    tables ({table: {'column', 'rewritten', 'conflicts', 'deleted', 'batches', 'seconds'}}),
+    executed, skipped and errors. Missing tables or columns are skipped.
+    """
+    settings = _settings()
+    conflict = conflict or settings["conflict"]
+    batch_size = batch_size or settings["batch_size"]
+    max_workers = max_workers or settings["max_workers"]
+    report = {"success": False, "updated": 0, "map": None, "tables": {}, "executed": [], "skipped": [],
+              "errors": []}
+    if conflict not in CONFLICT_STRATEGIES:
+        report["errors"].append(f"unknown conflict strategy: {conflict}")
+        return report
+
+    own_conn = conn is None
+    locked = False
+    try:
+        if own_conn:
+            conn = acquire_connection(conn_params)
+        with conn.cursor() as cur:
+            schema_catalog = get_catalog(cur, schema)
+            if not schema_catalog.has_column(table, "uuid_deprecated"):
+                report["errors"].append(f"table {schema}.{table} has no 'uuid_deprecated' column; run update_uuids first")
+                return report
+            # a session lock outlives the map's commit; in the caller's transaction it ends with it
+            lock = "pg_try_advisory_lock" if own_conn else "pg_try_advisory_xact_lock"
+            cur.execute(f"SELECT {lock}(hashtext(%s));", (LOCK_KEY,))
+            locked = cur.fetchone()[0]
+            if not locked:
+                report["errors"].append("another UUID propagation is running")
+                return report
+            report["map"] = build_uuid_map(cur, schema, table)
+            report["executed"].append(f"build {MAP_TABLE}")
+
+        targets = []
+        for ref_table, column in references:
+            if not schema_catalog.has_column(ref_table, column):
+                report["skipped"].append(f"{ref_table}.{column} does not exist")
+                continue
+            targets.append((ref_table, column, _reference_keys(schema_catalog, ref_table, column)))
+
+        if not own_conn:
+            for ref_table, column, keys in targets:
+                report["tables"][ref_table] = propagate_table(conn, ref_table, column, keys, conflict, batch_size,
+                                                              schema=schema)
+        else:
+            # the workers read the committed map from their own connections
+            conn.commit()
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(targets) or 1)),
+                                    thread_name_prefix="propagate") as pool:
+                # each worker runs in a copy of this context, so its statements land in the step's trace
+                futures = {ref_table: pool.submit(contextvars.copy_context().run, _table_worker, conn_params, schema,
+                                                  ref_table, column, keys, conflict, batch_size)
+                           for ref_table, column, keys in targets}
+                for ref_table, future in futures.items():
+                    try:
+                        report["tables"][ref_table] = future.result()
+                    except Exception as exc:
+                        report["errors"].append(f"{ref_table}: {exc}")
+        for ref_table, stats in report["tables"].items():
+            report["executed"].append(f"rewrite {ref_table}.{stats['column']}")
+        report["updated"] = sum(stats["rewritten"] for stats in report["tables"].values())
+        report["success"] = len(report["errors"]) == 0
+    except Exception as exc:
+        report["errors"].append(str(exc))
+        if own_conn and conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+    finally:
+        if own_conn:
+            if locked:
+                try:
+                    conn.rollback()
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT pg_advisory_unlock(hashtext(%s));", (LOCK_KEY,))
+                    conn.commit()
+                except Exception:
+                    pass
+            release_connection(conn)
+
+    return report
+
+
+if __name__ == '__main__':
+    # python -m ...propagate_uuids [--conflict skip|delete]
+    args = sys.argv[1:]
+    res = traced('propagate_uuids', propagate_uuids,
+                 conflict=args[args.index('--conflict') + 1] if '--conflict' in args else None)
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
@@ -0,0 +1,183 @@
+import json
+import sys
+import time
+
+try:
+    from psycopg2 import errors as pg_errors
+except Exception:
+    pg_errors = None
+
+from src.cannonical_data_pipeline.deduplication.add_columns import add_columns_to_table
+from src.cannonical_data_pipeline.deduplication.apply_deduplication import INSERT_SELECT
+from src.cannonical_data_pipeline.deduplication.indexes import ensure_indexes
+from src.cannonical_data_pipeline.deduplication.name_keys import refresh_name_keys
+from src.cannonical_data_pipeline.deduplication.update_uuids import update_uuids_in_table
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+
+
+DEDUP_TABLE = "deduplicated_institutions_kb"
+SHADOW_SUFFIX = "_shadow"
+
+# The swap waits at most this long for readers to release the live table, then retries,
+# so a long-running reader never makes new readers queue behind the rename.
+SWAP_LOCK_TIMEOUT = "2s"
+SWAP_ATTEMPTS = 5
+SWAP_RETRY_DELAY = 1.0
+
+
+def _shadow_index_name(name: str) -> str:
+    return f"{name[:63 - len(SHADOW_SUFFIX)]}{SHADOW_SUFFIX}"
+
+
+def _shadow_index_def(indexdef: str, name: str, live: str, shadow: str) -> str:
+    """Rewrite a pg_get_indexdef() statement of the live table to target the shadow table."""
+    head, sep, tail = indexdef.partition(" ON ")
+    head = head[: head.rindex(name)] + _shadow_index_name(name)
+    # pg_get_indexdef qualifies the table: "ON [ONLY] schema.table USING ..."
+    tail = tail.replace(live, shadow, 1)
+    return head + sep + tail
+
+
+def build_shadow(cur, schema: str = "public", report: dict = None) -> dict:
+    """Build the fully prepared shadow table with `cur` in the caller's transaction.
+
+    Refreshes the name keys (deduplication.name_keys), runs the deduplication SELECT, the
+    add_columns steps (uuid_country, uuid_deprecated, id PK), the UUID normalization, recreates the live table's secondary indexes and adds the supporting
+    indexes it lacks (deduplication.indexes). Returns a dict
+    {'indexes': [(live_name, shadow_name)], 'changes': [change_id, ...]}; raises on failure.
+    """
+    report = report if report is not None else {"executed": [], "skipped": [], "errors": []}
+    live = f"{schema}.{DEDUP_TABLE}"
+    shadow_tbl = f"{DEDUP_TABLE}{SHADOW_SUFFIX}"
+    shadow = f"{schema}.{shadow_tbl}"
+
+    # Secondary indexes of the live table, recreated on the shadow table below; reloaded in this
+    # transaction's snapshot so an index created since the catalog was cached is not lost
+    live_indexes = [(i["name"], i["definition"])
+                    for i in catalog.get_catalog(cur, schema, refresh=True).indexes(DEDUP_TABLE) if not i["primary"]]
+
+    report["name_keys"] = refresh_name_keys(cur, prune=True)
+    cur.execute(f"DROP TABLE IF EXISTS {shadow};")
+    cur.execute(f"CREATE TABLE {shadow} AS" + INSERT_SELECT.format(extra_select="", extra_join="", key_filter=""))
+    catalog.invalidate(schema)
+    report["executed"].append(f"CREATE TABLE {shadow} AS SELECT")
+
+    add_columns_to_table(cur, schema, shadow_tbl, report)
+    if report["errors"]:
+        raise RuntimeError(f"add_columns failed on {shadow}: {report['errors']}")
+
+    uuids = {"executed": [], "skipped": [], "errors": [], "updated": 0}
+    update_uuids_in_table(cur, schema, shadow_tbl, uuids)
+    if uuids["errors"]:
+        raise RuntimeError(f"update_uuids failed on {shadow}: {uuids['errors']}")
+    report["executed"].extend(uuids["executed"])
+    report["updated"] = uuids["updated"]
+
+    indexes = []
+    for name, indexdef in live_indexes:
+        cur.execute(_shadow_index_def(indexdef, name, live, shadow))
+        indexes.append((name, _shadow_index_name(name)))
+        report["executed"].append(f"CREATE INDEX {_shadow_index_name(name)}")
+    catalog.invalidate(schema)
+
+    # Supporting indexes the live table lacks (e.g. on the first rebuild)
+    indexes.extend(ensure_indexes(cur, schema, tables=(DEDUP_TABLE,), report=report, target=shadow_tbl,
+                                  rename=_shadow_index_name))
+    if report["errors"]:
+        raise RuntimeError(f"supporting indexes failed on {shadow}: {report['errors']}")
+
+    cur.execute(f"ANALYZE {shadow};")
+
+    # Changes visible to this snapshot are covered by the rebuild; the swap consumes them
+    changes = []
+    if catalog.get_catalog(cur, schema).has_table("dedup_change_log"):
+        cur.execute("SELECT change_id FROM dedup_change_log;")
+        changes = [r[0] for r in cur.fetchall()]
+    return {"indexes": indexes, "changes": changes}
+
+
+def swap_shadow(cur, schema: str, indexes, changes) -> None:
+    """Replace the live table by the shadow table in the caller's (short) transaction."""
+    live_tbl = DEDUP_TABLE
+    shadow_tbl = f"{DEDUP_TABLE}{SHADOW_SUFFIX}"
+    cur.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}';")
+    cur.execute(f"DROP TABLE IF EXISTS {schema}.{live_tbl};")
+    cur.execute(f"ALTER TABLE {schema}.{shadow_tbl} RENAME TO {live_tbl};")
+    cur.execute(f"ALTER TABLE {schema}.{live_tbl} RENAME CONSTRAINT {shadow_tbl}_pkey TO {live_tbl}_pkey;")
+    cur.execute(f"ALTER SEQUENCE {schema}.{shadow_tbl}_id_seq RENAME TO {live_tbl}_id_seq;")
+    for live_name, shadow_name in indexes:
+        cur.execute(f"ALTER INDEX {schema}.{shadow_name} RENAME TO {live_name};")
+    if changes:
+        cur.execute("DELETE FROM dedup_change_log WHERE change_id = ANY(%s);", (changes,))
+
+
+def rebuild_deduplication_shadow(conn_params=None, schema: str = "public"):
+    """Rebuild deduplicated_institutions_kb off the read path and swap it in atomically.
+
+    The shadow table is built and fully prepared (columns, uuid_country, UUID normalization,
+    indexes) in one REPEATABLE READ transaction that never touches the live table, so readers
+    keep using the old table meanwhile. A single short transaction then drops the live table
+    and renames the shadow table, its primary key, sequence and indexes into place; readers
+    see either the complete old table or the complete new one. The swap uses a lock timeout
+    and is retried so it never makes readers queue behind it for long.
+
+    Returns a dict with keys: success, table, mode, executed, skipped, errors, updated,
+    build_seconds, swap_seconds, swap_attempts.
+    """
+    report = {"success": False, "table": DEDUP_TABLE, "mode": "shadow", "executed": [], "skipped": [],
+              "errors": [], "updated": 0, "build_seconds": None, "swap_seconds": None, "swap_attempts": 0}
+
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        conn.set_session(isolation_level='REPEATABLE READ')
+        started = time.monotonic()
+        try:
+            with conn.cursor() as cur:
+                built = build_shadow(cur, schema, report)
+            conn.commit()
+        except Exception as exc:
+            report["errors"].append(f"shadow build failed: {exc}")
+            conn.rollback()
+            return report
+        finally:
+            conn.set_session(isolation_level='DEFAULT')
+        report["build_seconds"] = round(time.monotonic() - started, 3)
+
+        started = time.monotonic()
+        for attempt in range(1, SWAP_ATTEMPTS + 1):
+            report["swap_attempts"] = attempt
+            try:
+                with conn.cursor() as cur:
+                    swap_shadow(cur, schema, built["indexes"], built["changes"])
+                conn.commit()
+                report["executed"].append(f"SWAP {DEDUP_TABLE}{SHADOW_SUFFIX} -> {DEDUP_TABLE}")
+                break
+            except pg_errors.LockNotAvailable:
+                conn.rollback()
+                if attempt == SWAP_ATTEMPTS:
+                    report["errors"].append(f"swap gave up after {attempt} attempts waiting for readers")
+                    return report
+                time.sleep(SWAP_RETRY_DELAY * attempt)
+        report["swap_seconds"] = round(time.monotonic() - started, 3)
+        report["success"] = True
+    except Exception as exc:
+        report["errors"].append(str(exc))
+        try:
+            if conn is not None:
+                conn.rollback()
+        except Exception:
+            pass
+    finally:
+        # the shadow table was created, renamed or dropped again by a rollback
+        catalog.invalidate(schema)
+        release_connection(conn)
+
+    return report
+
+
+if __name__ == '__main__':
+    res = rebuild_deduplication_shadow()
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
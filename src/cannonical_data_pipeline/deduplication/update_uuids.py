@@ -1,18 +1,26 @@
 import json
 import sys
+import time
 
-import psycopg2
+try:
+    from psycopg2 import errors as pg_errors
+except Exception:
+    pg_errors = None
 
-from src.cannonical_data_pipeline.infra.db import get_conn_params
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+from src.cannonical_data_pipeline.infra.tracing import traced
 
 
-SQL_UPDATE = """
+SQL_UPDATE_TEMPLATE = """
 WITH normalized_uuids AS (
     SELECT
         MIN(uuid_institution) AS normalized_uuid,
         institution,
         uuid_country
-    FROM deduplicated_institutions_kb
+    FROM {table}{group_filter}
     GROUP BY institution, uuid_country
 ),
 records_to_update AS (
@@ -20,7 +28,7 @@ records_to_update AS (
         inst.id,
         inst.uuid_institution AS old_uuid,
         norm.normalized_uuid
-    FROM deduplicated_institutions_kb inst
+    FROM {table} inst
     JOIN normalized_uuids norm
         ON inst.institution = norm.institution
         AND (
@@ -29,10 +37,10 @@ records_to_update AS (
         )
     WHERE 
         inst.was_deduplicated = TRUE
-        AND (inst.uuid_institution IS DISTINCT FROM norm.normalized_uuid)
+        AND (inst.uuid_institution IS DISTINCT FROM norm.normalized_uuid){row_filter}
 )
 
-UPDATE deduplicated_institutions_kb inst
+UPDATE {table} inst
 SET 
     uuid_deprecated = r.old_uuid,
     uuid_institution = r.normalized_uuid
@@ -40,76 +48,264 @@ FROM records_to_update r
 WHERE inst.id = r.id;
 """
 
+DEDUP_TABLE = "deduplicated_institutions_kb"
 
-def table_exists(cur, schema: str, table: str) -> bool:
-    cur.execute("SELECT to_regclass(%s);", (f"{schema}.{table}",))
-    return cur.fetchone()[0] is not None
+SQL_UPDATE = SQL_UPDATE_TEMPLATE.format(table=DEDUP_TABLE, group_filter="", row_filter="")
 
+# Chunked mode: the groups of the institutions in (%(after)s, %(upto)s]; a group is keyed by
+# (institution, uuid_country), so a batch of whole institutions is a batch of whole groups
+CHUNK_GROUP_FILTER = """
+    WHERE (%(after)s::text IS NULL OR institution > %(after)s) AND institution <= %(upto)s"""
+CHUNK_ROW_FILTER = """
+        AND (%(after)s::text IS NULL OR inst.institution > %(after)s) AND inst.institution <= %(upto)s"""
 
-def column_exists(cur, schema: str, table: str, column: str) -> bool:
-    cur.execute(
-        "SELECT 1 FROM information_schema.columns WHERE table_schema=%s AND table_name=%s AND column_name=%s;",
-        (schema, table, column),
-    )
-    return cur.fetchone() is not None
+# Last institution of the next batch of `limit` distinct institutions (an index range scan on
+# the (institution, uuid_country) supporting index)
+NEXT_BATCH_SQL = """
+SELECT MAX(institution), COUNT(*) FROM (
+    SELECT DISTINCT institution FROM {table}
+    WHERE institution IS NOT NULL AND (%(after)s::text IS NULL OR institution > %(after)s)
+    ORDER BY institution
+    LIMIT %(limit)s
+) b
+"""
+
+REMAINING_SQL = """
+SELECT COUNT(DISTINCT institution) FROM {table}
+WHERE institution IS NOT NULL AND (%(after)s::text IS NULL OR institution > %(after)s)
+"""
+
+# One checkpoint per table; relid ties it to the table it was written for, so a checkpoint of a
+# table that has since been re-created (full rebuild, shadow swap) is not resumed
+CHECKPOINT_SQL = """
+CREATE TABLE IF NOT EXISTS update_uuids_checkpoint (
+    table_name TEXT PRIMARY KEY,
+    relid OID NOT NULL,
+    last_institution TEXT,
+    batches INTEGER NOT NULL DEFAULT 0,
+    updated_rows BIGINT NOT NULL DEFAULT 0,
+    started_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMPTZ
+)
+"""
+
+LOAD_CHECKPOINT_SQL = """
+SELECT relid, last_institution, batches, updated_rows, finished_at
+FROM update_uuids_checkpoint WHERE table_name = %s
+"""
+
+START_CHECKPOINT_SQL = """
+INSERT INTO update_uuids_checkpoint (table_name, relid) VALUES (%s, %s)
+ON CONFLICT (table_name) DO UPDATE SET
+    relid = EXCLUDED.relid, last_institution = NULL, batches = 0, updated_rows = 0,
+    started_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP, finished_at = NULL
+"""
+
+SAVE_CHECKPOINT_SQL = """
+UPDATE update_uuids_checkpoint
+SET last_institution = %(upto)s, batches = batches + 1, updated_rows = updated_rows + %(updated)s,
+    updated_at = CURRENT_TIMESTAMP
+WHERE table_name = %(table)s
+"""
+
+FINISH_CHECKPOINT_SQL = """
+UPDATE update_uuids_checkpoint SET finished_at = CURRENT_TIMESTAMP, updated_at = CURRENT_TIMESTAMP
+WHERE table_name = %s
+"""
+
+# A batch waits at most this long for row locks held by other sessions, then is retried
+BATCH_LOCK_TIMEOUT = "5s"
+BATCH_ATTEMPTS = 5
+BATCH_RETRY_DELAY = 1.0
+
+
+def update_sql(table: str, chunked: bool = False) -> str:
+    """The CTE + UPDATE for `table`; chunked=True restricts it to %(after)s < institution <= %(upto)s."""
+    if table == DEDUP_TABLE and not chunked:
+        return SQL_UPDATE
+    return SQL_UPDATE_TEMPLATE.format(table=table, group_filter=CHUNK_GROUP_FILTER if chunked else "",
+                                      row_filter=CHUNK_ROW_FILTER if chunked else "")
+
+
+def batch_size_setting() -> int:
+    """Institutions per batch of a standalone run (update_uuids_batch_size); 0 means one statement."""
+    return max(setting("update_uuids_batch_size", "UPDATE_UUIDS_BATCH_SIZE", 1000, int), 0)
+
+
+def _check_table(schema_catalog, schema: str, tbl: str, report: dict) -> bool:
+    # Check table exists
+    if not schema_catalog.has_table(tbl):
+        report["errors"].append(f"table {schema}.{tbl} does not exist")
+        return False
+
+    # Ensure id primary key/column exists
+    if not schema_catalog.has_column(tbl, "id"):
+        report["errors"].append(f"table {schema}.{tbl} does not have an 'id' column; aborting")
+        return False
+
+    # Optionally check uuid_institution column exists
+    if not schema_catalog.has_column(tbl, "uuid_institution"):
+        report["errors"].append(f"table {schema}.{tbl} does not have 'uuid_institution' column; aborting")
+        return False
+    return True
+
+
+def update_uuids_in_table(cur, schema: str, tbl: str, report: dict) -> dict:
+    """Run the checks and the CTE + UPDATE on `schema.tbl` with an existing cursor.
+
+    The caller owns the transaction. Failures are appended to report["errors"] and, for the
+    UPDATE itself, the connection is rolled back. Returns the report.
+    """
+    if not _check_table(get_catalog(cur, schema), schema, tbl, report):
+        return report
+
+    # Execute the UPDATE statement
+    try:
+        cur.execute(update_sql(tbl if tbl == DEDUP_TABLE else f"{schema}.{tbl}"))
+        updated = cur.rowcount if cur.rowcount is not None else 0
+        report["executed"].append("CTE_UPDATE")
+        report["updated"] = updated
+    except Exception as e:
+        # capture DB error (e.g., transaction aborted etc.) and return
+        report["errors"].append(f"failed to execute update: {e}")
+        try:
+            cur.connection.rollback()
+        except Exception:
+            pass
+    return report
+
+
+def _lock_timeout_error(exc) -> bool:
+    return pg_errors is not None and isinstance(exc, pg_errors.LockNotAvailable)
+
+
+def update_uuids_chunked(conn, schema: str, tbl: str, report: dict, batch_size: int, resume: bool = True,
+                         on_progress=None) -> dict:
+    """Normalize UUIDs batch by batch on `conn`, committing every batch with its checkpoint.
+
+    A batch covers the (institution, uuid_country) groups of the next `batch_size`
+    institutions (in institution order), so row locks and WAL stay bounded per transaction and
+    each group is still normalized as a whole. The checkpoint (update_uuids_checkpoint) is
+    written in the batch's transaction; with resume=True an unfinished run on the same table
+    continues after its last committed batch. A batch waits at most BATCH_LOCK_TIMEOUT for
+    locks held by other sessions and is retried BATCH_ATTEMPTS times. on_progress, when given,
+    is called with report["progress"] after every batch.
+    """
+    qualified = f"{schema}.{tbl}"
+    progress = {"batches": 0, "institutions": 0, "remaining_institutions": None, "rows": 0, "seconds": 0.0,
+                "rows_per_second": None, "last_institution": None}
+    report["progress"] = progress
+    with conn.cursor() as cur:
+        schema_catalog = get_catalog(cur, schema)
+        if not _check_table(schema_catalog, schema, tbl, report):
+            return report
+        if not schema_catalog.has_table("update_uuids_checkpoint"):
+            cur.execute(CHECKPOINT_SQL)
+            catalog.invalidate(schema)
+        cur.execute("SELECT to_regclass(%s)::oid;", (qualified,))
+        relid = cur.fetchone()[0]
+        cur.execute(LOAD_CHECKPOINT_SQL, (qualified,))
+        saved = cur.fetchone()
+        after = None
+        if resume and saved is not None and saved[0] == relid and saved[4] is None and saved[1] is not None:
+            after = saved[1]
+            report["resumed"] = {"after": after, "batches": saved[2], "updated_rows": saved[3]}
+        else:
+            cur.execute(START_CHECKPOINT_SQL, (qualified, relid))
+        cur.execute(REMAINING_SQL.format(table=qualified), {"after": after})
+        progress["remaining_institutions"] = cur.fetchone()[0]
+    conn.commit()
+    report["executed"].append(f"CHUNKED_UPDATE batch_size={batch_size}")
+
+    started = time.perf_counter()
+    while True:
+        for attempt in range(1, BATCH_ATTEMPTS + 1):
+            try:
+                with conn.cursor() as cur:
+                    cur.execute(f"SET LOCAL lock_timeout = '{BATCH_LOCK_TIMEOUT}';")
+                    params = {"after": after, "limit": batch_size}
+                    cur.execute(NEXT_BATCH_SQL.format(table=qualified), params)
+                    upto, institutions = cur.fetchone()
+                    if upto is None:
+                        break
+                    params["upto"] = upto
+                    cur.execute(update_sql(qualified, chunked=True), params)
+                    updated = cur.rowcount if cur.rowcount is not None else 0
+                    cur.execute(SAVE_CHECKPOINT_SQL, {"upto": upto, "updated": updated, "table": qualified})
+                conn.commit()
+                break
+            except Exception as exc:
+                conn.rollback()
+                if not _lock_timeout_error(exc) or attempt == BATCH_ATTEMPTS:
+                    raise
+                time.sleep(BATCH_RETRY_DELAY * attempt)
+        if upto is None:
+            break
+        after = upto
+        progress["batches"] += 1
+        progress["institutions"] += institutions
+        progress["remaining_institutions"] = max((progress["remaining_institutions"] or 0) - institutions, 0)
+        progress["rows"] += updated
+        progress["last_institution"] = upto
+        progress["seconds"] = round(time.perf_counter() - started, 3)
+        progress["rows_per_second"] = round(progress["rows"] / progress["seconds"], 1) if progress["seconds"] else None
+        report["updated"] = progress["rows"]
+        if on_progress is not None:
+            on_progress(dict(progress))
+
+    with conn.cursor() as cur:
+        cur.execute(FINISH_CHECKPOINT_SQL, (qualified,))
+    conn.commit()
+    progress["seconds"] = round(time.perf_counter() - started, 3)
+    return report
 
 
-def apply_update_uuids(conn_params=None, schema: str = "public"):
+def apply_update_uuids(conn_params=None, schema: str = "public", table: str = DEDUP_TABLE, conn=None,
+                       batch_size: int = None, resume: bool = True, on_progress=None):
     """Run the UUID normalization/update process and return a JSON-serializable report.
 
-    The function verifies the existence of `deduplicated_institutions_kb` and the `id` column
+    The function verifies the existence of `deduplicated_institutions_kb` (or `table`) and the `id` column
     (required to match rows), then executes the CTE + UPDATE. It returns a dict with keys:
       - success: bool
       - updated: number of rows updated (int) if successful
       - executed: list of statements or descriptions
       - skipped: list of skipped checks
       - errors: list of error messages
+      - progress: batches/institutions/rows/rows_per_second of a chunked run
 
     This function does not attempt to create missing columns or tables; it will fail fast with
-    a helpful error message so the caller can prepare the schema first.
+    a helpful error message so the caller can prepare the schema first. With `conn` the update
+    runs in the caller's transaction, which the caller commits.
+
+    Without `conn` the update runs in committed batches of `batch_size` institutions (default:
+    the update_uuids_batch_size setting; 0 runs a single statement), resuming an interrupted run
+    unless resume=False (see update_uuids_chunked). In the caller's transaction batching would
+    not release any lock, so a single statement is run there.
     """
-    params = conn_params or get_conn_params()
     report = {"success": False, "updated": 0, "executed": [], "skipped": [], "errors": []}
+    if batch_size is None:
+        batch_size = batch_size_setting()
 
-    conn = None
+    own_conn = conn is None
     try:
-        conn = psycopg2.connect(**params)
+        if own_conn:
+            conn = acquire_connection(conn_params)
+        if own_conn and batch_size > 0:
+            update_uuids_chunked(conn, schema, table, report, batch_size, resume=resume, on_progress=on_progress)
+            report["success"] = len(report["errors"]) == 0
+            return report
+        if not own_conn and batch_size > 0:
+            report["skipped"].append("batching: running in the caller's transaction")
         with conn.cursor() as cur:
-            tbl = "deduplicated_institutions_kb"
-
-            # Check table exists
-            if not table_exists(cur, schema, tbl):
-                report["errors"].append(f"table {schema}.{tbl} does not exist")
-                return report
-
-            # Ensure id primary key/column exists
-            if not column_exists(cur, schema, tbl, "id"):
-                report["errors"].append(f"table {schema}.{tbl} does not have an 'id' column; aborting")
-                return report
-
-            # Optionally check uuid_institution column exists
-            if not column_exists(cur, schema, tbl, "uuid_institution"):
-                report["errors"].append(f"table {schema}.{tbl} does not have 'uuid_institution' column; aborting")
-                return report
-
-            # Execute the UPDATE statement
-            try:
-                cur.execute(SQL_UPDATE)
-                updated = cur.rowcount if cur.rowcount is not None else 0
-                report["executed"].append("CTE_UPDATE")
-                report["updated"] = updated
-            except Exception as e:
-                # capture DB error (e.g., transaction aborted etc.) and return
-                report["errors"].append(f"failed to execute update: {e}")
-                try:
-                    conn.rollback()
-                except Exception:
-                    pass
+            update_uuids_in_table(cur, schema, table, report)
+            if report["errors"]:
                 return report
 
         # commit and finalise
         try:
-            conn.commit()
+            if own_conn:
+                conn.commit()
             report["success"] = len(report["errors"]) == 0
         except Exception as e:
             report["errors"].append(f"commit failed: {e}")
@@ -120,18 +316,28 @@ def apply_update_uuids(conn_params=None, schema: str = "public"):
 
     except Exception as exc:
         report["errors"].append(str(exc))
+        if own_conn and conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
     finally:
-        try:
-            if conn is not None:
-                conn.close()
-        except Exception:
-            pass
+        if own_conn:
+            release_connection(conn)
 
     return report
 
 
+def _print_progress(progress: dict):
+    sys.stderr.write(json.dumps(progress, ensure_ascii=False) + "\n")
+    sys.stderr.flush()
+
+
 if __name__ == '__main__':
-    res = apply_update_uuids()
+    # python -m ...update_uuids [--batch-size N] [--no-resume] [--progress]
+    args = sys.argv[1:]
+    size = int(args[args.index('--batch-size') + 1]) if '--batch-size' in args else None
+    res = traced('update_uuids', apply_update_uuids, batch_size=size, resume='--no-resume' not in args,
+                 on_progress=_print_progress if '--progress' in args else None)
     sys.stdout.write(json.dumps(res, ensure_ascii=False))
     sys.stdout.flush()
-
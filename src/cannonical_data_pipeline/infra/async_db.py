@@ -0,0 +1,260 @@
+"""Async database access for the API handlers (psycopg 3).
+
+The deduplication steps and the job workers use psycopg2 on threads (infra.db); the FastAPI
+handlers use this module instead, so a request waiting on the database does not hold one of the
+threadpool's slots.
+
+AsyncConnectionPool is the asyncio counterpart of infra.db.ConnectionPool, with the same
+settings (db_pool_*): connections are opened lazily up to max_size, callers wait up to timeout
+seconds for a free one, a connection idle for longer than health_check_interval is pinged before
+reuse, idle connections beyond min_size are closed after max_idle seconds, and returned
+connections are rolled back. The pool belongs to the event loop it was created on.
+
+arun_plan() runs the query plans of infra.db.run_plan on an async cursor; queries composed with
+psycopg2.sql are converted to their psycopg 3 equivalents, so existing plans run unchanged.
+"""
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+from src.cannonical_data_pipeline.infra.db import PoolError, _pool_settings, get_conn_params
+
+try:
+    import psycopg
+    from psycopg import pq
+    from psycopg import sql as pg3_sql
+except Exception:
+    psycopg = None
+    pq = None
+    pg3_sql = None
+
+try:
+    from psycopg2 import sql as pg2_sql
+except Exception:
+    pg2_sql = None
+
+
+class AsyncConnectionPool:
+    """asyncio psycopg 3 connection pool, see the module docstring."""
+
+    def __init__(self, conn_params, min_size=1, max_size=10, timeout=30.0, max_idle=300.0,
+                 health_check_interval=30.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"invalid pool size: min_size={min_size}, max_size={max_size}")
+        self.conn_params = {key: value for key, value in conn_params.items() if value is not None}
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+        self.loop = asyncio.get_running_loop()
+
+        self._slots = asyncio.Semaphore(max_size)
+        self._idle = []  # stack of (conn, last_used) so hot connections are reused first
+        self._in_use = set()
+        self._closed = False
+        self._stats = {"created": 0, "closed": 0, "requests": 0, "waits": 0, "wait_time_total": 0.0,
+                       "wait_time_max": 0.0, "timeouts": 0, "health_check_failures": 0, "evicted_idle": 0}
+
+    async def _close_conn(self, conn):
+        try:
+            await conn.close()
+        except Exception:
+            pass
+        self._stats["closed"] += 1
+
+    async def _evict_idle(self):
+        if not self.max_idle:
+            return
+        now = time.monotonic()
+        # oldest idle connections sit at the bottom of the stack
+        while (self._idle and len(self._idle) + len(self._in_use) > self.min_size
+               and now - self._idle[0][1] > self.max_idle):
+            conn, _ = self._idle.pop(0)
+            self._stats["evicted_idle"] += 1
+            await self._close_conn(conn)
+
+    async def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            await conn.execute("SELECT 1")
+            await conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    async def getconn(self, timeout=None):
+        """Borrow a connection, waiting up to `timeout` seconds (pool default if None)."""
+        if self._closed:
+            raise PoolError("connection pool is closed")
+        timeout = self.timeout if timeout is None else timeout
+        self._stats["requests"] += 1
+        start = time.monotonic()
+        if self._slots.locked():
+            self._stats["waits"] += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                raise PoolError(f"timed out after {timeout}s waiting for a database connection")
+            wait_time = time.monotonic() - start
+            self._stats["wait_time_total"] += wait_time
+            self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+        else:
+            await self._slots.acquire()
+
+        try:
+            await self._evict_idle()
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if time.monotonic() - last_used <= self.health_check_interval or await self._is_healthy(conn):
+                    break
+                self._stats["health_check_failures"] += 1
+                await self._close_conn(conn)
+            else:
+                conn = await psycopg.AsyncConnection.connect(**self.conn_params)
+                self._stats["created"] += 1
+        except BaseException:
+            self._slots.release()
+            raise
+        self._in_use.add(conn)
+        return conn
+
+    async def putconn(self, conn, close=False):
+        """Return a borrowed connection; close=True discards it instead of reusing it."""
+        if conn not in self._in_use:
+            await self._close_conn(conn)
+            return
+        self._in_use.discard(conn)
+        keep = not close and not self._closed and not conn.closed
+        if keep:
+            try:
+                if conn.info.transaction_status != pq.TransactionStatus.IDLE:
+                    await conn.rollback()
+                if conn.autocommit:
+                    await conn.set_autocommit(False)
+            except Exception:
+                keep = False
+        if keep:
+            self._idle.append((conn, time.monotonic()))
+        else:
+            await self._close_conn(conn)
+        self._slots.release()
+        await self._evict_idle()
+
+    async def closeall(self):
+        """Close idle connections and refuse new checkouts; in-use ones close on return."""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            await self._close_conn(conn)
+
+    def abandon(self):
+        """Close the idle connections without the event loop (the pool's loop is gone)."""
+        self._closed = True
+        idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            try:
+                conn.pgconn.finish()
+            except Exception:
+                pass
+            self._stats["closed"] += 1
+
+    def stats(self) -> dict:
+        out = dict(self._stats)
+        out.update({"min_size": self.min_size, "max_size": self.max_size,
+                    "size": len(self._idle) + len(self._in_use), "in_use": len(self._in_use),
+                    "idle": len(self._idle), "closed_pool": self._closed})
+        out["wait_time_avg"] = out["wait_time_total"] / out["waits"] if out["waits"] else 0.0
+        return out
+
+
+_pool = None
+
+
+def get_async_pool() -> AsyncConnectionPool:
+    """Return the async pool of the running event loop, creating it on first use."""
+    global _pool
+    if psycopg is None:
+        raise PoolError('psycopg (3) is required for async database access but not installed')
+    loop = asyncio.get_running_loop()
+    if _pool is None or _pool.loop is not loop:
+        if _pool is not None:
+            _pool.abandon()
+        _pool = AsyncConnectionPool(get_conn_params(quiet=True), **_pool_settings())
+    return _pool
+
+
+async def close_async_pool():
+    """Close the async pool (e.g. on application shutdown)."""
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None and pool.loop is asyncio.get_running_loop():
+        await pool.closeall()
+
+
+def async_pool_stats() -> dict:
+    pool = _pool
+    if pool is None:
+        return {"initialized": False}
+    return {"initialized": True, **pool.stats()}
+
+
+@asynccontextmanager
+async def async_connection(timeout=None):
+    """Borrow a pooled async connection for the duration of the block."""
+    pool = get_async_pool()
+    conn = await pool.getconn(timeout)
+    try:
+        yield conn
+    finally:
+        await pool.putconn(conn)
+
+
+def _convert(query):
+    """psycopg2.sql composables -> psycopg 3 ones; strings pass through."""
+    if pg2_sql is None or isinstance(query, str):
+        return query
+    if isinstance(query, pg2_sql.Composed):
+        return pg3_sql.Composed([_convert(part) for part in query.seq])
+    if isinstance(query, pg2_sql.Identifier):
+        return pg3_sql.Identifier(*query.strings)
+    if isinstance(query, pg2_sql.Literal):
+        return pg3_sql.Literal(query.wrapped)
+    if isinstance(query, pg2_sql.Placeholder):
+        return pg3_sql.Placeholder(query.name) if query.name else pg3_sql.Placeholder()
+    if isinstance(query, pg2_sql.SQL):
+        return pg3_sql.SQL(query.string)
+    return query
+
+
+async def arun_plan(cur, plan):
+    """Run a query plan (see infra.db.run_plan) on an async cursor and return its result."""
+    try:
+        step = next(plan)
+        while True:
+            query, params, fetch = step
+            try:
+                await cur.execute(_convert(query), params)
+                if fetch == 'one':
+                    result = await cur.fetchone()
+                elif fetch == 'all':
+                    result = await cur.fetchall()
+                elif fetch == 'rowcount':
+                    result = cur.rowcount
+                else:
+                    result = None
+            except Exception as exc:
+                step = plan.throw(exc)
+                continue
+            step = plan.send(result)
+    except StopIteration as stop:
+        return stop.value
+
+
+async def afetch_plan(plan, timeout=None):
+    """Run a read-only plan on a pooled async connection (rolled back afterwards)."""
+    async with async_connection(timeout) as conn:
+        async with conn.cursor() as cur:
+            return await arun_plan(cur, plan)
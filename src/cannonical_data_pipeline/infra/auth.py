@@ -0,0 +1,231 @@
+"""Cached, non-blocking verification of API credentials (used by main.auth_header).
+
+Keycloak bearer tokens are checked against the userinfo endpoint of their environment, and
+Dataverse API keys against the /api/users/token endpoint of their repository. Both lookups are
+async: Keycloak clients are created once per environment and reuse their pooled httpx client,
+and Dataverse calls share one pooled httpx.AsyncClient.
+
+Outcomes are kept in a CredentialCache, an LRU of at most `max_entries` keyed by the SHA-256 of
+(provider, scope, credential), so raw tokens are never stored. Accepted credentials are cached for
+`ttl` seconds and rejected ones for `negative_ttl` seconds; a revoked token therefore stays valid
+for up to `ttl` seconds. Concurrent lookups of the same credential share one request
+(single-flight). A provider that cannot be reached raises AuthUnavailable, which is not cached.
+
+HTTP clients and in-flight lookups belong to the event loop they were created on; the cache
+itself does not.
+"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+from keycloak import KeycloakAuthenticationError, KeycloakConnectionError, KeycloakError, KeycloakOpenID
+
+from src.cannonical_data_pipeline.infra.commons import setting
+
+DATAVERSE_TOKEN_URL = "https://{target}/api/users/token"
+
+
+class AuthUnavailable(Exception):
+    """Raised when an identity provider cannot be reached or fails (not a rejected credential)."""
+
+
+def _settings() -> dict:
+    return {
+        'ttl': setting('auth_cache_ttl', 'AUTH_CACHE_TTL', 60.0, float),
+        'negative_ttl': setting('auth_cache_negative_ttl', 'AUTH_CACHE_NEGATIVE_TTL', 10.0, float),
+        'max_entries': setting('auth_cache_max_entries', 'AUTH_CACHE_MAX_ENTRIES', 10000, int),
+        'timeout': setting('auth_http_timeout', 'AUTH_HTTP_TIMEOUT', 10.0, float),
+        'max_connections': setting('auth_http_max_connections', 'AUTH_HTTP_MAX_CONNECTIONS', 20, int),
+        'dataverse_url': setting('auth_dataverse_token_url', 'AUTH_DATAVERSE_TOKEN_URL', DATAVERSE_TOKEN_URL, str),
+    }
+
+
+class CredentialCache:
+    """TTL + LRU map of credential key -> accepted (bool); not thread-safe (one event loop)."""
+
+    def __init__(self, max_entries=10000, ttl=60.0, negative_ttl=10.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, accepted)
+        self._stats = {"hits": 0, "misses": 0, "evicted": 0}
+
+    @staticmethod
+    def key(*parts) -> str:
+        return hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+
+    def get(self, key):
+        """Return the cached outcome of `key`, or None when unknown or expired."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry[1]
+        if entry is not None:
+            del self._entries[key]
+        self._stats["misses"] += 1
+        return None
+
+    def put(self, key, accepted: bool):
+        ttl = self.ttl if accepted else self.negative_ttl
+        if ttl <= 0 or self.max_entries <= 0:
+            return
+        self._entries[key] = (time.monotonic() + ttl, accepted)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self._stats["evicted"] += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {**self._stats, "size": len(self._entries), "max_entries": self.max_entries,
+                "ttl": self.ttl, "negative_ttl": self.negative_ttl}
+
+
+class Authenticator:
+    """Verifies Keycloak tokens and Dataverse API keys, see the module docstring."""
+
+    def __init__(self, ttl=60.0, negative_ttl=10.0, max_entries=10000, timeout=10.0, max_connections=20,
+                 dataverse_url=DATAVERSE_TOKEN_URL):
+        self.cache = CredentialCache(max_entries, ttl, negative_ttl)
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.dataverse_url = dataverse_url
+        self.loop = None
+        self._http = None
+        self._keycloak = {}  # environment name -> KeycloakOpenID
+        self._inflight = {}  # credential key -> asyncio.Task
+        self._stats = {"lookups": 0, "shared": 0, "unavailable": 0}
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            # clients and tasks of another (finished) loop cannot be used or awaited here
+            self.loop = loop
+            self._http = None
+            self._keycloak = {}
+            self._inflight = {}
+
+    def _http_client(self) -> httpx.AsyncClient:
+        if self._http is None:
+            self._http = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections,
+                                    max_keepalive_connections=self.max_connections),
+            )
+        return self._http
+
+    def _keycloak_client(self, env_name, env) -> KeycloakOpenID:
+        client = self._keycloak.get(env_name)
+        if client is None:
+            client = KeycloakOpenID(server_url=env.URL, client_id=env.CLIENT_ID, realm_name=env.REALMS,
+                                    timeout=self.timeout, pool_maxsize=self.max_connections)
+            self._keycloak[env_name] = client
+        return client
+
+    async def _resolve(self, key, lookup) -> bool:
+        self._bind_loop()
+        accepted = self.cache.get(key)
+        if accepted is not None:
+            return accepted
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup(key, lookup))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._lookup_done(key, done))
+        else:
+            self._stats["shared"] += 1
+        # a waiter that is cancelled (client went away) must not cancel the shared lookup
+        return await asyncio.shield(task)
+
+    def _lookup_done(self, key, task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # retrieved, even when every waiter was cancelled
+
+    async def _lookup(self, key, lookup) -> bool:
+        self._stats["lookups"] += 1
+        try:
+            accepted = await lookup()
+        except AuthUnavailable:
+            self._stats["unavailable"] += 1
+            raise
+        self.cache.put(key, accepted)
+        return accepted
+
+    async def verify_keycloak(self, env_name, env, token) -> bool:
+        """True when the Keycloak environment `env` (URL, CLIENT_ID, REALMS) accepts the token."""
+        async def lookup():
+            client = self._keycloak_client(env_name, env)
+            try:
+                await client.a_userinfo(token)
+                return True
+            except KeycloakAuthenticationError:
+                return False
+            except KeycloakConnectionError as exc:
+                raise AuthUnavailable(f"keycloak {env_name} unreachable: {exc}") from exc
+            except KeycloakError as exc:
+                if (exc.response_code or 500) >= 500:
+                    raise AuthUnavailable(f"keycloak {env_name} failed: {exc}") from exc
+                return False
+
+        return await self._resolve(self.cache.key("keycloak", env_name, token), lookup)
+
+    async def verify_dataverse(self, target, api_key) -> bool:
+        """True when the Dataverse repository `target` (host[:port]) accepts the API key."""
+        async def lookup():
+            url = self.dataverse_url.format(target=target)
+            try:
+                response = await self._http_client().get(url, headers={"X-Dataverse-key": api_key})
+            except httpx.HTTPError as exc:
+                raise AuthUnavailable(f"dataverse {target} unreachable: {exc!r}") from exc
+            if response.status_code >= 500:
+                raise AuthUnavailable(f"dataverse {target} failed: HTTP {response.status_code}")
+            if response.status_code != 200:
+                logging.info("Dataverse %s rejected an API key: HTTP %s", target, response.status_code)
+            return response.status_code == 200
+
+        return await self._resolve(self.cache.key("dataverse", target, api_key), lookup)
+
+    async def aclose(self):
+        """Close the HTTP clients of the running loop."""
+        http, keycloak_clients = self._http, list(self._keycloak.values())
+        same_loop = self.loop is asyncio.get_running_loop()
+        self.loop, self._http, self._keycloak, self._inflight = None, None, {}, {}
+        if not same_loop:
+            return
+        if http is not None:
+            await http.aclose()
+        for client in keycloak_clients:
+            try:
+                await client.connection.aclose()
+            except Exception:
+                pass
+
+    def stats(self) -> dict:
+        return {**self._stats, "inflight": len(self._inflight), "cache": self.cache.stats()}
+
+
+_authenticator = None
+
+
+def get_authenticator() -> Authenticator:
+    """Return the process-wide authenticator, creating it from the auth_* settings on first use."""
+    global _authenticator
+    if _authenticator is None:
+        _authenticator = Authenticator(**_settings())
+    return _authenticator
+
+
+async def close_authenticator():
+    """Close the authenticator's HTTP clients (e.g. on application shutdown)."""
+    global _authenticator
+    authenticator, _authenticator = _authenticator, None
+    if authenticator is not None:
+        await authenticator.aclose()
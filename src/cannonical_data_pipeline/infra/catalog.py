@@ -0,0 +1,188 @@
+"""Cached schema introspection shared by the deduplication steps.
+
+One pg_catalog query loads, for every table of a schema, its columns, constraints and indexes
+(information_schema views are slow and were queried per table/column before). The result is
+cached per database and schema until invalidate() is called, which every step running DDL does
+right after it (and when its transaction ends, so a rolled-back ALTER is not remembered).
+schema_cache_ttl bounds how long a cache entry may miss DDL done by other processes.
+"""
+import threading
+import time
+
+from src.cannonical_data_pipeline.infra.commons import setting
+
+CATALOG_SQL = """
+SELECT c.relname,
+       c.relkind,
+       COALESCE((
+           SELECT json_agg(json_build_array(a.attname, format_type(a.atttypid, NULL), a.attnotnull) ORDER BY a.attnum)
+           FROM pg_attribute a
+           WHERE a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+       ), '[]'),
+       COALESCE((
+           SELECT json_agg(json_build_object(
+               'name', con.conname,
+               'type', con.contype,
+               'columns', (SELECT array_agg(a.attname ORDER BY k.ord)
+                           FROM unnest(con.conkey) WITH ORDINALITY k(attnum, ord)
+                           JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum)
+           ) ORDER BY con.conname)
+           FROM pg_constraint con
+           WHERE con.conrelid = c.oid
+       ), '[]'),
+       COALESCE((
+           SELECT json_agg(json_build_object(
+               'name', ic.relname,
+               'unique', i.indisunique,
+               'primary', i.indisprimary,
+               'columns', (SELECT array_agg(a.attname ORDER BY k.ord)
+                           FROM unnest(i.indkey::int2[]) WITH ORDINALITY k(attnum, ord)
+                           JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum = k.attnum),
+               'expression', i.indexprs IS NOT NULL,
+               'definition', pg_get_indexdef(i.indexrelid)
+           ) ORDER BY ic.relname)
+           FROM pg_index i
+           JOIN pg_class ic ON ic.oid = i.indexrelid
+           WHERE i.indrelid = c.oid
+       ), '[]')
+FROM pg_class c
+JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE n.nspname = %s AND c.relkind IN ('r', 'p', 'v', 'm')
+ORDER BY c.relname
+"""
+
+CONSTRAINT_TYPES = {"p": "PRIMARY KEY", "u": "UNIQUE", "f": "FOREIGN KEY", "c": "CHECK", "x": "EXCLUDE"}
+
+
+class TableInfo:
+    """Columns, constraints and indexes of one table as loaded by CATALOG_SQL."""
+
+    def __init__(self, name: str, kind: str, columns, constraints, indexes):
+        self.name = name
+        self.kind = kind
+        # [(column_name, data_type, not_null)] in ordinal order; data_type as information_schema
+        # spells it for base types ('character varying', 'text', 'integer', ...)
+        self.columns = [tuple(c) for c in columns]
+        self.constraints = [{**c, "type": CONSTRAINT_TYPES.get(c["type"], c["type"]),
+                             "columns": c["columns"] or []} for c in constraints]
+        self.indexes = [{**i, "columns": i["columns"] or []} for i in indexes]
+        self.column_names = {c[0] for c in self.columns}
+
+    @property
+    def primary_key(self) -> tuple:
+        for c in self.constraints:
+            if c["type"] == "PRIMARY KEY":
+                return tuple(c["columns"])
+        return ()
+
+    @property
+    def unique_columns(self) -> set:
+        """Columns covered by a PRIMARY KEY, UNIQUE constraint or unique index (those back both)."""
+        return {col for i in self.indexes if i["unique"] or i["primary"] for col in i["columns"]}
+
+
+class SchemaCatalog:
+    """Introspection snapshot of one schema."""
+
+    def __init__(self, schema: str, tables: dict):
+        self.schema = schema
+        self.tables = tables
+        self.loaded_at = time.monotonic()
+
+    @classmethod
+    def load(cls, cur, schema: str = "public") -> "SchemaCatalog":
+        cur.execute(CATALOG_SQL, (schema,))
+        return cls(schema, {row[0]: TableInfo(*row) for row in cur.fetchall()})
+
+    def table(self, table: str):
+        return self.tables.get(table)
+
+    def has_table(self, table: str) -> bool:
+        return table in self.tables
+
+    def columns(self, table: str) -> list:
+        """[(column_name, data_type)] in ordinal order; [] for a missing table."""
+        info = self.tables.get(table)
+        return [(name, data_type) for name, data_type, _ in info.columns] if info else []
+
+    def column_names(self, table: str) -> set:
+        info = self.tables.get(table)
+        return set(info.column_names) if info else set()
+
+    def has_column(self, table: str, column: str) -> bool:
+        info = self.tables.get(table)
+        return info is not None and column in info.column_names
+
+    def primary_key(self, table: str) -> tuple:
+        info = self.tables.get(table)
+        return info.primary_key if info else ()
+
+    def has_primary_key(self, table: str) -> bool:
+        return bool(self.primary_key(table))
+
+    def unique_columns(self, table: str) -> set:
+        info = self.tables.get(table)
+        return info.unique_columns if info else set()
+
+    def indexes(self, table: str) -> list:
+        info = self.tables.get(table)
+        return list(info.indexes) if info else []
+
+
+_cache = {}
+_cache_lock = threading.Lock()
+_stats = {"loads": 0, "hits": 0, "invalidations": 0}
+
+
+def _cache_ttl() -> float:
+    return setting("schema_cache_ttl", "SCHEMA_CACHE_TTL", 300.0, float)
+
+
+def _database_key(cur):
+    # Connections to different databases must not share entries; pooled ones share one dsn
+    return getattr(getattr(cur, "connection", None), "dsn", None)
+
+
+def get_catalog(cur, schema: str = "public", refresh: bool = False) -> SchemaCatalog:
+    """Return the cached SchemaCatalog of `schema`, loading it with `cur` when missing or stale.
+
+    A load runs in the cursor's transaction, so it sees that transaction's uncommitted DDL.
+    """
+    key = (_database_key(cur), schema)
+    ttl = _cache_ttl()
+    with _cache_lock:
+        catalog = _cache.get(key)
+        if catalog is not None and not refresh and time.monotonic() - catalog.loaded_at <= ttl:
+            _stats["hits"] += 1
+            return catalog
+    catalog = SchemaCatalog.load(cur, schema)
+    with _cache_lock:
+        _cache[key] = catalog
+        _stats["loads"] += 1
+    return catalog
+
+
+def invalidate(schema: str = None):
+    """Drop the cached catalog of `schema` (every schema when None); call it after DDL."""
+    with _cache_lock:
+        for key in [k for k in _cache if schema is None or k[1] == schema]:
+            del _cache[key]
+        _stats["invalidations"] += 1
+
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        return {**_stats, "entries": len(_cache)}
+
+
+# Helpers with the signatures the deduplication steps used before the catalog existed
+def table_exists(cur, schema: str, table: str) -> bool:
+    return get_catalog(cur, schema).has_table(table)
+
+
+def column_exists(cur, schema: str, table: str, column: str) -> bool:
+    return get_catalog(cur, schema).has_column(table, column)
+
+
+def table_has_primary_key(cur, schema: str, table: str) -> bool:
+    return get_catalog(cur, schema).has_primary_key(table)
@@ -31,6 +31,28 @@ if not base_dir:
 app_settings = Dynaconf(root_path=os.path.join(os.environ["BASE_DIR"], 'conf'), settings_files=["*.toml"],
                     environments=True)
 
+def _bool(val) -> bool:
+    return val if isinstance(val, bool) else str(val).strip().lower() in ("1", "true", "yes", "on")
+
+
+def setting(name: str, env_name: str = None, default=None, cast=None):
+    """Return setting `name` from app_settings, else environment variable `env_name` (NAME by
+    default), converted with `cast` (bool accepts 1/true/yes/on); `default` when unset or invalid."""
+    try:
+        val = app_settings.get(name)
+    except Exception:
+        val = None
+    if val is None:
+        val = os.environ.get(env_name or name.upper())
+    if val is None:
+        return default
+    if cast is bool:
+        cast = _bool
+    try:
+        return cast(val) if cast is not None else val
+    except (TypeError, ValueError):
+        return default
+
 def get_project_details(base_dir: str, keys: list):
     with open(os.path.join(base_dir, 'pyproject.toml'), 'rb') as file:
         package_details = tomli.load(file)
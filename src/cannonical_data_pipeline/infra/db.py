@@ -1,13 +1,26 @@
 import os
 import sys
+import threading
+import time
+from contextlib import contextmanager
 
+try:
+    import psycopg2
+    from psycopg2 import extensions as pg_extensions
+except Exception:
+    psycopg2 = None
+    pg_extensions = None
 
-def get_conn_params():
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.tracing import TracingCursor
+
+
+def get_conn_params(quiet: bool = False):
     """Read Postgres connection parameters using app_settings from infra.commons.
 
     This prefers values from `app_settings` (Dynaconf wrapper) and falls back to
     environment variables. It returns a dict suitable for psycopg2.connect()
-    and prints a small debug map to stderr (password masked).
+    and prints a small debug map to stderr (password masked) unless quiet=True.
     """
     # locate repo and secrets path (for debug only)
     repo_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
@@ -64,12 +77,13 @@ def get_conn_params():
     }
 
     # print per-key source debug
-    try:
-        src_map = {'host': s1, 'port': s2, 'dbname': s3, 'user': s4, 'password': s5}
-        print(f"[debug] config sources: {src_map} (secrets_path={secrets_path})", file=sys.stderr)
-        print(f"[debug] conn params: {masked}", file=sys.stderr)
-    except Exception:
-        pass
+    if not quiet:
+        try:
+            src_map = {'host': s1, 'port': s2, 'dbname': s3, 'user': s4, 'password': s5}
+            print(f"[debug] config sources: {src_map} (secrets_path={secrets_path})", file=sys.stderr)
+            print(f"[debug] conn params: {masked}", file=sys.stderr)
+        except Exception:
+            pass
 
     return {
         'host': host,
@@ -78,3 +92,321 @@ def get_conn_params():
         'user': user,
         'password': password,
     }
+
+
+class PoolError(Exception):
+    """Raised when the connection pool is closed or cannot hand out a connection in time."""
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 connection pool with health checks and idle eviction.
+
+    - Connections are created lazily up to `max_size`; callers block up to `timeout`
+      seconds when all connections are in use.
+    - A connection idle for longer than `health_check_interval` seconds is pinged
+      (SELECT 1) before being handed out; broken connections are replaced.
+    - Idle connections older than `max_idle` seconds are closed on checkout/checkin,
+      keeping at least `min_size` open.
+    - Returned connections are rolled back to a clean state before reuse.
+    """
+
+    def __init__(self, conn_params, min_size=1, max_size=10, timeout=30.0, max_idle=300.0,
+                 health_check_interval=30.0):
+        if max_size < 1 or min_size < 0 or min_size > max_size:
+            raise ValueError(f"invalid pool size: min_size={min_size}, max_size={max_size}")
+        self.conn_params = conn_params
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # stack of (conn, last_used) so hot connections are reused first
+        self._in_use = {}  # id(conn) -> conn
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "created": 0,
+            "closed": 0,
+            "requests": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+            "timeouts": 0,
+            "health_check_failures": 0,
+            "evicted_idle": 0,
+        }
+
+    def _connect(self):
+        conn = psycopg2.connect(**_with_tracing(self.conn_params))
+        with self._cond:
+            self._stats["created"] += 1
+        return conn
+
+    def _close_conn(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._stats["closed"] += 1
+
+    def _evict_idle_locked(self):
+        """Close idle connections past max_idle while keeping min_size. Caller holds the lock."""
+        if not self.max_idle:
+            return []
+        now = time.monotonic()
+        evicted = []
+        # oldest idle connections sit at the bottom of the stack
+        while self._idle and self._size > self.min_size and now - self._idle[0][1] > self.max_idle:
+            conn, _ = self._idle.pop(0)
+            self._size -= 1
+            self._stats["evicted_idle"] += 1
+            evicted.append(conn)
+        return evicted
+
+    def _is_healthy(self, conn) -> bool:
+        if getattr(conn, 'closed', 0):
+            return False
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _reset(self, conn) -> bool:
+        """Bring a returned connection back to an idle, non-autocommit state."""
+        try:
+            if conn.closed:
+                return False
+            if conn.get_transaction_status() != pg_extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+            return True
+        except Exception:
+            return False
+
+    def getconn(self, timeout=None):
+        """Borrow a connection, waiting up to `timeout` seconds (pool default if None)."""
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        waited = False
+        with self._cond:
+            self._stats["requests"] += 1
+
+        while True:
+            conn = None
+            last_used = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolError("connection pool is closed")
+                    evicted = self._evict_idle_locked()
+                    if self._idle:
+                        conn, last_used = self._idle.pop()
+                        break
+                    if self._size < self.max_size:
+                        self._size += 1
+                        break
+                    if not waited:
+                        self._stats["waits"] += 1
+                        waited = True
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolError(f"timed out after {timeout}s waiting for a database connection")
+                    self._cond.wait(remaining)
+            for old in evicted:
+                self._close_conn(old)
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif time.monotonic() - last_used > self.health_check_interval and not self._is_healthy(conn):
+                with self._cond:
+                    self._size -= 1
+                    self._stats["health_check_failures"] += 1
+                self._close_conn(conn)
+                continue
+
+            with self._cond:
+                self._in_use[id(conn)] = conn
+                if waited:
+                    wait_time = time.monotonic() - start
+                    self._stats["wait_time_total"] += wait_time
+                    self._stats["wait_time_max"] = max(self._stats["wait_time_max"], wait_time)
+            return conn
+
+    def owns(self, conn) -> bool:
+        with self._cond:
+            return id(conn) in self._in_use
+
+    def putconn(self, conn, close=False):
+        """Return a borrowed connection; close=True discards it instead of reusing it."""
+        keep = not close and self._reset(conn)
+        with self._cond:
+            if self._in_use.pop(id(conn), None) is None:
+                keep = False
+            else:
+                if keep and not self._closed:
+                    self._idle.append((conn, time.monotonic()))
+                else:
+                    keep = False
+                    self._size -= 1
+            evicted = self._evict_idle_locked()
+            self._cond.notify()
+        if not keep:
+            self._close_conn(conn)
+        for old in evicted:
+            self._close_conn(old)
+
+    def closeall(self):
+        """Close idle connections and refuse new checkouts; in-use ones close on return."""
+        with self._cond:
+            self._closed = True
+            idle = [c for c, _ in self._idle]
+            self._idle = []
+            self._size -= len(idle)
+            self._cond.notify_all()
+        for conn in idle:
+            self._close_conn(conn)
+
+    def stats(self) -> dict:
+        with self._cond:
+            out = dict(self._stats)
+            out.update({
+                "min_size": self.min_size,
+                "max_size": self.max_size,
+                "size": self._size,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "closed_pool": self._closed,
+            })
+        out["wait_time_avg"] = out["wait_time_total"] / out["waits"] if out["waits"] else 0.0
+        return out
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _pool_settings():
+    return {
+        'min_size': setting('db_pool_min_size', 'DB_POOL_MIN_SIZE', 1, int),
+        'max_size': setting('db_pool_max_size', 'DB_POOL_MAX_SIZE', 10, int),
+        'timeout': setting('db_pool_timeout', 'DB_POOL_TIMEOUT', 30.0, float),
+        'max_idle': setting('db_pool_max_idle', 'DB_POOL_MAX_IDLE', 300.0, float),
+        'health_check_interval': setting('db_pool_health_check_interval', 'DB_POOL_HEALTH_CHECK_INTERVAL', 30.0, float),
+    }
+
+
+def get_pool() -> ConnectionPool:
+    """Return the process-wide connection pool, creating it on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            if psycopg2 is None:
+                raise PoolError('psycopg2 is required but not installed')
+            _pool = ConnectionPool(get_conn_params(), **_pool_settings())
+        return _pool
+
+
+def close_pool():
+    """Close the process-wide pool (e.g. on application shutdown)."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.closeall()
+
+
+def pool_stats() -> dict:
+    """Return pool statistics, or {'initialized': False} when no connection was borrowed yet."""
+    pool = _pool
+    if pool is None:
+        return {"initialized": False}
+    return {"initialized": True, **pool.stats()}
+
+
+def _with_tracing(conn_params: dict) -> dict:
+    """Connection parameters whose cursors record into infra.tracing (unless a cursor_factory is given)."""
+    return {'cursor_factory': TracingCursor, **conn_params}
+
+
+def acquire_connection(conn_params=None):
+    """Borrow a pooled connection, or open a dedicated one when explicit conn_params are given.
+
+    Either way the connection's cursors are TracingCursor (see infra.tracing).
+    """
+    if conn_params:
+        return psycopg2.connect(**_with_tracing(conn_params))
+    return get_pool().getconn()
+
+
+def release_connection(conn, close=False):
+    """Return a connection from acquire_connection() to the pool, or close it if it is not pooled."""
+    if conn is None:
+        return
+    pool = _pool
+    if pool is not None and pool.owns(conn):
+        pool.putconn(conn, close=close)
+        return
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+@contextmanager
+def connection(conn_params=None):
+    """Context manager around acquire_connection()/release_connection()."""
+    conn = acquire_connection(conn_params)
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
+
+
+def _fetch(cur, fetch):
+    if fetch == 'one':
+        return cur.fetchone()
+    if fetch == 'all':
+        return cur.fetchall()
+    if fetch == 'rowcount':
+        return cur.rowcount
+    return None
+
+
+def run_plan(cur, plan):
+    """Run a query plan on `cur` and return its result.
+
+    A plan is a generator yielding (query, params, fetch) tuples, fetch being 'one', 'all',
+    'rowcount' or None; each result is sent back into the generator (a failed query raises its
+    exception at the yield) and the generator's return value is the result of the plan. The same
+    plan runs on an async psycopg 3 cursor with infra.async_db.arun_plan, so sync and async
+    callers share one implementation of a query.
+    """
+    try:
+        step = next(plan)
+        while True:
+            query, params, fetch = step
+            try:
+                cur.execute(query, params)
+                result = _fetch(cur, fetch)
+            except Exception as exc:
+                step = plan.throw(exc)
+                continue
+            step = plan.send(result)
+    except StopIteration as stop:
+        return stop.value
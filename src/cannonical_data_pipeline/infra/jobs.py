@@ -0,0 +1,694 @@
+"""Persistent job store and worker pool for the sync operations.
+
+Jobs and schedules live in two tables, sync_jobs and sync_schedules, so they survive restarts
+and are shared by every API process:
+  - enqueue() inserts a queued job; a job with an exclusive_key is refused while another job
+    with the same key is queued or running (a partial unique index), e.g. one pipeline run;
+  - claim() hands the oldest due job to one worker: the row is locked with
+    SELECT ... FOR UPDATE SKIP LOCKED, so concurrent workers of any process never get the same
+    job and never wait for each other;
+  - tick() enqueues the runs of due schedules the same way: the schedule rows are claimed
+    with SKIP LOCKED and advanced in the same transaction, so with several processes (e.g.
+    uvicorn workers) every due run is enqueued exactly once, without a leader election;
+  - running jobs carry a heartbeat; a job whose worker stopped beating for lease_seconds
+    (process killed, restart) is queued again, or failed after max_attempts.
+
+PostgresJobStore keeps the tables in the application database (pooled connections);
+SqliteJobStore is a stand-in for tests and local runs, where BEGIN IMMEDIATE serializes the
+claims instead of row locks.
+
+JobService runs a bounded pool of worker threads claiming and running jobs, plus a
+maintenance thread for schedules, heartbeats and stale jobs. Job status, timing and report are
+queryable through the store (get/list_jobs/last_finished); the API handlers use the *_async
+variants, which run the same query plans on the async pool (infra.async_db).
+"""
+import asyncio
+import json
+import os
+import re
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from src.cannonical_data_pipeline.infra import async_db
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection, run_plan
+
+STATUSES = ("queued", "running", "succeeded", "failed")
+
+JOB_COLUMNS = ("job_id", "mode", "params", "status", "schedule", "exclusive_key", "run_at", "created_at",
+               "started_at", "finished_at", "heartbeat_at", "worker", "attempts", "report", "error")
+
+SCHEDULE_COLUMNS = ("name", "mode", "params", "interval_seconds", "enabled", "next_run_at", "last_job_id",
+                    "created_at")
+
+POSTGRES_DDL = """
+CREATE TABLE IF NOT EXISTS sync_jobs (
+    job_id BIGSERIAL PRIMARY KEY,
+    mode TEXT NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued',
+    schedule TEXT,
+    exclusive_key TEXT,
+    run_at TIMESTAMPTZ NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL,
+    started_at TIMESTAMPTZ,
+    finished_at TIMESTAMPTZ,
+    heartbeat_at TIMESTAMPTZ,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    report JSONB,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS sync_jobs_queue_idx ON sync_jobs (run_at, job_id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS sync_jobs_finished_idx ON sync_jobs (finished_at) WHERE finished_at IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS sync_jobs_exclusive_idx ON sync_jobs (exclusive_key)
+    WHERE status IN ('queued', 'running') AND exclusive_key IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS sync_schedules (
+    name TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    params JSONB NOT NULL DEFAULT '{}',
+    interval_seconds INTEGER NOT NULL CHECK (interval_seconds > 0),
+    enabled BOOLEAN NOT NULL DEFAULT TRUE,
+    next_run_at TIMESTAMPTZ NOT NULL,
+    last_job_id BIGINT,
+    created_at TIMESTAMPTZ NOT NULL
+);
+"""
+
+SQLITE_DDL = """
+CREATE TABLE IF NOT EXISTS sync_jobs (
+    job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    mode TEXT NOT NULL,
+    params TEXT NOT NULL DEFAULT '{}',
+    status TEXT NOT NULL DEFAULT 'queued',
+    schedule TEXT,
+    exclusive_key TEXT,
+    run_at TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    started_at TEXT,
+    finished_at TEXT,
+    heartbeat_at TEXT,
+    worker TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    report TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS sync_jobs_queue_idx ON sync_jobs (run_at, job_id) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS sync_jobs_finished_idx ON sync_jobs (finished_at) WHERE finished_at IS NOT NULL;
+CREATE UNIQUE INDEX IF NOT EXISTS sync_jobs_exclusive_idx ON sync_jobs (exclusive_key)
+    WHERE status IN ('queued', 'running') AND exclusive_key IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS sync_schedules (
+    name TEXT PRIMARY KEY,
+    mode TEXT NOT NULL,
+    params TEXT NOT NULL DEFAULT '{}',
+    interval_seconds INTEGER NOT NULL CHECK (interval_seconds > 0),
+    enabled BOOLEAN NOT NULL DEFAULT 1,
+    next_run_at TEXT NOT NULL,
+    last_job_id INTEGER,
+    created_at TEXT NOT NULL
+);
+"""
+
+# Statements shared by both stores, in psycopg2's named parameter style; {skip_locked} is
+# " FOR UPDATE SKIP LOCKED" on Postgres
+INSERT_JOB_SQL = """
+INSERT INTO sync_jobs (mode, params, status, schedule, exclusive_key, run_at, created_at)
+VALUES (%(mode)s, %(params)s, 'queued', %(schedule)s, %(exclusive_key)s, %(run_at)s, %(now)s)
+ON CONFLICT (exclusive_key) WHERE status IN ('queued', 'running') AND exclusive_key IS NOT NULL DO NOTHING
+RETURNING {columns}
+"""
+
+CLAIM_SQL = """
+UPDATE sync_jobs
+SET status = 'running', started_at = %(now)s, heartbeat_at = %(now)s, worker = %(worker)s, attempts = attempts + 1
+WHERE job_id = (
+    SELECT job_id FROM sync_jobs
+    WHERE status = 'queued' AND run_at <= %(now)s
+    ORDER BY run_at, job_id
+    LIMIT 1{skip_locked}
+)
+RETURNING {columns}
+"""
+
+FINISH_SQL = """
+UPDATE sync_jobs
+SET status = %(status)s, finished_at = %(now)s, heartbeat_at = %(now)s, report = %(report)s, error = %(error)s
+WHERE job_id = %(job_id)s AND status = 'running'
+"""
+
+HEARTBEAT_SQL = "UPDATE sync_jobs SET heartbeat_at = %(now)s WHERE job_id = %(job_id)s AND status = 'running'"
+
+# Jobs whose worker stopped beating: queued again while attempts remain, failed otherwise
+REQUEUE_STALE_SQL = """
+UPDATE sync_jobs SET status = 'queued', worker = NULL, run_at = %(now)s
+WHERE status = 'running' AND heartbeat_at < %(stale_before)s AND attempts < %(max_attempts)s
+RETURNING job_id
+"""
+
+FAIL_STALE_SQL = """
+UPDATE sync_jobs SET status = 'failed', finished_at = %(now)s, error = 'worker lost (no heartbeat)'
+WHERE status = 'running' AND heartbeat_at < %(stale_before)s
+RETURNING job_id
+"""
+
+DUE_SCHEDULES_SQL = """
+SELECT name, mode, params, interval_seconds, next_run_at FROM sync_schedules
+WHERE enabled AND next_run_at <= %(now)s
+ORDER BY next_run_at{skip_locked}
+"""
+
+ADVANCE_SCHEDULE_SQL = """
+UPDATE sync_schedules SET next_run_at = %(next_run_at)s, last_job_id = COALESCE(%(job_id)s, last_job_id)
+WHERE name = %(name)s
+"""
+
+INSERT_SCHEDULE_SQL = """
+INSERT INTO sync_schedules (name, mode, params, interval_seconds, enabled, next_run_at, created_at)
+VALUES (%(name)s, %(mode)s, %(params)s, %(interval_seconds)s, %(enabled)s, %(next_run_at)s, %(now)s)
+ON CONFLICT (name) DO NOTHING
+RETURNING {columns}
+"""
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _iso(value):
+    if isinstance(value, datetime):
+        return value.astimezone(timezone.utc).isoformat().replace("+00:00", "Z")
+    return value
+
+
+class JobStore:
+    """Job and schedule persistence; subclasses provide the transaction and the SQL dialect.
+
+    Every operation is a query plan (see infra.db.run_plan) run in one transaction by the sync
+    method, or by its *_async counterpart for the API handlers.
+    """
+
+    skip_locked = ""
+
+    def ensure(self):
+        raise NotImplementedError
+
+    @contextmanager
+    def _transaction(self):
+        raise NotImplementedError
+
+    def _run(self, plan):
+        with self._transaction() as cur:
+            return run_plan(cur, plan)
+
+    async def _run_async(self, plan):
+        return await asyncio.to_thread(self._run, plan)
+
+    def _sql(self, query: str, **fmt) -> str:
+        return query.format(skip_locked=self.skip_locked, **fmt)
+
+    def _ts(self, value: datetime):
+        return value
+
+    def _json(self, value):
+        return None if value is None else json.dumps(value, ensure_ascii=False, default=str)
+
+    def _job(self, row) -> dict:
+        if row is None:
+            return None
+        job = dict(zip(JOB_COLUMNS, row))
+        for key in ("params", "report"):
+            if isinstance(job[key], str):
+                job[key] = json.loads(job[key])
+        for key in ("run_at", "created_at", "started_at", "finished_at", "heartbeat_at"):
+            job[key] = _iso(job[key])
+        return job
+
+    def _schedule(self, row) -> dict:
+        if row is None:
+            return None
+        schedule = dict(zip(SCHEDULE_COLUMNS, row))
+        if isinstance(schedule["params"], str):
+            schedule["params"] = json.loads(schedule["params"])
+        schedule["enabled"] = bool(schedule["enabled"])
+        for key in ("next_run_at", "created_at"):
+            schedule[key] = _iso(schedule[key])
+        return schedule
+
+    # plans
+
+    def _enqueue(self, mode, params=None, schedule=None, exclusive_key=None, run_at=None):
+        now = utcnow()
+        row = yield (self._sql(INSERT_JOB_SQL, columns=", ".join(JOB_COLUMNS)),
+                     {"mode": mode, "params": self._json(params or {}), "schedule": schedule,
+                      "exclusive_key": exclusive_key, "run_at": self._ts(run_at or now), "now": self._ts(now)}, "one")
+        return self._job(row)
+
+    def _claim(self, worker):
+        row = yield (self._sql(CLAIM_SQL, columns=", ".join(JOB_COLUMNS)),
+                     {"now": self._ts(utcnow()), "worker": worker}, "one")
+        return self._job(row)
+
+    def _finish(self, job_id, success, report, error):
+        count = yield (self._sql(FINISH_SQL), {"status": "succeeded" if success else "failed",
+                                               "now": self._ts(utcnow()), "report": self._json(report),
+                                               "error": error, "job_id": job_id}, "rowcount")
+        return count == 1
+
+    def _heartbeat(self, job_ids):
+        now = self._ts(utcnow())
+        for job_id in job_ids:
+            yield self._sql(HEARTBEAT_SQL), {"now": now, "job_id": job_id}, None
+
+    def _recover_stale(self, lease_seconds, max_attempts):
+        now = utcnow()
+        params = {"now": self._ts(now), "stale_before": self._ts(now - timedelta(seconds=lease_seconds)),
+                  "max_attempts": max_attempts}
+        requeued = yield self._sql(REQUEUE_STALE_SQL), params, "all"
+        failed = yield self._sql(FAIL_STALE_SQL), params, "all"
+        return {"requeued": [r[0] for r in requeued], "failed": [r[0] for r in failed]}
+
+    def _get(self, job_id):
+        row = yield (self._sql("SELECT {columns} FROM sync_jobs WHERE job_id = %(job_id)s",
+                               columns=", ".join(JOB_COLUMNS)), {"job_id": job_id}, "one")
+        return self._job(row)
+
+    def _list_jobs(self, status=None, mode=None, limit=50):
+        where = []
+        if status:
+            where.append("status = %(status)s")
+        if mode:
+            where.append("mode = %(mode)s")
+        query = ("SELECT {columns} FROM sync_jobs" + (" WHERE " + " AND ".join(where) if where else "")
+                 + " ORDER BY job_id DESC LIMIT %(limit)s")
+        rows = yield (self._sql(query, columns=", ".join(JOB_COLUMNS)),
+                      {"status": status, "mode": mode, "limit": limit}, "all")
+        return [self._job(row) for row in rows]
+
+    def _last_finished(self):
+        row = yield (self._sql("SELECT {columns} FROM sync_jobs WHERE finished_at IS NOT NULL"
+                               " ORDER BY finished_at DESC, job_id DESC LIMIT 1", columns=", ".join(JOB_COLUMNS)),
+                     None, "one")
+        return self._job(row)
+
+    def _tick(self):
+        now = utcnow()
+        enqueued = []
+        due = yield self._sql(DUE_SCHEDULES_SQL), {"now": self._ts(now)}, "all"
+        for name, mode, params, interval, next_run_at in due:
+            params = json.loads(params) if isinstance(params, str) else params
+            job = yield from self._enqueue(mode, params, schedule=name, exclusive_key=f"schedule:{name}")
+            if not isinstance(next_run_at, datetime):
+                next_run_at = datetime.fromisoformat(next_run_at)
+            following = next_run_at + timedelta(seconds=interval)
+            if following <= now:
+                # runs missed while no process was up are not replayed
+                following = now + timedelta(seconds=interval)
+            yield (self._sql(ADVANCE_SCHEDULE_SQL), {"next_run_at": self._ts(following), "name": name,
+                                                      "job_id": job["job_id"] if job else None}, None)
+            if job:
+                enqueued.append(job)
+        return enqueued
+
+    def _create_schedule(self, name, mode, interval_seconds, params=None, start_immediately=False):
+        now = utcnow()
+        first = now if start_immediately else now + timedelta(seconds=interval_seconds)
+        row = yield (self._sql(INSERT_SCHEDULE_SQL, columns=", ".join(SCHEDULE_COLUMNS)),
+                     {"name": name, "mode": mode, "params": self._json(params or {}),
+                      "interval_seconds": interval_seconds, "enabled": True, "next_run_at": self._ts(first),
+                      "now": self._ts(now)}, "one")
+        return self._schedule(row)
+
+    def _list_schedules(self):
+        rows = yield (self._sql("SELECT {columns} FROM sync_schedules ORDER BY name",
+                                columns=", ".join(SCHEDULE_COLUMNS)), None, "all")
+        return [self._schedule(row) for row in rows]
+
+    def _delete_schedule(self, name):
+        count = yield self._sql("DELETE FROM sync_schedules WHERE name = %(name)s"), {"name": name}, "rowcount"
+        return count == 1
+
+    def _set_schedule_enabled(self, name, enabled):
+        if not enabled:
+            count = yield (self._sql("UPDATE sync_schedules SET enabled = %(enabled)s WHERE name = %(name)s"),
+                           {"enabled": False, "name": name}, "rowcount")
+            return count == 1
+        row = yield (self._sql("SELECT interval_seconds, enabled FROM sync_schedules WHERE name = %(name)s"),
+                     {"name": name}, "one")
+        if row is None:
+            return False
+        if not row[1]:
+            yield (self._sql("UPDATE sync_schedules SET enabled = %(enabled)s, next_run_at = %(next_run_at)s"
+                             " WHERE name = %(name)s"),
+                   {"enabled": True, "name": name, "next_run_at": self._ts(utcnow() + timedelta(seconds=row[0]))},
+                   None)
+        return True
+
+    # jobs
+
+    def enqueue(self, mode: str, params: dict = None, schedule: str = None, exclusive_key: str = None,
+                run_at: datetime = None) -> dict:
+        """Insert a job and return it, or None when a job with `exclusive_key` is queued/running."""
+        return self._run(self._enqueue(mode, params, schedule, exclusive_key, run_at))
+
+    async def enqueue_async(self, mode: str, params: dict = None, schedule: str = None, exclusive_key: str = None,
+                            run_at: datetime = None) -> dict:
+        return await self._run_async(self._enqueue(mode, params, schedule, exclusive_key, run_at))
+
+    def claim(self, worker: str) -> dict:
+        """Mark the oldest due queued job running on `worker` and return it (None when idle)."""
+        return self._run(self._claim(worker))
+
+    def finish(self, job_id, success: bool, report=None, error: str = None) -> bool:
+        return self._run(self._finish(job_id, success, report, error))
+
+    def heartbeat(self, job_ids):
+        if job_ids:
+            self._run(self._heartbeat(job_ids))
+
+    def recover_stale(self, lease_seconds: float, max_attempts: int) -> dict:
+        """Requeue (or fail, after max_attempts) running jobs without a heartbeat for lease_seconds."""
+        return self._run(self._recover_stale(lease_seconds, max_attempts))
+
+    def get(self, job_id) -> dict:
+        return self._run(self._get(job_id))
+
+    async def get_async(self, job_id) -> dict:
+        return await self._run_async(self._get(job_id))
+
+    def list_jobs(self, status: str = None, mode: str = None, limit: int = 50) -> list:
+        return self._run(self._list_jobs(status, mode, limit))
+
+    async def list_jobs_async(self, status: str = None, mode: str = None, limit: int = 50) -> list:
+        return await self._run_async(self._list_jobs(status, mode, limit))
+
+    def last_finished(self) -> dict:
+        return self._run(self._last_finished())
+
+    async def last_finished_async(self) -> dict:
+        return await self._run_async(self._last_finished())
+
+    # schedules
+
+    def tick(self) -> list:
+        """Enqueue one job per due schedule and advance it; returns the enqueued jobs.
+
+        A schedule whose previous run is still queued or running is advanced without a new job.
+        """
+        return self._run(self._tick())
+
+    def create_schedule(self, name: str, mode: str, interval_seconds: int, params: dict = None,
+                        start_immediately: bool = False) -> dict:
+        """Insert a schedule and return it, or None when `name` exists."""
+        return self._run(self._create_schedule(name, mode, interval_seconds, params, start_immediately))
+
+    async def create_schedule_async(self, name: str, mode: str, interval_seconds: int, params: dict = None,
+                                    start_immediately: bool = False) -> dict:
+        return await self._run_async(self._create_schedule(name, mode, interval_seconds, params, start_immediately))
+
+    def list_schedules(self) -> list:
+        return self._run(self._list_schedules())
+
+    async def list_schedules_async(self) -> list:
+        return await self._run_async(self._list_schedules())
+
+    def delete_schedule(self, name: str) -> bool:
+        return self._run(self._delete_schedule(name))
+
+    async def delete_schedule_async(self, name: str) -> bool:
+        return await self._run_async(self._delete_schedule(name))
+
+    def set_schedule_enabled(self, name: str, enabled: bool) -> bool:
+        """Enable or disable a schedule; enabling sets its next run one interval from now."""
+        return self._run(self._set_schedule_enabled(name, enabled))
+
+    async def set_schedule_enabled_async(self, name: str, enabled: bool) -> bool:
+        return await self._run_async(self._set_schedule_enabled(name, enabled))
+
+
+class PostgresJobStore(JobStore):
+    """Job store in the application database: pooled psycopg2 connections for the workers,
+    the async pool (infra.async_db) for the *_async methods."""
+
+    skip_locked = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, conn_params=None):
+        self.conn_params = conn_params
+        self._ensured = False
+
+    def ensure(self):
+        with self._transaction(ensure=False) as cur:
+            cur.execute(POSTGRES_DDL)
+        self._ensured = True
+
+    @contextmanager
+    def _transaction(self, ensure: bool = True):
+        if ensure and not self._ensured:
+            self.ensure()
+        conn = acquire_connection(self.conn_params)
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            release_connection(conn)
+
+    async def _run_async(self, plan):
+        if self.conn_params or not self._ensured:
+            # dedicated connections and the one-off DDL stay on the sync path
+            return await super()._run_async(plan)
+        async with async_db.async_connection() as conn:
+            async with conn.cursor() as cur:
+                result = await async_db.arun_plan(cur, plan)
+            await conn.commit()
+        return result
+
+
+class _SqliteCursor:
+    """psycopg2-style named parameters (%(name)s) on a sqlite3 cursor."""
+
+    _PARAM = re.compile(r"%\((\w+)\)s")
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def execute(self, query, params=None):
+        self._cur.execute(self._PARAM.sub(r":\1", query), params or {})
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+
+class SqliteJobStore(JobStore):
+    """Job store in a SQLite file: a stand-in for tests and local runs without Postgres."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._ensured = False
+
+    def ensure(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            conn.executescript(SQLITE_DDL)
+        finally:
+            conn.close()
+        self._ensured = True
+
+    def _ts(self, value: datetime):
+        return None if value is None else _iso(value)
+
+    @contextmanager
+    def _transaction(self):
+        if not self._ensured:
+            self.ensure()
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # the write lock is taken up front: claims and ticks are serialized like row locks would
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield _SqliteCursor(conn.cursor())
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+
+
+def _settings() -> dict:
+    return {
+        "store": setting("jobs_store", "JOBS_STORE", "postgres", str),
+        "workers": setting("jobs_workers", "JOBS_WORKERS", 2, int),
+        "poll_interval": setting("jobs_poll_interval", "JOBS_POLL_INTERVAL", 1.0, float),
+        "lease_seconds": setting("jobs_lease_seconds", "JOBS_LEASE_SECONDS", 120.0, float),
+        "max_attempts": setting("jobs_max_attempts", "JOBS_MAX_ATTEMPTS", 3, int),
+    }
+
+
+def make_store(spec: str = "postgres") -> JobStore:
+    """'postgres' for the application database, 'sqlite:<path>' for a SQLite file."""
+    if spec == "postgres":
+        return PostgresJobStore()
+    if spec.startswith("sqlite:"):
+        return SqliteJobStore(spec[len("sqlite:"):])
+    raise ValueError(f"Unknown job store: {spec} (expected 'postgres' or 'sqlite:<path>')")
+
+
+class JobService:
+    """Run queued jobs on `workers` threads and keep schedules, heartbeats and leases going.
+
+    `runner(job)` executes a job and returns its report; a report with success=False (or an
+    exception) fails the job. Every process may run a service on the same store.
+    """
+
+    def __init__(self, store: JobStore, runner, workers: int = 2, poll_interval: float = 1.0,
+                 lease_seconds: float = 120.0, max_attempts: int = 3):
+        self.store = store
+        self.runner = runner
+        self.workers = max(1, workers)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+        self._wake = threading.Condition()
+        self._threads = []
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._status = {"started": 0, "succeeded": 0, "failed": 0, "last_error": None}
+
+    def submit(self, mode: str, params: dict = None, exclusive_key: str = None) -> dict:
+        """Enqueue a job and wake a local worker; None when `exclusive_key` is taken."""
+        job = self.store.enqueue(mode, params, exclusive_key=exclusive_key)
+        if job is not None:
+            self.wake()
+        return job
+
+    async def submit_async(self, mode: str, params: dict = None, exclusive_key: str = None) -> dict:
+        """submit() for the async API handlers."""
+        job = await self.store.enqueue_async(mode, params, exclusive_key=exclusive_key)
+        if job is not None:
+            self.wake()
+        return job
+
+    def wake(self):
+        with self._wake:
+            self._wake.notify_all()
+
+    def run_job(self, job: dict) -> dict:
+        """Run a claimed job and record its outcome; returns the finished job."""
+        with self._running_lock:
+            self._running[job["job_id"]] = job
+            self._status["started"] += 1
+        report, error = None, None
+        try:
+            report = self.runner(job)
+            if isinstance(report, dict) and report.get("success") is False:
+                error = report.get("error") or "; ".join(str(e) for e in report.get("errors") or []) or "job failed"
+        except Exception as exc:
+            error = str(exc)
+        finally:
+            with self._running_lock:
+                self._running.pop(job["job_id"], None)
+        self._status["failed" if error else "succeeded"] += 1
+        self.store.finish(job["job_id"], error is None, report, error)
+        return self.store.get(job["job_id"])
+
+    def run_once(self, worker: str = None) -> dict:
+        """Claim and run one due job; returns it finished, or None when the queue is empty."""
+        job = self.store.claim(worker or self.name)
+        return self.run_job(job) if job else None
+
+    def tick(self) -> dict:
+        """Enqueue due schedules, beat for the running jobs and recover stale ones."""
+        enqueued = self.store.tick()
+        with self._running_lock:
+            running = list(self._running)
+        self.store.heartbeat(running)
+        stale = self.store.recover_stale(self.lease_seconds, self.max_attempts)
+        if enqueued or stale["requeued"]:
+            self.wake()
+        return {"enqueued": [job["job_id"] for job in enqueued], **stale}
+
+    def status(self) -> dict:
+        with self._running_lock:
+            running = sorted(self._running)
+        return {"name": self.name, "workers": self.workers, "alive": sum(t.is_alive() for t in self._threads),
+                "running": running, **self._status}
+
+    def _work(self, index: int):
+        worker = f"{self.name}/{index}"
+        while not self._stop.is_set():
+            try:
+                job = self.run_once(worker)
+            except Exception as exc:
+                self._status["last_error"] = str(exc)
+                job = None
+            if job is None:
+                with self._wake:
+                    self._wake.wait(self.poll_interval)
+
+    def _maintain(self):
+        while not self._stop.is_set():
+            try:
+                self.tick()
+            except Exception as exc:
+                self._status["last_error"] = str(exc)
+            self._stop.wait(min(self.poll_interval, self.lease_seconds / 3))
+
+    def start(self):
+        if any(t.is_alive() for t in self._threads):
+            return
+        self._stop.clear()
+        self.store.ensure()
+        self._threads = [threading.Thread(target=self._work, args=(i,), name=f"jobs-worker-{i}", daemon=True)
+                         for i in range(self.workers)]
+        self._threads.append(threading.Thread(target=self._maintain, name="jobs-maintenance", daemon=True))
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = 5):
+        self._stop.set()
+        self.wake()
+        threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join(timeout=timeout)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service(runner=None) -> JobService:
+    """Return the process-wide job service, creating it from the settings on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            settings = _settings()
+            _service = JobService(make_store(settings.pop("store")), runner, **settings)
+        elif runner is not None:
+            _service.runner = runner
+        return _service
+
+
+def stop_service():
+    global _service
+    with _service_lock:
+        service, _service = _service, None
+    if service is not None:
+        service.stop()
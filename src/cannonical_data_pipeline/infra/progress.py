@@ -0,0 +1,129 @@
+"""Bounded, live progress events of running jobs.
+
+A ProgressLog is a ring buffer of events ({seq, time, kind, ...fields}) appended while a job
+runs: pipeline steps starting and finishing, row progress of batched steps, output lines of step
+subprocesses. Only the last `capacity` events are kept, so a long or chatty run has a fixed memory
+footprint; readers follow the log by sequence number (since/wait) and learn how many events they
+missed when the buffer wrapped. The log is callable as log(kind, **fields), which is the
+`on_event` signature of the pipeline runners.
+
+Logs are registered by job id (open_log/get_log) for the streaming endpoint; finished logs are
+kept until `max_logs` newer ones were opened. tail() returns the last events within a byte budget
+for the persisted job report; tail_text() caps a captured output string the same way.
+"""
+import json
+import threading
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+
+from src.cannonical_data_pipeline.infra.commons import setting
+
+MAX_LINE_CHARS = 2000
+
+
+def _settings() -> dict:
+    return {
+        "capacity": setting("progress_buffer_events", "PROGRESS_BUFFER_EVENTS", 1000, int),
+        "tail_bytes": setting("progress_tail_bytes", "PROGRESS_TAIL_BYTES", 16384, int),
+        "max_logs": setting("progress_max_logs", "PROGRESS_MAX_LOGS", 50, int),
+    }
+
+
+def tail_text(text, max_bytes: int = None):
+    """Return the last `max_bytes` (UTF-8) of `text`, marked when something was cut."""
+    if text is None:
+        return None
+    max_bytes = _settings()["tail_bytes"] if max_bytes is None else max_bytes
+    data = text.encode("utf-8")
+    if len(data) <= max_bytes:
+        return text
+    kept = data[-max_bytes:].decode("utf-8", errors="ignore")
+    return f"[... {len(data) - max_bytes} bytes truncated]\n{kept}"
+
+
+class ProgressLog:
+    """Thread-safe ring buffer of the last `capacity` progress events of one run."""
+
+    def __init__(self, capacity: int = 1000):
+        self.capacity = max(1, capacity)
+        self._events = deque(maxlen=self.capacity)
+        self._seq = 0
+        self._cond = threading.Condition()
+        self.closed = False
+
+    def emit(self, kind: str, **fields) -> dict:
+        for key, value in fields.items():
+            if isinstance(value, str) and len(value) > MAX_LINE_CHARS:
+                fields[key] = value[:MAX_LINE_CHARS] + "..."
+        with self._cond:
+            self._seq += 1
+            event = {"seq": self._seq, "time": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+                     "kind": kind, **fields}
+            self._events.append(event)
+            self._cond.notify_all()
+        return event
+
+    __call__ = emit
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    @property
+    def last_seq(self) -> int:
+        return self._seq
+
+    def since(self, seq: int = 0):
+        """Return (events after `seq`, number of those events already dropped from the buffer)."""
+        with self._cond:
+            events = [event for event in self._events if event["seq"] > seq]
+            first = events[0]["seq"] if events else self._seq + 1
+            return events, max(first - seq - 1, 0)
+
+    def wait(self, seq: int = 0, timeout: float = None):
+        """Like since(), blocking up to `timeout` seconds until there is an event after `seq` or the log closes."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._seq > seq or self.closed, timeout)
+        return self.since(seq)
+
+    def tail(self, max_bytes: int = None) -> list:
+        """The most recent events whose JSON fits in `max_bytes`, oldest first."""
+        max_bytes = _settings()["tail_bytes"] if max_bytes is None else max_bytes
+        with self._cond:
+            events = list(self._events)
+        kept, size = [], 0
+        for event in reversed(events):
+            size += len(json.dumps(event, ensure_ascii=False, default=str).encode("utf-8")) + 1
+            if size > max_bytes:
+                break
+            kept.append(event)
+        kept.reverse()
+        return kept
+
+
+_logs = OrderedDict()
+_logs_lock = threading.Lock()
+
+
+def open_log(key, capacity: int = None) -> ProgressLog:
+    """Create and register the log of `key` (e.g. a job id), dropping the oldest finished logs."""
+    settings = _settings()
+    log = ProgressLog(settings["capacity"] if capacity is None else capacity)
+    with _logs_lock:
+        _logs[key] = log
+        _logs.move_to_end(key)
+        for old in [k for k, v in _logs.items() if v.closed][:max(len(_logs) - settings["max_logs"], 0)]:
+            del _logs[old]
+    return log
+
+
+def get_log(key) -> ProgressLog:
+    with _logs_lock:
+        return _logs.get(key)
+
+
+def emit(on_event, kind: str, **fields):
+    """Send an event to an optional on_event callback."""
+    if on_event is not None:
+        on_event(kind, **fields)
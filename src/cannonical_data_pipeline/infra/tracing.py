@@ -0,0 +1,263 @@
+"""Statement tracing of the deduplication steps.
+
+Connections handed out by infra.db create TracingCursor cursors. Inside trace_step(name) every
+statement such a cursor runs (execute, executemany, copy_expert, callproc) is recorded with its
+duration, rowcount and error, whichever connection or thread runs it: the trace is a context
+variable, so worker threads started with contextvars.copy_context().run record into it too.
+Outside a trace the cursor only checks the context variable.
+
+StepTrace.summary() is what the step reports carry under `trace`: totals, the queries that took
+most time (statements are grouped by their text before parameter binding, so the batches of a
+chunked step add up) and, under `log`, the first `max_statements` statements in order. Under the plan capture
+of deduplication.explain the statements run on PlanCursor, which records them here as well,
+adding the buffer counts of their EXPLAIN (ANALYZE, BUFFERS) plans.
+
+With otlp_enable a traced step is an OpenTelemetry span and every statement a child span of it.
+The API registers its exporter in main.py; init_exporter() gives other processes (the CLIs) an
+OTLP exporter when none is registered yet.
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    from psycopg2.extensions import cursor as _base_cursor
+except Exception:
+    _base_cursor = object
+
+try:
+    from opentelemetry import trace as otel_trace
+except Exception:
+    otel_trace = None
+
+from src.cannonical_data_pipeline.infra.commons import setting
+
+_current = contextvars.ContextVar('statement_trace', default=None)
+_config = None
+_config_lock = threading.Lock()
+
+
+def _settings() -> dict:
+    return {
+        'max_statements': setting('trace_max_statements', 'TRACE_MAX_STATEMENTS', 50, int),
+        'statement_chars': setting('trace_statement_chars', 'TRACE_STATEMENT_CHARS', 300, int),
+        'top_queries': setting('trace_top_queries', 'TRACE_TOP_QUERIES', 10, int),
+        'otlp_enable': setting('otlp_enable', 'OTLP_ENABLE', False, bool),
+        'otlp_endpoint': setting('otlp_grpc_endpoint', 'OTLP_GRPC_ENDPOINT', 'http://localhost:4317', str),
+    }
+
+
+def config() -> dict:
+    """The tracing settings, read once per process."""
+    global _config
+    with _config_lock:
+        if _config is None:
+            _config = _settings()
+        return _config
+
+
+def _tracer():
+    if otel_trace is None or not config()['otlp_enable']:
+        return None
+    return otel_trace.get_tracer(__name__)
+
+
+def init_exporter(service_name: str = 'cannonical-data-pipeline') -> bool:
+    """Register an OTLP span exporter unless otlp_enable is off or a tracer provider exists.
+
+    Returns True when spans of this process are exported.
+    """
+    if _tracer() is None:
+        return False
+    try:
+        from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    except Exception:
+        return False
+    if isinstance(otel_trace.get_tracer_provider(), TracerProvider):
+        return True
+    provider = TracerProvider(resource=Resource.create({'service.name': service_name}))
+    provider.add_span_processor(BatchSpanProcessor(OTLPSpanExporter(endpoint=config()['otlp_endpoint'])))
+    otel_trace.set_tracer_provider(provider)  # flushed by the provider's atexit shutdown
+    return True
+
+
+class StepTrace:
+    """Statements recorded for one step (thread-safe)."""
+
+    def __init__(self, name: str, max_statements: int = 50, statement_chars: int = 300, top_queries: int = 10):
+        self.name = name
+        self.max_statements = max_statements
+        self.statement_chars = statement_chars
+        self.top_queries = top_queries
+        self.statements = []
+        self.dropped = 0
+        self.seconds = None
+        self._queries = {}  # statement text -> aggregate
+        self._totals = {'statements': 0, 'seconds': 0.0, 'rows': 0, 'errors': 0}
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+
+    def record(self, statement: str, seconds: float, rowcount=None, error=None, buffers=None, kind='execute'):
+        statement = statement[:self.statement_chars]
+        rows = rowcount if isinstance(rowcount, int) and rowcount > 0 else 0
+        entry = {'statement': statement, 'kind': kind, 'seconds': round(seconds, 6), 'rowcount': rowcount}
+        if error:
+            entry['error'] = error
+        if buffers:
+            entry['buffers'] = buffers
+        with self._lock:
+            self._totals['statements'] += 1
+            self._totals['seconds'] += seconds
+            self._totals['rows'] += rows
+            self._totals['errors'] += 1 if error else 0
+            query = self._queries.get(statement)
+            if query is None:
+                query = self._queries[statement] = {'statement': statement, 'calls': 0, 'seconds': 0.0,
+                                                    'max_seconds': 0.0, 'rows': 0, 'errors': 0}
+            query['calls'] += 1
+            query['seconds'] += seconds
+            query['max_seconds'] = max(query['max_seconds'], seconds)
+            query['rows'] += rows
+            query['errors'] += 1 if error else 0
+            for key, value in (buffers or {}).items():
+                query.setdefault('buffers', {})
+                query['buffers'][key] = query['buffers'].get(key, 0) + value
+            if len(self.statements) < self.max_statements:
+                self.statements.append(entry)
+            else:
+                self.dropped += 1
+
+    def finish(self):
+        """Fix the step's wall time; later calls keep the first."""
+        if self.seconds is None:
+            self.seconds = round(time.perf_counter() - self._started, 3)
+
+    def summary(self) -> dict:
+        with self._lock:
+            queries = sorted(self._queries.values(), key=lambda q: q['seconds'], reverse=True)[:self.top_queries]
+            return {
+                **self._totals,
+                'seconds': round(self._totals['seconds'], 6),
+                'wall_seconds': self.seconds,
+                'distinct_queries': len(self._queries),
+                'top_queries': [{**q, 'seconds': round(q['seconds'], 6), 'max_seconds': round(q['max_seconds'], 6)}
+                                for q in queries],
+                'log': list(self.statements),
+                'log_dropped': self.dropped,
+            }
+
+
+def current():
+    """The StepTrace of the running step, or None."""
+    return _current.get()
+
+
+def _operation(statement: str) -> str:
+    words = statement.split(None, 1)
+    return words[0].upper() if words else ''
+
+
+def record(statement: str, seconds: float, rowcount=None, error=None, buffers=None, kind='execute'):
+    """Record a finished statement in the current trace (no-op outside one) and export its span."""
+    trace = _current.get()
+    if trace is None:
+        return
+    trace.record(statement, seconds, rowcount, error, buffers, kind)
+    tracer = _tracer()
+    if tracer is None:
+        return
+    end = time.time_ns()
+    span = tracer.start_span(_operation(statement) or kind, start_time=end - int(seconds * 1e9))
+    span.set_attribute('db.system', 'postgresql')
+    span.set_attribute('db.operation', _operation(statement))
+    span.set_attribute('db.statement', statement[:trace.statement_chars])
+    span.set_attribute('pipeline.step', trace.name)
+    if isinstance(rowcount, int):
+        span.set_attribute('db.rowcount', rowcount)
+    for key, value in (buffers or {}).items():
+        span.set_attribute(f'db.buffers.{key}', value)
+    if error:
+        span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR, error))
+    span.end(end_time=end)
+
+
+def _text(cur, query) -> str:
+    if hasattr(query, 'as_string'):
+        try:
+            return query.as_string(cur)
+        except Exception:
+            return str(query)
+    if isinstance(query, bytes):
+        return query.decode('utf-8', 'replace')
+    return str(query)
+
+
+def _traced(cur, kind, query, call, *args):
+    if _current.get() is None:
+        return call(*args)
+    started = time.perf_counter()
+    error = None
+    try:
+        return call(*args)
+    except Exception as exc:
+        error = str(exc).strip().split('\n', 1)[0]
+        raise
+    finally:
+        rowcount = None if error else getattr(cur, 'rowcount', None)
+        record(_text(cur, query).strip(), time.perf_counter() - started, rowcount, error, kind=kind)
+
+
+class TracingCursor(_base_cursor):
+    """psycopg2 cursor recording its statements into the current StepTrace (see the module docstring)."""
+
+    def execute(self, query, vars=None):
+        return _traced(self, 'execute', query, super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return _traced(self, 'executemany', query, super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return _traced(self, 'copy', sql, super().copy_expert, sql, file, size)
+
+    def callproc(self, procname, parameters=None):
+        return _traced(self, 'callproc', procname, super().callproc, procname, parameters)
+
+
+@contextmanager
+def trace_step(name: str):
+    """Trace the statements run inside the block; yields the StepTrace (a span with otlp_enable)."""
+    settings = config()
+    trace = StepTrace(name, settings['max_statements'], settings['statement_chars'], settings['top_queries'])
+    tracer = _tracer()
+    token = _current.set(trace)
+    try:
+        if tracer is None:
+            yield trace
+        else:
+            with tracer.start_as_current_span(f'step {name}') as span:
+                span.set_attribute('pipeline.step', name)
+                try:
+                    yield trace
+                finally:
+                    trace.finish()
+                    totals = trace.summary()
+                    for key in ('statements', 'rows', 'errors', 'distinct_queries', 'wall_seconds'):
+                        span.set_attribute(f'pipeline.{key}', totals[key])
+    finally:
+        _current.reset(token)
+        trace.finish()
+
+
+def traced(name: str, fn, *args, **kwargs):
+    """Run a step function under trace_step (exporting spans with otlp_enable) and add its trace
+    to the returned report. Used by the step modules' command line entry points."""
+    init_exporter()
+    with trace_step(name) as trace:
+        report = fn(*args, **kwargs)
+    if isinstance(report, dict):
+        report['trace'] = trace.summary()
+    return report
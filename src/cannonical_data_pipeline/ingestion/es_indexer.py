@@ -0,0 +1,410 @@
+"""Bulk-index deduplicated_institutions_kb into Elasticsearch.
+
+Rows are streamed from Postgres with a server-side (named) cursor and folded into one document
+per canonical uuid_institution: the rows update_uuids merged into that uuid contribute their
+original names and deprecated uuids. Documents are sent through the `_bulk` API in batches of
+`batch_size`, with at most `max_in_flight` batches outstanding, so memory stays bounded by
+batch_size * max_in_flight documents whatever the table size.
+
+Back-pressure: a 429 (or 503) on a whole request, or on single items of a bulk response, makes
+every sender pause (honouring Retry-After, otherwise exponential backoff) before the rejected
+actions are retried, up to `max_retries` times. Any other per-document failure is captured in
+the report with its _id, status, error type and reason.
+"""
+import json
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import acquire_connection, release_connection
+
+DEDUP_TABLE = "deduplicated_institutions_kb"
+MAX_REPORTED_ERRORS = 100
+
+BACKOFF_BASE = 0.5  # seconds; doubled per retry of the same batch
+BACKOFF_MAX = 30.0
+THROTTLE_STATUSES = (429, 503)
+
+INDEX_SETTINGS = {
+    "mappings": {
+        "properties": {
+            "uuid_institution": {"type": "keyword"},
+            "institution": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 512}}},
+            "english_name": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 512}}},
+            "parent_institution": {"type": "keyword"},
+            "uuid_country": {"type": "keyword"},
+            "original_institutions": {"type": "text", "fields": {"keyword": {"type": "keyword", "ignore_above": 512}}},
+            "deprecated_uuids": {"type": "keyword"},
+            "was_deduplicated": {"type": "boolean"},
+            "deduplication_timestamp": {"type": "date"},
+            "ror_id": {"type": "keyword"},
+        }
+    }
+}
+
+# Columns add_columns/update_uuids provide; the document query relies on them
+REQUIRED_COLUMNS = ("id", "uuid_institution", "uuid_country", "uuid_deprecated")
+# Per-institution attributes taken from the first row (by id) of a canonical uuid that has them
+FIRST_VALUE_COLUMNS = ("institution", "english_name", "parent_institution", "uuid_country")
+OPTIONAL_COLUMNS = ("ror_id", "ror_score", "ror_match", "ror_fuzzy_fallback_used")
+
+
+def es_settings() -> dict:
+    """Read the Elasticsearch settings from app_settings, falling back to environment variables."""
+    return {
+        "url": setting("es_url", "ES_URL", "http://localhost:9200", str),
+        "index": setting("es_index", "ES_INDEX", "rda_institutions", str),
+        "username": setting("es_username", "ES_USERNAME", None, str),
+        "password": setting("es_password", "ES_PASSWORD", None, str),
+        "api_key": setting("es_api_key", "ES_API_KEY", None, str),
+        "batch_size": setting("es_bulk_batch_size", "ES_BULK_BATCH_SIZE", 500, int),
+        "max_in_flight": setting("es_bulk_max_in_flight", "ES_BULK_MAX_IN_FLIGHT", 4, int),
+        "max_retries": setting("es_bulk_max_retries", "ES_BULK_MAX_RETRIES", 5, int),
+        "timeout": setting("es_request_timeout", "ES_REQUEST_TIMEOUT", 60.0, float),
+    }
+
+
+def documents_sql(columns, where: str = "") -> str:
+    """SELECT returning one document row per canonical uuid_institution, ordered by it."""
+    first_values = ",\n    ".join(
+        f"(array_agg(d.{col} ORDER BY d.id) FILTER (WHERE d.{col} IS NOT NULL))[1] AS {col}"
+        for col in FIRST_VALUE_COLUMNS + tuple(c for c in OPTIONAL_COLUMNS if c in columns)
+    )
+    return f"""
+SELECT
+    d.uuid_institution,
+    {first_values},
+    array_agg(DISTINCT d.original_institution) FILTER (WHERE d.original_institution IS NOT NULL) AS original_institutions,
+    array_agg(DISTINCT d.uuid_deprecated)
+        FILTER (WHERE d.uuid_deprecated IS NOT NULL AND d.uuid_deprecated <> d.uuid_institution) AS deprecated_uuids,
+    bool_or(d.was_deduplicated) AS was_deduplicated,
+    MAX(d.deduplication_timestamp) AS deduplication_timestamp
+FROM {DEDUP_TABLE} d
+WHERE d.uuid_institution IS NOT NULL{where}
+GROUP BY d.uuid_institution
+ORDER BY d.uuid_institution
+"""
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    return value
+
+
+def row_to_document(row: dict) -> dict:
+    """Turn a documents_sql() row into an ES document (JSON-ready values, empty arrays for NULL)."""
+    doc = {key: _json_value(value) for key, value in row.items()}
+    doc["original_institutions"] = doc.get("original_institutions") or []
+    doc["deprecated_uuids"] = doc.get("deprecated_uuids") or []
+    return doc
+
+
+def table_columns(cur) -> set:
+    return get_catalog(cur).column_names(DEDUP_TABLE)
+
+
+def stream_rows(conn, query, params=None, batch_size: int = 500, name: str = "es_documents"):
+    """Yield the rows of `query` as dicts from a server-side cursor fetching `batch_size` rows per trip.
+
+    Runs in the connection's current transaction, which the caller ends.
+    """
+    with conn.cursor(name=name) as cur:
+        cur.itersize = batch_size
+        cur.execute(query, params)
+        names = None
+        for row in cur:
+            if names is None:
+                names = [d[0] for d in cur.description]
+            yield dict(zip(names, row))
+
+
+def check_columns(conn) -> set:
+    """Return the columns of the deduplicated table; raise when add_columns has not run on it."""
+    with conn.cursor() as cur:
+        columns = table_columns(cur)
+    missing = [c for c in REQUIRED_COLUMNS if c not in columns]
+    if missing:
+        raise RuntimeError(f"table {DEDUP_TABLE} lacks column(s) {', '.join(missing)}; run add_columns first")
+    return columns
+
+
+def iter_documents(conn, batch_size: int = 500, where: str = "", params=None):
+    """Yield (uuid_institution, document) for every canonical institution, streamed server-side."""
+    columns = check_columns(conn)
+    for row in stream_rows(conn, documents_sql(columns, where), params, batch_size):
+        doc = row_to_document(row)
+        yield doc["uuid_institution"], doc
+
+
+class BulkClient:
+    """Small `_bulk` client sharing one HTTP connection pool and one back-pressure clock.
+
+    Thread-safe: batches are sent from several worker threads. When any of them is throttled,
+    all of them wait until the pause has passed before sending again.
+    """
+
+    def __init__(self, url: str, index: str, username=None, password=None, api_key=None,
+                 timeout: float = 60.0, max_retries: int = 5, pool_size: int = 4):
+        self.url = url.rstrip("/")
+        self.index = index
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if api_key:
+            self.session.headers["Authorization"] = f"ApiKey {api_key}"
+        elif username:
+            self.session.auth = (username, password or "")
+        self._lock = threading.Lock()
+        self._pause_until = 0.0
+
+    @classmethod
+    def from_settings(cls, settings: dict = None, **overrides):
+        conf = dict(settings or es_settings())
+        conf.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(conf["url"], conf["index"], username=conf.get("username"), password=conf.get("password"),
+                   api_key=conf.get("api_key"), timeout=conf.get("timeout", 60.0),
+                   max_retries=conf.get("max_retries", 5), pool_size=conf.get("max_in_flight", 4))
+
+    def close(self):
+        self.session.close()
+
+    def _wait_back_pressure(self):
+        with self._lock:
+            delay = self._pause_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _throttle(self, attempt: int, retry_after=None):
+        """Push the shared pause out to Retry-After seconds or the backoff for `attempt`."""
+        try:
+            delay = float(retry_after)
+        except (TypeError, ValueError):
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempt - 1)))
+        with self._lock:
+            self._pause_until = max(self._pause_until, time.monotonic() + delay)
+
+    def ensure_index(self, settings: dict = None) -> bool:
+        """Create the index with INDEX_SETTINGS unless it exists; returns True when it was created."""
+        resp = self.session.head(f"{self.url}/{self.index}", timeout=self.timeout)
+        if resp.status_code == 200:
+            return False
+        resp = self.session.put(f"{self.url}/{self.index}", json=settings or INDEX_SETTINGS, timeout=self.timeout)
+        if resp.status_code >= 400 and "resource_already_exists_exception" not in resp.text:
+            raise RuntimeError(f"failed to create index {self.index}: HTTP {resp.status_code} {resp.text[:500]}")
+        return resp.status_code < 400
+
+    def refresh(self):
+        self.session.post(f"{self.url}/{self.index}/_refresh", timeout=self.timeout)
+
+    def _body(self, actions) -> bytes:
+        lines = []
+        for op, doc_id, doc, *_ in actions:
+            lines.append(json.dumps({op: {"_index": self.index, "_id": doc_id}}))
+            if op != "delete":
+                lines.append(json.dumps(doc, ensure_ascii=False))
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def bulk(self, actions) -> dict:
+        """Send one batch of (op, _id, document, *meta) actions, op being index or delete.
+
+        Returns {'ok': n, 'failed': [{_id, op, status, type, reason}], 'retries': n, 'throttled': n}.
+        A delete of a missing document counts as ok.
+        """
+        result = {"ok": 0, "failed": [], "retries": 0, "throttled": 0}
+        pending = list(actions)
+        attempt = 0
+
+        def _fail_all(items, status, error_type, reason):
+            result["failed"].extend({"_id": doc_id, "op": op, "status": status, "type": error_type, "reason": reason}
+                                    for op, doc_id, *_ in items)
+
+        while pending:
+            self._wait_back_pressure()
+            try:
+                resp = self.session.post(f"{self.url}/_bulk", data=self._body(pending), timeout=self.timeout,
+                                         headers={"Content-Type": "application/x-ndjson"})
+            except requests.RequestException as exc:
+                attempt += 1
+                if attempt > self.max_retries:
+                    _fail_all(pending, None, type(exc).__name__, str(exc))
+                    break
+                result["retries"] += 1
+                self._throttle(attempt)
+                continue
+
+            if resp.status_code in THROTTLE_STATUSES:
+                result["throttled"] += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    _fail_all(pending, resp.status_code, "throttled", f"gave up after {self.max_retries} retries")
+                    break
+                result["retries"] += 1
+                self._throttle(attempt, resp.headers.get("Retry-After"))
+                continue
+            if resp.status_code >= 400:
+                _fail_all(pending, resp.status_code, "bulk_request_failed", resp.text[:500])
+                break
+
+            items = resp.json().get("items", [])
+            retry = []
+            for action, item in zip(pending, items):
+                op, res = next(iter(item.items()))
+                status = res.get("status", 0)
+                if status < 300 or (op == "delete" and status == 404):
+                    result["ok"] += 1
+                elif status in THROTTLE_STATUSES:
+                    retry.append(action)
+                else:
+                    error = res.get("error") or {}
+                    if not isinstance(error, dict):
+                        error = {"reason": str(error)}
+                    result["failed"].append({"_id": res.get("_id", action[1]), "op": op, "status": status,
+                                             "type": error.get("type"), "reason": error.get("reason")})
+            if len(items) < len(pending):
+                _fail_all(pending[len(items):], None, "missing_item", "no item in bulk response")
+
+            if retry:
+                result["throttled"] += 1
+                attempt += 1
+                if attempt > self.max_retries:
+                    _fail_all(retry, 429, "throttled", f"gave up after {self.max_retries} retries")
+                    break
+                result["retries"] += 1
+                self._throttle(attempt)
+            pending = retry
+        return result
+
+
+def _batches(actions, batch_size: int):
+    batch = []
+    for action in actions:
+        batch.append(action)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_actions(client: BulkClient, actions, batch_size: int = 500, max_in_flight: int = 4,
+                 report: dict = None, on_batch=None) -> dict:
+    """Send (op, _id, document, *meta) `actions` through client.bulk in concurrent batches.
+
+    At most `max_in_flight` batches are outstanding: reading the next batch from `actions`
+    waits for a slot, so a slow or throttling cluster slows the producer down as well.
+    Counters are added to `report` (documents, ok, failed, batches, retries, throttled, errors).
+    `on_batch(batch, result)` is called from the sending thread after every batch; an exception
+    it raises is recorded in report["callback_errors"].
+    """
+    report = report if report is not None else {}
+    for key in ("documents", "ok", "failed", "batches", "retries", "throttled"):
+        report.setdefault(key, 0)
+    report.setdefault("errors", [])
+    report.setdefault("callback_errors", [])
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max(1, max_in_flight))
+
+    def _merge(batch_result):
+        with lock:
+            report["batches"] += 1
+            report["ok"] += batch_result["ok"]
+            report["failed"] += len(batch_result["failed"])
+            report["retries"] += batch_result["retries"]
+            report["throttled"] += batch_result["throttled"]
+            room = MAX_REPORTED_ERRORS - len(report["errors"])
+            if room > 0:
+                report["errors"].extend(batch_result["failed"][:room])
+
+    def _send(batch):
+        try:
+            try:
+                result = client.bulk(batch)
+            except Exception as exc:
+                result = {"ok": 0, "retries": 0, "throttled": 0,
+                          "failed": [{"_id": doc_id, "op": op, "status": None, "type": type(exc).__name__,
+                                      "reason": str(exc)} for op, doc_id, *_ in batch]}
+            _merge(result)
+            if on_batch is not None:
+                try:
+                    on_batch(batch, result)
+                except Exception as exc:
+                    with lock:
+                        if len(report["callback_errors"]) < MAX_REPORTED_ERRORS:
+                            report["callback_errors"].append(str(exc))
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max(1, max_in_flight), thread_name_prefix="es-bulk") as pool:
+        for batch in _batches(actions, batch_size):
+            slots.acquire()
+            with lock:
+                report["documents"] += len(batch)
+            pool.submit(_send, batch)
+    return report
+
+
+def index_institutions(conn_params=None, index: str = None, es_url: str = None, batch_size: int = None,
+                       max_in_flight: int = None, create_index: bool = True, refresh: bool = True) -> dict:
+    """Index every canonical institution of deduplicated_institutions_kb into Elasticsearch.
+
+    Without arguments the ES settings come from es_settings() and the connection from the pool.
+    Returns a dict with keys: success, index, documents, indexed, failed, batches, retries,
+    throttled, errors (first MAX_REPORTED_ERRORS per-document failures), error, seconds and
+    docs_per_second.
+    """
+    settings = es_settings()
+    batch_size = batch_size or settings["batch_size"]
+    max_in_flight = max_in_flight or settings["max_in_flight"]
+    client = BulkClient.from_settings(settings, url=es_url, index=index, max_in_flight=max_in_flight)
+    report = {"success": False, "index": client.index, "documents": 0, "indexed": 0, "failed": 0, "batches": 0,
+              "retries": 0, "throttled": 0, "errors": [], "error": None, "seconds": None, "docs_per_second": None}
+
+    started = time.monotonic()
+    conn = None
+    try:
+        if create_index:
+            report["index_created"] = client.ensure_index()
+        conn = acquire_connection(conn_params)
+        actions = (("index", doc_id, doc) for doc_id, doc in iter_documents(conn, batch_size))
+        bulk_actions(client, actions, batch_size=batch_size, max_in_flight=max_in_flight, report=report)
+        report["indexed"] = report.pop("ok")
+        if refresh:
+            client.refresh()
+        report["success"] = report["failed"] == 0
+    except Exception as exc:
+        report["error"] = str(exc)
+    finally:
+        report.pop("ok", None)
+        report.pop("callback_errors", None)
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        release_connection(conn)
+        client.close()
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    if report["seconds"]:
+        report["docs_per_second"] = round(report["indexed"] / report["seconds"], 1)
+    return report
+
+
+if __name__ == '__main__':
+    res = index_institutions()
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
@@ -0,0 +1,376 @@
+"""Incremental Elasticsearch sync of deduplicated_institutions_kb.
+
+The content hash of every indexed document is kept in `es_sync_state`, keyed by
+(es_index, uuid_institution), so every index has its own state. A sync computes the hashes in Postgres and streams only the documents whose
+hash differs from the stored one (new or changed institutions). It then deletes the documents
+whose uuid_institution no longer exists, which covers the uuids update_uuids deprecated. The
+canonical document keeps those uuids in `deprecated_uuids`, so they stay searchable as aliases.
+
+The state of a document is written only after Elasticsearch accepted it, so a failed document
+is retried by the next sync. Every run is recorded in `es_sync_runs`; sync_counts() and
+sync_lag() report from these tables.
+"""
+import json
+import sys
+import threading
+import time
+from datetime import datetime
+from itertools import chain
+
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.async_db import afetch_plan
+from src.cannonical_data_pipeline.infra.db import acquire_connection, connection, release_connection, run_plan
+from src.cannonical_data_pipeline.ingestion.es_indexer import (
+    DEDUP_TABLE, BulkClient, bulk_actions, check_columns, documents_sql, es_settings, row_to_document, stream_rows,
+)
+
+STATE_SQL = """
+CREATE TABLE IF NOT EXISTS es_sync_state (
+    uuid_institution VARCHAR NOT NULL,
+    es_index TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    source_timestamp TIMESTAMPTZ,
+    indexed_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (es_index, uuid_institution)
+);
+CREATE INDEX IF NOT EXISTS es_sync_state_indexed_at_idx ON es_sync_state (es_index, indexed_at);
+
+CREATE TABLE IF NOT EXISTS es_sync_runs (
+    run_id BIGSERIAL PRIMARY KEY,
+    es_index TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    started_at TIMESTAMPTZ NOT NULL,
+    finished_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    success BOOLEAN NOT NULL,
+    indexed INTEGER NOT NULL DEFAULT 0,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT
+);
+"""
+
+STATE_KEY = ("es_index", "uuid_institution")
+
+# State tables created when the key was uuid_institution alone: the indexes overwrote each other's state
+MIGRATE_STATE_KEY_SQL = """
+ALTER TABLE es_sync_state DROP CONSTRAINT es_sync_state_pkey, ADD PRIMARY KEY (es_index, uuid_institution);
+"""
+
+# Serialise syncs against each other
+SYNC_LOCK_KEY = 8_151_913
+
+# deduplication_timestamp is reset by every rebuild, so it is not part of the content
+CONTENT_HASH = "md5((to_jsonb(docs) - 'deduplication_timestamp')::text)"
+
+# uuids in the state that no longer identify a canonical institution (e.g. deprecated by update_uuids)
+STALE_SQL = f"""
+SELECT s.uuid_institution
+FROM es_sync_state s
+WHERE s.es_index = %(index)s
+  AND NOT EXISTS (SELECT 1 FROM {DEDUP_TABLE} d WHERE d.uuid_institution = s.uuid_institution)
+"""
+
+# With full=True: every deprecated uuid, whether or not the state knows it was indexed
+DEPRECATED_SQL = f"""
+SELECT DISTINCT d.uuid_deprecated AS uuid_institution
+FROM {DEDUP_TABLE} d
+WHERE d.uuid_deprecated IS NOT NULL
+  AND NOT EXISTS (SELECT 1 FROM {DEDUP_TABLE} c WHERE c.uuid_institution = d.uuid_deprecated)
+UNION
+""" + STALE_SQL
+
+UPSERT_STATE_SQL = """
+INSERT INTO es_sync_state (uuid_institution, es_index, content_hash, source_timestamp, indexed_at) VALUES %s
+ON CONFLICT (es_index, uuid_institution) DO UPDATE SET
+    content_hash = EXCLUDED.content_hash,
+    source_timestamp = EXCLUDED.source_timestamp,
+    indexed_at = EXCLUDED.indexed_at
+"""
+
+RECORD_RUN_SQL = """
+INSERT INTO es_sync_runs (es_index, mode, started_at, success, indexed, deleted, failed, error)
+VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+
+def ensure_state_tables(cur):
+    cur.execute(STATE_SQL)
+    catalog.invalidate()
+    primary_key = catalog.get_catalog(cur).primary_key("es_sync_state")
+    if primary_key and primary_key != STATE_KEY:
+        cur.execute(MIGRATE_STATE_KEY_SQL)
+        catalog.invalidate()
+
+
+def changed_documents_sql(columns, full: bool = False) -> str:
+    """Documents (plus their content_hash) whose hash differs from the state for %(index)s."""
+    changed = "TRUE" if full else f"s.content_hash IS DISTINCT FROM {CONTENT_HASH}"
+    return f"""
+SELECT docs.*, {CONTENT_HASH} AS content_hash
+FROM ({documents_sql(columns)}) docs
+LEFT JOIN es_sync_state s ON s.uuid_institution = docs.uuid_institution AND s.es_index = %(index)s
+WHERE {changed}
+"""
+
+
+def _index_actions(rows):
+    for row in rows:
+        content_hash = row.pop("content_hash")
+        source_timestamp = row.get("deduplication_timestamp")
+        doc = row_to_document(row)
+        yield "index", doc["uuid_institution"], doc, content_hash, source_timestamp
+
+
+def _delete_actions(rows):
+    for row in rows:
+        yield "delete", row["uuid_institution"], None
+
+
+def _apply_state(index: str, batch, result, conn_params=None) -> tuple:
+    """Record the accepted actions of a batch in es_sync_state; returns (indexed, deleted)."""
+    failed = {(f["op"], f["_id"]) for f in result["failed"]}
+    now = datetime.now().astimezone()
+    upserts, deletes = [], []
+    for op, doc_id, _, *meta in batch:
+        if (op, doc_id) in failed:
+            continue
+        if op == "delete":
+            deletes.append(doc_id)
+        else:
+            content_hash, source_timestamp = meta
+            upserts.append((doc_id, index, content_hash, source_timestamp, now))
+    with connection(conn_params) as conn:
+        with conn.cursor() as cur:
+            if upserts:
+                execute_values(cur, UPSERT_STATE_SQL, upserts)
+            if deletes:
+                cur.execute("DELETE FROM es_sync_state WHERE es_index = %s AND uuid_institution = ANY(%s);",
+                            (index, deletes))
+        conn.commit()
+    return len(upserts), len(deletes)
+
+
+def sync_institutions(conn_params=None, index: str = None, es_url: str = None, batch_size: int = None,
+                      max_in_flight: int = None, full: bool = False, create_index: bool = True,
+                      refresh: bool = True) -> dict:
+    """Sync the changed canonical institutions to Elasticsearch and delete the stale ones.
+
+    full=True re-sends every document and deletes every deprecated uuid, e.g. after the index
+    was recreated. Returns a dict with keys: success, index, mode, documents (actions sent),
+    indexed, deleted, failed, batches, retries, throttled, errors (first per-document failures),
+    error and seconds.
+    """
+    settings = es_settings()
+    batch_size = batch_size or settings["batch_size"]
+    max_in_flight = max_in_flight or settings["max_in_flight"]
+    client = BulkClient.from_settings(settings, url=es_url, index=index, max_in_flight=max_in_flight)
+    report = {"success": False, "index": client.index, "mode": "full" if full else "incremental",
+              "documents": 0, "indexed": 0, "deleted": 0, "failed": 0, "batches": 0, "retries": 0,
+              "throttled": 0, "errors": [], "error": None, "seconds": None}
+    counts_lock = threading.Lock()
+    started_at = datetime.now().astimezone()
+    started = time.monotonic()
+
+    def _on_batch(batch, result):
+        indexed, deleted = _apply_state(client.index, batch, result, conn_params)
+        with counts_lock:
+            report["indexed"] += indexed
+            report["deleted"] += deleted
+
+    conn = None
+    try:
+        conn = acquire_connection(conn_params)
+        with conn.cursor() as cur:
+            ensure_state_tables(cur)
+        conn.commit()
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_try_advisory_xact_lock(%s);", (SYNC_LOCK_KEY,))
+            if not cur.fetchone()[0]:
+                raise RuntimeError("another Elasticsearch sync is running")
+        columns = check_columns(conn)
+        if create_index:
+            report["index_created"] = client.ensure_index()
+
+        params = {"index": client.index}
+        actions = chain(
+            _index_actions(stream_rows(conn, changed_documents_sql(columns, full), params, batch_size)),
+            _delete_actions(stream_rows(conn, DEPRECATED_SQL if full else STALE_SQL, params, batch_size,
+                                        name="es_stale")),
+        )
+        bulk_actions(client, actions, batch_size=batch_size, max_in_flight=max_in_flight, report=report,
+                     on_batch=_on_batch)
+        report.pop("ok", None)
+        if report["callback_errors"]:
+            report["error"] = f"failed to record sync state: {report['callback_errors'][0]}"
+        if refresh and report["documents"]:
+            client.refresh()
+        report["success"] = report["failed"] == 0 and not report["error"]
+    except Exception as exc:
+        report["error"] = str(exc)
+    finally:
+        report.pop("ok", None)
+        report.pop("callback_errors", None)
+        if conn is not None:
+            try:
+                conn.rollback()
+            except Exception:
+                pass
+        release_connection(conn)
+        client.close()
+
+    report["seconds"] = round(time.monotonic() - started, 3)
+    try:
+        with connection(conn_params) as conn:
+            with conn.cursor() as cur:
+                ensure_state_tables(cur)
+                cur.execute(RECORD_RUN_SQL, (client.index, report["mode"], started_at, report["success"],
+                                             report["indexed"], report["deleted"], report["failed"], report["error"]))
+            conn.commit()
+    except Exception as exc:
+        report.setdefault("warnings", []).append(f"failed to record sync run: {exc}")
+    return report
+
+
+STATE_INSTALLED_SQL = "SELECT to_regclass('es_sync_state') IS NOT NULL AND to_regclass('es_sync_runs') IS NOT NULL;"
+
+
+def state_installed(cur) -> bool:
+    schema_catalog = catalog.get_catalog(cur)
+    return schema_catalog.has_table("es_sync_state") and schema_catalog.has_table("es_sync_runs")
+
+
+def last_run_plan(index: str, success_only: bool = False):
+    """Query plan (see infra.db.run_plan) of last_run()."""
+    row = yield (
+        "SELECT finished_at, success, indexed, deleted, failed FROM es_sync_runs WHERE es_index = %s"
+        + (" AND success" if success_only else "") + " ORDER BY run_id DESC LIMIT 1;",
+        (index,), "one",
+    )
+    if row is None:
+        return None
+    return {"finished_at": row[0].isoformat(), "success": row[1], "indexed": row[2], "deleted": row[3], "failed": row[4]}
+
+
+def last_run(cur, index: str, success_only: bool = False):
+    return run_plan(cur, last_run_plan(index, success_only))
+
+
+def sync_counts_plan(source_table: str = "institution", dedup_table: str = DEDUP_TABLE, es_index: str = None,
+                     since: str = None):
+    """Query plan of sync_counts()."""
+    es_index = es_index or es_settings()["index"]
+    report = {"source_count": None, "dedup_count": None, "es_count": 0, "delta_source_to_dedup": None,
+              "delta_dedup_to_es": None, "es_index": es_index, "snapshot_time": None, "last_sync": None}
+    report["source_count"] = (yield sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(source_table)),
+                              None, "one")[0]
+    report["dedup_count"] = (yield sql.SQL("SELECT COUNT(DISTINCT uuid_institution) FROM {}").format(
+        sql.Identifier(dedup_table)), None, "one")[0]
+    if (yield STATE_INSTALLED_SQL, None, "one")[0]:
+        report["es_count"] = (yield "SELECT COUNT(*) FROM es_sync_state WHERE es_index = %s;", (es_index,), "one")[0]
+        if since:
+            report["indexed_since"] = (yield "SELECT COUNT(*) FROM es_sync_state WHERE es_index = %s AND indexed_at >= %s;",
+                                       (es_index, since), "one")[0]
+        report["last_sync"] = yield from last_run_plan(es_index)
+        last_ok = yield from last_run_plan(es_index, success_only=True)
+        report["snapshot_time"] = last_ok["finished_at"] if last_ok else None
+    report["delta_source_to_dedup"] = report["source_count"] - report["dedup_count"]
+    report["delta_dedup_to_es"] = report["dedup_count"] - report["es_count"]
+    return report
+
+
+def sync_counts(conn_params=None, source_table: str = "institution", dedup_table: str = DEDUP_TABLE,
+                es_index: str = None, since: str = None) -> dict:
+    """Compare source rows, canonical institutions and documents recorded as indexed.
+
+    source_count counts `source_table` rows, dedup_count the distinct uuid_institution values of
+    `dedup_table` (one document each) and es_count the documents in es_sync_state for the index.
+    With `since` (ISO 8601) indexed_since counts the documents (re)indexed after that time.
+    """
+    with connection(conn_params) as conn:
+        try:
+            with conn.cursor() as cur:
+                return run_plan(cur, sync_counts_plan(source_table, dedup_table, es_index, since))
+        finally:
+            conn.rollback()
+
+
+async def sync_counts_async(source_table: str = "institution", dedup_table: str = DEDUP_TABLE,
+                            es_index: str = None, since: str = None) -> dict:
+    """sync_counts() on the async pool, for the API handlers."""
+    return await afetch_plan(sync_counts_plan(source_table, dedup_table, es_index, since))
+
+
+LAG_SQL = """
+SELECT COUNT(*),
+       AVG(lag),
+       percentile_cont(0.95) WITHIN GROUP (ORDER BY lag),
+       MAX(lag)
+FROM (
+    SELECT EXTRACT(EPOCH FROM indexed_at - source_timestamp) AS lag
+    FROM es_sync_state
+    WHERE es_index = %(index)s AND source_timestamp IS NOT NULL
+      AND indexed_at >= CURRENT_TIMESTAMP - make_interval(mins => %(window)s)
+) lags
+"""
+
+LAG_SAMPLES_SQL = """
+SELECT uuid_institution, indexed_at, EXTRACT(EPOCH FROM indexed_at - source_timestamp)
+FROM es_sync_state
+WHERE es_index = %(index)s AND source_timestamp IS NOT NULL
+  AND indexed_at >= CURRENT_TIMESTAMP - make_interval(mins => %(window)s)
+ORDER BY indexed_at DESC
+LIMIT %(limit)s
+"""
+
+
+def sync_lag_plan(window_minutes: int = 60, es_index: str = None, sample_limit: int = 20):
+    """Query plan of sync_lag()."""
+    es_index = es_index or es_settings()["index"]
+    report = {"avg_lag_seconds": None, "p95_lag_seconds": None, "max_lag_seconds": None, "count": 0,
+              "window_minutes": window_minutes, "es_index": es_index, "seconds_since_last_sync": None,
+              "samples": []}
+    if not (yield STATE_INSTALLED_SQL, None, "one")[0]:
+        return report
+    params = {"index": es_index, "window": window_minutes, "limit": sample_limit}
+    count, avg, p95, max_lag = yield LAG_SQL, params, "one"
+    report["count"] = count
+    if count:
+        report["avg_lag_seconds"] = round(float(avg), 3)
+        report["p95_lag_seconds"] = round(float(p95), 3)
+        report["max_lag_seconds"] = round(float(max_lag), 3)
+    samples = yield LAG_SAMPLES_SQL, params, "all"
+    report["samples"] = [{"uuid_institution": u, "indexed_at": t.isoformat(), "lag_seconds": round(float(lag), 3)}
+                         for u, t, lag in samples]
+    age = (yield ("SELECT EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MAX(finished_at)) FROM es_sync_runs "
+                  "WHERE es_index = %s AND success;"), (es_index,), "one")[0]
+    report["seconds_since_last_sync"] = round(float(age), 3) if age is not None else None
+    return report
+
+
+def sync_lag(conn_params=None, window_minutes: int = 60, es_index: str = None, sample_limit: int = 20) -> dict:
+    """Indexing lag of the documents indexed in the last `window_minutes`.
+
+    The lag of a document is the time between the deduplication run that produced its content
+    (deduplication_timestamp) and its indexing. seconds_since_last_sync is the age of the last
+    successful sync, i.e. how stale the index can be.
+    """
+    with connection(conn_params) as conn:
+        try:
+            with conn.cursor() as cur:
+                return run_plan(cur, sync_lag_plan(window_minutes, es_index, sample_limit))
+        finally:
+            conn.rollback()
+
+
+async def sync_lag_async(window_minutes: int = 60, es_index: str = None, sample_limit: int = 20) -> dict:
+    """sync_lag() on the async pool, for the API handlers."""
+    return await afetch_plan(sync_lag_plan(window_minutes, es_index, sample_limit))
+
+
+if __name__ == '__main__':
+    res = sync_institutions(full='--full' in sys.argv[1:])
+    sys.stdout.write(json.dumps(res, ensure_ascii=False))
+    sys.stdout.flush()
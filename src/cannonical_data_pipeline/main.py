@@ -13,19 +13,28 @@ import uvicorn
 from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 
-from keycloak import KeycloakOpenID, KeycloakAuthenticationError
 from starlette import status
 from starlette.middleware.cors import CORSMiddleware
 
 # Import app settings after sys.path has been adjusted
 from src.cannonical_data_pipeline.infra.commons import app_settings, get_project_details
-from src.cannonical_data_pipeline.api.v1 import metrics, sync
-
-import requests as http_request
+from src.cannonical_data_pipeline.api.v1 import duplicates, metrics, sync
+from src.cannonical_data_pipeline.infra import async_db, auth, jobs
+from src.cannonical_data_pipeline.infra.db import close_pool
+from src.cannonical_data_pipeline.reports import metrics_snapshot
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
+    # Metrics endpoints answer from a snapshot refreshed in the background
+    metrics_snapshot.get_service().start()
+    # Queued sync jobs and schedules run on this process's worker pool
+    jobs.get_service(sync.run_job).start()
     yield
+    jobs.stop_service()
+    metrics_snapshot.stop_service()
+    await auth.close_authenticator()
+    await async_db.close_async_pool()
+    close_pool()
 
 # Single source of truth for API keys / security
 api_keys = [getattr(app_settings, 'ACP_SERVICE_API_KEY', None)]
@@ -53,7 +62,7 @@ EXPOSE_PORT = _get_port_from_env(24895)
 OTLP_GRPC_ENDPOINT = os.environ.get("OTLP_GRPC_ENDPOINT", "http://localhost:4317")
 
 
-def auth_header(
+async def auth_header(
     request: Request,
     bearer_auth: Optional[HTTPAuthorizationCredentials] = Depends(bearer_security),
 ):
@@ -75,14 +84,13 @@ def auth_header(
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
 
         try:
-            KeycloakOpenID(
-                server_url=keycloak_env.URL,
-                client_id=keycloak_env.CLIENT_ID,
-                realm_name=keycloak_env.REALMS
-            ).userinfo(api_key)
-            return {"auth_type": "bearer", "api_key": api_key}
-        except KeycloakAuthenticationError:
+            accepted = await auth.get_authenticator().verify_keycloak(auth_env_header, keycloak_env, api_key)
+        except auth.AuthUnavailable as exc:
+            logging.error("Keycloak check failed for %s: %s", acn, exc)
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Authentication service unavailable")
+        if not accepted:
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
+        return {"auth_type": "bearer", "api_key": api_key}
 
     # Check if the password is a valid Dataverse API key (from header 'targets-credentials')
     targets_credentials_raw = request.headers.get('targets-credentials')
@@ -104,10 +112,13 @@ def auth_header(
         if not api_key_target_url or not api_key:
             logging.error(f'Invalid target credential structure for {acn}: %r', target_cred)
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
-        dv_response = http_request.get(f"https://{api_key_target_url}/api/users/token",
-                                       headers={"X-Dataverse-key": api_key}, timeout=10)
-        if dv_response.status_code != 200:
-            logging.error(f'Failed to get token for {acn}: {dv_response.status_code}')
+        try:
+            accepted = await auth.get_authenticator().verify_dataverse(api_key_target_url, api_key)
+        except auth.AuthUnavailable as exc:
+            logging.error(f'Failed to get token for {acn}: {exc}')
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Authentication service unavailable")
+        if not accepted:
+            logging.error(f'Failed to get token for {acn}: API key rejected by {api_key_target_url}')
             raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Forbidden")
 
         return {"auth_type": "API_KEY", "api_key": api_key}
@@ -145,11 +156,14 @@ if getattr(app_settings, 'otlp_enable', False) is False:
     logging.info("Logging configured without OTLP")
 else:
     logging.info("OTLP enabled - endpoint=%s", OTLP_GRPC_ENDPOINT)
-    # a_commons.set_otlp(app, APP_NAME, OTLP_GRPC_ENDPOINT, LOG_FILE, uvicorn.config.LOGGING_CONFIG)
+    # Tracer provider + OTLP exporter for the requests and the pipeline steps (infra.tracing) run by the jobs
+    from akmi_utils.otel import setting_otlp
+    setting_otlp(app, APP_NAME, OTLP_GRPC_ENDPOINT)
 
 pre_startup_routine(app)
 app.include_router(metrics.router, prefix="/api/v1/metrics", tags=["metrics"])
 app.include_router(sync.router, prefix="/api/v1/sync", tags=["sync"])
+app.include_router(duplicates.router, prefix="/api/v1/duplicates", tags=["duplicates"])
 
 # Root endpoint: expose basic service info (title, version, build number)
 @app.get("/", tags=["root"])
@@ -164,24 +178,30 @@ def root():
 def main():
     try:
         from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+        from src.cannonical_data_pipeline.infra.db import connection
     except Exception:
         err = {'error': 'import_error', 'details': traceback.format_exc()}
         print(json.dumps(err, default=str), flush=True)
         sys.exit(2)
 
+    # One NDJSON line per duplicate group, written as the groups are found
+    error = None
     try:
         l = ["deduplicated_individual_institution"]
-        report = {}
-        for table in l:
-            report = dup_mod.generate_duplicates_report(table_name=table, only_with_duplicates=True)
-            print(json.dumps(report, default=str), flush=True)
+        with connection() as conn:
+            for table in l:
+                try:
+                    for group in dup_mod.stream_duplicate_groups(conn, table):
+                        print(json.dumps({'table': table, **group}, default=str), flush=True)
+                except ValueError as exc:
+                    error = str(exc)
+                    print(json.dumps({'table': table, 'error': error}, default=str), flush=True)
     except Exception:
         err = {'error': 'unhandled_exception', 'details': traceback.format_exc()}
         print(json.dumps(err, default=str), flush=True)
         sys.exit(3)
 
-    print(json.dumps(report, default=str), flush=True)
-    sys.exit(0 if report.get('error') is None else 1)
+    sys.exit(0 if error is None else 1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,242 @@
+"""In-memory metrics snapshot served by the /metrics endpoints.
+
+collect_snapshot() gathers in a few queries what the metrics endpoints report:
+  - row counts of every public table, from the planner's pg_class.reltuples estimates (one
+    catalog query) or, with exact=True, a COUNT(*) per table;
+  - deduplication stats of deduplicated_institutions_kb: dedup rate, canonical institutions,
+    deprecated uuids and a per-country breakdown by uuid_country (one aggregate);
+  - the DB -> ES sync counts from the incremental sync state.
+
+MetricsSnapshotService refreshes the snapshot on a background thread every `ttl` seconds and
+hands out the last one from memory, so a request never touches the database. A failed refresh
+keeps serving the previous snapshot and reports the error in the service status.
+"""
+import asyncio
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+from src.cannonical_data_pipeline.deduplication.list_tables import table_row_counts
+from src.cannonical_data_pipeline.infra.catalog import get_catalog
+from src.cannonical_data_pipeline.infra.commons import setting
+from src.cannonical_data_pipeline.infra.db import connection
+from src.cannonical_data_pipeline.ingestion import es_sync
+
+DEDUP_TABLE = "deduplicated_institutions_kb"
+SOURCE_TABLE = "institution"
+
+DEDUP_STATS_SQL = """
+SELECT COUNT(*),
+       COUNT(*) FILTER (WHERE was_deduplicated),
+       COUNT(DISTINCT uuid_institution),
+       COUNT(DISTINCT uuid_deprecated),
+       MAX(deduplication_timestamp)
+FROM deduplicated_institutions_kb
+"""
+
+# Country label: institution_country.country for the uuid_country, if the table has one
+PER_COUNTRY_SQL = """
+SELECT d.uuid_country, c.country, COUNT(*), COUNT(*) FILTER (WHERE d.was_deduplicated)
+FROM deduplicated_institutions_kb d
+LEFT JOIN (
+    SELECT DISTINCT ON (uuid_country) uuid_country, country FROM institution_country ORDER BY uuid_country, country
+) c ON c.uuid_country = d.uuid_country
+GROUP BY d.uuid_country, c.country
+ORDER BY COUNT(*) DESC
+"""
+PER_COUNTRY_PLAIN_SQL = """
+SELECT uuid_country, NULL, COUNT(*), COUNT(*) FILTER (WHERE was_deduplicated)
+FROM deduplicated_institutions_kb
+GROUP BY uuid_country
+ORDER BY COUNT(*) DESC
+"""
+
+
+def _rate(part, total):
+    return round(part / total, 4) if total else 0.0
+
+
+def dedup_stats(cur) -> dict:
+    """Deduplication stats of deduplicated_institutions_kb, or {'available': False} without it."""
+    schema_catalog = get_catalog(cur)
+    columns = schema_catalog.column_names(DEDUP_TABLE)
+    if not {"uuid_country", "uuid_deprecated"} <= columns:
+        return {"available": False, "reason": f"{DEDUP_TABLE} missing or add_columns not applied"}
+
+    cur.execute(DEDUP_STATS_SQL)
+    total, deduplicated, canonical, deprecated, last_run = cur.fetchone()
+    cur.execute(PER_COUNTRY_SQL if schema_catalog.has_table("institution_country") else PER_COUNTRY_PLAIN_SQL)
+    per_country = {}
+    for uuid_country, country, rows, dedup_rows in cur.fetchall():
+        label = country or uuid_country or "unknown"
+        per_country[label] = {"uuid_country": uuid_country, "rows": rows, "deduplicated_rows": dedup_rows,
+                              "dedup_rate": _rate(dedup_rows, rows)}
+    return {
+        "available": True,
+        "total_rows": total,
+        "deduplicated_rows": deduplicated,
+        "dedup_rate": _rate(deduplicated, total),
+        "canonical_institutions": canonical,
+        "deprecated_uuids": deprecated,
+        "last_dedup_run": last_run.isoformat() if last_run else None,
+        "per_country": per_country,
+    }
+
+
+def sync_counts(cur, table_rows: dict, dedup: dict, es_index: str) -> dict:
+    """DB -> ES counts (the /metrics/sync/counts shape) from the table counts and dedup stats."""
+    source_count = table_rows.get(SOURCE_TABLE)
+    dedup_count = dedup.get("canonical_institutions")
+    report = {"source_count": source_count, "dedup_count": dedup_count, "es_count": 0,
+              "delta_source_to_dedup": None, "delta_dedup_to_es": None, "es_index": es_index,
+              "snapshot_time": None, "last_sync": None}
+    if es_sync.state_installed(cur):
+        cur.execute("SELECT COUNT(*) FROM es_sync_state WHERE es_index = %s;", (es_index,))
+        report["es_count"] = cur.fetchone()[0]
+        report["last_sync"] = es_sync.last_run(cur, es_index)
+        last_ok = es_sync.last_run(cur, es_index, success_only=True)
+        report["snapshot_time"] = last_ok["finished_at"] if last_ok else None
+    if source_count is not None and dedup_count is not None:
+        report["delta_source_to_dedup"] = source_count - dedup_count
+    if dedup_count is not None:
+        report["delta_dedup_to_es"] = dedup_count - report["es_count"]
+    return report
+
+
+def collect_snapshot(conn_params=None, exact: bool = False, es_index: str = None) -> dict:
+    """Compute a metrics snapshot (see the module docstring) in one read-only transaction."""
+    es_index = es_index or es_sync.es_settings()["index"]
+    started = time.monotonic()
+    with connection(conn_params) as conn:
+        try:
+            with conn.cursor() as cur:
+                tables = table_row_counts(cur, exact=exact)
+                table_rows = {t["name"]: t["rows"] for t in tables}
+                dedup = dedup_stats(cur)
+                sync = sync_counts(cur, table_rows, dedup, es_index)
+        finally:
+            conn.rollback()
+    return {
+        "generated_at": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+        "exact": exact,
+        "collect_seconds": round(time.monotonic() - started, 3),
+        "tables": tables,
+        "dedup": dedup,
+        "sync": sync,
+    }
+
+
+class MetricsSnapshotService:
+    """Keep a metrics snapshot in memory, refreshed every `ttl` seconds on a daemon thread.
+
+    get() never queries the database once a snapshot exists. Without a running background
+    thread (e.g. from a CLI) get() refreshes a snapshot older than `ttl` itself.
+    """
+
+    def __init__(self, ttl: float = 60.0, exact: bool = False, conn_params=None):
+        self.ttl = ttl
+        self.exact = exact
+        self.conn_params = conn_params
+        self._snapshot = None
+        self._refreshed_at = None  # monotonic
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._status = {"refreshes": 0, "failures": 0, "last_error": None, "last_error_at": None}
+
+    def refresh(self) -> dict:
+        """Collect a new snapshot and swap it in; on failure keep the previous one and re-raise."""
+        with self._refresh_lock:
+            try:
+                snapshot = collect_snapshot(self.conn_params, exact=self.exact)
+            except Exception as exc:
+                self._status["failures"] += 1
+                self._status["last_error"] = str(exc)
+                self._status["last_error_at"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+                raise
+            self._snapshot = snapshot
+            self._refreshed_at = time.monotonic()
+            self._status["refreshes"] += 1
+            return snapshot
+
+    def get(self) -> dict:
+        """Return the current snapshot, collecting the first one (or a stale one without thread)."""
+        snapshot = self._snapshot
+        running = self._thread is not None and self._thread.is_alive()
+        if snapshot is None or (not running and time.monotonic() - self._refreshed_at > self.ttl):
+            try:
+                return self.refresh()
+            except Exception:
+                if snapshot is None:
+                    raise
+        return snapshot
+
+    async def get_async(self) -> dict:
+        """get() for the async handlers: a collection it needs runs on a worker thread."""
+        snapshot = self._snapshot
+        running = self._thread is not None and self._thread.is_alive()
+        if snapshot is None or (not running and time.monotonic() - self._refreshed_at > self.ttl):
+            return await asyncio.to_thread(self.get)
+        return snapshot
+
+    def status(self) -> dict:
+        age = None if self._refreshed_at is None else round(time.monotonic() - self._refreshed_at, 3)
+        return {"ttl": self.ttl, "exact": self.exact, "running": self._thread is not None and self._thread.is_alive(),
+                "age_seconds": age, **self._status}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                pass  # recorded in status(); the previous snapshot keeps being served
+            self._stop.wait(self.ttl)
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join(timeout=5)
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def _service_settings():
+    return {
+        "ttl": setting("metrics_refresh_interval", "METRICS_REFRESH_INTERVAL", 60.0, float),
+        "exact": setting("metrics_exact_counts", "METRICS_EXACT_COUNTS", False, bool),
+    }
+
+
+def get_service() -> MetricsSnapshotService:
+    """Return the process-wide snapshot service, creating it from the settings on first use."""
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = MetricsSnapshotService(**_service_settings())
+        return _service
+
+
+def stop_service():
+    global _service
+    with _service_lock:
+        service, _service = _service, None
+    if service is not None:
+        service.stop()
+
+
+if __name__ == '__main__':
+    res = collect_snapshot(exact='--exact' in sys.argv[1:])
+    sys.stdout.write(json.dumps(res, ensure_ascii=False, default=str))
+    sys.stdout.flush()
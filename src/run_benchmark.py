@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Benchmark the deduplication steps on synthetic data (see cannonical_data_pipeline.benchmarks).
+
+For every combination of --rows and --duplicate-ratio a synthetic dataset is generated (and kept
+under logs/benchmarks/data/ for later runs), loaded into a dedicated benchmark database (its
+public schema is dropped first; by default <db_name>_benchmark, created when missing) and the
+steps run one after the other, each in its own process. Wall time, rows/sec, peak RSS and query
+counts are printed and saved as JSON under logs/benchmarks/, then compared with a baseline result
+(the previous run unless --baseline is given).
+
+Usage:
+  python3 src/run_benchmark.py [--rows 10000,100000,1000000] [--duplicate-ratio 0.1,0.5] [--seed 42]
+                               [--steps insert_mapping,apply_deduplication,...] [--dbname NAME]
+                               [--baseline FILE] [--tolerance 0.2] [--output FILE] [--fail-on-regression]
+
+Options:
+  --rows N[,N...]             Institution rows per scale (default 10000).
+  --duplicate-ratio R[,R...]  Share of rows that are spelling variants of another institution (default 0.3).
+  --mapping-coverage F        Share of the variants listed in the mapping CSV (default 1.0).
+  --country-noise F           Share of the variants with another country than their institution (default 0.1).
+  --seed N                    Seed of the data generator (default 42).
+  --steps S[,S...]            Steps to run, in this order (default: all).
+  --dbname NAME               Benchmark database (never the configured one).
+  --baseline FILE             Result to compare with (default: the latest saved result).
+  --tolerance F               Allowed growth of seconds/queries/peak RSS before a regression (default 0.2).
+  --output FILE               Where to save the result (default logs/benchmarks/<run_id>.json).
+  --fail-on-regression        Exit with status 1 when a regression was found.
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+_repo_root = str(Path(__file__).resolve().parents[1])
+if _repo_root not in sys.path:
+    sys.path.insert(0, _repo_root)
+
+from src.cannonical_data_pipeline.benchmarks.harness import (  # noqa: E402
+    STEPS, compare, latest_result, run_benchmark, save_result,
+)
+
+
+def _list(cast):
+    return lambda value: [cast(item) for item in value.split(',') if item.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the deduplication steps on synthetic data.')
+    parser.add_argument('--rows', type=_list(int), default=[10_000])
+    parser.add_argument('--duplicate-ratio', type=_list(float), default=[0.3])
+    parser.add_argument('--mapping-coverage', type=float, default=1.0)
+    parser.add_argument('--country-noise', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--steps', type=_list(str), default=list(STEPS))
+    parser.add_argument('--dbname')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--output')
+    parser.add_argument('--fail-on-regression', action='store_true')
+    args = parser.parse_args(argv)
+
+    result = run_benchmark(scales=args.rows, duplicate_ratios=args.duplicate_ratio, steps=args.steps,
+                           seed=args.seed, mapping_coverage=args.mapping_coverage,
+                           country_noise=args.country_noise, dbname=args.dbname)
+    baseline_path = Path(args.baseline) if args.baseline else latest_result(before=result['run_id'])
+    if baseline_path is not None:
+        with open(baseline_path, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+        result['baseline'] = {'file': str(baseline_path), 'run_id': baseline.get('run_id'),
+                              'version': baseline.get('version'), 'commit': baseline.get('commit')}
+        result['regressions'] = compare(result, baseline, args.tolerance)
+    else:
+        result['baseline'] = None
+        result['regressions'] = []
+    path = save_result(result, path=args.output)
+
+    print(f"{'rows':>10} {'dup':>5} {'step':<20} {'seconds':>9} {'rows/s':>12} {'queries':>8} {'peak RSS':>10}")
+    for scale in result['scales']:
+        for step in scale['steps']:
+            rss = f"{step['peak_rss_kb'] // 1024}M" if step.get('peak_rss_kb') else '-'
+            print(f"{scale['rows']:>10} {scale['duplicate_ratio']:>5} {step['name']:<20} {step['seconds']:>9} "
+                  f"{step['rows_per_second'] or '-':>12} {step['queries'] if step['queries'] is not None else '-':>8} "
+                  f"{rss:>10}" + (f"  error: {step['error']}" if step['error'] else ''))
+    for regression in result['regressions']:
+        print(f"[regression] rows={regression['rows']} dup={regression['duplicate_ratio']} {regression['step']}: "
+              f"{regression['metric']} {regression['baseline']} -> {regression['value']} (x{regression['ratio']})")
+    print(f"Result saved to {path}")
+
+    failed = any(step['error'] for scale in result['scales'] for step in scale['steps'])
+    if failed:
+        sys.exit(2)
+    if args.fail_on_regression and result['regressions']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
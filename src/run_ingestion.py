@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""Index deduplicated_institutions_kb into Elasticsearch.
+
+Streams the canonical institutions from Postgres and sends them through the `_bulk` API (see
+cannonical_data_pipeline.ingestion.es_indexer). Connection settings default to the es_* values
+in conf/settings.toml or the ES_* environment variables.
+
+Usage:
+  python3 src/run_ingestion.py [--es-url URL] [--index NAME] [--batch-size N] [--max-in-flight N]
+                               [--no-create-index] [--no-refresh]
+"""
+import argparse
+import json
+import sys
+from pathlib import Path
+
+_repo_root = str(Path(__file__).resolve().parents[1])
+if _repo_root not in sys.path:
+    sys.path.insert(0, _repo_root)
+
+from src.cannonical_data_pipeline.ingestion.es_indexer import index_institutions  # noqa: E402
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Bulk-index deduplicated institutions into Elasticsearch.')
+    parser.add_argument('--es-url')
+    parser.add_argument('--index')
+    parser.add_argument('--batch-size', type=int)
+    parser.add_argument('--max-in-flight', type=int)
+    parser.add_argument('--no-create-index', action='store_true')
+    parser.add_argument('--no-refresh', action='store_true')
+    args = parser.parse_args(argv)
+
+    report = index_institutions(
+        es_url=args.es_url,
+        index=args.index,
+        batch_size=args.batch_size,
+        max_in_flight=args.max_in_flight,
+        create_index=not args.no_create_index,
+        refresh=not args.no_refresh,
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if not report['success']:
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
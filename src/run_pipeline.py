@@ -2,120 +2,96 @@
 """Run the deduplication pipeline steps in order.
 
 Steps executed (in order):
-  1. insert_mapping.py
-  2. apply_deduplication.py
-  3. add_columns.py
-  4. update_uuids.py
-
-The runner captures stdout/stderr, attempts to parse JSON output from each step,
-stops on error by default, and returns a combined report.
+  1. insert_mapping
+  2. apply_deduplication
+  3. add_columns
+  4. update_uuids
+
+By default the steps run in-process over one shared connection and one transaction (see
+cannonical_data_pipeline.deduplication.pipeline); --subprocess runs every step in its own
+interpreter instead. --dag schedules the steps by the tables they read and write and runs
+independent steps concurrently. The runner stops on error by default and prints a combined
+report with per-step timing and statement traces (with otlp_enable also exported as OpenTelemetry
+spans to OTLP_GRPC_ENDPOINT). --explain also captures EXPLAIN (ANALYZE, BUFFERS) plans of every
+statement, saved per step under logs/plans/<run>/ (statements then run twice; diagnostics only).
 
 Usage:
-  python3 scripts/run_pipeline.py [--noop] [--continue-on-error]
+  python3 src/run_pipeline.py [--noop] [--continue-on-error] [--subprocess] [--no-atomic] [--explain] [--progress]
+  python3 src/run_pipeline.py --dag [--workers N] [--resume] [--explain] [--progress]
 
 Options:
-  --noop              Don't actually run the scripts; just print what would run.
-  --continue-on-error Continue running subsequent steps even if a step fails.
+  --noop              Don't actually run the steps; just print what would run.
+  --continue-on-error Continue running subsequent steps even if a step fails (not with an atomic run).
+  --subprocess        Run each step in a separate Python process (isolation mode).
+  --no-atomic         Commit after each in-process step instead of once at the end.
+  --dag               Run the steps as a DAG; each step commits on its own connection.
+  --workers N         Number of DAG steps run concurrently (default 4).
+  --resume            With --dag, skip the steps the previous DAG run finished.
+  --explain           Capture and save the query plans and timings of every step (not with --subprocess).
+  --progress          Print step and row progress events to stderr as JSON lines while running.
 """
+import argparse
 import json
-import subprocess
 import sys
 from pathlib import Path
 
-SCRIPT_DIR = Path(__file__).resolve().parents[1] / 'src' / 'cannonical_data_pipeline' / 'deduplication'
-SCRIPTS = [
-    ('insert_mapping', SCRIPT_DIR / 'insert_mapping.py'),
-    ('apply_deduplication', SCRIPT_DIR / 'apply_deduplication.py'),
-    ('add_columns', SCRIPT_DIR / 'add_columns.py'),
-    ('update_uuids', SCRIPT_DIR / 'update_uuids.py'),
-]
-
-
-def run_script(path: Path, noop: bool) -> dict:
-    """Run one script and return a result dict.
-
-    Result keys:
-      - name: script name
-      - path: script path
-      - returncode: int (None in noop)
-      - stdout: str
-      - stderr: str
-      - json: parsed JSON from stdout if parseable else None
-      - error: error message if returncode != 0 or parse flagged error
-    """
-    res = {
-        'name': path.stem,
-        'path': str(path),
-        'returncode': None,
-        'stdout': None,
-        'stderr': None,
-        'json': None,
-        'error': None,
-    }
-
-    if not path.exists():
-        res['error'] = f"script not found: {path}"
-        return res
-
-    if noop:
-        res['stdout'] = ''
-        res['stderr'] = ''
-        res['returncode'] = None
-        return res
-
-    cmd = [sys.executable, str(path)]
-    try:
-        completed = subprocess.run(cmd, capture_output=True, text=True, timeout=600)
-        res['returncode'] = completed.returncode
-        res['stdout'] = completed.stdout
-        res['stderr'] = completed.stderr
-        # Try to parse JSON output from stdout
-        try:
-            res['json'] = json.loads(completed.stdout) if completed.stdout and completed.stdout.strip() else None
-        except Exception:
-            res['json'] = None
-        if completed.returncode != 0:
-            # Prefer structured error if present
-            if res['json'] and isinstance(res['json'], dict) and res['json'].get('error'):
-                res['error'] = res['json'].get('error')
-            else:
-                res['error'] = (completed.stderr.strip() or f"script exited with code {completed.returncode}")
-    except subprocess.TimeoutExpired as e:
-        res['returncode'] = -1
-        res['stderr'] = 'timeout'
-        res['error'] = 'timeout'
-    except Exception as e:
-        res['returncode'] = -1
-        res['stderr'] = str(e)
-        res['error'] = str(e)
-
-    return res
-
-
-def main():
-    overall = {'steps': [], 'success': True}
-
-    # Run all scripts sequentially (always continue to next step)
-    for name, path in SCRIPTS:
-        print(f"\n--- Running step: {name} ({path}) ---")
-        result = run_script(path, noop=False)
-        overall['steps'].append(result)
-
-        # Print outputs for visibility
-        if result['stdout']:
-            print(f"[stdout]\n{result['stdout']}")
-        if result['stderr']:
-            print(f"[stderr]\n{result['stderr']}", file=sys.stderr)
-
-        if result.get('error'):
-            print(f"[error] Step {name} failed: {result['error']}", file=sys.stderr)
-            overall['success'] = False
+_repo_root = str(Path(__file__).resolve().parents[1])
+if _repo_root not in sys.path:
+    sys.path.insert(0, _repo_root)
+
+from src.cannonical_data_pipeline.deduplication.pipeline import DAG_MAX_WORKERS, run_dag, run_pipeline  # noqa: E402
+from src.cannonical_data_pipeline.infra.tracing import init_exporter  # noqa: E402
+
+
+def _print_event(kind, **fields):
+    print(json.dumps({'kind': kind, **fields}, ensure_ascii=False, default=str), file=sys.stderr, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the deduplication pipeline steps.')
+    parser.add_argument('--noop', action='store_true')
+    parser.add_argument('--continue-on-error', action='store_true')
+    parser.add_argument('--subprocess', action='store_true')
+    parser.add_argument('--no-atomic', action='store_true')
+    parser.add_argument('--dag', action='store_true')
+    parser.add_argument('--workers', type=int, default=DAG_MAX_WORKERS)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--explain', action='store_true')
+    parser.add_argument('--progress', action='store_true')
+    args = parser.parse_args(argv)
+    if args.explain and args.subprocess:
+        parser.error('--explain cannot be combined with --subprocess')
+
+    on_event = _print_event if args.progress else None
+    init_exporter('run_pipeline')  # step and statement spans, when otlp_enable is set
+    if args.dag:
+        overall = run_dag(max_workers=args.workers, resume=args.resume, explain=args.explain, on_event=on_event)
+    else:
+        overall = run_pipeline(
+            isolation='subprocess' if args.subprocess else 'inprocess',
+            atomic=not args.no_atomic,
+            continue_on_error=args.continue_on_error,
+            noop=args.noop,
+            explain=args.explain,
+            on_event=on_event,
+        )
+
+    for result in overall['steps']:
+        name = result['name']
+        if result.get('skipped'):
+            print(f"[skip] Step {name}")
+        elif result.get('error'):
+            print(f"[error] Step {name} failed after {result['seconds']}s: {result['error']}", file=sys.stderr)
         else:
-            print(f"[ok] Step {name} completed successfully")
+            print(f"[ok] Step {name} completed in {result['seconds']}s")
+        if result.get('explain'):
+            plans = result['explain']
+            delta = f", {plans['delta_execution_ms']:+}ms vs previous" if 'delta_execution_ms' in plans else ''
+            print(f"       {plans['explained']} plan(s), {plans['execution_ms']}ms executing{delta}: {plans['file']}")
 
     # Summarize and exit with non-zero on failure
     print('\n=== Pipeline summary ===')
-    print(json.dumps(overall, indent=2, ensure_ascii=False))
+    print(json.dumps(overall, indent=2, ensure_ascii=False, default=str))
     if not overall['success']:
         sys.exit(2)
 
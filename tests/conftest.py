@@ -0,0 +1,315 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import pytest
+from psycopg2 import sql
+
+from src.cannonical_data_pipeline.infra import catalog
+from src.cannonical_data_pipeline.infra.db import get_conn_params
+
+
+def render(query) -> str:
+    """Text of a statement for matching; psycopg2.sql objects are rendered without a connection."""
+    if isinstance(query, bytes):
+        return query.decode()
+    if isinstance(query, sql.Composed):
+        return "".join(render(part) for part in query.seq)
+    if isinstance(query, sql.SQL):
+        return query.string
+    if isinstance(query, sql.Identifier):
+        return ".".join('"%s"' % s.replace('"', '""') for s in query.strings)
+    if isinstance(query, sql.Placeholder):
+        return f"%({query.name})s" if query.name else "%s"
+    if isinstance(query, sql.Literal):
+        return repr(query.wrapped)
+    return str(query)
+
+
+class FakeCursor:
+    """Cursor of a FakeConn: logs every statement on the connection and answers it from the
+    connection's rules. Named cursors page their rows with fetchmany like server-side ones."""
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.connection = conn
+        self.name = name
+        self.itersize = None
+        self.rowcount = -1
+        self.description = None
+        self._rows = []
+
+    def execute(self, query, params=None):
+        text = render(query)
+        self.conn.executed.append((text, params, self.name))
+        self._rows, self.rowcount, self.description = [], 0, None
+        if self.conn.broken is not None:
+            raise self.conn.broken
+        for match, rows, rowcount, error, description in self.conn.rules:
+            if match(text, params, self) if callable(match) else match in text:
+                if error is not None:
+                    raise error
+                self._rows = list(rows(text, params) if callable(rows) else rows or [])
+                self.rowcount = rowcount if rowcount is not None else len(self._rows)
+                self.description = description
+                return
+
+    def executemany(self, query, vars_list):
+        for params in vars_list:
+            self.execute(query, params)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def fetchmany(self, size):
+        batch, self._rows = self._rows[:size], self._rows[size:]
+        return batch
+
+    def close(self):
+        pass
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+class FakeConn:
+    """Scripted psycopg2 connection of the fake_conn fixture.
+
+    Statements are answered by the first rule (see `on`) they match; others return no rows and
+    a rowcount of 0.
+    `tables` are the rows of the schema catalog query (infra.catalog). Every statement is kept
+    in `executed` as (text, params, cursor name), as are COMMIT and ROLLBACK, which `events`
+    lists on their own; `broken` set to an exception makes every statement raise it, like a
+    connection the server closed.
+    """
+    dsn = None
+
+    def __init__(self, tables=None):
+        self.rules = []
+        self.executed = []
+        self.events = []
+        self.broken = None
+        self.closed = 0
+        self.autocommit = False
+        self.isolation_level = None
+        self.transaction_status = 0  # psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        if tables is not None:
+            self.on("pg_attribute", rows=tables)
+
+    def on(self, match, rows=None, rowcount=None, error=None, description=None):
+        """Answer statements containing `match` (or for which match(text, params, cursor) is true)
+        with `rows` (a list or rows(text, params)), `rowcount` (default len(rows)) or `error`."""
+        self.rules.append((match, rows, rowcount, error, description))
+        return self
+
+    @property
+    def queries(self) -> list:
+        return [text for text, _, _ in self.executed]
+
+    def params(self, fragment: str) -> list:
+        """Parameters of the statements containing `fragment`, in order."""
+        return [params for text, params, _ in self.executed if fragment in text]
+
+    @property
+    def commits(self) -> int:
+        return self.events.count("commit")
+
+    def cursor(self, name=None, **kwargs):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self.events.append("commit")
+        self.executed.append(("COMMIT", None, None))
+
+    def rollback(self):
+        self.events.append("rollback")
+        self.executed.append(("ROLLBACK", None, None))
+
+    def set_session(self, isolation_level=None, **kwargs):
+        self.isolation_level = isolation_level
+
+    def get_transaction_status(self):
+        return self.transaction_status
+
+    def close(self):
+        self.closed += 1
+
+
+class StubElasticsearch:
+    """Local HTTP server speaking enough of the Elasticsearch API for the bulk indexer.
+
+    Supports HEAD/PUT /<index>, POST /<index>/_refresh and POST /_bulk (NDJSON index/delete
+    actions). Behaviour knobs:
+      - throttle_requests: number of upcoming _bulk requests answered with a whole-request 429
+      - throttle_items: {_id: n} answer that item with a 429 n times before accepting it
+      - reject_items: {_id: (status, type, reason)} per-item failures
+    """
+
+    def __init__(self):
+        self.docs = {}
+        self.indices = set()
+        self.bulk_requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.throttle_requests = 0
+        self.throttle_items = {}
+        self.reject_items = {}
+        self.delay = 0.0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, payload=None, headers=None):
+                body = json.dumps(payload).encode() if payload is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                if self.command != "HEAD":
+                    self.wfile.write(body)
+
+            def _body(self):
+                return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            def do_HEAD(self):
+                self._reply(200 if self.path.strip("/") in stub.indices else 404)
+
+            def do_PUT(self):
+                self._body()
+                stub.indices.add(self.path.strip("/"))
+                self._reply(200, {"acknowledged": True})
+
+            def do_POST(self):
+                body = self._body()
+                if self.path.endswith("/_refresh"):
+                    return self._reply(200, {})
+                if self.path != "/_bulk":
+                    return self._reply(404, {"error": "not found"})
+                with stub._lock:
+                    stub.bulk_requests += 1
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                    throttle = stub.throttle_requests > 0
+                    if throttle:
+                        stub.throttle_requests -= 1
+                try:
+                    if stub.delay:
+                        threading.Event().wait(stub.delay)
+                    if throttle:
+                        return self._reply(429, {"error": "too many requests"}, {"Retry-After": "0"})
+                    self._reply(200, stub.apply_bulk(body.decode()))
+                finally:
+                    with stub._lock:
+                        stub.in_flight -= 1
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+
+    def apply_bulk(self, body: str) -> dict:
+        lines = body.splitlines()
+        items, i = [], 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op, meta = next(iter(action.items()))
+            doc = None if op == "delete" else json.loads(lines[i + 1])
+            i += 1 if op == "delete" else 2
+            doc_id = meta["_id"]
+            with self._lock:
+                if self.throttle_items.get(doc_id):
+                    self.throttle_items[doc_id] -= 1
+                    items.append({op: {"_id": doc_id, "status": 429, "error": {"type": "es_rejected_execution_exception"}}})
+                    continue
+                if doc_id in self.reject_items:
+                    status, error_type, reason = self.reject_items[doc_id]
+                    items.append({op: {"_id": doc_id, "status": status, "error": {"type": error_type, "reason": reason}}})
+                    continue
+                if op == "delete":
+                    status = 200 if self.docs.pop(doc_id, None) is not None else 404
+                else:
+                    status = 200 if doc_id in self.docs else 201
+                    self.docs[doc_id] = doc
+            items.append({op: {"_id": doc_id, "status": status}})
+        return {"took": 1, "errors": any(it[next(iter(it))]["status"] >= 300 for it in items), "items": items}
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def es_stub():
+    stub = StubElasticsearch().start()
+    try:
+        yield stub
+    finally:
+        stub.stop()
+
+
+@pytest.fixture
+def fake_conn():
+    """Factory of FakeConn connections: fake_conn(tables=[...]) answers the catalog query."""
+    return FakeConn
+
+
+@pytest.fixture(scope="session")
+def pg_database():
+    """Connection parameters of a scratch database `<db_name>_test` on the configured server,
+    dropped after the session. Tests using it are skipped when the server cannot be reached."""
+    params = {**get_conn_params(quiet=True), "connect_timeout": 3}
+    dbname = f"{params['dbname']}_test"
+    try:
+        admin = psycopg2.connect(**params)
+    except psycopg2.Error as exc:
+        pytest.skip(f"PostgreSQL is not reachable: {exc}")
+    admin.autocommit = True
+    try:
+        with admin.cursor() as cur:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(dbname)))
+            cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(dbname)))
+        yield {**params, "dbname": dbname}
+        with admin.cursor() as cur:
+            cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(dbname)))
+    finally:
+        admin.close()
+
+
+@pytest.fixture
+def pg_conn(pg_database):
+    """A connection to the scratch database with an empty public schema."""
+    conn = psycopg2.connect(**pg_database)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+        conn.commit()
+        yield conn
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+@pytest.fixture(autouse=True)
+def fresh_schema_catalog():
+    """Fake connections share one schema catalog cache entry; start every test without it."""
+    catalog.invalidate()
+    yield
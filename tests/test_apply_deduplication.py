@@ -0,0 +1,128 @@
+from src.cannonical_data_pipeline.deduplication.add_columns import apply_add_columns
+from src.cannonical_data_pipeline.deduplication.apply_deduplication import apply_deduplication
+from src.cannonical_data_pipeline.deduplication.update_uuids import apply_update_uuids
+
+KB_COLUMNS = [[c, 'text', False] for c in ('institution', 'uuid_institution', 'institution_key', 'english_name_key')]
+TRACKED = [('deduplicated_institutions_kb', 'r', KB_COLUMNS, [], []), ('dedup_change_log', 'r', [], [], [])]
+
+SOURCE_SQL = """
+CREATE TABLE institution (uuid_institution TEXT, institution TEXT, english_name TEXT, parent_institution TEXT);
+CREATE TABLE institution_country (uuid_institution TEXT PRIMARY KEY, uuid_country TEXT);
+CREATE TABLE institution_mapping (id SERIAL PRIMARY KEY, original TEXT UNIQUE, normalized TEXT);
+INSERT INTO institution VALUES
+    ('u1', 'Alpha University', 'Alpha University', ''),
+    ('u5', 'ALPHA UNIVERSITY', 'Alpha University', ''),
+    ('u3', 'Beta Institute', 'Beta Institute', ''),
+    ('u4', 'Beta Inst.', 'Beta Institute', ''),
+    ('u6', 'Gamma College', 'Gamma College', '');
+INSERT INTO institution_country VALUES ('u1', 'c1'), ('u5', 'c1'), ('u3', 'c2'), ('u4', 'c2'), ('u6', 'c2');
+INSERT INTO institution_mapping (original, normalized) VALUES
+    ('ALPHA UNIVERSITY', 'Alpha University'), ('Beta Inst.', 'Beta Institute');
+"""
+
+ROWS_SQL = """
+SELECT original_institution, institution, uuid_institution, uuid_deprecated, uuid_country, english_name
+FROM deduplicated_institutions_kb ORDER BY original_institution
+"""
+
+
+def _steps(conn, incremental=True):
+    """apply_deduplication, add_columns and update_uuids in one transaction; returns the first report."""
+    report = apply_deduplication(conn=conn, incremental=incremental)
+    assert report['success'], report['error']
+    assert apply_add_columns(conn=conn)['errors'] == []
+    assert apply_update_uuids(conn=conn)['errors'] == []
+    conn.commit()
+    return report
+
+
+def _rows(conn):
+    with conn.cursor() as cur:
+        cur.execute(ROWS_SQL)
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+def _change(conn, statement):
+    with conn.cursor() as cur:
+        cur.execute(statement)
+    conn.commit()
+
+
+def _rebuilt(conn):
+    """The rows a full rebuild gives for the current source tables."""
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE deduplicated_institutions_kb;")
+    _steps(conn, incremental=False)
+    return _rows(conn)
+
+
+def test_full_and_incremental_paths(fake_conn):
+    conn = fake_conn(tables=[TRACKED[0]])
+    assert apply_deduplication(conn=conn, incremental=True)['mode'] == 'full (bootstrap)'
+    assert any('CREATE TRIGGER dedup_log_institution ' in q for q in conn.queries)
+
+    conn = fake_conn(tables=TRACKED)
+    report = apply_deduplication(conn=conn)
+    assert report['success'] and report['mode'] == 'full'
+    # runs are serialized, and the log only loses the changes the rebuild's snapshot includes
+    order = [next(i for i, q in enumerate(conn.queries) if q.startswith(prefix))
+             for prefix in ('SELECT pg_advisory_xact_lock', 'DELETE FROM dedup_change_log', '\nDROP TABLE')]
+    assert order == sorted(order)
+    assert not any('TRUNCATE' in q for q in conn.queries)
+
+    conn = fake_conn(tables=TRACKED)
+    report = apply_deduplication(conn=conn, incremental=True)
+    assert report['success'] and report['mode'] == 'incremental' and report['changes'] == 0
+    assert any('pg_advisory_xact_lock' in q for q in conn.queries)
+    assert not any('deduplicated_institutions_kb' in q for q in conn.queries if q.startswith(('DELETE', 'INSERT')))
+
+
+def test_changed_institution_regroups_only_its_groups(pg_conn):
+    with pg_conn.cursor() as cur:
+        cur.execute(SOURCE_SQL)
+    assert _steps(pg_conn)['mode'] == 'full (bootstrap)'
+    before = _rows(pg_conn)
+    assert before['ALPHA UNIVERSITY'][1:3] == ('u1', 'u5')
+
+    _change(pg_conn, "UPDATE institution SET english_name = 'Alpha U' WHERE uuid_institution = 'u1';")
+    report = apply_deduplication(conn=pg_conn, incremental=True)
+    assert report['success'], report['error']
+    assert (report['changes'], report['affected_keys'], report['deleted'], report['inserted']) == (2, 1, 1, 1)
+    rows = _rows(pg_conn)
+    # the Alpha group is reset for update_uuids to redo; the Beta group is left alone
+    assert rows['ALPHA UNIVERSITY'][1:3] == ('u5', None)
+    assert rows['Alpha University'] == ('Alpha University', 'u1', None, 'c1', 'Alpha U')
+    assert rows['Beta Inst.'] == before['Beta Inst.']
+
+    apply_update_uuids(conn=pg_conn)
+    pg_conn.commit()
+    assert _rows(pg_conn) == _rebuilt(pg_conn)
+
+
+def test_mapping_change_moves_rows_into_the_mapped_group(pg_conn):
+    with pg_conn.cursor() as cur:
+        cur.execute(SOURCE_SQL)
+    _steps(pg_conn)
+
+    _change(pg_conn, "INSERT INTO institution_mapping (original, normalized) VALUES ('Gamma College', 'Beta Institute');")
+    report = apply_deduplication(conn=pg_conn, incremental=True)
+    assert report['success'], report['error']
+    assert (report['changes'], report['affected_keys']) == (1, 1)
+    assert _rows(pg_conn)['Gamma College'][:3] == ('Beta Institute', 'u6', None)
+
+    apply_update_uuids(conn=pg_conn)
+    pg_conn.commit()
+    rows = _rows(pg_conn)
+    assert rows['Gamma College'][1:3] == ('u3', 'u6') and rows['Beta Inst.'][1:3] == ('u3', 'u4')
+    assert rows == _rebuilt(pg_conn)
+
+
+def test_empty_change_log_is_a_no_op(pg_conn):
+    with pg_conn.cursor() as cur:
+        cur.execute(SOURCE_SQL)
+    _steps(pg_conn)
+    before = _rows(pg_conn)
+
+    report = apply_deduplication(conn=pg_conn, incremental=True)
+    assert report['success'] and report['changes'] == 0 and 'up to date' in report['message']
+    assert _rows(pg_conn) == before
@@ -0,0 +1,116 @@
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from src.cannonical_data_pipeline.infra import auth
+
+
+class StubProvider(BaseHTTPRequestHandler):
+    """Keycloak userinfo and Dataverse /api/users/token, accepting the credential 'good'."""
+
+    hits = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        time.sleep(0.05)  # slow enough for concurrent lookups to overlap
+        if self.path.endswith("/protocol/openid-connect/userinfo"):
+            ok = self.headers.get("Authorization") == "Bearer good"
+        elif self.path == "/api/users/token":
+            ok = self.headers.get("X-Dataverse-key") == "good"
+        else:
+            ok = False
+        body = b'{"sub": "someone"}' if ok else b'{"error": "invalid_token"}'
+        self.send_response(200 if ok else 401)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    StubProvider.hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubProvider)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def _authenticator(**kwargs):
+    return auth.Authenticator(dataverse_url="http://{target}/api/users/token", timeout=5, **kwargs)
+
+
+def test_concurrent_lookups_share_one_request_and_outcomes_are_cached(stub):
+    authenticator = _authenticator()
+
+    async def scenario():
+        accepted = await asyncio.gather(*(authenticator.verify_dataverse(stub, "good") for _ in range(10)))
+        rejected = await asyncio.gather(*(authenticator.verify_dataverse(stub, "bad") for _ in range(10)))
+        again = [await authenticator.verify_dataverse(stub, key) for key in ("good", "bad")]
+        await authenticator.aclose()
+        return accepted, rejected, again
+
+    accepted, rejected, again = asyncio.run(scenario())
+    assert all(accepted) and not any(rejected) and again == [True, False]
+    assert StubProvider.hits == ["/api/users/token"] * 2
+    assert authenticator.stats()["shared"] == 18
+
+
+def test_keycloak_clients_are_reused_per_environment(stub):
+    authenticator = _authenticator()
+    env = SimpleNamespace(URL=f"http://{stub}/", CLIENT_ID="rcdp", REALMS="dans")
+
+    async def scenario():
+        results = [await authenticator.verify_keycloak("dev", env, token) for token in ("good", "bad", "good")]
+        clients = dict(authenticator._keycloak)
+        await authenticator.aclose()
+        return results, clients
+
+    results, clients = asyncio.run(scenario())
+    assert results == [True, False, True] and list(clients) == ["dev"]
+    assert StubProvider.hits == ["/realms/dans/protocol/openid-connect/userinfo"] * 2
+
+
+def test_unreachable_provider_is_not_cached(stub):
+    authenticator = _authenticator()
+    port = int(stub.rsplit(":", 1)[1])
+    with ThreadingHTTPServer(("127.0.0.1", 0), StubProvider) as closed:
+        down = f"127.0.0.1:{closed.server_address[1]}"  # nothing listens there once closed
+
+    async def scenario():
+        with pytest.raises(auth.AuthUnavailable):
+            await authenticator.verify_dataverse(down, "good")
+        with pytest.raises(auth.AuthUnavailable):
+            await authenticator.verify_dataverse(down, "good")
+        ok = await authenticator.verify_dataverse(f"127.0.0.1:{port}", "good")
+        await authenticator.aclose()
+        return ok
+
+    assert asyncio.run(scenario())
+    assert authenticator.stats()["unavailable"] == 2 and authenticator.stats()["lookups"] == 3
+
+
+def test_credential_cache_expires_and_evicts_least_recently_used(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(auth.time, "monotonic", lambda: now[0])
+    cache = auth.CredentialCache(max_entries=2, ttl=60, negative_ttl=5)
+    a, b, c = (cache.key("dataverse", "repo", token) for token in "abc")
+    assert len(a) == 64  # keys are digests, not the credentials
+
+    cache.put(a, True)
+    cache.put(b, False)
+    now[0] += 10
+    assert cache.get(a) is True and cache.get(b) is None  # rejection expired, acceptance did not
+    cache.put(b, True)
+    cache.get(a)
+    cache.put(c, True)  # evicts b, the least recently used
+    assert cache.get(b) is None and cache.get(a) is True and cache.get(c) is True
+    assert cache.stats()["evicted"] == 1
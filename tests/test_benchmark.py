@@ -0,0 +1,62 @@
+import csv
+import multiprocessing
+import os
+import time
+
+import pytest
+
+from src.cannonical_data_pipeline.benchmarks import harness, synthetic
+
+
+def test_synthetic_data_is_reproducible_and_has_the_requested_duplicates(tmp_path):
+    rows = list(synthetic.iter_rows(5000, 0.4, seed=7))
+    assert rows == list(synthetic.iter_rows(5000, 0.4, seed=7))
+    assert rows != list(synthetic.iter_rows(5000, 0.4, seed=8))
+
+    canonical = [row for row in rows if row[1] == row[2]]
+    variants = [row for row in rows if row[1] != row[2]]
+    assert len({row[1] for row in canonical}) == len(canonical)  # canonical names are unique
+    assert abs(len(variants) / len(rows) - 0.4) < 0.03
+    assert all(row[6] == row[2] for row in variants) and all(row[6] is None for row in canonical)
+    assert len({row[0] for row in rows}) == len(rows)
+
+    manifest = synthetic.generate(tmp_path, 5000, 0.4, seed=7)
+    assert manifest["counts"] == {"institution": 5000, "variants": len(variants), "mapping": len(variants)}
+    with open(synthetic.mapping_csv(manifest), newline="", encoding="utf-8") as fh:
+        mapping = list(csv.DictReader(fh))
+    assert mapping[0] == {"original": variants[0][1], "normalized": variants[0][2]}
+    assert synthetic.generate(tmp_path, 5000, 0.4, seed=7)["reused"]
+
+
+def test_compare_flags_slower_steps_and_more_queries():
+    def result(update_seconds, update_queries, report_seconds):
+        return {"scales": [{"rows": 10000, "duplicate_ratio": 0.3, "steps": [
+            {"name": "update_uuids", "seconds": update_seconds, "queries": update_queries, "peak_rss_kb": 40000},
+            {"name": "duplicates_report", "seconds": report_seconds, "queries": 3, "peak_rss_kb": 40000},
+        ]}]}
+
+    baseline = result(2.0, 40, 0.01)
+    assert harness.compare(result(2.3, 40, 0.09), baseline) == []  # within tolerance / below the noise floor
+    regressions = harness.compare(result(3.0, 60, 0.09), baseline)
+    assert [(r["step"], r["metric"], r["ratio"]) for r in regressions] == [
+        ("update_uuids", "seconds", 1.5), ("update_uuids", "queries", 1.5)]
+
+
+def test_wait_for_result_notices_a_dead_step_process():
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=os._exit, args=(3,))
+    process.start()
+    started = time.monotonic()
+    with pytest.raises(RuntimeError, match="exited with code 3 without a result"):
+        harness._wait_for_result(process, results, timeout=60)
+    assert time.monotonic() - started < 30
+
+    process = context.Process(target=time.sleep, args=(30,))
+    process.start()
+    try:
+        with pytest.raises(TimeoutError):
+            harness._wait_for_result(process, results, timeout=0.5)
+    finally:
+        process.terminate()
+        process.join()
@@ -0,0 +1,37 @@
+from src.cannonical_data_pipeline.deduplication.add_columns import add_columns_to_table
+from src.cannonical_data_pipeline.infra import catalog
+
+KB_ROW = ('deduplicated_institutions_kb', 'r',
+          [['institution', 'text', False], ['uuid_institution', 'character varying', False]],
+          [], [{'name': 'kb_uuid_idx', 'unique': True, 'primary': False, 'columns': ['uuid_institution'],
+                'expression': False, 'definition': 'CREATE UNIQUE INDEX kb_uuid_idx ...'}])
+COUNTRY_ROW = ('institution_country', 'r', [['uuid_institution', 'character varying', False]],
+               [{'name': 'institution_country_pkey', 'type': 'p', 'columns': ['uuid_institution']}], [])
+
+
+def test_catalog_is_loaded_once_and_reloaded_after_invalidate(fake_conn):
+    conn = fake_conn(tables=[KB_ROW, COUNTRY_ROW])
+    cur = conn.cursor()
+    schema_catalog = catalog.get_catalog(cur)
+    assert schema_catalog.columns('deduplicated_institutions_kb') == [('institution', 'text'),
+                                                                      ('uuid_institution', 'character varying')]
+    assert catalog.column_exists(cur, 'public', 'deduplicated_institutions_kb', 'uuid_institution')
+    assert not catalog.table_has_primary_key(cur, 'public', 'deduplicated_institutions_kb')
+    assert catalog.get_catalog(cur).primary_key('institution_country') == ('uuid_institution',)
+    assert catalog.get_catalog(cur).unique_columns('deduplicated_institutions_kb') == {'uuid_institution'}
+    assert not catalog.table_exists(cur, 'public', 'missing')
+    assert len(conn.queries) == 1
+
+    catalog.invalidate('public')
+    catalog.get_catalog(cur)
+    assert len(conn.queries) == 2
+
+
+def test_add_columns_reads_catalog_once_and_invalidates_after_ddl(fake_conn):
+    conn = fake_conn(tables=[KB_ROW, COUNTRY_ROW])
+    report = add_columns_to_table(conn.cursor(), 'public', 'deduplicated_institutions_kb',
+                                  {'executed': [], 'skipped': [], 'errors': []})
+    assert report['executed'] == ['ADD COLUMN uuid_country', 'ADD COLUMN uuid_deprecated',
+                                  'ADD COLUMN id SERIAL PRIMARY KEY', 'UPDATE uuid_country from institution_country']
+    assert sum('pg_attribute' in q for q in conn.queries) == 1
+    assert catalog.cache_stats()['entries'] == 0
@@ -1,27 +1,38 @@
 from unittest import mock
 import pytest
 
+from src.cannonical_data_pipeline.infra import catalog
+
 
 def make_fake_conn(columns, duplicates):
     """Return a fake connection object where get_table_columns returns columns and
-    find_duplicates_for_column will return duplicates mapping. This will be used by
+    the single-pass duplicate scan returns the duplicates groups. This will be used by
     patching psycopg2.connect to return an object with a cursor that responds to execute/fetchall.
     """
+    queries = []
+
     class FakeCursor:
         def __init__(self):
             self._last_query = None
+            self.description = None
 
         def execute(self, query, params=None):
             self._last_query = (query, params)
+            queries.append(query)
 
         def fetchall(self):
-            # If last executed query was the information_schema columns query, return columns
+            # Schema catalog query: one 'poc' table with the given columns and 'id' as primary key
             q, p = self._last_query
-            if isinstance(q, str) and 'information_schema.columns' in q:
-                return columns
-            # Otherwise, assume it's the duplicates aggregation and return based on query params
-            # For our testing, return the provided duplicates (list of tuples)
-            return duplicates
+            if isinstance(q, str) and 'pg_attribute' in q:
+                pkey = {'name': 'poc_pkey', 'unique': True, 'primary': True, 'columns': ['id'],
+                        'expression': False, 'definition': ''}
+                return [('poc', 'r', [[name, data_type, False] for name, data_type in columns],
+                         [{'name': 'poc_pkey', 'type': 'p', 'columns': ['id']}], [pkey])]
+            # Group aggregation: return the provided duplicates (list of (col, val, ids, cnt))
+            if 'HAVING COUNT(*) > 1' in repr(q):
+                return duplicates
+            # Member rows query: no records in this fake
+            return []
 
         def fetchone(self):
             # For checking 'id' column existence we can return 1
@@ -34,9 +45,15 @@ def make_fake_conn(columns, duplicates):
             pass
 
     class FakeConn:
+        def __init__(self):
+            self.queries = queries
+
         def cursor(self):
             return FakeCursor()
 
+        def rollback(self):
+            pass
+
         def close(self):
             pass
 
@@ -46,8 +63,8 @@ def make_fake_conn(columns, duplicates):
 def test_generate_report_happy_path(monkeypatch):
     # Prepare fake table columns and duplicates
     columns = [('id', 'bigint'), ('text1', 'text'), ('text2', 'text')]
-    # duplicates should be returned as list of (val, ids, cnt)
-    duplicates = [('example', [1, 2], 2)]
+    # duplicates should be returned as list of (col, val, ids, cnt)
+    duplicates = [('text1', 'example', [1, 2], 2)]
 
     fake_conn = make_fake_conn(columns, duplicates)
 
@@ -64,6 +81,26 @@ def test_generate_report_happy_path(monkeypatch):
     entry = report['columns']['text1'][0]
     assert entry['value'] == 'example'
     assert entry['count'] == 2
+    assert 'text2' not in report['columns']
+
+
+def test_generate_report_query_count_is_constant(monkeypatch):
+    from src.cannonical_data_pipeline.deduplication.check_duplicates import generate_duplicates_report
+
+    counts = []
+    for n_cols in (2, 20):
+        columns = [('id', 'bigint')] + [(f'text{i}', 'text') for i in range(n_cols)]
+        duplicates = [(f'text{i}', f'v{j}', [j, j + 1], 2) for i in range(n_cols) for j in range(5)]
+        fake_conn = make_fake_conn(columns, duplicates)
+        catalog.invalidate()
+        with mock.patch('src.cannonical_data_pipeline.deduplication.check_duplicates.psycopg2.connect', return_value=fake_conn):
+            report = generate_duplicates_report()
+        assert len(report['columns']) == n_cols
+        assert all(len(groups) == 5 for groups in report['columns'].values())
+        counts.append(len(fake_conn.queries))
+
+    # schema catalog (columns and unique indexes), groups, member rows
+    assert counts == [3, 3]
 
 
 def test_generate_report_connection_error(monkeypatch):
@@ -80,3 +117,76 @@ def test_generate_report_connection_error(monkeypatch):
 
     assert report['error'] is not None
     assert 'Failed to connect' in report['error'] or 'Error while checking duplicates' in report['error']
+
+
+@pytest.fixture
+def stream_conn(fake_conn):
+    """Fake connection for stream_duplicate_groups: named cursors page `groups` (val, ids, cnt)
+    with fetchmany, plain cursors answer the catalog and the member-row queries with `members`."""
+    def make(columns, groups, members):
+        pkey = {'name': 'poc_pkey', 'unique': True, 'primary': True, 'columns': ['id'],
+                'expression': False, 'definition': ''}
+        tables = [('poc', 'r', [[n, t, False] for n, t in columns],
+                   [{'name': 'poc_pkey', 'type': 'p', 'columns': ['id']}], [pkey])]
+        return (fake_conn(tables=tables)
+                .on(lambda text, params, cur: cur.name, rows=groups)
+                .on('', rows=lambda text, params: [m for m in members if m[1] in params[1]],
+                    description=[('col',), ('val',), ('id',), ('text1',)]))
+    return make
+
+
+def test_stream_duplicate_groups_batches_records_and_resumes_after_cursor(stream_conn):
+    from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+
+    columns = [('id', 'bigint'), ('text1', 'text')]
+    groups = [('a', [1, 2, 3], 3), ('b', [4, 5], 2), ('c', [6, 7], 2)]
+    members = [('text1', 'a', 1, 'A'), ('text1', 'a', 2, 'a'), ('text1', 'b', 4, 'B'), ('text1', 'c', 6, 'c')]
+    conn = stream_conn(columns, groups, members)
+
+    streamed = list(dup_mod.stream_duplicate_groups(conn, 'poc', fields=['id', 'text1'], limit=10, batch_size=2))
+    assert [(g['value'], g['count']) for g in streamed] == [('a', 3), ('b', 2), ('c', 2)]
+    assert streamed[0]['records'] == [{'id': 1, 'text1': 'A'}, {'id': 2, 'text1': 'a'}]
+    member_queries = [q for q, p, name in conn.executed if name is None and 'pg_attribute' not in q]
+    assert len(member_queries) == 2  # one per batch of two groups
+    assert 't."text1"' in member_queries[0] and 't.*' not in member_queries[0]
+
+    after = dup_mod.decode_cursor(dup_mod.encode_cursor(streamed[1]))
+    assert after == {'column': 'text1', 'count': 2, 'value': 'b'}
+    list(dup_mod.stream_duplicate_groups(conn, 'poc', after=after, limit=5, include_records=False))
+    query, params, name = conn.executed[-1]
+    assert name == 'duplicate_groups' and params == [2, 2, 'b', 5]
+
+
+def test_stream_duplicate_groups_rejects_unknown_fields(stream_conn):
+    from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+
+    conn = stream_conn([('id', 'bigint'), ('text1', 'text')], [], [])
+    with pytest.raises(ValueError):
+        next(dup_mod.stream_duplicate_groups(conn, 'poc', fields=['secret']))
+    with pytest.raises(ValueError):
+        dup_mod.decode_cursor('not-a-cursor')
+
+
+def test_name_columns_are_grouped_on_their_stored_keys(pg_conn):
+    from src.cannonical_data_pipeline.deduplication import check_duplicates as dup_mod
+
+    with pg_conn.cursor() as cur:
+        cur.execute("CREATE TABLE kb (id SERIAL PRIMARY KEY, institution TEXT, english_name TEXT, note TEXT,"
+                    "                 institution_key TEXT, english_name_key TEXT);"
+                    "INSERT INTO kb (institution, english_name, note, institution_key, english_name_key) VALUES"
+                    "    ('Helmholtz-Zentrum Berlin', 'HZB', 'x', 'helmholtz zentrum berlin', 'hzb'),"
+                    "    ('Helmholtz Zentrum, Berlin', NULL, 'X', 'helmholtz zentrum berlin', NULL),"
+                    "    ('DANS', NULL, 'y', 'dans', NULL);")
+    pg_conn.commit()
+
+    # LOWER() alone would not group the two spellings; the key columns are not scanned themselves
+    groups = list(dup_mod.stream_duplicate_groups(pg_conn, 'kb', fields=['id', 'institution']))
+    assert [(g['column'], g['value'], g['ids']) for g in groups] == [
+        ('institution', 'helmholtz zentrum berlin', [1, 2]), ('note', 'x', [1, 2])]
+    assert groups[0]['records'] == [{'id': 1, 'institution': 'Helmholtz-Zentrum Berlin'},
+                                    {'id': 2, 'institution': 'Helmholtz Zentrum, Berlin'}]
+
+    report = dup_mod.scan_duplicates(pg_conn, 'kb', [('institution', 'text'), ('note', 'text')],
+                                     key_columns=dup_mod.get_name_key_columns(pg_conn, 'kb'))
+    assert [g['ids'] for g in report['institution']] == [[1, 2]]
+    assert [r['id'] for r in report['institution'][0]['records']] == [1, 2]
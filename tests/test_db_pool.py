@@ -0,0 +1,83 @@
+import threading
+import time
+from unittest import mock
+
+import pytest
+
+from src.cannonical_data_pipeline.infra import db
+
+
+@pytest.fixture
+def fake_connect(fake_conn):
+    def connect(**kwargs):
+        conn = fake_conn().on('SELECT 1', rows=[(1,)])
+        conn.transaction_status = db.pg_extensions.TRANSACTION_STATUS_INTRANS
+        return conn
+
+    with mock.patch('src.cannonical_data_pipeline.infra.db.psycopg2.connect', side_effect=connect) as m:
+        yield m
+
+
+def test_pool_reuses_and_resets_connections(fake_connect):
+    pool = db.ConnectionPool({}, min_size=1, max_size=2)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert conn.events == ['rollback']
+    assert pool.getconn() is conn
+    stats = pool.stats()
+    assert stats['created'] == 1
+    assert stats['in_use'] == 1
+    assert stats['requests'] == 2
+
+
+def test_pool_waits_then_times_out(fake_connect):
+    pool = db.ConnectionPool({}, min_size=0, max_size=1, timeout=0.05)
+    held = pool.getconn()
+    with pytest.raises(db.PoolError):
+        pool.getconn()
+
+    # a waiter gets the connection once it is returned
+    threading.Timer(0.05, pool.putconn, args=(held,)).start()
+    assert pool.getconn(timeout=2) is held
+    stats = pool.stats()
+    assert stats['waits'] == 2
+    assert stats['timeouts'] == 1
+    assert stats['wait_time_max'] > 0
+
+
+def test_pool_replaces_unhealthy_and_evicts_idle(fake_connect):
+    pool = db.ConnectionPool({}, min_size=1, max_size=3, max_idle=0.01, health_check_interval=0)
+    a, b = pool.getconn(), pool.getconn()
+    pool.putconn(a)
+    pool.putconn(b)
+    time.sleep(0.02)
+    # b is on top of the idle stack; a is evicted as stale beyond min_size
+    b.broken = Exception('server closed the connection unexpectedly')
+    conn = pool.getconn()
+    assert conn is not a and conn is not b
+    assert a.closed and b.closed
+    stats = pool.stats()
+    assert stats['evicted_idle'] == 1
+    assert stats['health_check_failures'] == 1
+    assert stats['size'] == 1
+
+
+def test_release_connection_closes_unpooled(fake_conn):
+    conn = fake_conn()
+    db.release_connection(conn)
+    assert conn.closed
+
+
+def test_run_plan_sends_results_and_raises_errors_into_the_plan(fake_conn):
+    conn = fake_conn().on("bad", error=RuntimeError("boom")).on("one", rows=[("one",)]).on("update", rowcount=3)
+
+    def plan():
+        first = yield "one", None, "one"
+        try:
+            yield "bad", None, None
+        except RuntimeError as exc:
+            recovered = str(exc)
+        count = yield "update", None, "rowcount"
+        return first, recovered, count
+
+    assert db.run_plan(conn.cursor(), plan()) == (("one",), "boom", 3)
@@ -0,0 +1,80 @@
+import threading
+from unittest import mock
+
+import pytest
+
+from src.cannonical_data_pipeline.deduplication import dedup_tables
+
+ROLE = {"target": "deduplicated_institution_institution_role", "source": "institution_institution_role",
+        "name_column": "Institution", "uuid_column": "UUID_Institution",
+        "normalize_from": "deduplicated_institutions_kb"}
+
+
+def test_load_specs_fills_defaults_and_validates():
+    spec, = dedup_tables.load_specs([ROLE, {**ROLE, "target": "off", "enabled": False}])
+    assert spec["mapping"] == "institution_mapping" and spec["key_columns"] == ["institution", "uuid_country"]
+    assert dedup_tables.load_specs([{**ROLE, "normalize_from": None}])[0]["normalize_from"] == ROLE["target"]
+
+    with pytest.raises(ValueError, match="missing source"):
+        dedup_tables.load_specs([{"target": "t", "name_column": "n"}])
+    with pytest.raises(ValueError, match="unknown key"):
+        dedup_tables.load_specs([{**ROLE, "uuid": "x"}])
+    with pytest.raises(ValueError, match="declared twice"):
+        dedup_tables.load_specs([ROLE, ROLE])
+    with pytest.raises(ValueError, match="circular"):
+        dedup_tables._dependencies(dedup_tables.load_specs([
+            {"target": "a", "source": "b", "name_column": "n"}, {"target": "b", "source": "a", "name_column": "n"}]))
+
+
+# The source columns are mixed case: unquoted, PostgreSQL would fold them to lower case
+ROLE_SQL = """
+CREATE TABLE institution_institution_role ("Institution" TEXT, "UUID_Institution" TEXT, "InstitutionRoleID" INTEGER);
+CREATE TABLE institution_mapping (original TEXT, normalized TEXT);
+CREATE TABLE institution_country (uuid_institution TEXT, uuid_country TEXT);
+CREATE TABLE deduplicated_institutions_kb (institution TEXT, uuid_country TEXT, uuid_institution TEXT);
+INSERT INTO institution_institution_role VALUES
+    ('Alpha University', 'u1', 1), ('ALPHA UNIVERSITY', 'u5', 2), ('Beta Institute', 'u3', 3);
+INSERT INTO institution_mapping VALUES ('ALPHA UNIVERSITY', 'Alpha University');
+INSERT INTO institution_country VALUES ('u1', 'c1'), ('u5', 'c1'), ('u3', 'c2');
+INSERT INTO deduplicated_institutions_kb VALUES
+    ('Alpha University', 'c1', 'u1'), ('Alpha University', 'c1', 'u5'), ('Beta Institute', 'c2', 'u3');
+"""
+
+
+def test_statements_quote_the_declared_columns(pg_conn):
+    spec = dedup_tables.load_specs([ROLE])[0]
+    with pg_conn.cursor() as cur:
+        cur.execute(ROLE_SQL)
+        for mode in ("created", "refreshed"):
+            report = dedup_tables.dedup_table(cur, spec)
+            assert report["success"] and report["mode"] == mode, report["errors"]
+            assert (report["inserted"], report["normalized"]) == (3, 1)
+            cur.execute('SELECT original_institution, institution, "UUID_Institution", uuid_deprecated, '
+                        'uuid_country FROM deduplicated_institution_institution_role ORDER BY "InstitutionRoleID";')
+            assert cur.fetchall() == [("Alpha University", "Alpha University", "u1", None, "c1"),
+                                      ("ALPHA UNIVERSITY", "Alpha University", "u1", "u5", "c1"),
+                                      ("Beta Institute", "Beta Institute", "u3", None, "c2")]
+
+
+def test_tables_run_concurrently_after_the_tables_they_read():
+    specs = [{"target": "a", "source": "src_a", "name_column": "n"},
+             {"target": "b", "source": "src_b", "name_column": "n"},
+             {"target": "c", "source": "a", "name_column": "n", "normalize_from": "b"},
+             {"target": "d", "source": "bad", "name_column": "n"},
+             {"target": "e", "source": "d", "name_column": "n"}]
+    barrier = threading.Barrier(2, timeout=5)
+    order = []
+
+    def worker(conn_params, spec, schema):
+        if spec["target"] in ("a", "b"):
+            barrier.wait()  # a and b only pass when they run at the same time
+        order.append(spec["target"])
+        ok = spec["target"] != "d"
+        return {"success": ok, "target": spec["target"], "errors": [] if ok else ["no source"]}
+
+    with mock.patch.object(dedup_tables, "_table_worker", worker):
+        report = dedup_tables.run_dedup_tables(specs=specs, max_workers=4)
+
+    assert order.index("c") > max(order.index("a"), order.index("b"))
+    assert "e" not in order and "e: a table it reads failed" in report["skipped"]
+    assert not report["success"] and report["errors"] == ["d: no source"]
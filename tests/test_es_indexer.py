@@ -0,0 +1,60 @@
+from unittest import mock
+
+from src.cannonical_data_pipeline.ingestion import es_indexer
+
+
+def _docs(n):
+    return [('index', f'u{i}', {'uuid_institution': f'u{i}', 'institution': f'Inst {i}'}) for i in range(n)]
+
+
+def test_bulk_actions_batches_within_in_flight_limit(es_stub):
+    es_stub.delay = 0.02
+    client = es_indexer.BulkClient(es_stub.url, 'idx', pool_size=3)
+    report = es_indexer.bulk_actions(client, iter(_docs(95)), batch_size=10, max_in_flight=3)
+    assert report['documents'] == 95 and report['ok'] == 95 and report['failed'] == 0
+    assert report['batches'] == 10 == es_stub.bulk_requests
+    assert 1 < es_stub.max_in_flight <= 3
+    assert es_stub.docs['u42']['institution'] == 'Inst 42'
+
+
+def test_bulk_backs_off_on_429_and_captures_item_errors(es_stub):
+    es_stub.throttle_requests = 1
+    es_stub.throttle_items = {'u3': 2}
+    es_stub.reject_items = {'u5': (400, 'mapper_parsing_exception', 'failed to parse field')}
+    client = es_indexer.BulkClient(es_stub.url, 'idx', max_retries=5)
+    with mock.patch.object(es_indexer, 'BACKOFF_BASE', 0.001):
+        result = client.bulk(_docs(8))
+    assert result['ok'] == 7
+    assert result['throttled'] == 3 and result['retries'] == 3
+    assert result['failed'] == [{'_id': 'u5', 'op': 'index', 'status': 400,
+                                 'type': 'mapper_parsing_exception', 'reason': 'failed to parse field'}]
+    assert 'u3' in es_stub.docs and 'u5' not in es_stub.docs
+
+
+def test_bulk_gives_up_after_max_retries(es_stub):
+    es_stub.throttle_requests = 10
+    client = es_indexer.BulkClient(es_stub.url, 'idx', max_retries=2)
+    with mock.patch.object(es_indexer, 'BACKOFF_BASE', 0.001):
+        result = client.bulk(_docs(2))
+    assert result['ok'] == 0 and es_stub.bulk_requests == 3
+    assert [f['status'] for f in result['failed']] == [429, 429]
+
+
+def test_index_institutions_streams_documents(es_stub):
+    rows = [('u1', {'uuid_institution': 'u1'}), ('u2', {'uuid_institution': 'u2'})]
+    with mock.patch.object(es_indexer, 'acquire_connection', return_value=mock.Mock()), \
+            mock.patch.object(es_indexer, 'release_connection'), \
+            mock.patch.object(es_indexer, 'iter_documents', return_value=iter(rows)):
+        report = es_indexer.index_institutions(es_url=es_stub.url, index='inst', batch_size=1, max_in_flight=2)
+    assert report['success'] and report['index_created']
+    assert report['indexed'] == 2 and report['batches'] == 2
+    assert 'inst' in es_stub.indices and set(es_stub.docs) == {'u1', 'u2'}
+
+
+def test_row_to_document_is_json_ready():
+    import datetime
+    doc = es_indexer.row_to_document({'uuid_institution': 'u1', 'original_institutions': None,
+                                      'deprecated_uuids': ['u0'],
+                                      'deduplication_timestamp': datetime.datetime(2024, 1, 2, 3, 4, 5)})
+    assert doc == {'uuid_institution': 'u1', 'original_institutions': [], 'deprecated_uuids': ['u0'],
+                   'deduplication_timestamp': '2024-01-02T03:04:05'}
@@ -0,0 +1,69 @@
+from contextlib import contextmanager
+from unittest import mock
+
+from src.cannonical_data_pipeline.ingestion import es_sync
+
+
+def test_changed_documents_sql_filters_on_content_hash():
+    incremental = es_sync.changed_documents_sql({'ror_id'})
+    assert 's.content_hash IS DISTINCT FROM md5(' in incremental
+    assert "- 'deduplication_timestamp'" in incremental
+    assert 'WHERE TRUE' in es_sync.changed_documents_sql(set(), full=True)
+
+
+def test_sync_records_state_only_for_accepted_documents(es_stub, fake_conn):
+    es_stub.reject_items = {'u2': (400, 'mapper_parsing_exception', 'bad')}
+    changed = [{'uuid_institution': f'u{i}', 'institution': f'I{i}', 'deduplication_timestamp': None,
+                'content_hash': f'h{i}'} for i in range(1, 4)]
+    stale = [{'uuid_institution': 'old1'}]
+    conn = fake_conn().on('advisory', rows=[(True,)])
+    upserts = []
+
+    @contextmanager
+    def fake_connection(conn_params=None):
+        yield conn
+
+    def fake_stream(conn, query, params=None, batch_size=500, name='es_documents'):
+        return iter(changed if name == 'es_documents' else stale)
+
+    with mock.patch.object(es_sync, 'acquire_connection', return_value=conn), \
+            mock.patch.object(es_sync, 'release_connection'), \
+            mock.patch.object(es_sync, 'connection', fake_connection), \
+            mock.patch.object(es_sync, 'check_columns', return_value=set()), \
+            mock.patch.object(es_sync, 'stream_rows', fake_stream), \
+            mock.patch.object(es_sync, 'execute_values', lambda cur, q, rows: upserts.extend(rows)):
+        report = es_sync.sync_institutions(es_url=es_stub.url, index='inst', batch_size=2, max_in_flight=1)
+
+    assert (report['documents'], report['indexed'], report['deleted'], report['failed']) == (4, 2, 1, 1)
+    assert not report['success'] and report['errors'][0]['_id'] == 'u2'
+    assert sorted((u[0], u[2]) for u in upserts) == [('u1', 'h1'), ('u3', 'h3')]
+    assert conn.params('DELETE FROM es_sync_state') == [('inst', ['old1'])]
+    assert 'content_hash' not in es_stub.docs['u1']
+    run = conn.params('INSERT INTO es_sync_runs')[0]
+    assert run[:2] == ('inst', 'incremental') and run[4:7] == (2, 1, 1)
+
+
+def test_state_is_kept_per_index(pg_conn):
+    with pg_conn.cursor() as cur:
+        # the layout before the state was keyed by index
+        cur.execute("CREATE TABLE es_sync_state (uuid_institution VARCHAR PRIMARY KEY, es_index TEXT NOT NULL, "
+                    "content_hash TEXT NOT NULL, source_timestamp TIMESTAMPTZ, indexed_at TIMESTAMPTZ NOT NULL);")
+        es_sync.ensure_state_tables(cur)
+    pg_conn.commit()
+
+    @contextmanager
+    def fake_connection(conn_params=None):
+        yield pg_conn
+
+    def accepted(*actions):
+        return [(op, doc_id, None, *meta) for op, doc_id, *meta in actions], {'failed': []}
+
+    with mock.patch.object(es_sync, 'connection', fake_connection):
+        assert es_sync._apply_state('a', *accepted(('index', 'u1', 'h1', None), ('index', 'u2', 'h2', None))) == (2, 0)
+        assert es_sync._apply_state('b', *accepted(('index', 'u1', 'h9', None))) == (1, 0)
+        assert es_sync._apply_state('a', *accepted(('index', 'u1', 'h3', None), ('delete', 'u2'))) == (1, 1)
+        assert es_sync._apply_state('b', *accepted(('delete', 'u2'))) == (0, 1)
+
+    with pg_conn.cursor() as cur:
+        cur.execute("SELECT es_index, uuid_institution, content_hash FROM es_sync_state ORDER BY 1, 2;")
+        assert cur.fetchall() == [('a', 'u1', 'h3'), ('b', 'u1', 'h9')]
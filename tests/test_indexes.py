@@ -0,0 +1,51 @@
+from src.cannonical_data_pipeline.deduplication import indexes
+from src.cannonical_data_pipeline.deduplication.explain import is_explainable, split_statements
+from src.cannonical_data_pipeline.infra import catalog
+
+KB_COLUMNS = [[c, 'character varying', False] for c in
+              ('institution', 'english_name', 'uuid_institution', 'uuid_country', 'uuid_deprecated')]
+LOWER_IDX = {'name': 'deduplicated_institutions_kb_lower_institution_idx', 'unique': False, 'primary': False,
+             'columns': [], 'expression': True,
+             'definition': 'CREATE INDEX deduplicated_institutions_kb_lower_institution_idx'
+                           ' ON public.deduplicated_institutions_kb USING btree (lower((institution)::text))'}
+PK_IDX = {'name': 'institution_country_pkey', 'unique': True, 'primary': True, 'columns': ['uuid_institution'],
+          'expression': False, 'definition': ''}
+TABLES = [('deduplicated_institutions_kb', 'r', KB_COLUMNS, [], [LOWER_IDX]),
+          ('institution_country', 'r', [['uuid_institution', 'character varying', True]], [], [PK_IDX])]
+
+
+def test_advise_reports_covered_missing_and_absent_tables(fake_conn):
+    status = {a['name']: (a['status'], a['covered_by']) for a in indexes.advise(fake_conn(tables=TABLES).cursor())}
+    assert status['institution_country_uuid_institution_idx'] == ('present', 'institution_country_pkey')
+    assert status['deduplicated_institutions_kb_lower_institution_idx'][0] == 'present'
+    assert status['deduplicated_institutions_kb_group_idx'] == ('missing', None)
+    assert status['institution_institution_idx'] == ('table_missing', None)
+
+
+def test_ensure_indexes_creates_only_missing_ones_and_analyzes(fake_conn):
+    conn = fake_conn(tables=TABLES)
+    report = {'executed': [], 'skipped': [], 'errors': []}
+    created = indexes.ensure_indexes(conn.cursor(), tables=('deduplicated_institutions_kb',), report=report)
+    assert [name for _, name in created] == ['deduplicated_institutions_kb_group_idx',
+                                             'deduplicated_institutions_kb_source_uuid_idx',
+                                             'deduplicated_institutions_kb_uuid_institution_idx',
+                                             'deduplicated_institutions_kb_lower_english_name_idx']
+    ddl = [q for q in conn.queries if q.startswith(('CREATE INDEX', 'ANALYZE'))]
+    assert ddl[0] == ('CREATE INDEX IF NOT EXISTS "deduplicated_institutions_kb_group_idx" ON '
+                      'public."deduplicated_institutions_kb" ("institution", "uuid_country");')
+    assert ddl[-1] == 'ANALYZE public."deduplicated_institutions_kb";'
+    assert catalog.cache_stats()['entries'] == 0
+
+
+def test_lower_indexed_columns_parses_index_definitions(fake_conn):
+    schema_catalog = catalog.get_catalog(fake_conn(tables=TABLES).cursor())
+    assert indexes.lower_indexed_columns(schema_catalog, 'deduplicated_institutions_kb') == {'institution'}
+
+
+def test_split_statements_respects_quotes_and_dollar_bodies():
+    sql = "DROP TABLE x; CREATE TABLE x AS SELECT ';' AS s;\nCREATE FUNCTION f() RETURNS int AS $$ BEGIN; END; $$ LANGUAGE plpgsql;"
+    parts = split_statements(sql)
+    assert parts == ['DROP TABLE x', "CREATE TABLE x AS SELECT ';' AS s",
+                     'CREATE FUNCTION f() RETURNS int AS $$ BEGIN; END; $$ LANGUAGE plpgsql']
+    assert [is_explainable(p) for p in parts] == [False, True, False]
+    assert not is_explainable('CREATE TABLE IF NOT EXISTS t (a int GENERATED ALWAYS AS (1) STORED)')
@@ -0,0 +1,62 @@
+import csv
+import io
+
+from src.cannonical_data_pipeline.deduplication import insert_mapping
+
+
+def _report():
+    return {'inserted': 0, 'merged': 0, 'rejected': 0, 'errors': [], 'error': None,
+            'auto_fixed': 0, 'auto_fixed_examples': []}
+
+
+def test_staging_lines_mark_rejects_and_stream_through_copy_reader():
+    text = 'original,normalized\nA,a1\nB\n"Q, x",q\n'
+    reader = csv.DictReader(io.StringIO(text))
+    report = _report()
+
+    stream = insert_mapping._LineStream(insert_mapping._staging_lines(reader, report))
+    chunks = []
+    while True:
+        chunk = stream.read(7)
+        if not chunk:
+            break
+        chunks.append(chunk)
+
+    staged = list(csv.reader(io.StringIO(''.join(chunks))))
+    assert staged[0] == ['2', 'A', 'a1', '', '']
+    assert staged[1][0] == '3' and staged[1][1:3] == ['', ''] and staged[1][4] == 'missing columns'
+    assert staged[2] == ['4', 'Q, x', 'q', '', '']
+    assert report['inserted'] == 2
+    assert report['rejected'] == 1
+    assert len(report['errors']) == 1
+
+
+def test_staging_lines_write_nulls_unquoted():
+    reader = csv.DictReader(io.StringIO('original,normalized\nA,\n'))
+    line = next(insert_mapping._staging_lines(reader, _report()))
+    # empty strings are quoted so COPY keeps them, None (NULL) is written bare
+    assert line == '"2","A","",,\n'
+
+
+def test_streaming_repair_matches_whole_file_repair_across_chunk_boundaries():
+    import re
+
+    text = 'original,normalized\n"Uni, Galway",Uni Galway\nA "  B,c\nend "\n  x,"\t\n'
+    expected = re.sub(r'"\s*(?=[A-Za-z0-9])', '",', text)
+    for chunk_size in (1, 2, 3, 5, 8, -1):
+        stats = {}
+        chunks = insert_mapping.iter_repaired_chunks(io.StringIO(text), chunk_size=chunk_size, stats=stats)
+        lines = list(insert_mapping.iter_lines(chunks))
+        assert ''.join(lines) == expected
+        assert lines == io.StringIO(expected).readlines()
+        assert stats['repairs'] == 3
+
+
+def test_dry_run_counts_rows_in_one_pass(tmp_path):
+    path = tmp_path / 'mapping.csv'
+    path.write_text('original,normalized\nA,a\nB\nC,c\n', encoding='utf-8')
+    report = insert_mapping.insert_mapping_csv(str(path), dry_run=True, chunk_size=4)
+    assert report['error'] is None
+    assert report['found_rows'] == 3
+    assert report['rejected'] == 1
+    assert report['inserted'] == 0
@@ -0,0 +1,117 @@
+import threading
+import time
+from datetime import timedelta
+
+from src.cannonical_data_pipeline.infra import jobs
+
+
+def _store(tmp_path):
+    return jobs.SqliteJobStore(str(tmp_path / "jobs.db"))
+
+
+def test_jobs_are_claimed_once_and_exclusive_keys_hold(tmp_path):
+    store = _store(tmp_path)
+    first = store.enqueue("update-uuids", {"schema": "public"})
+    store.enqueue("es-sync")
+    assert store.enqueue("pipeline", exclusive_key="pipeline")["status"] == "queued"
+    assert store.enqueue("pipeline", exclusive_key="pipeline") is None
+
+    claimed = [store.claim("w1"), store.claim("w2"), store.claim("w3"), store.claim("w4")]
+    assert [job["mode"] for job in claimed[:3]] == ["update-uuids", "es-sync", "pipeline"]
+    assert claimed[3] is None
+    assert claimed[0]["job_id"] == first["job_id"] and claimed[0]["params"] == {"schema": "public"}
+    assert claimed[0]["status"] == "running" and claimed[0]["attempts"] == 1
+
+    assert store.finish(claimed[2]["job_id"], True, {"success": True})
+    assert not store.finish(claimed[2]["job_id"], False)  # only running jobs finish
+    assert store.enqueue("pipeline", exclusive_key="pipeline") is not None
+    last = store.last_finished()
+    assert last["mode"] == "pipeline" and last["status"] == "succeeded" and last["report"] == {"success": True}
+
+
+def test_due_schedules_are_enqueued_once_across_processes(tmp_path):
+    store = _store(tmp_path)
+    store.create_schedule("nightly", "run-all", 3600, {"schema": "public"}, start_immediately=True)
+    assert store.create_schedule("nightly", "run-all", 60) is None
+
+    # two services (processes) tick the same store at the same time
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(_store(tmp_path).tick())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    enqueued = [job for result in results for job in result]
+    assert len(enqueued) == 1 and enqueued[0]["schedule"] == "nightly"
+
+    schedule, = store.list_schedules()
+    assert schedule["last_job_id"] == enqueued[0]["job_id"] and schedule["next_run_at"] > enqueued[0]["created_at"]
+    assert store.set_schedule_enabled("nightly", False) and not store.list_schedules()[0]["enabled"]
+    assert not store.set_schedule_enabled("missing", True)
+    assert store.delete_schedule("nightly") and store.list_schedules() == []
+
+
+def test_stale_running_jobs_are_requeued_then_failed(tmp_path, monkeypatch):
+    store = _store(tmp_path)
+    job = store.enqueue("es-sync")
+    store.claim("dead-worker")
+    assert store.recover_stale(lease_seconds=60, max_attempts=2) == {"requeued": [], "failed": []}
+
+    later = jobs.utcnow() + timedelta(seconds=120)
+    monkeypatch.setattr(jobs, "utcnow", lambda: later)
+    assert store.recover_stale(lease_seconds=60, max_attempts=2)["requeued"] == [job["job_id"]]
+    assert store.claim("w")["attempts"] == 2
+
+    monkeypatch.setattr(jobs, "utcnow", lambda: later + timedelta(seconds=120))
+    assert store.recover_stale(lease_seconds=60, max_attempts=2)["failed"] == [job["job_id"]]
+    assert store.get(job["job_id"])["status"] == "failed"
+
+
+def test_worker_pool_runs_jobs_concurrently_and_records_reports(tmp_path):
+    barrier = threading.Barrier(2, timeout=5)
+
+    def runner(job):
+        if job["mode"] == "fail":
+            return {"success": False, "errors": ["boom"]}
+        barrier.wait()  # both jobs only pass when two workers run them at the same time
+        return {"success": True, "mode": job["mode"]}
+
+    service = jobs.JobService(_store(tmp_path), runner, workers=2, poll_interval=0.05)
+    ids = [service.submit(mode)["job_id"] for mode in ("a", "b", "fail")]
+    service.start()
+    try:
+        deadline = time.time() + 10
+        while time.time() < deadline and any(service.store.get(i)["finished_at"] is None for i in ids):
+            time.sleep(0.05)
+    finally:
+        service.stop()
+
+    a, b, failed = (service.store.get(i) for i in ids)
+    assert a["status"] == b["status"] == "succeeded" and a["report"] == {"success": True, "mode": "a"}
+    assert a["worker"] != b["worker"]
+    assert failed["status"] == "failed" and failed["error"] == "boom"
+    assert service.status()["succeeded"] == 2
+
+
+def test_async_handlers_queue_every_run_as_a_job(tmp_path, monkeypatch):
+    from fastapi import FastAPI
+    from fastapi.testclient import TestClient
+
+    from src.cannonical_data_pipeline.api.v1 import sync
+
+    service = jobs.JobService(_store(tmp_path), sync.run_job)
+    monkeypatch.setattr(jobs, "_service", service)
+    app = FastAPI()
+    app.include_router(sync.router)
+    client = TestClient(app)
+
+    response = client.post("/sync/trigger", json={"mode": "es-sync", "background": False})
+    assert response.status_code == 202 and response.json()["status"] == "queued"
+    assert client.post("/sync/trigger", json={"mode": "nope"}).status_code == 400
+    assert client.post("/sync/sync-now").status_code == 202
+    assert client.post("/sync/sync-now").status_code == 429
+
+    listed = client.get("/sync/jobs").json()["jobs"]
+    assert [job["mode"] for job in listed] == ["pipeline", "es-sync"]
+    assert client.get(f"/sync/jobs/{response.json()['task_id']}").json()["params"] == {"schema": "public"}
+    assert client.get("/sync/jobs/999").status_code == 404
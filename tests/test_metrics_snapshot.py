@@ -0,0 +1,50 @@
+import threading
+from unittest import mock
+
+from src.cannonical_data_pipeline.deduplication.list_tables import table_row_counts
+from src.cannonical_data_pipeline.reports import metrics_snapshot
+
+
+def test_row_counts_use_estimates_unless_exact(fake_conn):
+    conn = fake_conn().on('pg_class', rows=[('institution', 1200), ('institution_country', 40)])
+    assert table_row_counts(conn.cursor()) == [{'name': 'institution', 'rows': 1200, 'estimated': True},
+                                               {'name': 'institution_country', 'rows': 40, 'estimated': True}]
+    assert len(conn.queries) == 1 and 'COUNT' not in conn.queries[0]
+
+    conn = fake_conn().on('pg_class', rows=[('institution', 1200)]).on('COUNT(*)', rows=[(7,)])
+    assert table_row_counts(conn.cursor(), exact=True) == [{'name': 'institution', 'rows': 7, 'estimated': False}]
+    assert sum('COUNT(*)' in q for q in conn.queries) == 1
+
+
+def test_service_serves_snapshot_from_memory_until_refreshed():
+    calls = []
+
+    def fake_collect(conn_params=None, exact=False):
+        calls.append(exact)
+        return {'n': len(calls)}
+
+    service = metrics_snapshot.MetricsSnapshotService(ttl=3600)
+    with mock.patch.object(metrics_snapshot, 'collect_snapshot', fake_collect):
+        assert service.get() == {'n': 1}
+        assert service.get() == {'n': 1} and calls == [False]
+        service.refresh()
+        assert service.get() == {'n': 2}
+
+
+def test_failed_refresh_keeps_previous_snapshot():
+    service = metrics_snapshot.MetricsSnapshotService(ttl=0.01)
+    refreshed = threading.Event()
+
+    def failing_collect(conn_params=None, exact=False):
+        refreshed.set()
+        raise RuntimeError('db down')
+
+    with mock.patch.object(metrics_snapshot, 'collect_snapshot', return_value={'n': 1}):
+        service.get()
+    with mock.patch.object(metrics_snapshot, 'collect_snapshot', failing_collect):
+        service.start()
+        assert refreshed.wait(2)
+        service.stop()
+        assert service.get() == {'n': 1}
+    status = service.status()
+    assert status['failures'] >= 1 and status['last_error'] == 'db down' and not status['running']
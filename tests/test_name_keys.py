@@ -0,0 +1,51 @@
+from unittest import mock
+
+from src.cannonical_data_pipeline.deduplication import name_keys
+
+TABLES = [('institution', 'r', [['uuid_institution', 'character varying', True]], [], []),
+          ('institution_mapping', 'r', [['original', 'text', False]], [], []),
+          ('institution_name_keys', 'r', [['name', 'text', True], ['name_key', 'text', True]], [], [])]
+
+
+def _conn(fake_conn, new_names):
+    # the named (server-side) cursor pages the names without a key
+    return fake_conn(tables=TABLES).on(lambda text, params, cur: cur.name, rows=[(n,) for n in new_names])
+
+
+def test_refresh_normalizes_only_names_without_key_in_batches(fake_conn):
+    conn = _conn(fake_conn, ['Helmholtz-Zentrum Berlin', 'Université de Paris', 'DANS'])
+    inserted = []
+    with mock.patch.object(name_keys, 'execute_values', lambda cur, sql, rows, page_size: inserted.append(rows)):
+        stats = name_keys.refresh_name_keys(conn.cursor(), uuids={'u2', 'u1'}, originals=['DANS'], batch_size=2)
+
+    assert stats == {'new_names': 3, 'pruned': 0}
+    assert inserted == [[('Helmholtz-Zentrum Berlin', 'helmholtz zentrum berlin'),
+                         ('Université de Paris', 'universite de paris')], [('DANS', 'dans')]]
+    query, params, _ = [q for q in conn.executed if q[2] == 'institution_new_names'][0]
+    assert 'uuid_institution = ANY(%(uuids)s)' in query and '"original" = ANY(%(originals)s)' in query
+    assert params == {'uuids': ['u1', 'u2'], 'originals': ['DANS']}
+    assert not any('CREATE TABLE' in q for q in conn.queries)
+
+
+def test_full_refresh_scans_every_name_and_prunes(fake_conn):
+    conn = _conn(fake_conn, [])
+    with mock.patch.object(name_keys, 'execute_values') as execute_values:
+        name_keys.refresh_name_keys(conn.cursor(), prune=True)
+    execute_values.assert_not_called()
+    queries = conn.queries
+    assert not any('ANY(' in q for q in queries)
+    assert any(q.lstrip().startswith('DELETE FROM institution_name_keys') for q in queries)
+
+
+def test_key_columns_are_added_and_filled_on_an_older_table(pg_conn):
+    with pg_conn.cursor() as cur:
+        cur.execute("CREATE TABLE institution (uuid_institution TEXT, institution TEXT, english_name TEXT);"
+                    "INSERT INTO institution VALUES ('u1', 'Helmholtz-Zentrum Berlin', 'Helmholtz Centre, Berlin'),"
+                    "    ('u2', 'Universite X', NULL);"
+                    'CREATE TABLE "Deduplicated KB" (institution TEXT, english_name TEXT);'
+                    'INSERT INTO "Deduplicated KB" SELECT institution, english_name FROM institution;')
+        name_keys.ensure_keys_table(cur)
+        assert name_keys.ensure_key_columns(cur, 'Deduplicated KB')
+        cur.execute('SELECT institution_key, english_name_key FROM "Deduplicated KB" ORDER BY institution;')
+        assert cur.fetchall() == [('helmholtz zentrum berlin', 'helmholtz centre berlin'), ('universite x', None)]
+        assert not name_keys.ensure_key_columns(cur, 'Deduplicated KB')
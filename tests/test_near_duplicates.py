@@ -0,0 +1,49 @@
+import numpy as np
+
+from src.cannonical_data_pipeline.deduplication import near_duplicates as nd
+
+
+def test_normalize_name_folds_case_accents_and_punctuation():
+    assert nd.normalize_name('Helmholtz-Zentrum  Berlin ') == 'helmholtz zentrum berlin'
+    assert nd.normalize_name('Université de Paris') == nd.normalize_name('UNIVERSITE DE PARIS.')
+    assert nd.normalize_name('Straße_(TU)') == 'strasse tu'
+    assert nd.normalize_name(None) == ''
+
+
+def test_trigram_dice_matches_set_definition():
+    keys = ['helmholtz zentrum berlin', 'helmholtz zentrum dresden', 'dans', 'dans']
+    index = nd.TrigramIndex(keys)
+
+    def dice(a, b):
+        ga = {f' {a} '[i:i + 3] for i in range(len(a))}
+        gb = {f' {b} '[i:i + 3] for i in range(len(b))}
+        return 2 * len(ga & gb) / (len(ga) + len(gb))
+
+    scores = index.dice([0, 0, 2], [1, 2, 3])
+    assert np.allclose(scores, [dice(keys[0], keys[1]), dice(keys[0], keys[2]), 1.0])
+
+
+def test_blocking_skips_tokens_shared_by_too_many_keys():
+    keys = ['university of a', 'university of b', 'university of c', 'alpha institute', 'alpha institut']
+    pairs = nd.candidate_pairs(keys, max_block_size=2, block_tokens=3)
+    assert list(map(tuple, pairs.to_numpy())) == [(3, 4)]
+
+
+def test_find_candidates_ranks_mappings_towards_most_frequent_spelling():
+    names = {
+        'Helmholtz Zentrum Berlin': 5,
+        'Helmholtz-Zentrum Berlin': 2,
+        'Helmholtz Zentrum Berlln': 1,
+        'Université de Paris': 1,
+        'Universite de Paris': 1,
+        'Helmholtz Zentrum Dresden': 3,
+    }
+    candidates, stats = nd.find_candidates(names, threshold=0.8)
+    assert [(c['original'], c['normalized']) for c in candidates] == [
+        ('Helmholtz-Zentrum Berlin', 'Helmholtz Zentrum Berlin'),
+        ('Universite de Paris', 'Université de Paris'),
+        ('Helmholtz Zentrum Berlln', 'Helmholtz Zentrum Berlin'),
+    ]
+    assert candidates[0]['score'] == 1.0 and candidates[2]['score'] < 1.0
+    assert candidates[0]['cluster'] == candidates[2]['cluster'] != candidates[1]['cluster']
+    assert stats['names'] == 6 and stats['keys'] == 4
@@ -0,0 +1,144 @@
+import io
+from unittest import mock
+
+import pytest
+
+from src.cannonical_data_pipeline.deduplication import pipeline
+
+
+def _steps(failing=None):
+    def make(name):
+        def step(conn):
+            conn.events.append(name)
+            if name == failing:
+                return {'success': False, 'errors': [f'{name} broke']}
+            return {'success': True}
+        return step
+    return {name: make(name) for name in pipeline.STEPS}
+
+
+@pytest.fixture
+def pipeline_conn(fake_conn):
+    conn = fake_conn()
+    with mock.patch.object(pipeline, 'acquire_connection', return_value=conn), \
+            mock.patch.object(pipeline, 'release_connection'):
+        yield conn
+
+
+def test_inprocess_runs_steps_in_one_transaction(pipeline_conn):
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _steps()):
+        report = pipeline.run_pipeline()
+    assert report['success'] and report['committed']
+    assert pipeline_conn.events == list(pipeline.STEPS) + ['commit']
+    assert [s['name'] for s in report['steps']] == list(pipeline.STEPS)
+    assert all(s['seconds'] is not None and s['error'] is None for s in report['steps'])
+
+
+def test_atomic_failure_rolls_back_everything_and_skips_rest(pipeline_conn):
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _steps(failing='add_columns')):
+        report = pipeline.run_pipeline(continue_on_error=True)
+    assert not report['success'] and not report['committed']
+    assert pipeline_conn.events == ['insert_mapping', 'apply_deduplication', 'add_columns', 'rollback']
+    assert report['steps'][2]['error'] == 'add_columns broke'
+    assert report['steps'][3].get('skipped')
+
+
+def test_non_atomic_commits_per_step_and_can_continue(pipeline_conn):
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _steps(failing='apply_deduplication')):
+        report = pipeline.run_pipeline(atomic=False, continue_on_error=True)
+    assert not report['success']
+    assert pipeline_conn.events == ['insert_mapping', 'commit', 'apply_deduplication', 'rollback',
+                                'add_columns', 'commit', 'update_uuids', 'commit']
+
+
+def test_subprocess_mode_parses_step_json():
+    proc = mock.Mock(stdout=io.StringIO('{"error": "no table"}'), stderr=io.StringIO(''))
+    proc.wait.return_value = 1
+    with mock.patch.object(pipeline.subprocess, 'Popen', return_value=proc) as popen:
+        report = pipeline.run_pipeline(isolation='subprocess')
+    assert popen.call_args[0][0][1:] == ['-m', 'src.cannonical_data_pipeline.deduplication.insert_mapping']
+    assert report['steps'][0]['error'] == 'no table'
+    assert [s.get('skipped') for s in report['steps']] == [None, True, True, True]
+
+
+def test_subprocess_step_streams_progress_and_keeps_a_capped_tail():
+    stderr = '{"batches": 1, "rows": 500}\n' + 'warning\n' * 1000
+    proc = mock.Mock(stdout=io.StringIO('{"success": true, "updated": 500}'), stderr=io.StringIO(stderr))
+    proc.wait.return_value = 0
+    events = []
+    with mock.patch.object(pipeline.subprocess, 'Popen', return_value=proc) as popen, \
+            mock.patch.object(pipeline, 'STDERR_TAIL_LINES', 10):
+        result = pipeline.run_step_subprocess('update_uuids', on_event=lambda kind, **f: events.append((kind, f)))
+    assert popen.call_args[0][0][-1] == '--progress'
+    assert result['error'] is None and result['json']['updated'] == 500
+    assert result['stderr'] == '\n'.join(['warning'] * 10)
+    assert events[0] == ('progress', {'step': 'update_uuids', 'batches': 1, 'rows': 500})
+    assert len(events) == 1001 and events[-1] == ('output', {'step': 'update_uuids', 'stream': 'stderr',
+                                                              'line': 'warning'})
+
+
+def test_unknown_isolation_mode():
+    with pytest.raises(ValueError):
+        pipeline.run_pipeline(isolation='threads')
+
+
+def test_build_dag_from_declared_tables():
+    assert pipeline.build_dag() == {
+        'insert_mapping': set(),
+        'apply_deduplication': {'insert_mapping'},
+        'add_columns': {'apply_deduplication'},
+        'update_uuids': {'apply_deduplication', 'add_columns'},
+    }
+    # a step touching only the other tables apply_deduplication reads or writes still orders it
+    tables = {**pipeline.STEP_TABLES, 'load': {'reads': (), 'writes': ('institution_country',)},
+              'keys': {'reads': (), 'writes': ('institution_name_keys',)}}
+    assert pipeline.build_dag(('load', 'keys', 'apply_deduplication'), tables)['apply_deduplication'] == {'load', 'keys'}
+
+    tables = {'a': {'reads': ('src',), 'writes': ('x',)},
+              'b': {'reads': ('src',), 'writes': ('y',)},
+              'c': {'reads': ('x', 'y'), 'writes': ('z',)}}
+    assert pipeline.build_dag(('a', 'b', 'c'), tables) == {'a': set(), 'b': set(), 'c': {'a', 'b'}}
+
+
+DAG_TABLES = {'a': {'reads': (), 'writes': ('x',)},
+              'b': {'reads': (), 'writes': ('y',)},
+              'a2': {'reads': ('x',), 'writes': ('x2',)},
+              'b2': {'reads': ('y',), 'writes': ('y2',)}}
+
+
+def _dag_steps(calls, failing=None, barrier=None):
+    def make(name):
+        def step(conn):
+            if barrier is not None and name in ('a', 'b'):
+                barrier.wait(timeout=5)  # both roots must be running at the same time
+            calls.append(name)
+            return {'success': name != failing, 'errors': [f'{name} broke']}
+        return step
+    return {name: make(name) for name in DAG_TABLES}
+
+
+def test_dag_runs_independent_branches_concurrently(pipeline_conn, tmp_path):
+    import threading
+    calls = []
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _dag_steps(calls, barrier=threading.Barrier(2))):
+        report = pipeline.run_dag(steps=tuple(DAG_TABLES), tables=DAG_TABLES, state_path=tmp_path / 'state.json')
+    assert report['success']
+    assert sorted(calls) == ['a', 'a2', 'b', 'b2']
+    assert pipeline_conn.events.count('commit') == 4
+
+
+def test_dag_failure_blocks_dependents_and_resume_skips_done_nodes(pipeline_conn, tmp_path):
+    state = tmp_path / 'state.json'
+    calls = []
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _dag_steps(calls, failing='a')):
+        report = pipeline.run_dag(steps=tuple(DAG_TABLES), tables=DAG_TABLES, state_path=state)
+    assert not report['success']
+    assert report['nodes'] == {'a': 'failed', 'b': 'done', 'a2': 'blocked', 'b2': 'done'}
+    assert pipeline.load_dag_state(state) == report['nodes']
+
+    calls.clear()
+    with mock.patch.dict(pipeline.STEP_FUNCTIONS, _dag_steps(calls)):
+        report = pipeline.run_dag(steps=tuple(DAG_TABLES), tables=DAG_TABLES, state_path=state, resume=True)
+    assert report['success']
+    assert calls == ['a', 'a2']
+    assert sorted(report['resumed']) == ['b', 'b2']
@@ -0,0 +1,37 @@
+import json
+import threading
+
+from src.cannonical_data_pipeline.infra import progress
+
+
+def test_ring_buffer_keeps_the_last_events_and_counts_the_dropped():
+    log = progress.ProgressLog(capacity=3)
+    for i in range(5):
+        log("progress", rows=i)
+    events, dropped = log.since(0)
+    assert [e["rows"] for e in events] == [2, 3, 4] and dropped == 2
+    events, dropped = log.since(4)
+    assert [e["seq"] for e in events] == [5] and dropped == 0
+    assert log.since(5) == ([], 0)
+
+
+def test_wait_returns_new_events_and_wakes_on_close():
+    log = progress.ProgressLog()
+    threading.Timer(0.05, lambda: log("step_started", step="x")).start()
+    events, _ = log.wait(0, timeout=5)
+    assert events[0]["kind"] == "step_started"
+    threading.Timer(0.05, log.close).start()
+    assert log.wait(1, timeout=5) == ([], 0) and log.closed
+
+
+def test_tails_fit_the_byte_budget():
+    log = progress.ProgressLog()
+    for i in range(100):
+        log("output", line="x" * 100)
+    tail = log.tail(max_bytes=1000)
+    assert 0 < len(tail) < 10 and tail[-1]["seq"] == 100
+    assert sum(len(json.dumps(e)) + 1 for e in tail) <= 1000
+
+    assert progress.tail_text("short", 100) == "short"
+    capped = progress.tail_text("a" * 500 + "end", 10)
+    assert capped.startswith("[... 493 bytes truncated]") and capped.endswith("a" * 7 + "end")
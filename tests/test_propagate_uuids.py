@@ -0,0 +1,94 @@
+import pytest
+
+from src.cannonical_data_pipeline.deduplication import propagate_uuids as prop
+
+TABLES = [
+    ('deduplicated_institutions_kb', 'r', [['uuid_institution', 'text', False], ['uuid_deprecated', 'text', False]],
+     [], []),
+    ('individual_institution', 'r', [['uuid_institution', 'character varying', True],
+                                     ['uuid_rda_member', 'character varying', True]],
+     [{'name': 'pk', 'type': 'p', 'columns': ['uuid_institution', 'uuid_rda_member']}], []),
+    ('website_member_institutions', 'r', [['id', 'integer', True], ['kb_uuid', 'text', False]],
+     [{'name': 'pkey', 'type': 'p', 'columns': ['id']}], []),
+]
+
+
+# A1 and A2 were normalized to A, C1 to C1b and then to C
+PROPAGATE_SQL = """
+CREATE TABLE deduplicated_institutions_kb (uuid_institution TEXT, uuid_deprecated TEXT);
+CREATE TABLE individual_institution (uuid_institution VARCHAR, uuid_rda_member VARCHAR,
+                                     PRIMARY KEY (uuid_institution, uuid_rda_member));
+CREATE TABLE website_member_institutions (id INTEGER PRIMARY KEY, kb_uuid TEXT);
+INSERT INTO deduplicated_institutions_kb VALUES
+    ('A', NULL), ('A', 'A1'), ('A', 'A2'), ('C1b', 'C1'), ('C', 'C1b'), ('B', NULL);
+INSERT INTO individual_institution VALUES
+    ('A', 'm1'), ('A1', 'm1'), ('A1', 'm2'), ('A2', 'm2'), ('A2', 'm3'), ('C1', 'm1');
+INSERT INTO website_member_institutions VALUES (1, 'A1'), (2, 'A2'), (3, 'B'), (4, 'C1');
+"""
+
+REFERENCES = (("individual_institution", "uuid_institution"), ("website_member_institutions", "kb_uuid"))
+
+
+def _propagate(conn, conflict):
+    with conn.cursor() as cur:
+        cur.execute(PROPAGATE_SQL)
+    report = prop.propagate_uuids(conn=conn, conflict=conflict, batch_size=2, references=REFERENCES)
+    assert report['success'], report['errors']
+    with conn.cursor() as cur:
+        cur.execute("SELECT uuid_institution, uuid_rda_member FROM individual_institution ORDER BY 1, 2;")
+        members = cur.fetchall()
+        cur.execute("SELECT id, kb_uuid FROM website_member_institutions ORDER BY id;")
+        websites = cur.fetchall()
+    return report, members, websites
+
+
+def test_key_conflicts_keep_the_deprecated_row_with_skip(pg_conn):
+    report, members, websites = _propagate(pg_conn, 'skip')
+    assert report['map'] == {'uuids': 4, 'chained': 1}
+    # A1/m1 collides with A/m1 and A2/m2 with A1/m2, rewritten first: both keep their UUID
+    assert members == [('A', 'm1'), ('A', 'm2'), ('A', 'm3'), ('A1', 'm1'), ('A2', 'm2'), ('C', 'm1')]
+    stats = report['tables']['individual_institution']
+    assert (stats['rewritten'], stats['conflicts'], stats['deleted']) == (3, 2, 0)
+    # a column outside the primary key never conflicts
+    assert websites == [(1, 'A'), (2, 'A'), (3, 'B'), (4, 'C')]
+    assert report['updated'] == 6
+
+
+def test_key_conflicts_are_deleted_with_delete(pg_conn):
+    report, members, websites = _propagate(pg_conn, 'delete')
+    assert members == [('A', 'm1'), ('A', 'm2'), ('A', 'm3'), ('C', 'm1')]
+    stats = report['tables']['individual_institution']
+    assert (stats['rewritten'], stats['conflicts'], stats['deleted']) == (3, 2, 2)
+    assert websites == [(1, 'A'), (2, 'A'), (3, 'B'), (4, 'C')]
+
+
+def test_rewrite_sql_rejects_unknown_strategies():
+    with pytest.raises(ValueError):
+        prop.rewrite_sql('institution_country', 'uuid_institution', (), conflict='merge')
+
+
+def test_propagate_in_callers_transaction_reports_rows_per_table(fake_conn):
+    batches = ['A2', None, 'A2', None]  # keyset pages of uuid_remap: one batch per referencing table
+
+    def next_batch(text, params):
+        upto = batches.pop(0)
+        return [(upto, 1 if upto else 0)]
+
+    conn = (fake_conn(tables=TABLES)
+            .on('advisory', rows=[(True,)])
+            .on('COUNT(*) FROM "public"."uuid_remap"', rows=[(3,)])
+            .on('LIMIT %(limit)s', rows=next_batch)
+            .on('WITH batch AS', rows=[(2, 1, 0)]))
+    report = prop.propagate_uuids(conn=conn, batch_size=10)
+
+    assert report['success'], report['errors']
+    assert report['map'] == {'uuids': 3, 'chained': 0}
+    assert set(report['tables']) == {'individual_institution', 'website_member_institutions'}
+    assert report['tables']['individual_institution']['rewritten'] == 2
+    assert report['tables']['individual_institution']['conflicts'] == 1
+    assert report['updated'] == 4
+    assert 'institution_country.uuid_institution does not exist' in report['skipped']
+    # the transaction-scoped lock ends with the caller's transaction
+    assert any('pg_try_advisory_xact_lock' in q for q in conn.queries)
+    assert any('FROM "public"."deduplicated_institutions_kb"' in q for q in conn.queries if 'CREATE UNLOGGED' in q)
+    assert all('"public"."uuid_remap"' in q for q in conn.queries if 'uuid_remap' in q)
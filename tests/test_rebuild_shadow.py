@@ -0,0 +1,109 @@
+from unittest import mock
+
+import pytest
+from psycopg2 import errors as pg_errors
+
+from src.cannonical_data_pipeline.deduplication import rebuild_shadow
+from src.cannonical_data_pipeline.deduplication.rebuild_shadow import _shadow_index_def, rebuild_deduplication_shadow
+
+LIVE = 'public.deduplicated_institutions_kb'
+SHADOW = 'public.deduplicated_institutions_kb_shadow'
+DROP_LIVE = f'DROP TABLE IF EXISTS {LIVE};'
+BUILT = {'indexes': [('deduplicated_institutions_kb_group_idx', 'deduplicated_institutions_kb_group_idx_shadow')],
+         'changes': [1, 2]}
+
+
+@pytest.fixture
+def swap_conn(fake_conn):
+    """A fake connection handed to the rebuild, with the shadow build itself stubbed out."""
+    conn = fake_conn()
+    with mock.patch.object(rebuild_shadow, 'acquire_connection', return_value=conn), \
+            mock.patch.object(rebuild_shadow, 'release_connection'), \
+            mock.patch.object(rebuild_shadow, 'build_shadow', return_value=BUILT), \
+            mock.patch.object(rebuild_shadow, 'SWAP_RETRY_DELAY', 0):
+        yield conn
+
+
+def _lock_timeouts(count):
+    """Rows callable that fails the first `count` statements with a lock timeout."""
+    left = [count]
+
+    def rows(text, params):
+        if left[0]:
+            left[0] -= 1
+            raise pg_errors.LockNotAvailable('canceling statement due to lock timeout')
+        return []
+    return rows
+
+
+@pytest.mark.parametrize('indexdef, name, expected', [
+    ('CREATE INDEX deduplicated_institutions_kb_group_idx ON public.deduplicated_institutions_kb '
+     'USING btree (institution, uuid_country)',
+     'deduplicated_institutions_kb_group_idx',
+     'CREATE INDEX deduplicated_institutions_kb_group_idx_shadow ON public.deduplicated_institutions_kb_shadow '
+     'USING btree (institution, uuid_country)'),
+    # the index name contains the table name, and the column list the index name
+    ('CREATE UNIQUE INDEX deduplicated_institutions_kb ON ONLY public.deduplicated_institutions_kb '
+     'USING btree (deduplicated_institutions_kb)',
+     'deduplicated_institutions_kb',
+     'CREATE UNIQUE INDEX deduplicated_institutions_kb_shadow ON ONLY public.deduplicated_institutions_kb_shadow '
+     'USING btree (deduplicated_institutions_kb)'),
+    # names are truncated to fit the 63 character identifier limit
+    ('CREATE INDEX ' + 'x' * 63 + ' ON public.deduplicated_institutions_kb USING btree (institution)',
+     'x' * 63,
+     'CREATE INDEX ' + 'x' * 56 + '_shadow ON public.deduplicated_institutions_kb_shadow USING btree (institution)'),
+])
+def test_shadow_index_def_targets_the_shadow_table(indexdef, name, expected):
+    assert _shadow_index_def(indexdef, name, LIVE, SHADOW) == expected
+
+
+def test_swap_drops_the_live_table_in_the_renaming_transaction(swap_conn):
+    report = rebuild_deduplication_shadow()
+    assert report['success'] and report['swap_attempts'] == 1, report['errors']
+    queries = swap_conn.queries
+    swap = queries[queries.index("SET LOCAL lock_timeout = '2s';"):]
+    assert swap == [
+        "SET LOCAL lock_timeout = '2s';",
+        DROP_LIVE,
+        f'ALTER TABLE {SHADOW} RENAME TO deduplicated_institutions_kb;',
+        f'ALTER TABLE {LIVE} RENAME CONSTRAINT deduplicated_institutions_kb_shadow_pkey '
+        'TO deduplicated_institutions_kb_pkey;',
+        'ALTER SEQUENCE public.deduplicated_institutions_kb_shadow_id_seq RENAME TO deduplicated_institutions_kb_id_seq;',
+        'ALTER INDEX public.deduplicated_institutions_kb_group_idx_shadow RENAME TO deduplicated_institutions_kb_group_idx;',
+        'DELETE FROM dedup_change_log WHERE change_id = ANY(%s);',
+        'COMMIT',
+    ]
+    assert swap_conn.params('DELETE FROM dedup_change_log') == [([1, 2],)]
+    assert swap_conn.isolation_level == 'DEFAULT'
+
+
+def test_swap_retries_on_lock_timeout(swap_conn):
+    swap_conn.on(DROP_LIVE, rows=_lock_timeouts(2))
+    report = rebuild_deduplication_shadow()
+    assert report['success'] and report['swap_attempts'] == 3, report['errors']
+    # build commit, two rolled back swaps, then the swap that went through
+    assert swap_conn.events == ['commit', 'rollback', 'rollback', 'commit']
+    assert swap_conn.queries.count(DROP_LIVE) == 3
+
+
+def test_swap_gives_up_after_the_last_attempt(swap_conn):
+    swap_conn.on(DROP_LIVE, error=pg_errors.LockNotAvailable('canceling statement due to lock timeout'))
+    with mock.patch.object(rebuild_shadow, 'SWAP_ATTEMPTS', 3):
+        report = rebuild_deduplication_shadow()
+    assert not report['success'] and report['swap_attempts'] == 3
+    assert report['errors'] == ['swap gave up after 3 attempts waiting for readers']
+    assert swap_conn.events == ['commit', 'rollback', 'rollback', 'rollback']
+    # the old table is left in place: nothing past the failing DROP ran
+    assert not any('RENAME' in q or q.startswith('DELETE') for q in swap_conn.queries)
+
+
+def test_failed_build_leaves_the_live_table_alone(fake_conn):
+    conn = fake_conn().on(f'CREATE TABLE {SHADOW} AS', error=RuntimeError('disk full'))
+    with mock.patch.object(rebuild_shadow, 'acquire_connection', return_value=conn), \
+            mock.patch.object(rebuild_shadow, 'release_connection'):
+        report = rebuild_deduplication_shadow()
+    assert not report['success'] and report['swap_attempts'] == 0
+    assert report['errors'] == ['shadow build failed: disk full']
+    assert conn.events == ['rollback']
+    assert DROP_LIVE not in conn.queries
+    assert not any(LIVE + ' ' in q or q.startswith('ALTER') for q in conn.queries)
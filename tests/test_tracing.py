@@ -0,0 +1,76 @@
+import contextvars
+import threading
+
+import pytest
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+from src.cannonical_data_pipeline.infra import tracing
+
+
+@pytest.fixture
+def cur(fake_conn):
+    conn = (fake_conn()
+            .on("BROKEN", error=RuntimeError("syntax error at or near BROKEN\nLINE 1: BROKEN"))
+            .on("UPDATE", rowcount=7)
+            .on("", rowcount=1))
+    return conn.cursor()
+
+
+def _execute(cur, query, vars=None):
+    return tracing._traced(cur, 'execute', query, cur.execute, query, vars)
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(tracing, "_config", {"max_statements": 3, "statement_chars": 40, "top_queries": 2,
+                                             "otlp_enable": False, "otlp_endpoint": None})
+
+
+def test_statements_are_recorded_only_inside_a_trace(limits, cur):
+    _execute(cur, "SELECT 1")  # not traced
+
+    with tracing.trace_step("update_uuids") as trace:
+        for _ in range(3):
+            _execute(cur, "UPDATE t SET a = %(a)s WHERE id <= %(upto)s", {"a": 1, "upto": 10})
+        _execute(cur, "SELECT COUNT(*) FROM t")
+        with pytest.raises(RuntimeError):
+            _execute(cur, "BROKEN")
+        # worker threads started in a copy of the context record into the same trace
+        worker = threading.Thread(target=contextvars.copy_context().run, args=(_execute, cur.conn.cursor(), "ANALYZE t"))
+        worker.start()
+        worker.join()
+    assert tracing.current() is None
+
+    summary = trace.summary()
+    assert (summary["statements"], summary["rows"], summary["errors"]) == (6, 23, 1)
+    assert summary["distinct_queries"] == 4 and len(summary["top_queries"]) == 2
+    update = next(q for q in summary["top_queries"] if q["statement"].startswith("UPDATE"))
+    assert update["calls"] == 3 and update["rows"] == 21 and len(update["statement"]) == 40
+    assert [s["rowcount"] for s in summary["log"]] == [7, 7, 7] and summary["log_dropped"] == 3
+    assert summary["wall_seconds"] is not None
+
+
+def test_traced_steps_export_a_span_per_statement(limits, cur, monkeypatch):
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    monkeypatch.setattr(tracing, "_tracer", lambda: provider.get_tracer("test"))
+
+    def step():
+        _execute(cur, "UPDATE t SET a = 1")
+        tracing.record("SELECT * FROM t", 0.002, 5, buffers={"shared_hit_blocks": 12})
+        return {"success": True}
+
+    report = tracing.traced("add_columns", step)
+    assert report["trace"]["statements"] == 2
+
+    spans = {span.name: span for span in exporter.get_finished_spans()}
+    assert set(spans) == {"UPDATE", "SELECT", "step add_columns"}
+    step_span = spans["step add_columns"]
+    assert all(spans[name].parent.span_id == step_span.context.span_id for name in ("UPDATE", "SELECT"))
+    assert spans["UPDATE"].attributes["db.rowcount"] == 7
+    assert spans["SELECT"].attributes["db.buffers.shared_hit_blocks"] == 12
+    assert step_span.attributes["pipeline.statements"] == 2
+    assert step_span.attributes["pipeline.wall_seconds"] == report["trace"]["wall_seconds"] is not None
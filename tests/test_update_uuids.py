@@ -0,0 +1,72 @@
+from unittest import mock
+
+import pytest
+
+from src.cannonical_data_pipeline.deduplication import update_uuids
+
+KB_COLUMNS = [['id', 'integer', True], ['institution', 'text', False], ['uuid_institution', 'text', False]]
+TABLES = [('deduplicated_institutions_kb', 'r', KB_COLUMNS, [], [])]
+
+
+@pytest.fixture
+def kb_conn(fake_conn):
+    """deduplicated_institutions_kb whose distinct institutions come in `batches` (the keyset
+    pages of update_uuids), with an optional checkpoint row."""
+    def make(batches, checkpoint=None):
+        def next_batch(text, params):
+            batch = batches.pop(0) if batches else []
+            return [(batch[-1] if batch else None, len(batch))]
+
+        checkpoint_table = [('update_uuids_checkpoint', 'r', [], [], [])] if checkpoint else []
+        return (fake_conn(tables=TABLES + checkpoint_table)
+                .on('to_regclass', rows=[(42,)])
+                .on('FROM update_uuids_checkpoint', rows=[checkpoint] if checkpoint else [])
+                .on('COUNT(DISTINCT institution)', rows=lambda text, params: [(sum(len(b) for b in batches),)])
+                .on('SELECT DISTINCT institution', rows=next_batch)
+                .on('records_to_update', rowcount=10))
+    return make
+
+
+def _run(conn, **kwargs):
+    with mock.patch.object(update_uuids, 'acquire_connection', return_value=conn), \
+            mock.patch.object(update_uuids, 'release_connection'):
+        return update_uuids.apply_update_uuids(**kwargs)
+
+
+def test_chunked_run_commits_every_batch_with_its_checkpoint(kb_conn):
+    conn = kb_conn([['a', 'b'], ['c']])
+    progress = []
+    report = _run(conn, batch_size=2, on_progress=progress.append)
+
+    assert report['success'] and report['updated'] == 20
+    assert [p['institutions'] for p in progress] == [2, 3] and progress[-1]['remaining_institutions'] == 0
+    # setup, two batches and the finish mark are separate transactions
+    assert conn.commits == 4
+    updates = conn.params('records_to_update')
+    assert updates == [{'after': None, 'limit': 2, 'upto': 'b'}, {'after': 'b', 'limit': 2, 'upto': 'c'}]
+    saves = conn.params('SET last_institution')
+    assert [s['upto'] for s in saves] == ['b', 'c']
+    assert any('CREATE TABLE IF NOT EXISTS update_uuids_checkpoint' in q for q in conn.queries)
+
+
+def test_chunked_run_resumes_after_last_committed_batch(kb_conn):
+    conn = kb_conn([['c']], checkpoint=(42, 'b', 1, 10, None))
+    report = _run(conn, batch_size=2)
+
+    assert report['resumed'] == {'after': 'b', 'batches': 1, 'updated_rows': 10}
+    assert [p['after'] for p in conn.params('records_to_update')] == ['b']
+    assert not any('ON CONFLICT (table_name)' in q for q in conn.queries)
+
+    restarted = kb_conn([['a']], checkpoint=(42, 'b', 1, 10, None))
+    _run(restarted, batch_size=2, resume=False)
+    assert [p['after'] for p in restarted.params('records_to_update')] == [None]
+
+
+def test_callers_transaction_runs_one_statement(kb_conn):
+    conn = kb_conn([['a']])
+    report = update_uuids.apply_update_uuids(conn=conn, batch_size=2)
+
+    assert report['success'] and report['executed'] == ['CTE_UPDATE']
+    assert report['skipped'] == ["batching: running in the caller's transaction"]
+    assert conn.commits == 0
+    assert '%(upto)s' not in [q for q in conn.queries if 'records_to_update' in q][0]